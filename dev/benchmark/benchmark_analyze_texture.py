@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark the texture computation of sct_analyze_texture on a synthetic axial image of the spinal cord: GLCM voxel by
+# voxel with skimage (previous implementation) vs. all the windows of a slice at once, serial and with a pool of
+# processes.
+#
+# Usage: python dev/benchmark/benchmark_analyze_texture.py [nz] [distance] [cpu_number]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+from spinalcordtoolbox.image import Image
+from sct_analyze_texture import ExtractGLCM, Param, ParamGLCM
+
+
+def dummy_cord(nz, size=(64, 64), seed=0):
+    """
+    Noisy spinal cord (elliptic cross-section, brighter gray matter) in the CSF, and its segmentation
+    :return: image data, segmentation data, RPI
+    """
+    rng = np.random.RandomState(seed)
+    x, y = np.mgrid[:size[0], :size[1]] - np.array(size)[:, None, None] / 2.
+    seg = ((x / 12.) ** 2 + (y / 8.) ** 2 < 1)
+    gm = ((x / 7.) ** 2 + (y / 2.5) ** 2 < 1) | ((np.abs(x) - 4) ** 2 / 9. + (y / 5.) ** 2 < 1)
+    im = np.where(seg, 90., 200.) + 40 * gm
+    im = np.repeat(im[:, :, None], nz, axis=2) + rng.normal(0, 15, size + (nz,))
+    return np.clip(im, 0, 255), np.repeat(seg[:, :, None], nz, axis=2).astype(np.float64)
+
+
+def main(nz=20, distance=1, cpu_number=0):
+    data_im, data_seg = dummy_cord(nz)
+    print("Input image: {}, {} voxels in the segmentation".format(data_im.shape, int(data_seg.sum())))
+
+    param, param_glcm = Param(), ParamGLCM()
+    param_glcm.distance = distance
+    durations, dct_data = {}, {}
+    for key, method, cpu in [('loop', 'loop', 1), ('vectorized', 'vectorized', 1),
+                             ('vectorized_pool', 'vectorized', cpu_number or multiprocessing.cpu_count())]:
+        glcm = ExtractGLCM.__new__(ExtractGLCM)
+        glcm.param, glcm.param_glcm = param, param_glcm
+        glcm.param.cpu_number = cpu
+        # same metrics as ExtractGLCM.__init__
+        glcm.metric_lst = [(f if f.upper() != 'ASM' else 'ASM') + '_' + str(distance) + '_' + a
+                           for f in param_glcm.feature.split(',') for a in param_glcm.angle.split(',')]
+        glcm.dct_im_seg = {'im': [data_im[:, :, z] for z in range(nz)], 'seg': [data_seg[:, :, z] for z in range(nz)]}
+        dct_metric = {m: Image(np.zeros(data_im.shape)) for m in glcm.metric_lst}
+        time_start = time.time()
+        if method == 'loop':
+            glcm.compute_texture_loop(dct_metric, distance)
+        else:
+            glcm.compute_texture_vectorized(dct_metric, distance)
+        durations[key] = time.time() - time_start
+        dct_data[key] = dct_metric
+
+    print("\nTexture (s): loop={:.2f}, vectorized={:.3f}, vectorized with {} processes={:.3f}, speedup={:.1f}x".format(
+        durations['loop'], durations['vectorized'], cpu_number or multiprocessing.cpu_count(),
+        durations['vectorized_pool'], durations['loop'] / durations['vectorized']))
+    for key in ['vectorized', 'vectorized_pool']:
+        print("Max relative difference with the loop ({}): {:.2e}".format(key, max(
+            np.max(np.abs(dct_data[key][m].data - dct_data['loop'][m].data) /
+                   np.maximum(np.abs(dct_data['loop'][m].data), 1e-12)) for m in dct_data['loop'])))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark the CNN centerline detection of deepseg_sc (spinalcordtoolbox.deepseg_sc.core.heatmap) on a synthetic
+# whole-spine scan, for several numbers of slices scanned at once when the spinal cord is lost. The detection network
+# is built with random weights (the latency does not depend on them), and the number of calls to predict() is
+# reported: before blocks were batched, there was one call per predicted block.
+#
+# Usage: python dev/benchmark/benchmark_deepseg_sc_heatmap.py [nz]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import, division
+
+import sys
+import time
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.deepseg_sc.core import heatmap
+from spinalcordtoolbox.deepseg_sc.cnn_models import nn_architecture_ctr
+
+
+class CountingModel(object):
+    """Wrap a Keras model to count the calls to predict() and the number of predicted blocks"""
+    def __init__(self, model):
+        self.model = model
+        self.nb_calls, self.nb_blocks = 0, 0
+
+    def predict(self, x, batch_size=None):
+        self.nb_calls += 1
+        self.nb_blocks += len(x)
+        return self.model.predict(x, batch_size=batch_size)
+
+
+def main(nz=600):
+    # Large FOV (0.5mm in-plane), with a bright "cord" missing at the top (brain) and at the bottom of the scan
+    nx, ny = 320, 320
+    rng = np.random.RandomState(0)
+    data = rng.rand(nx, ny, nz).astype(np.float32) * 20
+    xx, yy = np.mgrid[:nx, :ny]
+    for zz in range(nz // 10, nz - nz // 10):
+        x_center, y_center = nx / 2 + 20 * np.sin(zz / 50.), ny / 2 + 10 * np.cos(zz / 80.)
+        data[..., zz] += 200 * (((xx - x_center) ** 2 + (yy - y_center) ** 2) < 64)
+    im = Image(data, hdr=nib.Nifti1Header(), dim=data.shape + (1, 0.5, 0.5, 1, 1))
+    print("Input image: {}".format(data.shape))
+
+    model = CountingModel(nn_architecture_ctr(height=80, width=80, channels=1, classes=1, features=16, depth=2,
+                                              temperature=1.0, padding='same', batchnorm=True, dropout=0.0,
+                                              dilation_layers=2))
+
+    print("{:<18}{:>12}{:>12}{:>16}{:>12}".format("Slices per scan", "Calls", "Blocks", "Duration (s)",
+                                                  "Slices/s"))
+    for nb_slices_scan in [1, 4, 8]:
+        model.nb_calls, model.nb_blocks = 0, 0
+        time_start = time.time()
+        try:
+            heatmap(im.copy(), model, (80, 80), 51.1417, 57.4408, brain_bool=False, nb_slices_scan=nb_slices_scan)
+        except SystemExit:
+            # no SC detected by the network (random weights): the latency is still measured
+            pass
+        duration = time.time() - time_start
+        print("{:<18}{:>12}{:>12}{:>16.2f}{:>12.1f}".format(nb_slices_scan, model.nb_calls, model.nb_blocks,
+                                                            duration, nz / duration))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark sct_compute_hausdorff_distance on a synthetic cervical gray matter segmentation (two raters, 0.1mm in-plane
+# resolution, as resampled by the script): thinning pixel by pixel (previous implementation) vs. with a lookup table,
+# and distances with pairwise loops (previous implementation) vs. with a k-d tree, serial and with a pool of threads.
+#
+# Usage: python dev/benchmark/benchmark_hausdorff_distance.py [nz] [cpu_number]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+from spinalcordtoolbox.image import Image
+from sct_compute_hausdorff_distance import Thinning, HausdorffDistance
+
+
+def dummy_gm_segmentation(nz, fname, shift=(0., 0.), scale=1., size=160, pixdim=(0.1, 0.1, 2.5)):
+    """
+    Butterfly-shaped gray matter (ventral and dorsal horns joined by the commissure), whose width increases at the
+    level of the cervical enlargement
+    :return: Image, IRP
+    """
+    x, y = np.mgrid[:size, :size] * pixdim[0] - size * pixdim[0] / 2.
+    data = np.zeros((size, size, nz), dtype=np.uint8)
+    for z in range(nz):
+        s = scale * (1 + 0.3 * np.exp(-((z - 0.7 * nz) / (0.2 * nz)) ** 2))
+        xs, ys = (x - shift[0]) / s, (y - shift[1]) / s
+        gm = (xs / 1.2) ** 2 + (ys / 0.5) ** 2 < 1  # commissure
+        for side in [-1, 1]:
+            # ventral horns (anterior: y < 0) and dorsal horns, tilted laterally
+            for cx, cy, a, b, angle in [(2.0, -1.2, 1.6, 1.0, 0.6), (1.6, 1.8, 2.2, 0.5, -1.0)]:
+                u, v = xs - side * cx, ys - cy
+                c, t = np.cos(side * angle), np.sin(side * angle)
+                gm |= ((u * c + v * t) / a) ** 2 + ((-u * t + v * c) / b) ** 2 < 1
+        data[:, :, z] = gm
+    affine = np.diag(list(pixdim) + [1])
+    nii = nib.Nifti1Image(data, affine)
+    im = Image(data, hdr=nii.header, dim=data.shape)
+    im.absolutepath = fname
+    # as in sct_compute_hausdorff_distance.ComputeDistances
+    return im.change_orientation('IRP', generate_path=True)
+
+
+def main(nz=30, cpu_number=0):
+    def get_images():
+        return [dummy_gm_segmentation(nz, 'gmseg_rater1.nii.gz'),
+                dummy_gm_segmentation(nz, 'gmseg_rater2.nii.gz', shift=(0.15, -0.1), scale=1.05)]
+    list_im = get_images()
+    print("Input segmentations: {}, {} pixels".format(list_im[0].data.shape, int(list_im[0].data.sum())))
+
+    durations, skeletons = {}, {}
+    for method in ['loop', 'lut']:
+        list_im = get_images()
+        time_start = time.time()
+        skeletons[method] = [Thinning(im, v=0, method=method).thinned_image.data for im in list_im]
+        durations[method] = time.time() - time_start
+    print("\nThinning (s): loop={:.2f}, lut={:.2f}, speedup={:.1f}x".format(
+        durations['loop'], durations['lut'], durations['loop'] / durations['lut']))
+    print("Differing pixels between methods: {}".format(
+        sum(int((a != b).sum()) for a, b in zip(skeletons['loop'], skeletons['lut']))))
+
+    dat1, dat2 = skeletons['lut']
+    distances = {}
+    for method in ['loop', 'kdtree']:
+        time_start = time.time()
+        distances[method] = [HausdorffDistance(slice1, slice2, v=0, method=method) for slice1, slice2 in zip(dat1, dat2)]
+        durations[method] = time.time() - time_start
+    pool = ThreadPool(cpu_number or multiprocessing.cpu_count())
+    time_start = time.time()
+    pool.map(lambda slices: HausdorffDistance(slices[0], slices[1], v=0), list(zip(dat1, dat2)))
+    durations['kdtree_pool'] = time.time() - time_start
+    pool.close()
+    print("\nDistances (s): loop={:.2f}, kdtree={:.3f}, kdtree with {} threads={:.3f}, speedup={:.1f}x".format(
+        durations['loop'], durations['kdtree'], cpu_number or multiprocessing.cpu_count(), durations['kdtree_pool'],
+        durations['loop'] / durations['kdtree']))
+    print("Max difference of Hausdorff distance between methods (pixels): {}".format(
+        max(abs(d1.H - d2.H) for d1, d2 in zip(distances['loop'], distances['kdtree']))))
+    print("Hausdorff distance (mm): max={:.2f}, mean surface distance (mm): {:.3f}".format(
+        max(d.H for d in distances['kdtree']) * 0.1, np.mean([d.M for d in distances['kdtree']]) * 0.1))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
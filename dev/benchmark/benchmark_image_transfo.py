@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Micro-benchmark of the coordinate transformations of spinalcordtoolbox.image.Image: latency per million points of
+# transfo_pix2phys and transfo_phys2pix, for several sizes of input.
+#
+# Usage: python dev/benchmark/benchmark_image_transfo.py
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import timeit
+
+import numpy as np
+
+from spinalcordtoolbox.testing.create_test_data import dummy_centerline
+
+
+def main():
+    img, _, _ = dummy_centerline(size_arr=(9, 9, 9), pixdim=(0.5, 0.5, 1))
+    print("{:>20} {:>10} {:>12} {:>16}".format('function', 'points', 'dtype', 'ms/Mpoints'))
+    for nb_points in [1, 1000, 1000000]:
+        coord = np.random.uniform(0, 100, (nb_points, 3))
+        number = max(1, 100000 // nb_points)
+        for name, func in [('transfo_pix2phys', lambda dtype: img.transfo_pix2phys(coord, dtype=dtype)),
+                           ('transfo_phys2pix', lambda dtype: img.transfo_phys2pix(coord, real=False, dtype=dtype))]:
+            for dtype in [np.float64, np.float32]:
+                duration = min(timeit.repeat(lambda: func(dtype), number=number, repeat=3)) / number
+                print("{:>20} {:>10} {:>12} {:>16.2f}".format(name, nb_points, dtype.__name__,
+                                                               duration * 1e9 / nb_points))
+
+
+if __name__ == "__main__":
+    main()
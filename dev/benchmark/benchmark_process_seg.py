@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark spinalcordtoolbox.process_seg.compute_shape on synthetic spinal cords (a small 1000-slice cord and a large
+# cord), and check that the 'batch' method gives the same results as the 'slicewise' (reference) method.
+#
+# Usage: python dev/benchmark/benchmark_process_seg.py
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import sys
+import time
+
+import numpy as np
+
+from spinalcordtoolbox.process_seg import compute_shape
+from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.testing.create_test_data import dummy_segmentation
+
+
+def main(nz=1000):
+    # Angled elliptic cord, with 0.5mm in-plane resolution, and a large cord (as in test_process_seg)
+    list_im_seg = [
+        dummy_segmentation(size_arr=(100, 100, nz), pixdim=(0.5, 0.5, 1), shape='ellipse', radius_RL=8.0,
+                           radius_AP=5.0, angle_RL=-1.0, angle_AP=1.0),
+        dummy_segmentation(size_arr=(128, 128, nz // 10), pixdim=(1, 1, 1), shape='ellipse', radius_RL=50.0,
+                           radius_AP=30.0)]
+    for im_seg in list_im_seg:
+        print("\nInput segmentation: {}".format(im_seg.data.shape))
+        metrics, durations = {}, {}
+        for method in ['slicewise', 'batch']:
+            time_start = time.time()
+            metrics[method], _ = compute_shape(im_seg.copy(), angle_correction=True,
+                                               param_centerline=ParamCenterline(), verbose=0, method=method)
+            durations[method] = time.time() - time_start
+
+        print("\nDuration (s): slicewise={:.2f}, batch={:.2f}, speedup={:.1f}x".format(
+            durations['slicewise'], durations['batch'], durations['slicewise'] / durations['batch']))
+        print("\nMax relative difference between methods:")
+        for key in sorted(metrics['slicewise']):
+            diff = np.abs(metrics['batch'][key].data - metrics['slicewise'][key].data) / \
+                np.maximum(np.abs(metrics['slicewise'][key].data), 1e-12)
+            print("  {}: {}".format(key, np.nanmax(diff) if not np.isnan(diff).all() else np.nan))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
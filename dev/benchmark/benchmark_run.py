@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark sct_utils.run() on SCT Python scripts: in-process execution vs. subprocess execution (which pays the
+# interpreter startup and the imports at each call). SCT scripts need to be in the PATH for the subprocess execution.
+#
+# Usage: python dev/benchmark/benchmark_run.py [nb_repeat]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import sys
+import os
+import time
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+import sct_utils as sct
+
+
+def main(nb_repeat=5):
+    path_tmp = sct.tmp_create(basename="benchmark_run", verbose=0)
+    data = np.random.rand(64, 64, 32).astype(np.float32)
+    nibabel.save(nibabel.Nifti1Image(data, np.diag([0.5, 0.5, 1, 1])), os.path.join(path_tmp, 'data.nii.gz'))
+    list_cmd = [
+        ['sct_maths', '-i', 'data.nii.gz', '-bin', '0.5', '-o', 'data_bin.nii.gz'],
+        ['sct_image', '-i', 'data.nii.gz', '-pad', '0,0,5', '-o', 'data_pad.nii.gz'],
+        ['sct_resample', '-i', 'data.nii.gz', '-mm', '1x1x1', '-o', 'data_r.nii.gz'],
+    ]
+
+    print("{:<15}{:>15}{:>15}{:>15}".format("Command", "Subprocess (s)", "In-process (s)", "Saved (s)"))
+    for cmd in list_cmd:
+        durations = {}
+        for mode in ['0', '1']:
+            os.environ['SCT_RUN_IN_PROCESS'] = mode
+            time_start = time.time()
+            for i in range(nb_repeat):
+                sct.run(cmd, verbose=0, cwd=path_tmp)
+            durations[mode] = (time.time() - time_start) / nb_repeat
+        print("{:<15}{:>15.3f}{:>15.3f}{:>15.3f}".format(cmd[0], durations['0'], durations['1'],
+                                                         durations['0'] - durations['1']))
+
+    sct.rmtree(path_tmp, verbose=0)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+#########################################################################################
+#
+# Benchmark the computation of the straightening warping field on a synthetic 300-slice T2-like volume: slice-by-slice
+# computation (previous implementation) vs. chunked computation, serial and with a pool of processes.
+#
+# Usage: python dev/benchmark/benchmark_straightening.py [nz] [cpu_number]
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import print_function, absolute_import
+
+import os
+import sys
+import time
+import multiprocessing
+
+import numpy as np
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+from spinalcordtoolbox.straightening import SpinalCordStraightener, _get_centerline
+from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.types import Centerline
+from spinalcordtoolbox.testing.create_test_data import dummy_segmentation
+
+
+def compute_warp_slicewise(image, centerline_src, centerline_dest, lookup_table, threshold_distance):
+    """Previous implementation of the curved2straight warping field, computed slice by slice"""
+    nx, ny, nz = image.data.shape
+    data_warp = np.zeros((nx, ny, nz, 1, 3))
+    for u in range(nz):
+        x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
+        indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
+        physical_coordinates = image.transfo_pix2phys(indexes)
+        nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates)
+        distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+        lookup = lookup_table[nearest_indexes]
+        indexes_out_distance = np.logical_or(
+            np.logical_or(distances > threshold_distance, distances < -threshold_distance), lookup == 0)
+        projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+        coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+        displacements = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup) - physical_coordinates
+        displacements[:, 2] = -displacements[:, 2]
+        displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+        data_warp[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements
+    return data_warp
+
+
+def main(nz=300, cpu_number=multiprocessing.cpu_count()):
+    # T2-like volume: 0.8mm isotropic, 70mm field of view in the axial plane, curved cord
+    im_seg = dummy_segmentation(size_arr=(88, 88, nz), pixdim=(0.8, 0.8, 0.8), shape='ellipse', radius_RL=5.0,
+                                radius_AP=3.0, angle_RL=5.0, angle_AP=-3.0)
+    print("Input volume: {}".format(im_seg.data.shape))
+    centerline = _get_centerline(im_seg, ParamCenterline(), verbose=0)
+    points = centerline.points.copy()
+    points[:, 0:2] = points[:, 0:2].mean(axis=0)
+    derivs = np.zeros_like(points)
+    derivs[:, 2] = 1
+    centerline_straight = Centerline(points[:, 0], points[:, 1], points[:, 2], derivs[:, 0], derivs[:, 1], derivs[:, 2])
+    lookup_table = np.arange(centerline.number_of_points)
+    sc_straight = SpinalCordStraightener('', '')
+
+    time_start = time.time()
+    data_warp_ref = compute_warp_slicewise(im_seg, centerline_straight, centerline, lookup_table,
+                                           sc_straight.threshold_distance)
+    durations = {'slicewise': time.time() - time_start}
+
+    for n in sorted({1, cpu_number}):
+        sc_straight.cpu_number = n
+        data_warp = np.zeros(im_seg.data.shape + (1, 3), dtype=np.float32)
+        time_start = time.time()
+        sc_straight._compute_warping_field(data_warp, im_seg, centerline_straight, centerline, lookup_table,
+                                           mode='curved2straight')
+        durations['chunked ({} cpu)'.format(n)] = time.time() - time_start
+        print("Max absolute difference with slicewise ({} cpu): {}".format(n, np.abs(data_warp - data_warp_ref).max()))
+
+    print("\nDuration (s):")
+    for key, duration in sorted(durations.items()):
+        print("  {}: {:.2f} (speedup: {:.1f}x)".format(key, duration, durations['slicewise'] / duration))
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -22,6 +22,7 @@
 from __future__ import absolute_import
 
 import sys, os, glob
+import multiprocessing
 from tqdm import tqdm
 import numpy as np
 import scipy.interpolate
@@ -74,15 +75,15 @@ def moco(param):
     file_target = "target.nii.gz"
     convert(param.file_target, file_target)
 
+    # number of CPU cores shared by the registrations and their ITK threads
+    cpu_number = sct.get_cpu_number(param.cpu_number)
+
     # If scan is sagittal, split src and target along Z (slice)
     if param.is_sagittal:
         dim_sag = 2  # TODO: find it
-        # z-split data (time series)
-        im_z_list = split_data(im_data, dim=dim_sag, squeeze_data=False)
-        file_data_splitZ = []
-        for im_z in im_z_list:
-            im_z.save()
-            file_data_splitZ.append(im_z.absolutepath)
+        # z-split data (time series). The z-split data is kept in memory: only the volumes to register are written to
+        # the workspace (see below)
+        im_data_splitZ = split_data(im_data, dim=dim_sag, squeeze_data=False)
         # z-split target
         im_targetz_list = split_data(Image(file_target), dim=dim_sag, squeeze_data=False)
         file_target_splitZ = []
@@ -101,7 +102,7 @@ def moco(param):
 
     # axial orientation
     else:
-        file_data_splitZ = [file_data]  # TODO: make it absolute like above
+        im_data_splitZ = [im_data]
         file_target_splitZ = [file_target]  # TODO: make it absolute like above
         # initialize file list for output matrices
         file_mat = np.empty((1, nt), dtype=object)
@@ -111,86 +112,91 @@ def moco(param):
             convert(param.fname_mask, file_mask, squeeze_data=False)
             im_maskz_list = [Image(file_mask)]  # use a list with single element
 
-    # Loop across file list, where each file is either a 2D volume (if sagittal) or a 3D volume (otherwise)
-    # file_mat = tuple([[[] for i in range(nt)] for i in range(nz)])
+    # Workspace of the volumes to register and of the registered volumes. The same files are reused across Z.
+    file_data_splitT = [sct.add_suffix(file_data, '_T' + str(it).zfill(4)) for it in range(nt)]
+    file_data_splitT_moco = [sct.add_suffix(file_splitT, '_moco') for file_splitT in file_data_splitT]
+
+    # With iterative averaging, the target is updated after each of the first volumes is registered, so these volumes
+    # are registered one after another (and in order). The other volumes are registered in parallel.
+    nt_avg = min(10, nt) if int(param.iterAvg) and not param.todo == 'apply' else 0
 
-    file_data_splitZ_moco = []
+    im_data_splitZ_moco = []
+    pool = multiprocessing.Pool(cpu_number) if cpu_number > 1 and nt - nt_avg > 1 else None
     sct.printv('\nRegister. Loop across Z (note: there is only one Z if orientation is axial')
-    for file in file_data_splitZ:
-        iz = file_data_splitZ.index(file)
-        # Split data along T dimension
-        # sct.printv('\nSplit data along T dimension.', verbose)
-        im_z = Image(file)
-        list_im_zt = split_data(im_z, dim=3)
-        file_data_splitZ_splitT = []
-        for im_zt in list_im_zt:
-            im_zt.save(verbose=0)
-            file_data_splitZ_splitT.append(im_zt.absolutepath)
-        # file_data_splitT = file_data + '_T'
-
-        # Motion correction: initialization
-        index = np.arange(nt)
-        file_data_splitT_num = []
-        file_data_splitZ_splitT_moco = []
-        failed_transfo = [0 for i in range(nt)]
-
-        # Motion correction: Loop across T
-        for indice_index in tqdm(range(nt), unit='iter', unit_scale=False,
-                                 desc="Z=" + str(iz) + "/" + str(len(file_data_splitZ)-1), ascii=True, ncols=80):
-
-            # create indices and display stuff
-            it = index[indice_index]
-            file_mat[iz][it] = os.path.join(folder_mat, "mat.Z") + str(iz).zfill(4) + 'T' + str(it).zfill(4)
-            file_data_splitZ_splitT_moco.append(sct.add_suffix(file_data_splitZ_splitT[it], '_moco'))
+    try:
+        for iz, im_z in enumerate(im_data_splitZ):
+            # Split data along T dimension
+            for im_zt, file_splitT in zip(split_data(im_z, dim=3), file_data_splitT):
+                im_zt.save(file_splitT, verbose=0)
+
+            # Motion correction: initialization
+            failed_transfo = [0 for i in range(nt)]
             # deal with masking
             if not param.fname_mask == '':
                 input_mask = im_maskz_list[iz]
             else:
                 input_mask = None
-            # run 3D registration
-            failed_transfo[it] = register(param, file_data_splitZ_splitT[it], file_target_splitZ[iz], file_mat[iz][it],
-                                          file_data_splitZ_splitT_moco[it], im_mask=input_mask)
-
-            # average registered volume with target image
-            # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
-            if param.iterAvg and indice_index < 10 and failed_transfo[it] == 0 and not param.todo == 'apply':
-                im_targetz = Image(file_target_splitZ[iz])
-                data_targetz = im_targetz.data
-                data_mocoz = Image(file_data_splitZ_splitT_moco[it]).data
-                data_targetz = (data_targetz * (indice_index + 1) + data_mocoz) / (indice_index + 2)
-                im_targetz.data = data_targetz
-                im_targetz.save(verbose=0)
-
-        # Replace failed transformation with the closest good one
-        fT = [i for i, j in enumerate(failed_transfo) if j == 1]
-        gT = [i for i, j in enumerate(failed_transfo) if j == 0]
-        for it in range(len(fT)):
-            abs_dist = [np.abs(gT[i] - fT[it]) for i in range(len(gT))]
-            if not abs_dist == []:
-                index_good = abs_dist.index(min(abs_dist))
-                sct.printv('  transfo #' + str(fT[it]) + ' --> use transfo #' + str(gT[index_good]), verbose)
-                # copy transformation
-                sct.copy(file_mat[iz][gT[index_good]] + 'Warp.nii.gz', file_mat[iz][fT[it]] + 'Warp.nii.gz')
-                # apply transformation
-                sct_apply_transfo.main(args=['-i', file_data_splitZ_splitT[fT[it]],
-                                             '-d', file_target,
-                                             '-w', file_mat[iz][fT[it]] + 'Warp.nii.gz',
-                                             '-o', file_data_splitZ_splitT_moco[fT[it]],
-                                             '-x', param.interp])
-            else:
-                # exit program if no transformation exists.
-                sct.printv('\nERROR in ' + os.path.basename(__file__) + ': No good transformation exist. Exit program.\n', verbose, 'error')
-                sys.exit(2)
-
-        # Merge data along T
-        file_data_splitZ_moco.append(sct.add_suffix(file, suffix))
-        if todo != 'estimate':
-            im_out = concat_data(file_data_splitZ_splitT_moco, 3)
-            im_out.save(file_data_splitZ_moco[iz])
-
-    # If sagittal, merge along Z
-    if param.is_sagittal:
-        im_out = concat_data(file_data_splitZ_moco, 2)
+            list_args = []
+            for it in range(nt):
+                file_mat[iz][it] = os.path.join(folder_mat, "mat.Z") + str(iz).zfill(4) + 'T' + str(it).zfill(4)
+                list_args.append((param, file_data_splitT[it], file_target_splitZ[iz], file_mat[iz][it],
+                                  file_data_splitT_moco[it], input_mask))
+
+            # Motion correction: Loop across T
+            with tqdm(total=nt, unit='iter', unit_scale=False, desc="Z=" + str(iz) + "/" + str(len(im_data_splitZ)-1),
+                      ascii=True, ncols=80) as pbar:
+                for it in range(nt_avg):
+                    # run 3D registration, using all the cores for ITK
+                    failed_transfo[it] = register(*list_args[it], itk_threads=cpu_number)
+                    # average registered volume with target image
+                    # N.B. use weighted averaging: (target * nb_it + moco) / (nb_it + 1)
+                    if failed_transfo[it] == 0:
+                        im_targetz = Image(file_target_splitZ[iz])
+                        data_targetz = im_targetz.data
+                        data_mocoz = Image(file_data_splitT_moco[it]).data
+                        data_targetz = (data_targetz * (it + 1) + data_mocoz) / (it + 2)
+                        im_targetz.data = data_targetz
+                        im_targetz.save(verbose=0)
+                    pbar.update()
+                for it, failed in register_parallel(list(range(nt_avg, nt)), list_args[nt_avg:], cpu_number, pool):
+                    failed_transfo[it] = failed
+                    pbar.update()
+
+            # Replace failed transformation with the closest good one
+            fT = [i for i, j in enumerate(failed_transfo) if j == 1]
+            gT = [i for i, j in enumerate(failed_transfo) if j == 0]
+            for it in range(len(fT)):
+                abs_dist = [np.abs(gT[i] - fT[it]) for i in range(len(gT))]
+                if not abs_dist == []:
+                    index_good = abs_dist.index(min(abs_dist))
+                    sct.printv('  transfo #' + str(fT[it]) + ' --> use transfo #' + str(gT[index_good]), verbose)
+                    # copy transformation
+                    sct.copy(file_mat[iz][gT[index_good]] + 'Warp.nii.gz', file_mat[iz][fT[it]] + 'Warp.nii.gz')
+                    # apply transformation
+                    sct_apply_transfo.main(args=['-i', file_data_splitT[fT[it]],
+                                                 '-d', file_target,
+                                                 '-w', file_mat[iz][fT[it]] + 'Warp.nii.gz',
+                                                 '-o', file_data_splitT_moco[fT[it]],
+                                                 '-x', param.interp])
+                else:
+                    # exit program if no transformation exists.
+                    sct.printv('\nERROR in ' + os.path.basename(__file__) + ': No good transformation exist. Exit program.\n', verbose, 'error')
+                    sys.exit(2)
+
+            # Merge data along T (in memory, before the workspace is reused for the next Z)
+            if todo != 'estimate':
+                im_data_splitZ_moco.append(concat_data(file_data_splitT_moco, 3))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    if todo != 'estimate':
+        # If sagittal, merge along Z
+        if param.is_sagittal:
+            im_out = concat_data(im_data_splitZ_moco, 2)
+        else:
+            im_out = im_data_splitZ_moco[0]
         dirname, basename, ext = sct.extract_fname(file_data)
         path_out = os.path.join(dirname, basename + suffix + ext)
         im_out.save(path_out)
@@ -198,7 +204,31 @@ def moco(param):
     return file_mat
 
 
-def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
+def register_parallel(list_index, list_args, cpu_number, pool=None):
+    """
+    Run several registrations in parallel, sharing the CPU cores between the registrations and their ITK threads.
+    :param list_index: list of indexes of the registrations (returned with the results)
+    :param list_args: list of arguments of register() for each registration
+    :param cpu_number: int: number of CPU cores
+    :param pool: multiprocessing.Pool with cpu_number processes. If None, the registrations are run one after another.
+    :return: iterator of (index, failed_transfo), in the order of completion
+    """
+    if not list_args:
+        return iter([])
+    nb_jobs = min(cpu_number, len(list_args)) if pool is not None else 1
+    itk_threads = max(1, cpu_number // nb_jobs)
+    list_jobs = [(index, args, itk_threads) for index, args in zip(list_index, list_args)]
+    if nb_jobs > 1:
+        return pool.imap_unordered(_register_worker, list_jobs)
+    return (_register_worker(job) for job in list_jobs)
+
+
+def _register_worker(job):
+    index, args, itk_threads = job
+    return index, register(*args, itk_threads=itk_threads)
+
+
+def register(param, file_src, file_dest, file_mat, file_out, im_mask=None, itk_threads=1):
     """
     Register two images by estimating slice-wise Tx and Ty transformations, which are regularized along Z. This function
     uses ANTs' isct_antsSliceRegularizedRegistration.
@@ -208,6 +238,7 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
     :param file_mat:
     :param file_out:
     :param im_mask: Image of mask, could be 2D or 3D
+    :param itk_threads: int: number of threads used by ANTs
     :return:
     """
 
@@ -224,8 +255,16 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
         metric_radius = '4'
     file_out_concat = file_out
 
-    kw = dict()
-    im_data = Image(file_src)  # TODO: pass argument to use antsReg instead of opening Image each time
+    # The workspace files are reused across Z: remove the output of a previous registration, so that a failed
+    # registration is detected (see below) instead of silently using a stale volume
+    if os.path.isfile(file_out_concat):
+        os.remove(file_out_concat)
+    if param.todo != 'apply':
+        for file_transfo in [file_mat + ext for ext in ['Warp.nii.gz', 'InverseWarp.nii.gz', '0GenericAffine.mat']]:
+            if os.path.isfile(file_transfo):
+                os.remove(file_transfo)
+
+    im_data = Image(file_src, lazy=True)  # only the header is needed
 
     # register file_src to file_dest
     if param.todo == 'estimate' or param.todo == 'estimate_and_apply':
@@ -267,13 +306,11 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
                 cmd += ['--mask', im_mask.absolutepath]
         # run command
         if do_registration:
-            kw.update(dict(is_sct_binary=True))
             env = dict()
             env.update(os.environ)
-            env = kw.get("env", env)
-            # reducing the number of CPU used for moco (see issue #201)
-            env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = "1"
-            status, output = sct.run(cmd, verbose=0, **kw)
+            # limit the number of CPU used by each registration (see issue #201)
+            env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(itk_threads)
+            status, output = sct.run(cmd, verbose=0, env=env, is_sct_binary=True)
 
     elif param.todo == 'apply':
         sct_apply_transfo.main(args=['-i', file_src,
@@ -295,7 +332,7 @@ def register(param, file_src, file_dest, file_mat, file_out, im_mask=None):
         failed_transfo = 1
 
     # TODO: if sagittal, copy header (because ANTs screws it) and add singleton in 3rd dimension (for z-concatenation)
-    if im_data.orientation[2] in 'LR' and do_registration:
+    if im_data.orientation[2] in 'LR' and do_registration and not failed_transfo:
         im_out = Image(file_out_concat)
         im_out.header = im_data.header
         im_out.data = np.expand_dims(im_out.data, 2)
@@ -16,7 +16,7 @@
 
 from __future__ import division, absolute_import
 
-import sys, os, logging
+import sys, os, logging, multiprocessing
 from math import asin, cos, sin, acos
 import numpy as np
 from tqdm import tqdm
@@ -26,13 +26,15 @@ from scipy.signal import argrelmax, medfilt
 from scipy.io import loadmat
 from nibabel import load, Nifti1Image, save
 
-from spinalcordtoolbox.image import Image, find_zmin_zmax, spatial_crop
+from spinalcordtoolbox.image import Image, find_zmin_zmax, spatial_crop, apply_affine
+from spinalcordtoolbox import cache
 
 import sct_utils as sct
 import sct_apply_transfo
 import sct_concat_transfo
 from sct_convert import convert
-from sct_image import split_data, concat_warp2d
+from sct_image import split_data, concat_warp2d, pad_image
+from sct_maths import laplacian
 from msct_register_landmarks import register_landmarks
 
 logger = logging.getLogger(__name__)
@@ -276,8 +278,16 @@ def register_wrapper(fname_src, fname_dest, param, paramregmulti, fname_src_seg=
                     '-o', sct.add_suffix(src[ifile], '_reg'),
                     '-x', interp_step[ifile]])
                 src[ifile] = sct.add_suffix(src[ifile], '_reg')
-        # register src --> dest
-        warp_forward_out, warp_inverse_out = register(src, dest, paramregmulti, param, str(i_step))
+        # register src --> dest (the transformations of a previous run with the same inputs and parameters are
+        # reused, see spinalcordtoolbox.cache)
+        input_files = src + dest + (['mask.nii.gz'] if param.fname_mask else [])
+        with cache.step('msct_register.register', input_files=input_files,
+                        params={'step': str(i_step), 'paramreg': vars(paramregmulti.steps[str(i_step)]),
+                                'padding': param.padding}) as step:
+            if not step.hit:
+                step.result = register(src, dest, paramregmulti, param, str(i_step))
+                step.outputs = [warp.lstrip('-') for warp in step.result]
+        warp_forward_out, warp_inverse_out = step.result
         # deal with transformations with "-" as prefix. They should be inverted with calling sct_concat_transfo.
         if warp_forward_out[0] == "-":
             warp_forward_out = warp_forward_out[1:]
@@ -466,15 +476,17 @@ def register(src, dest, paramregmulti, param, i_step_str):
             # N.B. no need to pad if iter = 0
             if not paramregmulti.steps[i_step_str].iter == '0':
                 dest_pad = sct.add_suffix(dest, '_pad')
-                sct.run(['sct_image', '-i', dest, '-o', dest_pad, '-pad', '0,0,' + str(param.padding)])
+                pad_image(Image(dest), pad_z_i=param.padding, pad_z_f=param.padding).save(dest_pad)
                 dest = dest_pad
             # apply Laplacian filter
             if not paramregmulti.steps[i_step_str].laplacian == '0':
                 sct.printv('\nApply Laplacian filter', param.verbose)
-                sct.run(['sct_maths', '-i', src, '-laplacian', paramregmulti.steps[i_step_str].laplacian + ','
-                         + paramregmulti.steps[i_step_str].laplacian + ',0', '-o', sct.add_suffix(src, '_laplacian')])
-                sct.run(['sct_maths', '-i', dest, '-laplacian', paramregmulti.steps[i_step_str].laplacian + ','
-                         + paramregmulti.steps[i_step_str].laplacian + ',0', '-o', sct.add_suffix(dest, '_laplacian')])
+                sigma = float(paramregmulti.steps[i_step_str].laplacian)
+                for fname in [src, dest]:
+                    # same as: sct_maths -laplacian sigma,sigma,0 (sigmas are adjusted to the voxel size)
+                    im = Image(fname)
+                    im.data = laplacian(im.data, [sigma / im.dim[4], sigma / im.dim[5], 0])
+                    im.save(sct.add_suffix(fname, '_laplacian'))
                 src = sct.add_suffix(src, '_laplacian')
                 dest = sct.add_suffix(dest, '_laplacian')
             # Estimate transformation
@@ -731,23 +743,13 @@ def register2d_centermassrot(fname_src, fname_dest, paramreg=None, fname_warp='w
 
     # Get image dimensions and retrieve nz
     sct.printv('\nGet image dimensions of destination image...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest[0]).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest[0], lazy=True).dim
     sct.printv('  matrix size: ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
     sct.printv('  voxel size:  ' + str(px) + 'mm x ' + str(py) + 'mm x ' + str(pz) + 'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input segmentation...', verbose)
+    # Open source and destination segmentations (the slices are processed in memory)
     im_src = Image(fname_src[0])
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination segmentation...', verbose)
     im_dest = Image(fname_dest[0])
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
 
     data_src = im_src.data
     data_dest = im_dest.data
@@ -762,19 +764,8 @@ def register2d_centermassrot(fname_src, fname_dest, paramreg=None, fname_warp='w
 
     # Deal with cases where both an image and segmentation are input
     if len(fname_src) > 1:
-        # Split source volume along z
-        sct.printv('\nSplit input image...', verbose)
         im_src_im = Image(fname_src[1])
-        split_source_list = split_data(im_src_im, 2)
-        for im in split_source_list:
-            im.save()
-
-        # Split destination volume along z
-        sct.printv('\nSplit destination image...', verbose)
         im_dest_im = Image(fname_dest[1])
-        split_dest_list = split_data(im_dest_im, 2)
-        for im in split_dest_list:
-            im.save()
 
         data_src_im = im_src_im.data
         data_dest_im = im_dest_im.data
@@ -786,78 +777,33 @@ def register2d_centermassrot(fname_src, fname_dest, paramreg=None, fname_warp='w
     pca_dest = [None] * nz
     centermass_src = np.zeros([nz, 2])
     centermass_dest = np.zeros([nz, 2])
-    # displacement_forward = np.zeros([nz, 2])
-    # displacement_inverse = np.zeros([nz, 2])
     angle_src_dest = np.zeros(nz)
     z_nonzero = []
     th_max_angle *= np.pi / 180
-
-    # Loop across slices
-    for iz in tqdm(range(0, nz), unit='iter', unit_scale=False, desc="Estimate cord angle for each slice",
-                   ascii=False, ncols=100):
-        try:
-            # compute PCA and get center or mass based on segmentation
-            coord_src[iz], pca_src[iz], centermass_src[iz, :] = compute_pca(data_src[:, :, iz])
-            coord_dest[iz], pca_dest[iz], centermass_dest[iz, :] = compute_pca(data_dest[:, :, iz])
-
-            # detect rotation using the HOG method
-            if rot_method in ['hog', 'pcahog']:
-                angle_src_hog, conf_score_src = find_angle_hog(data_src_im[:, :, iz], centermass_src[iz, :],
-                                                               px, py, angle_range=th_max_angle)
-                angle_dest_hog, conf_score_dest = find_angle_hog(data_dest_im[:, :, iz], centermass_dest[ iz, : ],
-                                                                 px, py, angle_range=th_max_angle)
-                # In case no maxima is found (it should never happen)
-                if (angle_src_hog is None) or (angle_dest_hog is None):
-                    sct.printv('WARNING: Slice #' + str(iz) + ' no angle found in dest or src. It will be ignored.',
-                               verbose, 'warning')
-                    continue
-                if rot_method == 'hog':
-                    angle_src = -angle_src_hog  # flip sign to be consistent with PCA output
-                    angle_dest = angle_dest_hog
-
-            # Detect rotation using the PCA or PCA-HOG method
-            if rot_method in ['pca', 'pcahog']:
-                eigenv_src = pca_src[iz].components_.T[0][0], pca_src[iz].components_.T[1][0]
-                eigenv_dest = pca_dest[iz].components_.T[0][0], pca_dest[iz].components_.T[1][0]
-                # Make sure first element is always positive (to prevent sign flipping)
-                if eigenv_src[0] <= 0:
-                    eigenv_src = tuple([i * (-1) for i in eigenv_src])
-                if eigenv_dest[0] <= 0:
-                    eigenv_dest = tuple([i * (-1) for i in eigenv_dest])
-                angle_src = angle_between(eigenv_src, [1, 0])
-                angle_dest = angle_between([1, 0], eigenv_dest)
-                # compute ratio between axis of PCA
-                pca_eigenratio_src = pca_src[iz].explained_variance_ratio_[0] / pca_src[iz].explained_variance_ratio_[1]
-                pca_eigenratio_dest = pca_dest[iz].explained_variance_ratio_[0] / pca_dest[iz].explained_variance_ratio_[1]
-                # angle is set to 0 if either ratio between axis is too low or outside angle range
-                if pca_eigenratio_src < pca_eigenratio_th or angle_src > th_max_angle or angle_src < -th_max_angle:
-                    if rot_method == 'pca':
-                        angle_src = 0
-                    elif rot_method == 'pcahog':
-                        logger.info("Switched to method 'hog' for slice: {}".format(iz))
-                        angle_src = -angle_src_hog  # flip sign to be consistent with PCA output
-                if pca_eigenratio_dest < pca_eigenratio_th or angle_dest > th_max_angle or angle_dest < -th_max_angle:
-                    if rot_method == 'pca':
-                        angle_dest = 0
-                    elif rot_method == 'pcahog':
-                        logger.info("Switched to method 'hog' for slice: {}".format(iz))
-                        angle_dest = angle_dest_hog
-
-            if not rot_method == 'none':
-                # bypass estimation is source or destination angle is known a priori
-                if paramreg.rot_src is not None:
-                    angle_src = paramreg.rot_src
-                if paramreg.rot_dest is not None:
-                    angle_dest = paramreg.rot_dest
-                # the angle between (src, dest) is the angle between (src, origin) + angle between (origin, dest)
-                angle_src_dest[iz] = angle_src + angle_dest
-
-            # append to list of z_nonzero
-            z_nonzero.append(iz)
-
-        # if one of the slice is empty, ignore it
-        except ValueError:
-            sct.printv('WARNING: Slice #' + str(iz) + ' is empty. It will be ignored.', verbose, 'warning')
+    rot_src, rot_dest = (paramreg.rot_src, paramreg.rot_dest) if paramreg is not None else (None, None)
+
+    # Loop across slices: the estimation of each slice is independent, so the slices are processed in parallel
+    list_args = [(iz, data_src[:, :, iz], data_dest[:, :, iz],
+                  data_src_im[:, :, iz] if len(fname_src) > 1 else None,
+                  data_dest_im[:, :, iz] if len(fname_src) > 1 else None,
+                  rot_method, px, py, th_max_angle, pca_eigenratio_th, rot_src, rot_dest, verbose) for iz in range(nz)]
+    cpu_number = sct.get_cpu_number()
+    pool = multiprocessing.Pool(min(cpu_number, nz)) if cpu_number > 1 and nz > 1 else None
+    try:
+        results = pool.imap(_estimate_centermassrot_slice, list_args) if pool is not None \
+            else map(_estimate_centermassrot_slice, list_args)
+        for iz, estimation in enumerate(tqdm(results, total=nz, unit='iter', unit_scale=False,
+                                             desc="Estimate cord angle for each slice", ascii=False, ncols=100)):
+            coord_src[iz], pca_src[iz], centermass_src[iz, :], coord_dest[iz], pca_dest[iz], centermass_dest[iz, :], \
+                angle = estimation
+            # if one of the slice is empty (or if no angle is found), ignore it
+            if angle is not None:
+                angle_src_dest[iz] = angle
+                z_nonzero.append(iz)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     # regularize rotation
     if not filter_size == 0 and (rot_method in ['pca', 'hog', 'pcahog']):
@@ -880,29 +826,35 @@ def register2d_centermassrot(fname_src, fname_dest, paramreg=None, fname_warp='w
     warp_inv_x = np.zeros(data_src.shape)
     warp_inv_y = np.zeros(data_src.shape)
 
-    # construct 3D warping matrix
-    for iz in tqdm(z_nonzero, unit='iter', unit_scale=False, desc="Build 3D deformation field",
-                   ascii=False, ncols=100):
-        # get indices of x and y coordinates
+    # construct 3D warping matrix, for all the slices at once
+    sct.printv('\nBuild 3D deformation field...', verbose)
+    if z_nonzero:
+        affine = im_src.get_affine()
+        z = np.array(z_nonzero)
+        # physical coordinates of the pixels (nx x ny x len(z_nonzero))
         row, col = np.indices((nx, ny))
-        # build 2xn array of coordinates in pixel space
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
-        # get centermass coordinates in physical space
-        centermass_src_phy = im_src.transfo_pix2phys([[centermass_src[iz, :].T[0], centermass_src[iz, :].T[1], iz]])[0]
-        centermass_dest_phy = im_src.transfo_pix2phys([[centermass_dest[iz, :].T[0], centermass_dest[iz, :].T[1], iz]])[0]
-        # build rotation matrix
-        R = np.matrix(((cos(angle_src_dest[iz]), sin(angle_src_dest[iz])), (-sin(angle_src_dest[iz]), cos(angle_src_dest[iz]))))
-        # build 3D rotation matrix
-        R3d = np.eye(3)
-        R3d[0:2, 0:2] = R
+        coord_pix = np.stack(np.broadcast_arrays(row[:, :, None], col[:, :, None], z[None, None, :]), axis=-1)
+        coord_phy = apply_affine(affine, coord_pix).reshape(coord_pix.shape)
+        x_phy, y_phy = coord_phy[..., 0], coord_phy[..., 1]
+        # centermass coordinates in physical space
+        centermass_src_x, centermass_src_y = apply_affine(affine, np.column_stack((centermass_src[z], z))).T[:2]
+        centermass_dest_x, centermass_dest_y = apply_affine(affine, np.column_stack((centermass_dest[z], z))).T[:2]
+        # rotation of angle_src_dest in the (x, y) plane
+        cos_z, sin_z = np.cos(angle_src_dest[z]), np.sin(angle_src_dest[z])
         # apply forward transformation (in physical space)
-        coord_forward_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_dest_phy)), R3d) + np.transpose(centermass_src_phy))
+        dx, dy = x_phy - centermass_dest_x, y_phy - centermass_dest_y
+        warp_x[:, :, z] = dx * cos_z - dy * sin_z + centermass_src_x - x_phy
+        warp_y[:, :, z] = dx * sin_z + dy * cos_z + centermass_src_y - y_phy
         # apply inverse transformation (in physical space)
-        coord_inverse_phy = np.array(np.dot((coord_init_phy - np.transpose(centermass_src_phy)), R3d.T) + np.transpose(centermass_dest_phy))
-        # display rotations
+        dx, dy = x_phy - centermass_src_x, y_phy - centermass_src_y
+        warp_inv_x[:, :, z] = dx * cos_z + dy * sin_z + centermass_dest_x - x_phy
+        warp_inv_y[:, :, z] = - dx * sin_z + dy * cos_z + centermass_dest_y - y_phy
+
+    # display rotations
+    for iz in z_nonzero:
         if verbose == 2 and not angle_src_dest[iz] == 0 and not rot_method == 'hog':
+            # build rotation matrix
+            R = np.matrix(((cos(angle_src_dest[iz]), sin(angle_src_dest[iz])), (-sin(angle_src_dest[iz]), cos(angle_src_dest[iz]))))
             # compute new coordinates
             coord_src_rot = coord_src[iz] * R
             coord_dest_rot = coord_dest[iz] * R.T
@@ -950,17 +902,89 @@ def register2d_centermassrot(fname_src, fname_dest, paramreg=None, fname_warp='w
             plt.savefig(os.path.join(path_qc, 'register2d_centermassrot_pca_z' + str(iz) + '.png'))
             plt.close()
 
-        # construct 3D warping matrix
-        warp_x[:, :, iz] = np.array([coord_forward_phy[i, 0] - coord_init_phy[i, 0] for i in range(nx * ny)]).reshape((nx, ny))
-        warp_y[:, :, iz] = np.array([coord_forward_phy[i, 1] - coord_init_phy[i, 1] for i in range(nx * ny)]).reshape((nx, ny))
-        warp_inv_x[:, :, iz] = np.array([coord_inverse_phy[i, 0] - coord_init_phy[i, 0] for i in range(nx * ny)]).reshape((nx, ny))
-        warp_inv_y[:, :, iz] = np.array([coord_inverse_phy[i, 1] - coord_init_phy[i, 1] for i in range(nx * ny)]).reshape((nx, ny))
-
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest[0], warp_x, warp_y, fname_warp, verbose)
     generate_warping_field(fname_src[0], warp_inv_x, warp_inv_y, fname_warp_inv, verbose)
 
 
+def _estimate_centermassrot_slice(args):
+    """
+    Estimate the center of mass of a source and destination slice, and the rotation between them (see
+    register2d_centermassrot).
+    :param args: iz, src2d, dest2d, src2d_im, dest2d_im, rot_method, px, py, th_max_angle (in rad), pca_eigenratio_th,
+        rot_src, rot_dest, verbose
+    :return: coord_src, pca_src, centermass_src, coord_dest, pca_dest, centermass_dest, angle_src_dest (None if the
+        slice is ignored)
+    """
+    iz, src2d, dest2d, src2d_im, dest2d_im, rot_method, px, py, th_max_angle, pca_eigenratio_th, rot_src, rot_dest, \
+        verbose = args
+    coord_src, pca_src, centermass_src = None, None, np.zeros(2)
+    coord_dest, pca_dest, centermass_dest = None, None, np.zeros(2)
+    angle_src_dest = 0
+    try:
+        # compute PCA and get center or mass based on segmentation
+        coord_src, pca_src, centermass_src = compute_pca(src2d)
+        coord_dest, pca_dest, centermass_dest = compute_pca(dest2d)
+
+        # detect rotation using the HOG method
+        if rot_method in ['hog', 'pcahog']:
+            angle_src_hog, conf_score_src = find_angle_hog(src2d_im, centermass_src, px, py, angle_range=th_max_angle)
+            angle_dest_hog, conf_score_dest = find_angle_hog(dest2d_im, centermass_dest, px, py,
+                                                             angle_range=th_max_angle)
+            # In case no maxima is found (it should never happen)
+            if (angle_src_hog is None) or (angle_dest_hog is None):
+                sct.printv('WARNING: Slice #' + str(iz) + ' no angle found in dest or src. It will be ignored.',
+                           verbose, 'warning')
+                return coord_src, pca_src, centermass_src, coord_dest, pca_dest, centermass_dest, None
+            if rot_method == 'hog':
+                angle_src = -angle_src_hog  # flip sign to be consistent with PCA output
+                angle_dest = angle_dest_hog
+
+        # Detect rotation using the PCA or PCA-HOG method
+        if rot_method in ['pca', 'pcahog']:
+            eigenv_src = pca_src.components_.T[0][0], pca_src.components_.T[1][0]
+            eigenv_dest = pca_dest.components_.T[0][0], pca_dest.components_.T[1][0]
+            # Make sure first element is always positive (to prevent sign flipping)
+            if eigenv_src[0] <= 0:
+                eigenv_src = tuple([i * (-1) for i in eigenv_src])
+            if eigenv_dest[0] <= 0:
+                eigenv_dest = tuple([i * (-1) for i in eigenv_dest])
+            angle_src = angle_between(eigenv_src, [1, 0])
+            angle_dest = angle_between([1, 0], eigenv_dest)
+            # compute ratio between axis of PCA
+            pca_eigenratio_src = pca_src.explained_variance_ratio_[0] / pca_src.explained_variance_ratio_[1]
+            pca_eigenratio_dest = pca_dest.explained_variance_ratio_[0] / pca_dest.explained_variance_ratio_[1]
+            # angle is set to 0 if either ratio between axis is too low or outside angle range
+            if pca_eigenratio_src < pca_eigenratio_th or angle_src > th_max_angle or angle_src < -th_max_angle:
+                if rot_method == 'pca':
+                    angle_src = 0
+                elif rot_method == 'pcahog':
+                    logger.info("Switched to method 'hog' for slice: {}".format(iz))
+                    angle_src = -angle_src_hog  # flip sign to be consistent with PCA output
+            if pca_eigenratio_dest < pca_eigenratio_th or angle_dest > th_max_angle or angle_dest < -th_max_angle:
+                if rot_method == 'pca':
+                    angle_dest = 0
+                elif rot_method == 'pcahog':
+                    logger.info("Switched to method 'hog' for slice: {}".format(iz))
+                    angle_dest = angle_dest_hog
+
+        if not rot_method == 'none':
+            # bypass estimation is source or destination angle is known a priori
+            if rot_src is not None:
+                angle_src = rot_src
+            if rot_dest is not None:
+                angle_dest = rot_dest
+            # the angle between (src, dest) is the angle between (src, origin) + angle between (origin, dest)
+            angle_src_dest = angle_src + angle_dest
+
+    # if one of the slice is empty, ignore it
+    except ValueError:
+        sct.printv('WARNING: Slice #' + str(iz) + ' is empty. It will be ignored.', verbose, 'warning')
+        return coord_src, pca_src, centermass_src, coord_dest, pca_dest, centermass_dest, None
+
+    return coord_src, pca_src, centermass_src, coord_dest, pca_dest, centermass_dest, angle_src_dest
+
+
 def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz', fname_warp_inv='warp_inverse.nii.gz', verbose=0, path_qc='./', smoothWarpXY=1):
     """
     Column-wise non-linear registration of segmentations. Based on an idea from Allan Martin.
@@ -980,31 +1004,15 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
     # initialization
     th_nonzero = 0.5  # values below are considered zero
 
-    # for display stuff
-    if verbose == 2:
-        import matplotlib
-        matplotlib.use('Agg')  # prevent display figure
-        import matplotlib.pyplot as plt
-
     # Get image dimensions and retrieve nz
     sct.printv('\nGet image dimensions of destination image...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest, lazy=True).dim
     sct.printv('  matrix size: ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
     sct.printv('  voxel size:  ' + str(px) + 'mm x ' + str(py) + 'mm x ' + str(pz) + 'mm', verbose)
 
-    # Split source volume along z
-    sct.printv('\nSplit input volume...', verbose)
+    # Open source and destination volumes (the slices are processed in memory)
     im_src = Image('src.nii')
-    split_source_list = split_data(im_src, 2)
-    for im in split_source_list:
-        im.save()
-
-    # Split destination volume along z
-    sct.printv('\nSplit destination volume...', verbose)
     im_dest = Image('dest.nii')
-    split_dest_list = split_data(im_dest, 2)
-    for im in split_dest_list:
-        im.save()
 
     # open image
     data_src = im_src.data
@@ -1026,194 +1034,24 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
     warp_inv_x = np.zeros(data_src.shape)
     warp_inv_y = np.zeros(data_src.shape)
 
-    # Loop across slices
+    # Loop across slices: the estimation of each slice is independent, so the slices are processed in parallel
     sct.printv('\nEstimate columnwise transformation...', verbose)
-    for iz in range(0, nz):
-        sct.printv(str(iz) + '/' + str(nz) + '..',)
-
-        # PREPARE COORDINATES
-        # ============================================================
-        # get indices of x and y coordinates
-        row, col = np.indices((nx, ny))
-        # build 2xn array of coordinates in pixel space
-        # ordering of indices is as follows:
-        # coord_init_pix[:, 0] = 0, 0, 0, ..., 1, 1, 1..., nx, nx, nx
-        # coord_init_pix[:, 1] = 0, 1, 2, ..., 0, 1, 2..., 0, 1, 2
-        coord_init_pix = np.array([row.ravel(), col.ravel(), np.array(np.ones(len(row.ravel())) * iz)]).T
-        # convert coordinates to physical space
-        coord_init_phy = np.array(im_src.transfo_pix2phys(coord_init_pix))
-        # get 2d data from the selected slice
-        src2d = data_src[:, :, iz]
-        dest2d = data_dest[:, :, iz]
-        # julien 20161105
-        #<<<
-        # threshold at 0.5
-        src2d[src2d < th_nonzero] = 0
-        dest2d[dest2d < th_nonzero] = 0
-        # get non-zero coordinates, and transpose to obtain nx2 dimensions
-        coord_src2d = np.array(np.where(src2d > 0)).T
-        coord_dest2d = np.array(np.where(dest2d > 0)).T
-        # here we use 0.5 as threshold for non-zero value
-        # coord_src2d = np.array(np.where(src2d > th_nonzero)).T
-        # coord_dest2d = np.array(np.where(dest2d > th_nonzero)).T
-        #>>>
-
-        # SCALING R-L (X dimension)
-        # ============================================================
-        # sum data across Y to obtain 1D signal: src_y and dest_y
-        src1d = np.sum(src2d, 1)
-        dest1d = np.sum(dest2d, 1)
-        # make sure there are non-zero data in src or dest
-        if np.any(src1d > th_nonzero) and np.any(dest1d > th_nonzero):
-            # retrieve min/max of non-zeros elements (edge of the segmentation)
-            # julien 20161105
-            # <<<
-            src1d_min, src1d_max = min(np.where(src1d != 0)[0]), max(np.where(src1d != 0)[0])
-            dest1d_min, dest1d_max = min(np.where(dest1d != 0)[0]), max(np.where(dest1d != 0)[0])
-            # for i in range(len(src1d)):
-            #     if src1d[i] > 0.5:
-            #         found index above 0.5, exit loop
-                    # break
-            # get indices (in continuous space) at half-maximum of upward and downward slope
-            # src1d_min, src1d_max = find_index_halfmax(src1d)
-            # dest1d_min, dest1d_max = find_index_halfmax(dest1d)
-            # >>>
-            # 1D matching between src_y and dest_y
-            mean_dest_x = (dest1d_max + dest1d_min) / 2
-            mean_src_x = (src1d_max + src1d_min) / 2
-            # compute x-scaling factor
-            Sx = (dest1d_max - dest1d_min + 1) / float(src1d_max - src1d_min + 1)
-            # apply transformation to coordinates
-            coord_src2d_scaleX = np.copy(coord_src2d)  # need to use np.copy to avoid copying pointer
-            coord_src2d_scaleX[:, 0] = (coord_src2d[:, 0] - mean_src_x) * Sx + mean_dest_x
-            coord_init_pix_scaleX = np.copy(coord_init_pix)
-            coord_init_pix_scaleX[:, 0] = (coord_init_pix[:, 0] - mean_src_x) * Sx + mean_dest_x
-            coord_init_pix_scaleXinv = np.copy(coord_init_pix)
-            coord_init_pix_scaleXinv[:, 0] = (coord_init_pix[:, 0] - mean_dest_x) / float(Sx) + mean_src_x
-            # apply transformation to image
-            from skimage.transform import warp
-            row_scaleXinv = np.reshape(coord_init_pix_scaleXinv[:, 0], [nx, ny])
-            src2d_scaleX = warp(src2d, np.array([row_scaleXinv, col]), order=1)
-
-            # ============================================================
-            # COLUMN-WISE REGISTRATION (Y dimension for each Xi)
-            # ============================================================
-            coord_init_pix_scaleY = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-            coord_init_pix_scaleYinv = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-            # coord_src2d_scaleXY = np.copy(coord_src2d_scaleX)  # need to use np.copy to avoid copying pointer
-            # loop across columns (X dimension)
-            for ix in range(nx):
-                # retrieve 1D signal along Y
-                src1d = src2d_scaleX[ix, :]
-                dest1d = dest2d[ix, :]
-                # make sure there are non-zero data in src or dest
-                if np.any(src1d > th_nonzero) and np.any(dest1d > th_nonzero):
-                    # retrieve min/max of non-zeros elements (edge of the segmentation)
-                    # src1d_min, src1d_max = min(np.nonzero(src1d)[0]), max(np.nonzero(src1d)[0])
-                    # dest1d_min, dest1d_max = min(np.nonzero(dest1d)[0]), max(np.nonzero(dest1d)[0])
-                    # 1D matching between src_y and dest_y
-                    # Ty = (dest1d_max + dest1d_min)/2 - (src1d_max + src1d_min)/2
-                    # Sy = (dest1d_max - dest1d_min) / float(src1d_max - src1d_min)
-                    # apply translation and scaling to coordinates in column
-                    # get indices (in continuous space) at half-maximum of upward and downward slope
-                    # src1d_min, src1d_max = find_index_halfmax(src1d)
-                    # dest1d_min, dest1d_max = find_index_halfmax(dest1d)
-                    src1d_min, src1d_max = np.min(np.where(src1d > th_nonzero)), np.max(np.where(src1d > th_nonzero))
-                    dest1d_min, dest1d_max = np.min(np.where(dest1d > th_nonzero)), np.max(np.where(dest1d > th_nonzero))
-                    # 1D matching between src_y and dest_y
-                    mean_dest_y = (dest1d_max + dest1d_min) / 2
-                    mean_src_y = (src1d_max + src1d_min) / 2
-                    # Tx = (dest1d_max + dest1d_min)/2 - (src1d_max + src1d_min)/2
-                    Sy = (dest1d_max - dest1d_min + 1) / float(src1d_max - src1d_min + 1)
-                    # apply forward transformation (in pixel space)
-                    # below: only for debugging purpose
-                    # coord_src2d_scaleX = np.copy(coord_src2d)  # need to use np.copy to avoid copying pointer
-                    # coord_src2d_scaleX[:, 0] = (coord_src2d[:, 0] - mean_src) * Sx + mean_dest
-                    # coord_init_pix_scaleY = np.copy(coord_init_pix)  # need to use np.copy to avoid copying pointer
-                    # coord_init_pix_scaleY[:, 0] = (coord_init_pix[:, 0] - mean_src ) * Sx + mean_dest
-                    range_x = list(range(ix * ny, ix * ny + nx))
-                    coord_init_pix_scaleY[range_x, 1] = (coord_init_pix[range_x, 1] - mean_src_y) * Sy + mean_dest_y
-                    coord_init_pix_scaleYinv[range_x, 1] = (coord_init_pix[range_x, 1] - mean_dest_y) / float(Sy) + mean_src_y
-            # apply transformation to image
-            col_scaleYinv = np.reshape(coord_init_pix_scaleYinv[:, 1], [nx, ny])
-            src2d_scaleXY = warp(src2d, np.array([row_scaleXinv, col_scaleYinv]), order=1)
-            # regularize Y warping fields
-            from skimage.filters import gaussian
-            col_scaleY = np.reshape(coord_init_pix_scaleY[:, 1], [nx, ny])
-            col_scaleYsmooth = gaussian(col_scaleY, smoothWarpXY)
-            col_scaleYinvsmooth = gaussian(col_scaleYinv, smoothWarpXY)
-            # apply smoothed transformation to image
-            src2d_scaleXYsmooth = warp(src2d, np.array([row_scaleXinv, col_scaleYinvsmooth]), order=1)
-            # reshape warping field as 1d
-            coord_init_pix_scaleY[:, 1] = col_scaleYsmooth.ravel()
-            coord_init_pix_scaleYinv[:, 1] = col_scaleYinvsmooth.ravel()
-            # display
-            if verbose == 2:
-                # FIG 1
-                plt.figure(figsize=(15, 3))
-                # plot #1
-                ax = plt.subplot(141)
-                plt.imshow(np.swapaxes(src2d, 1, 0), cmap=plt.cm.gray, interpolation='none')
-                plt.hold(True)  # add other layer
-                plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
-                plt.title('src')
-                plt.xlabel('x')
-                plt.ylabel('y')
-                plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
-                ax.grid(True, color='w')
-                # plot #2
-                ax = plt.subplot(142)
-                plt.imshow(np.swapaxes(src2d_scaleX, 1, 0), cmap=plt.cm.gray, interpolation='none')
-                plt.hold(True)  # add other layer
-                plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
-                plt.title('src_scaleX')
-                plt.xlabel('x')
-                plt.ylabel('y')
-                plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
-                ax.grid(True, color='w')
-                # plot #3
-                ax = plt.subplot(143)
-                plt.imshow(np.swapaxes(src2d_scaleXY, 1, 0), cmap=plt.cm.gray, interpolation='none')
-                plt.hold(True)  # add other layer
-                plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
-                plt.title('src_scaleXY')
-                plt.xlabel('x')
-                plt.ylabel('y')
-                plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
-                ax.grid(True, color='w')
-                # plot #4
-                ax = plt.subplot(144)
-                plt.imshow(np.swapaxes(src2d_scaleXYsmooth, 1, 0), cmap=plt.cm.gray, interpolation='none')
-                plt.hold(True)  # add other layer
-                plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
-                plt.title('src_scaleXYsmooth (s=' + str(smoothWarpXY) + ')')
-                plt.xlabel('x')
-                plt.ylabel('y')
-                plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
-                plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
-                ax.grid(True, color='w')
-                # save figure
-                plt.savefig(os.path.join(path_qc, 'register2d_columnwise_image_z' + str(iz) + '.png'))
-                plt.close()
-
-            # ============================================================
-            # CALCULATE TRANSFORMATIONS
-            # ============================================================
-            # calculate forward transformation (in physical space)
-            coord_init_phy_scaleX = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleX))
-            coord_init_phy_scaleY = np.array(im_dest.transfo_pix2phys(coord_init_pix_scaleY))
-            # calculate inverse transformation (in physical space)
-            coord_init_phy_scaleXinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleXinv))
-            coord_init_phy_scaleYinv = np.array(im_src.transfo_pix2phys(coord_init_pix_scaleYinv))
-            # compute displacement per pixel in destination space (for forward warping field)
-            warp_x[:, :, iz] = np.array([coord_init_phy_scaleXinv[i, 0] - coord_init_phy[i, 0] for i in range(nx * ny)]).reshape((nx, ny))
-            warp_y[:, :, iz] = np.array([coord_init_phy_scaleYinv[i, 1] - coord_init_phy[i, 1] for i in range(nx * ny)]).reshape((nx, ny))
-            # compute displacement per pixel in source space (for inverse warping field)
-            warp_inv_x[:, :, iz] = np.array([coord_init_phy_scaleX[i, 0] - coord_init_phy[i, 0] for i in range(nx * ny)]).reshape((nx, ny))
-            warp_inv_y[:, :, iz] = np.array([coord_init_phy_scaleY[i, 1] - coord_init_phy[i, 1] for i in range(nx * ny)]).reshape((nx, ny))
+    list_args = [(iz, data_src[:, :, iz], data_dest[:, :, iz], im_src.get_affine(), im_dest.get_affine(), th_nonzero,
+                  smoothWarpXY, path_qc, verbose) for iz in range(nz)]
+    cpu_number = sct.get_cpu_number()
+    pool = multiprocessing.Pool(min(cpu_number, nz)) if cpu_number > 1 and nz > 1 else None
+    try:
+        results = pool.imap(_register2d_columnwise_slice, list_args) if pool is not None \
+            else map(_register2d_columnwise_slice, list_args)
+        for iz, warp2d in enumerate(tqdm(results, total=nz, unit='iter', unit_scale=False,
+                                         desc="Estimate columnwise transformation", ascii=False, ncols=100)):
+            # slices with no data in src or dest are not transformed
+            if warp2d is not None:
+                warp_x[:, :, iz], warp_y[:, :, iz], warp_inv_x[:, :, iz], warp_inv_y[:, :, iz] = warp2d
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     # Generate forward warping field (defined in destination space)
     generate_warping_field(fname_dest, warp_x, warp_y, fname_warp, verbose)
@@ -1221,6 +1059,146 @@ def register2d_columnwise(fname_src, fname_dest, fname_warp='warp_forward.nii.gz
     generate_warping_field(fname_src, warp_inv_x, warp_inv_y, fname_warp_inv, verbose)
 
 
+def _register2d_columnwise_slice(args):
+    """
+    Column-wise registration of a slice (see register2d_columnwise).
+    :param args: iz, src2d, dest2d, affine_src, affine_dest, th_nonzero, smoothWarpXY, path_qc, verbose
+    :return: warp_x, warp_y, warp_inv_x, warp_inv_y: nx x ny arrays of the displacement in physical space, or None if
+        there are no data in src or dest.
+    """
+    iz, src2d, dest2d, affine_src, affine_dest, th_nonzero, smoothWarpXY, path_qc, verbose = args
+    from skimage.transform import warp
+    from skimage.filters import gaussian
+
+    nx, ny = dest2d.shape
+    # PREPARE COORDINATES
+    # ============================================================
+    # get indices of x and y coordinates
+    row, col = np.indices((nx, ny))
+    z = np.full((nx, ny), iz)
+    # physical coordinates of the pixels
+    coord_phy = apply_affine(affine_src, np.dstack((row, col, z))).reshape(nx, ny, 3)
+    x_phy, y_phy = coord_phy[..., 0], coord_phy[..., 1]
+    # julien 20161105
+    # threshold at 0.5
+    src2d = np.where(src2d < th_nonzero, 0, src2d)
+    dest2d = np.where(dest2d < th_nonzero, 0, dest2d)
+
+    # SCALING R-L (X dimension)
+    # ============================================================
+    # sum data across Y to obtain 1D signal: src_y and dest_y
+    src1d = np.sum(src2d, 1)
+    dest1d = np.sum(dest2d, 1)
+    # make sure there are non-zero data in src or dest
+    if not (np.any(src1d > th_nonzero) and np.any(dest1d > th_nonzero)):
+        return None
+    # retrieve min/max of non-zeros elements (edge of the segmentation)
+    src1d_min, src1d_max = min(np.where(src1d != 0)[0]), max(np.where(src1d != 0)[0])
+    dest1d_min, dest1d_max = min(np.where(dest1d != 0)[0]), max(np.where(dest1d != 0)[0])
+    # 1D matching between src_y and dest_y
+    mean_dest_x = (dest1d_max + dest1d_min) / 2
+    mean_src_x = (src1d_max + src1d_min) / 2
+    # compute x-scaling factor
+    Sx = (dest1d_max - dest1d_min + 1) / float(src1d_max - src1d_min + 1)
+    # apply transformation to coordinates
+    row_scaleX = (row - mean_src_x) * Sx + mean_dest_x
+    row_scaleXinv = (row - mean_dest_x) / float(Sx) + mean_src_x
+    # apply transformation to image
+    src2d_scaleX = warp(src2d, np.array([row_scaleXinv, col]), order=1)
+
+    # ============================================================
+    # COLUMN-WISE REGISTRATION (Y dimension for each Xi)
+    # ============================================================
+    # retrieve min/max of the elements above threshold along Y, for all the columns (X dimension) at once
+    mask_src, mask_dest = src2d_scaleX > th_nonzero, dest2d > th_nonzero
+    # make sure there are non-zero data in src or dest
+    column = np.any(mask_src, 1) & np.any(mask_dest, 1)
+    src1d_min, src1d_max = np.argmax(mask_src, 1), ny - 1 - np.argmax(mask_src[:, ::-1], 1)
+    dest1d_min, dest1d_max = np.argmax(mask_dest, 1), ny - 1 - np.argmax(mask_dest[:, ::-1], 1)
+    # 1D matching between src_y and dest_y
+    mean_dest_y = ((dest1d_max + dest1d_min) / 2)[:, None]
+    mean_src_y = ((src1d_max + src1d_min) / 2)[:, None]
+    Sy = ((dest1d_max - dest1d_min + 1) / (src1d_max - src1d_min + 1).astype(float))[:, None]
+    # apply translation and scaling to coordinates in column
+    col_scaleY = np.where(column[:, None], (col - mean_src_y) * Sy + mean_dest_y, col)
+    col_scaleYinv = np.where(column[:, None], (col - mean_dest_y) / Sy + mean_src_y, col)
+    # regularize Y warping fields
+    col_scaleYsmooth = gaussian(col_scaleY, smoothWarpXY)
+    col_scaleYinvsmooth = gaussian(col_scaleYinv, smoothWarpXY)
+    # display
+    if verbose == 2:
+        import matplotlib
+        matplotlib.use('Agg')  # prevent display figure
+        import matplotlib.pyplot as plt
+        # apply transformation to image
+        src2d_scaleXY = warp(src2d, np.array([row_scaleXinv, col_scaleYinv]), order=1)
+        # apply smoothed transformation to image
+        src2d_scaleXYsmooth = warp(src2d, np.array([row_scaleXinv, col_scaleYinvsmooth]), order=1)
+        mean_dest_y = mean_dest_y[column][-1, 0] if np.any(column) else ny / 2
+        # FIG 1
+        plt.figure(figsize=(15, 3))
+        # plot #1
+        ax = plt.subplot(141)
+        plt.imshow(np.swapaxes(src2d, 1, 0), cmap=plt.cm.gray, interpolation='none')
+        plt.hold(True)  # add other layer
+        plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
+        plt.title('src')
+        plt.xlabel('x')
+        plt.ylabel('y')
+        plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
+        plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+        ax.grid(True, color='w')
+        # plot #2
+        ax = plt.subplot(142)
+        plt.imshow(np.swapaxes(src2d_scaleX, 1, 0), cmap=plt.cm.gray, interpolation='none')
+        plt.hold(True)  # add other layer
+        plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
+        plt.title('src_scaleX')
+        plt.xlabel('x')
+        plt.ylabel('y')
+        plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
+        plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+        ax.grid(True, color='w')
+        # plot #3
+        ax = plt.subplot(143)
+        plt.imshow(np.swapaxes(src2d_scaleXY, 1, 0), cmap=plt.cm.gray, interpolation='none')
+        plt.hold(True)  # add other layer
+        plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
+        plt.title('src_scaleXY')
+        plt.xlabel('x')
+        plt.ylabel('y')
+        plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
+        plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+        ax.grid(True, color='w')
+        # plot #4
+        ax = plt.subplot(144)
+        plt.imshow(np.swapaxes(src2d_scaleXYsmooth, 1, 0), cmap=plt.cm.gray, interpolation='none')
+        plt.hold(True)  # add other layer
+        plt.imshow(np.swapaxes(dest2d, 1, 0), cmap=plt.cm.copper, interpolation='none', alpha=0.5)
+        plt.title('src_scaleXYsmooth (s=' + str(smoothWarpXY) + ')')
+        plt.xlabel('x')
+        plt.ylabel('y')
+        plt.xlim(mean_dest_x - 15, mean_dest_x + 15)
+        plt.ylim(mean_dest_y - 15, mean_dest_y + 15)
+        ax.grid(True, color='w')
+        # save figure
+        plt.savefig(os.path.join(path_qc, 'register2d_columnwise_image_z' + str(iz) + '.png'))
+        plt.close()
+
+    # ============================================================
+    # CALCULATE TRANSFORMATIONS
+    # ============================================================
+    # calculate forward transformation (in physical space)
+    x_phy_scaleX = apply_affine(affine_dest, np.dstack((row_scaleX, col, z)))[:, 0].reshape(nx, ny)
+    y_phy_scaleY = apply_affine(affine_dest, np.dstack((row, col_scaleYsmooth, z)))[:, 1].reshape(nx, ny)
+    # calculate inverse transformation (in physical space)
+    x_phy_scaleXinv = apply_affine(affine_src, np.dstack((row_scaleXinv, col, z)))[:, 0].reshape(nx, ny)
+    y_phy_scaleYinv = apply_affine(affine_src, np.dstack((row, col_scaleYinvsmooth, z)))[:, 1].reshape(nx, ny)
+    # displacement per pixel in destination space (for forward warping field), and in source space (for inverse warping
+    # field)
+    return x_phy_scaleXinv - x_phy, y_phy_scaleYinv - y_phy, x_phy_scaleX - x_phy, y_phy_scaleY - y_phy
+
+
 def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.nii.gz',
                fname_warp_inv='warp_inverse.nii.gz',
                paramreg=Paramreg(step='0', type='im', algo='Translation', metric='MI', iter='5', shrink='1', smooth='0',
@@ -1260,7 +1238,7 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
 
     # Get image dimensions and retrieve nz
     sct.printv('\nGet image dimensions of destination image...', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest, lazy=True).dim
     sct.printv('.. matrix size: ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz), verbose)
     sct.printv('.. voxel size:  ' + str(px) + 'mm x ' + str(py) + 'mm x ' + str(pz) + 'mm', verbose)
 
@@ -1292,79 +1270,39 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
         y_displacement = [0 for i in range(nz)]
         theta_rotation = [0 for i in range(nz)]
     if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-        list_warp = []
-        list_warp_inv = []
-
-    # loop across slices
-    for i in range(nz):
-        # set masking
-        sct.printv('Registering slice ' + str(i) + '/' + str(nz - 1) + '...', verbose)
-        num = numerotation(i)
-        prefix_warp2d = 'warp2d_' + num
-        # if mask is used, prepare command for ANTs
-        if fname_mask != '':
-            masking = ['-x', 'mask_Z' + num + '.nii.gz']
-        else:
-            masking = []
-        # main command for registration
-        # TODO fixup isct_ants* parsers
-        cmd = ['isct_antsRegistration',
-         '--dimensionality', '2',
-         '--transform', paramreg.algo + '[' + str(paramreg.gradStep) + ants_registration_params[paramreg.algo.lower()] + ']',
-         '--metric', paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + ']',  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
-         '--convergence', str(paramreg.iter),
-         '--shrink-factors', str(paramreg.shrink),
-         '--smoothing-sigmas', str(paramreg.smooth) + 'mm',
-         '--output', '[' + prefix_warp2d + ',src_Z' + num + '_reg.nii]',    #--> file.mat (contains Tx,Ty, theta)
-         '--interpolation', 'BSpline[3]',
-         '--verbose', '1',
-        ] + masking
-        # add init translation
-        if not paramreg.init == '':
-            init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
-            cmd += ['-r', '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']']
-
-        try:
-            # run registration
-            sct.run(cmd, is_sct_binary=True)
-
+        list_warp = [None] * nz
+        list_warp_inv = [None] * nz
+
+    # loop across slices: the slices are registered in parallel (the split volumes are shared in the working directory),
+    # the CPU cores being shared between the registrations and their ITK threads
+    cpu_number = sct.get_cpu_number()
+    nb_jobs = min(cpu_number, nz)
+    itk_threads = max(1, cpu_number // nb_jobs)
+    # the paths of the ANTs binaries are resolved (and the binaries downloaded if they are missing) once, before the
+    # parallel registrations
+    list_binary = ['isct_antsRegistration'] + (['isct_ComposeMultiTransform'] if paramreg.algo in ['Rigid', 'Affine']
+                                               else [])
+    path_binaries = {name: sct.get_sct_binary(name) for name in list_binary}
+    list_args = [(i, fname_mask, paramreg, ants_registration_params, metricSize, itk_threads, path_binaries)
+                 for i in range(nz)]
+    pool = multiprocessing.Pool(nb_jobs) if nb_jobs > 1 else None
+    try:
+        results = pool.imap_unordered(_register2d_slice, list_args) if pool is not None \
+            else map(_register2d_slice, list_args)
+        for i, result, error in tqdm(results, total=nz, unit='slice', unit_scale=False, desc="Register slices",
+                                     ascii=False, ncols=100):
+            # if an exception occurs with ants, the slice is not transformed (identity)
+            if error is not None:
+                sct.printv('ERROR: Exception occurred.\n' + error, 1, 'error')
+                continue
             if paramreg.algo in ['Translation']:
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                matfile = loadmat(file_mat, struct_as_record=True)
-                array_transfo = matfile['AffineTransform_double_2_2']
-                x_displacement[i] = array_transfo[4][0]  # Tx in ITK'S coordinate system
-                y_displacement[i] = array_transfo[5][0]  # Ty  in ITK'S and fslview's coordinate systems
-                theta_rotation[i] = asin(array_transfo[2])  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
-
+                x_displacement[i], y_displacement[i], theta_rotation[i] = result
             if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-                # List names of 2d warping fields for subsequent merge along Z
-                file_warp2d = prefix_warp2d + '0Warp.nii.gz'
-                file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
-                list_warp.append(file_warp2d)
-                list_warp_inv.append(file_warp2d_inv)
-
-            if paramreg.algo in ['Rigid', 'Affine']:
-                # Generating null 2d warping field (for subsequent concatenation with affine transformation)
-                # TODO fixup isct_ants* parsers
-                sct.run(['isct_antsRegistration',
-                 '-d', '2',
-                 '-t', 'SyN[1,1,1]',
-                 '-c', '0',
-                 '-m', 'MI[dest_Z' + num + '.nii,src_Z' + num + '.nii,1,32]',
-                 '-o', 'warp2d_null',
-                 '-f', '1',
-                 '-s', '0',
-                ], is_sct_binary=True)
-                # --> outputs: warp2d_null0Warp.nii.gz, warp2d_null0InverseWarp.nii.gz
-                file_mat = prefix_warp2d + '0GenericAffine.mat'
-                # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d, '-R', 'dest_Z' + num + '.nii', 'warp2d_null0Warp.nii.gz', file_mat], is_sct_binary=True)
-                sct.run(['isct_ComposeMultiTransform', '2', file_warp2d_inv, '-R', 'src_Z' + num + '.nii', 'warp2d_null0InverseWarp.nii.gz', '-i', file_mat], is_sct_binary=True)
-
-        # if an exception occurs with ants, take the last value for the transformation
-        # TODO: DO WE NEED TO DO THAT??? (julien 2016-03-01)
-        except Exception as e:
-            sct.printv('ERROR: Exception occurred.\n' + str(e), 1, 'error')
+                list_warp[i], list_warp_inv[i] = result
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     # Merge warping field along z
     sct.printv('\nMerge warping fields along z...', verbose)
@@ -1380,11 +1318,99 @@ def register2d(fname_src, fname_dest, fname_mask='', fname_warp='warp_forward.ni
         generate_warping_field(fname_src, -x_disp_a, -y_disp_a, fname_warp=fname_warp_inv)
 
     if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
-        # concatenate 2d warping fields along z
+        # identity for the slices whose registration failed
+        list_warp = [np.zeros((nx, ny, 1, 1, 2)) if warp is None else warp for warp in list_warp]
+        list_warp_inv = [np.zeros((nx, ny, 1, 1, 2)) if warp is None else warp for warp in list_warp_inv]
+        # concatenate 2d warping fields along z (in memory)
         concat_warp2d(list_warp, fname_warp, fname_dest)
         concat_warp2d(list_warp_inv, fname_warp_inv, fname_src)
 
 
+def _register2d_slice(args):
+    """
+    Register a slice of the source and destination volumes split in the working directory (see register2d).
+    :param args: i, fname_mask, paramreg, ants_registration_params, metricSize, itk_threads, path_binaries (dict:
+        absolute path of each ANTs binary, see sct_utils.get_sct_binary)
+    :return: i, result, error: result is (Tx, Ty, theta) if algo==Translation, or the 2d forward and inverse warping
+        fields (arrays) if algo==Rigid, Affine, BSplineSyN or SyN. error is None, or the message of the exception (the
+        registration is then incomplete).
+    """
+    i, fname_mask, paramreg, ants_registration_params, metricSize, itk_threads, path_binaries = args
+    num = numerotation(i)
+    prefix_warp2d = 'warp2d_' + num
+    # limit the number of CPU used by each registration (see issue #201)
+    env = dict(os.environ)
+    env["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(itk_threads)
+    # if mask is used, prepare command for ANTs
+    if fname_mask != '':
+        masking = ['-x', 'mask_Z' + num + '.nii.gz']
+    else:
+        masking = []
+    # main command for registration
+    # TODO fixup isct_ants* parsers
+    cmd = [path_binaries['isct_antsRegistration'],
+     '--dimensionality', '2',
+     '--transform', paramreg.algo + '[' + str(paramreg.gradStep) + ants_registration_params[paramreg.algo.lower()] + ']',
+     '--metric', paramreg.metric + '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii' + ',1,' + metricSize + ']',  #[fixedImage,movingImage,metricWeight +nb_of_bins (MI) or radius (other)
+     '--convergence', str(paramreg.iter),
+     '--shrink-factors', str(paramreg.shrink),
+     '--smoothing-sigmas', str(paramreg.smooth) + 'mm',
+     '--output', '[' + prefix_warp2d + ',src_Z' + num + '_reg.nii]',    #--> file.mat (contains Tx,Ty, theta)
+     '--interpolation', 'BSpline[3]',
+     '--verbose', '1',
+    ] + masking
+    # add init translation
+    if not paramreg.init == '':
+        init_dict = {'geometric': '0', 'centermass': '1', 'origin': '2'}
+        cmd += ['-r', '[dest_Z' + num + '.nii' + ',src_Z' + num + '.nii,' + init_dict[paramreg.init] + ']']
+
+    result = None
+    try:
+        # run registration
+        sct.run(cmd, verbose=0, env=env)
+
+        if paramreg.algo in ['Translation']:
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            matfile = loadmat(file_mat, struct_as_record=True)
+            array_transfo = matfile['AffineTransform_double_2_2']
+            result = (array_transfo[4][0],  # Tx in ITK'S coordinate system
+                      array_transfo[5][0],  # Ty  in ITK'S and fslview's coordinate systems
+                      asin(array_transfo[2]))  # angle of rotation theta in ITK'S coordinate system (minus theta for fslview)
+
+        if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
+            # names of 2d warping fields for subsequent merge along Z
+            file_warp2d = prefix_warp2d + '0Warp.nii.gz'
+            file_warp2d_inv = prefix_warp2d + '0InverseWarp.nii.gz'
+
+        if paramreg.algo in ['Rigid', 'Affine']:
+            # Generating null 2d warping field (for subsequent concatenation with affine transformation)
+            # TODO fixup isct_ants* parsers
+            prefix_null = prefix_warp2d + '_null'
+            sct.run([path_binaries['isct_antsRegistration'],
+             '-d', '2',
+             '-t', 'SyN[1,1,1]',
+             '-c', '0',
+             '-m', 'MI[dest_Z' + num + '.nii,src_Z' + num + '.nii,1,32]',
+             '-o', prefix_null,
+             '-f', '1',
+             '-s', '0',
+            ], verbose=0, env=env)
+            # --> outputs: warp2d_XXXX_null0Warp.nii.gz, warp2d_XXXX_null0InverseWarp.nii.gz
+            file_mat = prefix_warp2d + '0GenericAffine.mat'
+            # Concatenating mat transfo and null 2d warping field to obtain 2d warping field of affine transformation
+            sct.run([path_binaries['isct_ComposeMultiTransform'], '2', file_warp2d, '-R', 'dest_Z' + num + '.nii', prefix_null + '0Warp.nii.gz', file_mat], verbose=0, env=env)
+            sct.run([path_binaries['isct_ComposeMultiTransform'], '2', file_warp2d_inv, '-R', 'src_Z' + num + '.nii', prefix_null + '0InverseWarp.nii.gz', '-i', file_mat], verbose=0, env=env)
+
+        if paramreg.algo in ['Rigid', 'Affine', 'BSplineSyN', 'SyN']:
+            # load the 2d warping fields, which are concatenated in memory
+            result = (np.asarray(load(file_warp2d).get_data()), np.asarray(load(file_warp2d_inv).get_data()))
+
+    except Exception as e:
+        return i, result, str(e)
+
+    return i, result, None
+
+
 def numerotation(nb):
     """Indexation of number for matching fslsplit's index.
 
@@ -1427,7 +1453,7 @@ def generate_warping_field(fname_dest, warp_x, warp_y, fname_warp='warping_field
 
     # Get image dimensions
     # sct.printv('Get destination dimension', verbose)
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_dest, lazy=True).dim
     # sct.printv('  matrix size: '+str(nx)+' x '+str(ny)+' x '+str(nz), verbose)
     # sct.printv('  voxel size:  '+str(px)+'mm x '+str(py)+'mm x '+str(pz)+'mm', verbose)
 
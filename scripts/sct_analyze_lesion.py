@@ -18,6 +18,7 @@ import pandas as pd
 from skimage.measure import label
 
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox.metadata import load_sparse_labels
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, ActionCreateFolder
 
@@ -151,6 +152,7 @@ class AnalyzeLeion:
             self.path_atlas, self.path_levels = None, None
         self.vert_lst = None
         self.atlas_roi_lst = None
+        self.atlas_sparse = None  # sparse copy of the atlas (see sct_warp_template), used instead of the atlas files
         self.distrib_matrix_dct = {}
 
         # output names
@@ -385,6 +387,10 @@ class AnalyzeLeion:
             atlas_data_dct = {}  # dict containing the np.array of the registrated atlas
             for fname_atlas_roi in self.atlas_roi_lst:
                 tract_id = int(fname_atlas_roi.split('_')[-1].split('.nii.gz')[0])
+                if self.atlas_sparse is not None:
+                    # the sparse copy is in RPI orientation
+                    atlas_data_dct[tract_id] = self.atlas_sparse.get_data(fname_atlas_roi)
+                    continue
                 img_cur = Image(fname_atlas_roi)
                 img_cur_copy = img_cur.copy()
                 atlas_data_dct[tract_id] = img_cur_copy.data
@@ -461,7 +467,7 @@ class AnalyzeLeion:
 
     def orient2rpi(self):
         # save input image orientation
-        self.orientation = Image(self.fname_mask).orientation
+        self.orientation = Image(self.fname_mask, lazy=True).orientation
 
         if not self.orientation == 'RPI':
             printv('\nOrient input image(s) to RPI orientation...', self.verbose, 'normal')
@@ -473,8 +479,9 @@ class AnalyzeLeion:
                 self._orient(self.fname_ref, 'RPI')
             if self.path_template is not None:
                 self._orient(self.path_levels, 'RPI')
-                for fname_atlas in self.atlas_roi_lst:
-                    self._orient(fname_atlas, 'RPI')
+                if self.atlas_sparse is None:
+                    for fname_atlas in self.atlas_roi_lst:
+                        self._orient(fname_atlas, 'RPI')
 
     def ifolder2tmp(self):
         # copy input image
@@ -500,11 +507,18 @@ class AnalyzeLeion:
             self.path_levels = ''.join(extract_fname(self.path_levels)[1:])
 
             self.atlas_roi_lst = []
-            for fname_atlas_roi in os.listdir(self.path_atlas):
+            self.atlas_sparse = load_sparse_labels(self.path_atlas)
+            if self.atlas_sparse is not None:
+                # the atlas is read from its sparse copy: no need to copy the atlas files
+                list_fname_atlas_roi = self.atlas_sparse.files
+            else:
+                list_fname_atlas_roi = os.listdir(self.path_atlas)
+            for fname_atlas_roi in list_fname_atlas_roi:
                 if fname_atlas_roi.endswith('.nii.gz'):
                     tract_id = int(fname_atlas_roi.split('_')[-1].split('.nii.gz')[0])
                     if tract_id < 36:  # Not interested in CSF
-                        sct.copy(os.path.join(self.path_atlas, fname_atlas_roi), self.tmp_dir)
+                        if self.atlas_sparse is None:
+                            sct.copy(os.path.join(self.path_atlas, fname_atlas_roi), self.tmp_dir)
                         self.atlas_roi_lst.append(fname_atlas_roi)
 
         os.chdir(self.tmp_dir)  # go to tmp directory
@@ -16,9 +16,14 @@ import sys
 import numpy as np
 import itertools
 import argparse
+import multiprocessing
+from scipy import ndimage
 
 import tqdm
-from skimage.feature import greycomatrix, greycoprops
+try:
+    from skimage.feature import graycomatrix as greycomatrix, graycoprops as greycoprops
+except ImportError:  # scikit-image < 0.19
+    from skimage.feature import greycomatrix, greycoprops
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -104,6 +109,13 @@ def get_parser():
         type=int,
         choices=(0, 1),
         default=int(Param().rm_tmp))
+    optional.add_argument(
+        "-cpu-nb",
+        type=int,
+        help="Number of processes to compute the texture of the slices in parallel. 0: use all available cores.",
+        metavar=Metavar.int,
+        required=False,
+        default=Param().cpu_number)
     optional.add_argument(
         "-v",
         help="Verbose: 0 = nothing, 1 = classic, 2 = expended.",
@@ -115,6 +127,96 @@ def get_parser():
     return parser
 
 
+def get_glcm_pairs(distance, angle):
+    """
+    Get the pairs of pixels of a GLCM window that are counted by skimage.feature.greycomatrix, the window being a square
+    of (2 * distance + 1) pixels centred on the voxel (as in ExtractGLCM.compute_texture).
+    :param distance: int: distance offset, in pixel
+    :param angle: float: angle, in radians
+    :return: (row, col) of the reference pixels and (row, col) of their neighbours, relative to the window centre
+    """
+    size = 2 * distance + 1
+    offset_row, offset_col = int(np.round(np.sin(angle) * distance)), int(np.round(np.cos(angle) * distance))
+    row, col = np.mgrid[:size, :size]
+    inside = (row + offset_row >= 0) & (row + offset_row < size) & (col + offset_col >= 0) & (col + offset_col < size)
+    row, col = row[inside] - distance, col[inside] - distance
+    return (row, col), (row + offset_row, col + offset_col)
+
+
+def compute_glcm_properties(values_i, values_j, features):
+    """
+    Compute GLCM properties of several windows at once, from the pairs of grey levels accumulated in their GLCM. The
+    properties are those of skimage.feature.greycoprops (on the normalized GLCM), without building the 256x256 matrices.
+    :param values_i: NxM array: grey levels of the reference pixels of the M pairs of each of the N windows
+    :param values_j: NxM array: grey levels of the neighbours
+    :param features: list of GLCM properties
+    :return: dict: property --> N array
+    """
+    nb_window, nb_pair = values_i.shape
+    values_i, values_j = values_i.astype(np.float64), values_j.astype(np.float64)
+    diff = values_i - values_j
+    dct_property = {}
+    for feature in features:
+        if feature == 'contrast':
+            dct_property[feature] = np.mean(diff ** 2, axis=1)
+        elif feature == 'dissimilarity':
+            dct_property[feature] = np.mean(np.abs(diff), axis=1)
+        elif feature == 'homogeneity':
+            dct_property[feature] = np.mean(1. / (1. + diff ** 2), axis=1)
+        elif feature in ['ASM', 'energy']:
+            # count the occurrences of each (window, grey level i, grey level j) with a single integer code
+            code = (np.arange(nb_window)[:, None] * 256 + values_i.astype(np.int64)) * 256 + values_j.astype(np.int64)
+            code, count = np.unique(code, return_counts=True)
+            asm = np.bincount(code // 65536, weights=(count / float(nb_pair)) ** 2, minlength=nb_window)
+            dct_property[feature] = asm if feature == 'ASM' else np.sqrt(asm)
+        elif feature == 'correlation':
+            diff_i = values_i - np.mean(values_i, axis=1, keepdims=True)
+            diff_j = values_j - np.mean(values_j, axis=1, keepdims=True)
+            std_i, std_j = np.sqrt(np.mean(diff_i ** 2, axis=1)), np.sqrt(np.mean(diff_j ** 2, axis=1))
+            cov = np.mean(diff_i * diff_j, axis=1)
+            # as greycoprops: correlation of 1 if a standard deviation is (near) zero
+            correlation = np.ones(nb_window)
+            mask = (std_i >= 1e-15) & (std_j >= 1e-15)
+            correlation[mask] = cov[mask] / (std_i[mask] * std_j[mask])
+            dct_property[feature] = correlation
+        else:
+            raise ValueError('%s is an invalid property' % feature)
+    return dct_property
+
+
+def compute_texture_slice(im_z, seg_z, distance, angles, features, symmetric=True):
+    """
+    Compute the GLCM properties of all the voxels of a slice whose window is entirely within the slice and the mask.
+    Equivalent to ExtractGLCM.compute_texture with method='loop', but the pairs of grey levels of all the windows are
+    gathered at once, by shifting the slice.
+    :param im_z: 2D array: image slice
+    :param seg_z: 2D array: mask slice
+    :param distance: int: distance offset, in pixel
+    :param angles: list of angles, in degrees
+    :param features: list of GLCM properties
+    :param symmetric: bool: GLCM symmetric (i.e. also count the pairs in the opposite direction)
+    :return: x, y: coordinates of the voxels, dict: angle --> dict: property --> values at (x, y)
+    """
+    distance = int(distance)
+    data = im_z.astype(np.uint8)
+    # voxels whose window is entirely within the mask (the mask is considered empty outside the slice)
+    inside = ndimage.minimum_filter((seg_z != 0).astype(np.uint8), size=2 * distance + 1, mode='constant', cval=0)
+    x, y = np.nonzero(inside)
+    dct_texture = {}
+    for angle in angles:
+        (row_i, col_i), (row_j, col_j) = get_glcm_pairs(distance, np.radians(int(angle)))
+        values_i = data[x[:, None] + row_i, y[:, None] + col_i]
+        values_j = data[x[:, None] + row_j, y[:, None] + col_j]
+        if symmetric:
+            values_i, values_j = np.hstack([values_i, values_j]), np.hstack([values_j, values_i])
+        dct_texture[angle] = compute_glcm_properties(values_i, values_j, features)
+    return x, y, dct_texture
+
+
+def _compute_texture_slice(args):
+    return compute_texture_slice(*args)
+
+
 class ExtractGLCM:
     def __init__(self, param=None, param_glcm=None):
         self.param = param if param is not None else Param()
@@ -140,7 +242,7 @@ class ExtractGLCM:
         self.dct_im_seg = {'im': None, 'seg': None}
 
         # to re-orient the data at the end if needed
-        self.orientation_im = Image(self.param.fname_im).orientation
+        self.orientation_im = Image(self.param.fname_im, lazy=True).orientation
 
         self.fname_metric_lst = {}
 
@@ -251,6 +353,46 @@ class ExtractGLCM:
             dct_metric[m] = im_2save
             # dct_metric[m] = Image(self.fname_metric_lst[m])
 
+        if self.param_glcm.method == 'loop':
+            self.compute_texture_loop(dct_metric, offset)
+        else:
+            self.compute_texture_vectorized(dct_metric, offset)
+
+        for m in self.metric_lst:
+            fname_out = sct.add_suffix("".join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
+            dct_metric[m].save(fname_out)
+            self.fname_metric_lst[m] = fname_out
+
+    def compute_texture_vectorized(self, dct_metric, offset):
+        """
+        Compute the texture metrics slice by slice (see compute_texture_slice), the slices being processed in parallel.
+        :param dct_metric: dict: metric --> Image, filled in place
+        :param offset: int: distance offset
+        """
+        angles = self.param_glcm.angle.split(',')
+        features = sorted(set(m.split('_')[0] for m in self.metric_lst))
+        list_args = [(im_z, seg_z, offset, angles, features, self.param_glcm.symmetric)
+                     for im_z, seg_z in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'])]
+        cpu_number = self.param.cpu_number or multiprocessing.cpu_count()
+        pool = multiprocessing.Pool(min(cpu_number, len(list_args))) if cpu_number > 1 and len(list_args) > 1 else None
+        try:
+            results = pool.imap(_compute_texture_slice, list_args) if pool is not None \
+                else map(_compute_texture_slice, list_args)
+            for zz, (x, y, dct_texture) in enumerate(tqdm.tqdm(results, total=len(list_args), unit='slice')):
+                for m in self.metric_lst:
+                    feature, _, angle = m.split('_')
+                    dct_metric[m].data[x, y, zz] = dct_texture[angle][feature]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def compute_texture_loop(self, dct_metric, offset):
+        """
+        Compute the texture metrics voxel by voxel, with skimage (reference implementation).
+        :param dct_metric: dict: metric --> Image, filled in place
+        :param offset: int: distance offset
+        """
         with tqdm.tqdm() as pbar:
             for im_z, seg_z, zz in zip(self.dct_im_seg['im'], self.dct_im_seg['seg'], range(len(self.dct_im_seg['im']))):
                 for xx in range(im_z.shape[0]):
@@ -280,11 +422,6 @@ class ExtractGLCM:
                         pbar.set_postfix(pos="{}/{}".format(zz, len(self.dct_im_seg["im"])))
                         pbar.update(1)
 
-        for m in self.metric_lst:
-            fname_out = sct.add_suffix("".join(sct.extract_fname(self.param.fname_im)[1:]), '_' + m)
-            dct_metric[m].save(fname_out)
-            self.fname_metric_lst[m] = fname_out
-
     def reorient_data(self):
         for f in self.fname_metric_lst:
             os.rename(self.fname_metric_lst[f], sct.add_suffix("".join(sct.extract_fname(self.param.fname_im)[1:]), '_2reorient'))
@@ -301,6 +438,7 @@ class Param:
         self.verbose = 1
         self.dim = 'ax'
         self.rm_tmp = True
+        self.cpu_number = 0  # number of processes for the slice-wise computation (0: all available cores)
 
 
 class ParamGLCM(object):
@@ -310,6 +448,7 @@ class ParamGLCM(object):
         self.feature = 'contrast,dissimilarity,homogeneity,energy,correlation,ASM'  # The property formulae are detailed here: http://scikit-image.org/docs/dev/api/skimage.feature.html#greycoprops
         self.distance = 1  # Size of the window: distance = 1 --> a reference pixel and its immediate neighbor
         self.angle = '0,45,90,135'  # Rotation angles for co-occurrence matrix
+        self.method = 'vectorized'  # 'vectorized': all the windows of a slice at once, 'loop': voxel by voxel (skimage)
 
 
 def main(args=None):
@@ -351,6 +490,7 @@ def main(args=None):
         param.dim = arguments.dim
     if arguments.r is not None:
         param.rm_tmp = bool(arguments.r)
+    param.cpu_number = arguments.cpu_nb
     verbose = arguments.v
     sct.init_sct(log_level=verbose, update=True)  # Update log level
 
@@ -22,6 +22,7 @@ import argparse
 from spinalcordtoolbox.utils import Metavar, SmartFormatter
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.cropping import ImageCropper
+from spinalcordtoolbox import warping
 
 import sct_utils as sct
 import sct_image
@@ -98,6 +99,13 @@ def get_parser():
         required=False,
         default='spline',
         choices=('nn', 'linear', 'spline', 'label'))
+    optional.add_argument(
+        "-cpu-nb",
+        metavar=Metavar.int,
+        type=int,
+        help="Number of CPU cores used to resample the volumes of a 4D input. 0: use all available cores.",
+        required=False,
+        default=1)
     optional.add_argument(
         "-r",
         help="""Remove temporary files.""",
@@ -118,7 +126,7 @@ def get_parser():
 
 class Transform:
     def __init__(self, input_filename, fname_dest, list_warp, list_warpinv=[], output_filename='', verbose=0, crop=0,
-                 interp='spline', remove_temp_files=1, debug=0):
+                 interp='spline', remove_temp_files=1, debug=0, cpu_number=1):
         self.input_filename = input_filename
         self.list_warp = list_warp
         self.list_warpinv = list_warpinv
@@ -129,6 +137,7 @@ class Transform:
         self.verbose = verbose
         self.remove_temp_files = remove_temp_files
         self.debug = debug
+        self.cpu_number = cpu_number
 
     def apply(self):
         # Initialization
@@ -195,7 +204,7 @@ class Transform:
 
         # Get dimensions of data
         sct.printv('\nGet dimensions of data...', verbose)
-        img_src = Image(fname_src)
+        img_src = Image(fname_src, lazy=True)
         nx, ny, nz, nt, px, py, pz, pt = img_src.dim
         # nx, ny, nz, nt, px, py, pz, pt = sct.get_dimension(fname_src)
         sct.printv('  ' + str(nx) + ' x ' + str(ny) + ' x ' + str(nz) + ' x ' + str(nt), verbose)
@@ -228,7 +237,28 @@ class Transform:
                      '-t'
                      ] + fname_warp_list_invert + ['-r', fname_dest] + interp, verbose=verbose, is_sct_binary=True)
 
-        # if 4d, loop across the T dimension
+        # if 4d, resample each 3D volume in Python: the voxel coordinates of the destination space in the source space
+        # are computed once, and the volumes are streamed from the input file into the output array
+        elif not islabel and all(warping.is_supported(path_warp) for path_warp in list_warp):
+            dim = '4'
+            sct.printv('\nCompute transformation...', verbose)
+            im_dest = Image(fname_dest, lazy=True)
+            list_transfo = [warping.load_transfo(path_warp, inverse=path_warp in self.list_warpinv)
+                            for path_warp in list_warp]
+            coords = warping.compute_source_coordinates(list_transfo, im_dest, img_src.hdr.get_best_affine())
+
+            sct.printv('\nApply transformation to each 3D volume...', verbose)
+            # the volumes of an uncompressed file are read one at a time, but a compressed file is decompressed once:
+            # reading a volume from it decompresses the file from its beginning
+            data_src = img_src.dataobj if ext_src == '.nii' else img_src.data
+            data_out = warping.resample_4d(data_src, coords, interp=self.interp, cpu_number=self.cpu_number)
+            hdr_out = im_dest.hdr.copy()
+            hdr_out.set_data_shape(data_out.shape)
+            hdr_out.set_zooms(im_dest.hdr.get_zooms()[:3] + (pt,))
+            hdr_out.set_data_dtype(data_out.dtype)
+            Image(data_out, hdr=hdr_out).save(fname_out, verbose=0)
+
+        # otherwise, loop across the T dimension with ANTs
         else:
             if islabel:
                 raise NotImplementedError
@@ -367,6 +397,7 @@ def main(args=None):
     transform.output_filename = arguments.o
     transform.interp = arguments.x
     transform.remove_temp_files = arguments.r
+    transform.cpu_number = arguments.cpu_nb
     transform.verbose = arguments.v
     sct.init_sct(log_level=transform.verbose, update=True)  # Update log level
 
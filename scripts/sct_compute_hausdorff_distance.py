@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 #
 # Thinning with the Zhang-Suen algorithm (1984) --> code taken from  https://github.com/linbojin/Skeletonization-by-Zhang-Suen-Thinning-Algorithm
-# Computation of the distances between two skeleton
+# and vectorized with a lookup table of the configurations of the neighbours (see zhang_suen_lut)
+# Computation of the distances between two skeleton (nearest points found with a k-d tree)
 # ---------------------------------------------------------------------------------------
 # Copyright (c) 2013 Polytechnique Montreal <www.neuro.polymtl.ca>
 # Authors: Sara Dupont
@@ -13,8 +14,10 @@
 from __future__ import absolute_import, division
 
 import sys, io, os, time, shutil, argparse
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
+from scipy.spatial import cKDTree
 
 import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
@@ -32,13 +35,20 @@ class Param:
     def __init__(self):
         self.debug = 0
         self.thinning = True
+        self.cpu_number = 0  # number of threads for the slice-wise distances (0: all available cores)
         self.verbose = 1
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 # THINNING -------------------------------------------------------------------------------------------------------------
 class Thinning:
-    def __init__(self, im, v=1):
+    def __init__(self, im, v=1, method='lut'):
+        """
+        :param im: Image
+        :param v: verbose
+        :param method: {'lut', 'loop'}: 'lut' runs the vectorized algorithm (see zhang_suen_lut), on all the slices of
+        a 3D image at once. 'loop' runs the reference implementation (see Thinning.zhang_suen), pixel by pixel.
+        """
         sct.printv('Thinning ... ', v, 'normal')
         self.image = im
         self.image.data = bin_data(self.image.data)
@@ -46,7 +56,10 @@ class Thinning:
 
         if self.dim_im == 2:
             self.thinned_image = msct_image.empty_like(self.image)
-            self.thinned_image.data = self.zhang_suen(self.image.data)
+            if method == 'loop':
+                self.thinned_image.data = self.zhang_suen(self.image.data)
+            else:
+                self.thinned_image.data = zhang_suen_lut(self.image.data)
             self.thinned_image.absolutepath = sct.add_suffix(self.image.absolutepath, "_thinned")
 
         elif self.dim_im == 3:
@@ -54,7 +67,10 @@ class Thinning:
                 sct.printv('-- changing orientation ...')
                 self.image.change_orientation('IRP')
 
-            thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            if method == 'loop':
+                thinned_data = np.asarray([self.zhang_suen(im_slice) for im_slice in self.image.data])
+            else:
+                thinned_data = zhang_suen_lut(self.image.data)
 
             self.thinned_image = msct_image.empty_like(self.image)
             self.thinned_image.data = thinned_data
@@ -145,12 +161,81 @@ class Thinning:
         return image_thinned
 
 
+# Offsets of the 8-neighbours P2, P3, ..., P9 of a pixel P1, in clockwise order (see Thinning.get_neighbours)
+NEIGHBOURS_OFFSETS = [(-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1)]
+
+
+def get_zhang_suen_luts():
+    """
+    Lookup tables of the Zhang-Suen algorithm: the 8-neighbours of a pixel are encoded as an 8-bit code (bit k is the
+    value of the neighbour P(k+2)), and each table tells, for each of the 256 codes, if the pixel is removed by the
+    first or second sub-iteration (same conditions as Thinning.zhang_suen).
+    :return: lut1, lut2: boolean arrays of size 256
+    """
+    codes = np.arange(256)
+    P2, P3, P4, P5, P6, P7, P8, P9 = n = [(codes >> k) & 1 for k in range(8)]
+    transitions = sum((n[k] == 0) & (n[(k + 1) % 8] == 1) for k in range(8))  # Condition 2: S(P1)=1
+    cond = (2 <= sum(n)) & (sum(n) <= 6) & (transitions == 1)  # Condition 1: 2<= N(P1) <= 6
+    lut1 = cond & (P2 * P4 * P6 == 0) & (P4 * P6 * P8 == 0)
+    lut2 = cond & (P2 * P4 * P8 == 0) & (P2 * P6 * P8 == 0)
+    return lut1, lut2
+
+
+ZHANG_SUEN_LUTS = get_zhang_suen_luts()
+
+
+def zhang_suen_lut(data):
+    """
+    Vectorized Zhang-Suen thinning: at each sub-iteration, the neighbours of all the pixels are encoded at once, and
+    the pixels to remove are found in a lookup table (see get_zhang_suen_luts). Gives the same result as
+    Thinning.zhang_suen.
+    :param data: binary 2D array, or 3D array of 2D slices along the first axis, which are all thinned at once
+    :return: thinned array, same shape and type as data
+    """
+    image_thinned = data.copy()
+    # as in Thinning.zhang_suen, the pixels of the rows and columns 1 and n-1 (n: number of rows) are never removed
+    n_max = data.shape[-2] - 1
+    removable = np.ones(data.shape[-2:], dtype=bool)
+    removable[[1, n_max], :] = False
+    removable[:, [i for i in (1, n_max) if i < data.shape[-1]]] = False
+    # only process the bounding box of the foreground (with a margin of 1 pixel), unless it touches the borders of the
+    # image (as in Thinning.get_neighbours, the indices of the neighbours then wrap around the borders)
+    crop = (Ellipsis, slice(None), slice(None))
+    coord = np.argwhere(np.any(data > 0, axis=tuple(range(data.ndim - 2))))
+    if coord.size == 0:
+        return image_thinned
+    (xmin, ymin), (xmax, ymax) = coord.min(axis=0), coord.max(axis=0)
+    if xmin > 0 and ymin > 0 and xmax < data.shape[-2] - 1 and ymax < data.shape[-1] - 1:
+        crop = (Ellipsis, slice(xmin - 1, xmax + 2), slice(ymin - 1, ymax + 2))
+    view = image_thinned[crop]
+    removable = removable[crop[1:]]
+    pad = [(0, 0)] * (data.ndim - 2) + [(1, 1), (1, 1)]
+    nx, ny = view.shape[-2:]
+    changing = True
+    while changing:  # iterates until no further changes occur in the image
+        changing = False
+        for lut in ZHANG_SUEN_LUTS:
+            foreground = view > 0
+            foreground_pad = np.pad(foreground, pad, mode='wrap').view(np.uint8)
+            code = np.zeros(view.shape, dtype=np.uint8)
+            for k, (dx, dy) in enumerate(NEIGHBOURS_OFFSETS):
+                # value of the neighbour (x+dx, y+dy) of each pixel (x, y)
+                code |= foreground_pad[..., 1 + dx:1 + dx + nx, 1 + dy:1 + dy + ny] << np.uint8(k)
+            to_remove = foreground & removable & lut[code]
+            if to_remove.any():
+                view[to_remove] = 0
+                changing = True
+    return image_thinned
+
+
 # ----------------------------------------------------------------------------------------------------------------------
 # HAUSDORFF'S DISTANCE -------------------------------------------------------------------------------------------------
 class HausdorffDistance:
-    def __init__(self, data1, data2, v=1):
+    def __init__(self, data1, data2, v=1, method='kdtree'):
         """
         the hausdorff distance between two sets is the maximum of the distances from a point in any of the sets to the nearest point in the other set
+        :param method: {'kdtree', 'loop'}: 'kdtree' finds the nearest points with a k-d tree, 'loop' computes the
+        distances between all pairs of points (reference implementation)
         :return:
         """
         # now = time.time()
@@ -158,8 +243,12 @@ class HausdorffDistance:
         self.data1 = bin_data(data1)
         self.data2 = bin_data(data2)
 
-        self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
-        self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
+        if method == 'loop':
+            self.min_distances_1 = self.relative_hausdorff_dist(self.data1, self.data2, v)
+            self.min_distances_2 = self.relative_hausdorff_dist(self.data2, self.data1, v)
+        else:
+            self.min_distances_1 = self.relative_hausdorff_dist_kdtree(self.data1, self.data2, v)
+            self.min_distances_2 = self.relative_hausdorff_dist_kdtree(self.data2, self.data1, v)
 
         # relatives hausdorff's distances in pixel
         self.h1 = np.max(self.min_distances_1)
@@ -167,6 +256,12 @@ class HausdorffDistance:
 
         # Hausdorff's distance in pixel
         self.H = max(self.h1, self.h2)
+
+        # relative mean surface distances, and (symmetric) mean surface distance in pixel
+        dist1, dist2 = self.min_distances_1[self.data1 > 0], self.min_distances_2[self.data2 > 0]
+        self.m1 = np.mean(dist1) if dist1.size else 0.0
+        self.m2 = np.mean(dist2) if dist2.size else 0.0
+        self.M = (np.sum(dist1) + np.sum(dist2)) / max(dist1.size + dist2.size, 1)
         # t = time.time() - now
         # sct.printv('Hausdorff dist time :', t)
 
@@ -193,6 +288,21 @@ class HausdorffDistance:
             sct.printv('Warning: an image is empty', v, 'warning')
         return h
 
+    # ------------------------------------------------------------------------------------------------------------------
+    def relative_hausdorff_dist_kdtree(self, dat1, dat2, v=1):
+        """
+        Same as relative_hausdorff_dist, with the nearest point of dat2 to each point of dat1 found in a k-d tree.
+        :return: array of the shape of dat1, with the distance to the nearest point of dat2 at each point of dat1
+        """
+        h = np.zeros(dat1.shape)
+        coord_1 = np.argwhere(dat1 > 0)
+        coord_2 = np.argwhere(dat2 > 0)
+        if len(coord_1) != 0 and len(coord_2) != 0:
+            h[tuple(coord_1.T)], _ = cKDTree(coord_2).query(coord_1)
+        else:
+            sct.printv('Warning: an image is empty', v, 'warning')
+        return h
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 # COMPUTE DISTANCES ----------------------------------------------------------------------------------------------------
@@ -285,7 +395,8 @@ class ComputeDistances:
         self.distances = HausdorffDistance(dat1, dat2, self.param.verbose)
         self.res = 'Hausdorff\'s distance : ' + str(self.distances.H * self.dim_pix) + ' mm\n\n' \
                    'First relative Hausdorff\'s distance : ' + str(self.distances.h1 * self.dim_pix) + ' mm\n' \
-                   'Second relative Hausdorff\'s distance : ' + str(self.distances.h2 * self.dim_pix) + ' mm'
+                   'Second relative Hausdorff\'s distance : ' + str(self.distances.h2 * self.dim_pix) + ' mm\n\n' \
+                   'Mean surface distance : ' + str(self.distances.M * self.dim_pix) + ' mm'
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_1im_3d(self):
@@ -297,9 +408,7 @@ class ComputeDistances:
         else:
             dat1 = bin_data(self.im1.data)
 
-        self.distances = []
-        for i, dat_slice in enumerate(dat1[:-1]):
-            self.distances.append(HausdorffDistance(bin_data(dat_slice), bin_data(dat1[i + 1]), self.param.verbose))
+        self.distances = self.compute_dist_slices(dat1[:-1], dat1[1:])
 
     # ------------------------------------------------------------------------------------------------------------------
     def compute_dist_2im_3d(self):
@@ -316,9 +425,21 @@ class ComputeDistances:
             dat1 = bin_data(self.im1.data)
             dat2 = bin_data(self.im2.data)
 
-        self.distances = []
-        for slice1, slice2 in zip(dat1, dat2):
-            self.distances.append(HausdorffDistance(slice1, slice2, self.param.verbose))
+        self.distances = self.compute_dist_slices(dat1, dat2)
+
+    # ------------------------------------------------------------------------------------------------------------------
+    def compute_dist_slices(self, list_slice1, list_slice2):
+        """
+        Compute the distances between pairs of slices, in parallel (the k-d tree queries release the GIL)
+        :return: list of HausdorffDistance
+        """
+        pool = ThreadPool(self.param.cpu_number or None)
+        try:
+            return pool.map(lambda slices: HausdorffDistance(slices[0], slices[1], self.param.verbose),
+                            list(zip(list_slice1, list_slice2)))
+        finally:
+            pool.close()
+            pool.join()
 
     # ------------------------------------------------------------------------------------------------------------------
     def show_results(self):
@@ -477,6 +598,14 @@ def get_parser():
         metavar=Metavar.float,
         required=False,
         default=0.1)
+    optional.add_argument(
+        "-cpu-nb",
+        type=int,
+        help="Number of threads to compute the distances of the slices in parallel (3D images). 0: use all available "
+             "cores.",
+        metavar=Metavar.int,
+        required=False,
+        default=0)
     optional.add_argument(
         "-o",
         help='Name of the output file Example: my_hausdorff_dist.txt',
@@ -521,6 +650,7 @@ if __name__ == "__main__":
             resample_to = arguments.resampling
         if arguments.o is not None:
             output_fname = arguments.o
+        param.cpu_number = arguments.cpu_nb
         param.verbose = arguments.v
         sct.init_sct(log_level=param.verbose, update=True)  # Update log level
 
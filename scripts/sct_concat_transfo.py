@@ -19,6 +19,7 @@ import sys, os, functools, argparse
 
 import sct_utils as sct
 from spinalcordtoolbox.image import Image
+from spinalcordtoolbox import warping
 from spinalcordtoolbox.utils import Metavar, SmartFormatter
 
 class Param:
@@ -100,7 +101,7 @@ def main(args=None):
 
     # Get output folder and file name
     if fname_warp_final == '':
-        path_out, file_out, ext_out = sct.extract_fname(param.fname_warp_final)
+        path_out, file_out, ext_out = sct.extract_fname(Param().fname_warp_final)
     else:
         path_out, file_out, ext_out = sct.extract_fname(fname_warp_final)
 
@@ -111,8 +112,16 @@ def main(args=None):
     else:
         dimensionality = '3'
 
-    cmd = ['isct_ComposeMultiTransform', dimensionality, 'warp_final' + ext_out, '-R', fname_dest] + fname_warp_list_invert
-    status, output = sct.run(cmd, verbose=verbose, is_sct_binary=True)
+    if dimensionality == '3' and all(warping.is_supported(fname) for fname in fname_warp_list) \
+            and not any(fname.endswith(('.nii', '.nii.gz')) for fname in warpinv_filename):
+        # compose the transformations in Python, into a displacement field on the grid of the destination image
+        sct.printv('\nCompose transformations...', verbose)
+        output = ''
+        warping.load_composed_transfo(fname_warp_list, fname_dest, warpinv_filename).save('warp_final' + ext_out)
+    else:
+        cmd = ['isct_ComposeMultiTransform', dimensionality, 'warp_final' + ext_out, '-R', fname_dest] \
+              + fname_warp_list_invert
+        status, output = sct.run(cmd, verbose=verbose, is_sct_binary=True)
 
     # check if output was generated
     if not os.path.isfile('warp_final' + ext_out):
@@ -185,6 +194,5 @@ def get_parser():
 #=======================================================================================================================
 if __name__ == "__main__":
     sct.init_sct()
-    param = Param()
     # call main function
     main()
@@ -178,7 +178,7 @@ def create_mask(param):
     path_tmp = sct.tmp_create(basename="create_mask", verbose=param.verbose)
 
     sct.printv('\nOrientation:', param.verbose)
-    orientation_input = Image(param.fname_data).orientation
+    orientation_input = Image(param.fname_data, lazy=True).orientation
     sct.printv('  ' + orientation_input, param.verbose)
 
     # copy input data to tmp folder and re-orient to RPI
@@ -214,11 +214,8 @@ def create_mask(param):
         # get file name
         # extract coordinate of point
         sct.printv('\nExtract coordinate of point...', param.verbose)
-        # TODO: change this way to remove dependence to sct.run. ProcessLabels.display_voxel returns list of coordinates
-        status, output = sct.run(['sct_label_utils', '-i', 'point_RPI.nii', '-display'], verbose=param.verbose)
-        # parse to get coordinate
-        # TODO fixup... this is quite magic
-        coord = output[output.find('Position=') + 10:-17].split(',')
+        coordinates = Image('point_RPI.nii').get_nonzero_coordinates(sorting='value')
+        coord = [coordinates['x'][0], coordinates['y'][0]]
 
     if method_type == 'center':
         # set coordinate at center of FOV
@@ -15,6 +15,7 @@ import os
 import argparse
 
 import sct_utils as sct
+from spinalcordtoolbox import inference
 from spinalcordtoolbox.utils import Metavar, SmartFormatter
 
 from spinalcordtoolbox.reports.qc import generate_qc
@@ -84,6 +85,14 @@ def get_parser():
              "Better results, but takes more time and "
              "provides non-deterministic results.",
         metavar='')
+    misc.add_argument(
+        "-tta-margin",
+        type=float,
+        help="With TTA (-t), only augment the slices where the prediction is uncertain, i.e. where some pixels are "
+             "within this margin of the threshold (or of 0.5 if there is no threshold). The other slices are not "
+             "augmented, which is faster. Example: 0.2",
+        metavar=Metavar.float,
+        default=None)
     misc.add_argument(
         "-v",
         type=int,
@@ -94,9 +103,17 @@ def get_parser():
     return parser
 
 
-def run_main():
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    # run in the inference worker, if it is running (see sct_inference_worker)
+    status = inference.forward('sct_deepseg_gm', args)
+    if status is not None:
+        if status != 0:
+            sys.exit(status)
+        return
     parser = get_parser()
-    arguments = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    arguments = parser.parse_args(args=args if args else ['--help'])
     input_filename = arguments.i
     if arguments.o is not None:
         output_filename = arguments.o
@@ -121,13 +138,13 @@ def run_main():
 
     out_fname = deepseg_gm.segment_file(input_filename, output_filename,
                                         model_name, threshold, int(verbose),
-                                        use_tta)
+                                        use_tta, arguments.tta_margin)
 
     path_qc = arguments.qc
     qc_dataset = arguments.qc_dataset
     qc_subject = arguments.qc_subject
     if path_qc is not None:
-        generate_qc(fname_in1=input_filename, fname_seg=out_fname, args=sys.argv[1:], path_qc=os.path.abspath(path_qc),
+        generate_qc(fname_in1=input_filename, fname_seg=out_fname, args=args, path_qc=os.path.abspath(path_qc),
                     dataset=qc_dataset, subject=qc_subject, process='sct_deepseg_gm')
 
     sct.display_viewer_syntax([input_filename, format(out_fname)],
@@ -138,4 +155,4 @@ def run_main():
 
 if __name__ == '__main__':
     sct.init_sct()
-    run_main()
+    main()
@@ -21,6 +21,7 @@ import argparse
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, ActionCreateFolder
 
 import sct_utils as sct
+from spinalcordtoolbox import inference
 
 
 def get_parser():
@@ -111,34 +112,42 @@ def get_parser():
     return parser
 
 
-def main():
+def main(args=None):
     """Main function."""
+    if args is None:
+        args = sys.argv[1:]
+    # run in the inference worker, if it is running (see sct_inference_worker)
+    status = inference.forward('sct_deepseg_lesion', args)
+    if status is not None:
+        if status != 0:
+            sys.exit(status)
+        return
     parser = get_parser()
-    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    arguments = parser.parse_args(args=args if args else ['--help'])
 
-    fname_image = args.i
-    contrast_type = args.c
+    fname_image = arguments.i
+    contrast_type = arguments.c
 
-    ctr_algo = args.centerline
+    ctr_algo = arguments.centerline
 
-    brain_bool = bool(args.brain)
-    if args.brain is None and contrast_type in ['t2s', 't2_ax']:
+    brain_bool = bool(arguments.brain)
+    if arguments.brain is None and contrast_type in ['t2s', 't2_ax']:
         brain_bool = False
 
-    output_folder = args.ofolder
+    output_folder = arguments.ofolder
 
-    if ctr_algo == 'file' and args.file_centerline is None:
+    if ctr_algo == 'file' and arguments.file_centerline is None:
         sct.printv('Please use the flag -file_centerline to indicate the centerline filename.', 1, 'error')
         sys.exit(1)
 
-    if args.file_centerline is not None:
-        manual_centerline_fname = args.file_centerline
+    if arguments.file_centerline is not None:
+        manual_centerline_fname = arguments.file_centerline
         ctr_algo = 'file'
     else:
         manual_centerline_fname = None
 
-    remove_temp_files = args.r
-    verbose = args.v
+    remove_temp_files = arguments.r
+    verbose = arguments.v
     sct.init_sct(log_level=verbose, update=True)  # Update log level
 
     algo_config_stg = '\nMethod:'
@@ -18,6 +18,7 @@ import sys
 import argparse
 
 import sct_utils as sct
+from spinalcordtoolbox import inference, cache
 from spinalcordtoolbox.utils import Metavar, SmartFormatter, ActionCreateFolder
 
 
@@ -27,7 +28,7 @@ def get_parser():
     parser = argparse.ArgumentParser(
         description="Spinal Cord Segmentation using convolutional networks. Reference: Gros et al. Automatic "
                     "segmentation of the spinal cord and intramedullary multiple sclerosis lesions with convolutional "
-                    "neural networks. Neuroimage. 2018 Oct 6;184:901-915. ",
+                    "neural networks. Neuroimage. 2018 Oct 6;184:901-915. " + cache.HELP,
         formatter_class=SmartFormatter,
         add_help=None,
         prog=os.path.basename(__file__).strip(".py"))
@@ -124,57 +125,65 @@ def get_parser():
     return parser
 
 
-def main():
+def main(args=None):
     """Main function."""
+    if args is None:
+        args = sys.argv[1:]
+    # run in the inference worker, if it is running (see sct_inference_worker)
+    status = inference.forward('sct_deepseg_sc', args)
+    if status is not None:
+        if status != 0:
+            sys.exit(status)
+        return
     parser = get_parser()
-    args = parser.parse_args(args=None if sys.argv[1:] else ['--help'])
+    arguments = parser.parse_args(args=args if args else ['--help'])
 
-    fname_image = os.path.abspath(args.i)
-    contrast_type = args.c
+    fname_image = os.path.abspath(arguments.i)
+    contrast_type = arguments.c
 
-    ctr_algo = args.centerline
+    ctr_algo = arguments.centerline
 
-    if args.brain is None:
+    if arguments.brain is None:
         if contrast_type in ['t2s', 'dwi']:
             brain_bool = False
         if contrast_type in ['t1', 't2']:
             brain_bool = True
     else:
-        brain_bool = bool(args.brain)
+        brain_bool = bool(arguments.brain)
 
-    if bool(args.brain) and ctr_algo == 'svm':
+    if bool(arguments.brain) and ctr_algo == 'svm':
         sct.printv('Please only use the flag "-brain 1" with "-centerline cnn".', 1, 'warning')
         sys.exit(1)
 
-    kernel_size = args.kernel
+    kernel_size = arguments.kernel
     if kernel_size == '3d' and contrast_type == 'dwi':
         kernel_size = '2d'
         sct.printv('3D kernel model for dwi contrast is not available. 2D kernel model is used instead.',
                    type="warning")
 
-    if ctr_algo == 'file' and args.file_centerline is None:
+    if ctr_algo == 'file' and arguments.file_centerline is None:
         sct.printv('Please use the flag -file_centerline to indicate the centerline filename.', 1, 'warning')
         sys.exit(1)
 
-    if args.file_centerline is not None:
-        manual_centerline_fname = args.file_centerline
+    if arguments.file_centerline is not None:
+        manual_centerline_fname = arguments.file_centerline
         ctr_algo = 'file'
     else:
         manual_centerline_fname = None
 
-    threshold = args.thr
+    threshold = arguments.thr
     if threshold is not None:
         if threshold > 1.0 or (threshold < 0.0 and threshold != -1.0):
             raise SyntaxError("Threshold should be between 0 and 1, or equal to -1 (no threshold)")
 
-    remove_temp_files = args.r
-    verbose = args.v
+    remove_temp_files = arguments.r
+    verbose = arguments.v
     sct.init_sct(log_level=verbose, update=True)  # Update log level
 
-    path_qc = args.qc
-    qc_dataset = args.qc_dataset
-    qc_subject = args.qc_subject
-    output_folder = args.ofolder
+    path_qc = arguments.qc
+    qc_dataset = arguments.qc_dataset
+    qc_subject = arguments.qc_subject
+    output_folder = arguments.ofolder
 
     # check if input image is 2D or 3D
     sct.check_dim(fname_image, dim_lst=[2, 3])
@@ -184,21 +193,32 @@ def main():
     from spinalcordtoolbox.deepseg_sc.core import deep_segmentation_spinalcord
     from spinalcordtoolbox.reports.qc import generate_qc
 
-    im_image = Image(fname_image)
-    # note: below we pass im_image.copy() otherwise the field absolutepath becomes None after execution of this function
-    im_seg, im_image_RPI_upsamp, im_seg_RPI_upsamp = \
-        deep_segmentation_spinalcord(im_image.copy(), contrast_type, ctr_algo=ctr_algo,
-                                     ctr_file=manual_centerline_fname, brain_bool=brain_bool, kernel_size=kernel_size,
-                                     threshold_seg=threshold, remove_temp_files=remove_temp_files, verbose=verbose)
-
-    # Save segmentation
     fname_seg = os.path.abspath(os.path.join(output_folder, sct.extract_fname(fname_image)[1] + '_seg' +
                                              sct.extract_fname(fname_image)[2]))
-    im_seg.save(fname_seg)
+
+    # the segmentation of a previous run with the same inputs and parameters is reused (see spinalcordtoolbox.cache),
+    # unless the centerline is drawn in the viewer, which is not an input of the step
+    step_cache = cache.get_cache() if ctr_algo != 'viewer' else None
+    with cache.Step(step_cache, 'sct_deepseg_sc', input_files=[fname_image, manual_centerline_fname],
+                    params={'contrast': contrast_type, 'centerline': ctr_algo, 'brain': brain_bool,
+                            'kernel': kernel_size, 'threshold': threshold},
+                    outputs=[fname_seg]) as step:
+        if not step.hit:
+            im_image = Image(fname_image)
+            # note: below we pass im_image.copy() otherwise the field absolutepath becomes None after execution of this
+            # function
+            im_seg, im_image_RPI_upsamp, im_seg_RPI_upsamp = \
+                deep_segmentation_spinalcord(im_image.copy(), contrast_type, ctr_algo=ctr_algo,
+                                             ctr_file=manual_centerline_fname, brain_bool=brain_bool,
+                                             kernel_size=kernel_size, threshold_seg=threshold,
+                                             remove_temp_files=remove_temp_files, verbose=verbose)
+
+            # Save segmentation
+            im_seg.save(fname_seg)
 
     # Generate QC report
     if path_qc is not None:
-        generate_qc(fname_image, fname_seg=fname_seg, args=sys.argv[1:], path_qc=os.path.abspath(path_qc),
+        generate_qc(fname_image, fname_seg=fname_seg, args=args, path_qc=os.path.abspath(path_qc),
                     dataset=qc_dataset, subject=qc_subject, process='sct_deepseg_sc')
     sct.display_viewer_syntax([fname_image, fname_seg], colormaps=['gray', 'red'], opacities=['', '0.7'])
 
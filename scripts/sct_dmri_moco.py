@@ -79,6 +79,7 @@ class Param:
         self.otsu = 0  # use otsu algorithm to segment dwi data for better moco. Value coresponds to data threshold. For no segmentation set to 0.
         self.iterAvg = 1  # iteratively average target image for more robust moco
         self.is_sagittal = False  # if True, then split along Z (right-left) and register each 2D slice (vs. 3D volume)
+        self.cpu_number = 0  # number of CPU cores shared by the registrations and ITK. 0: all available cores.
 # Note: this feature is currently ONLY supported by sct_fmri_moco (not here).
 
     # update constructor with user's parameters
@@ -182,6 +183,14 @@ def get_parser():
                       mandatory=False,
                       default_value='./',
                       example='dmri_moco_results/')
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU cores used for motion correction. Volumes are registered in parallel, "
+                                  "and the cores are shared with ITK threads. 0: use all available cores (or "
+                                  "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS if defined).",
+                      mandatory=False,
+                      default_value=param_default.cpu_number,
+                      example=['0', '4'])
     parser.usage.addSection('MISC')
     parser.add_option(name="-r",
                       type_value="multiple_choice",
@@ -213,7 +222,7 @@ def main(args=None):
 
     # Get parser info
     parser = get_parser()
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
 
     param.fname_data = arguments['-i']
     param.fname_bvecs = arguments['-bvec']
@@ -236,6 +245,8 @@ def main(args=None):
         path_out = arguments['-ofolder']
     if '-r' in arguments:
         param.remove_temp_files = int(arguments['-r'])
+    if '-cpu-nb' in arguments:
+        param.cpu_number = arguments['-cpu-nb']
     param.verbose = int(arguments.get('-v'))
     sct.init_sct(log_level=param.verbose, update=True)  # Update log level
 
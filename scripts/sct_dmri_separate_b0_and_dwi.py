@@ -94,6 +94,20 @@ def get_parser():
 
 # MAIN
 # ==========================================================================================
+def average_data(im):
+    """
+    Average an image along time (same as: sct_maths -mean t)
+    :param im: Image: 3D or 4D image
+    :return: Image: averaged image
+    """
+    im_mean = im.copy()
+    data = im.data
+    if data.ndim < 4:
+        data = data[..., np.newaxis]
+    im_mean.data = np.mean(data, 3)
+    return im_mean
+
+
 def main(args=None):
     if not args:
         args = sys.argv[1:]
@@ -185,7 +199,7 @@ def main(args=None):
     # Average b=0 images
     if average:
         sct.printv('\nAverage b=0...', verbose)
-        sct.run(['sct_maths', '-i', b0_name + ext, '-o', b0_mean_name + ext, '-mean', 't'], verbose)
+        average_data(im_out).save(b0_mean_name + ext)
 
     # Merge DWI
     l = []
@@ -196,7 +210,7 @@ def main(args=None):
     # Average DWI images
     if average:
         sct.printv('\nAverage DWI...', verbose)
-        sct.run(['sct_maths', '-i', dwi_name + ext, '-o', dwi_mean_name + ext, '-mean', 't'], verbose)
+        average_data(im_out).save(dwi_mean_name + ext)
 
     # come back
     os.chdir(curdir)
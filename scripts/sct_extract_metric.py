@@ -24,7 +24,7 @@ import sys, os
 
 import numpy as np
 
-from spinalcordtoolbox.metadata import read_label_file
+from spinalcordtoolbox.metadata import read_label_file, load_sparse_labels
 from spinalcordtoolbox.utils import parse_num_list
 from spinalcordtoolbox.aggregate_slicewise import check_labels, extract_metric, save_as_csv, Metric, LabelStruc
 import sct_utils as sct
@@ -59,10 +59,12 @@ def get_parser():
     parser.usage.set_description("""This program extracts metrics (e.g., DTI or MTR) within labels. Labels could be a single file or a folder generated with 'sct_warp_template' and containing multiple label files and a label description file (info_label.txt). The labels should be in the same space coordinates as the input image.""")
     # Mandatory arguments
     parser.add_option(name='-i',
-                      type_value='image_nifti',
-                      description='File to extract metrics from.',
+                      type_value=[[','], 'image_nifti'],
+                      description='File to extract metrics from. Several files can be separated with ",": the labels '
+                                  'are then loaded once, and the results of all files are written in the same output '
+                                  'file.',
                       mandatory=True,
-                      example='FA.nii.gz')
+                      example='FA.nii.gz,MD.nii.gz')
     # Optional arguments
     parser.add_option(name='-f',
                       type_value='folder',
@@ -226,7 +228,8 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
          fname_vertebral_labeling="", perslice=1, perlevel=1, verbose=1, combine_labels=True):
     """
     Extract metrics from MRI data based on mask (could be single file of folder to atlas)
-    :param fname_data: data to extract metric from
+    :param fname_data: data to extract metric from. Could be a list of files: the labels are loaded once, and the
+           metrics are extracted within each label in a single pass.
     :param path_label: mask: could be single file or folder to atlas (which contains info_label.txt)
     :param method {'wa', 'bin', 'ml', 'map'}
     :param slices. Slices of interest. Accepted format:
@@ -303,29 +306,30 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
     nb_labels = len(indiv_labels_files)
 
     # Load data and systematically reorient to RPI because we need the 3rd dimension to be z
+    if not isinstance(fname_data, list):
+        fname_data = [fname_data]
     sct.printv('\nLoad metric image...', verbose)
-    input_im = Image(fname_data).change_orientation("RPI")
-
-    data = Metric(data=input_im.data, label='')
-    # Load labels
-    labels_tmp = np.empty([nb_labels], dtype=object)
-    for i_label in range(nb_labels):
-        im_label = Image(os.path.join(path_label, indiv_labels_files[i_label])).change_orientation("RPI")
-        labels_tmp[i_label] = np.expand_dims(im_label.data, 3)  # TODO: generalize to 2D input label
-    labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
+    list_data = [Metric(data=Image(fname).change_orientation("RPI").data, label='') for fname in fname_data]
+    # Load labels: from their sparse copy if available (see sct_warp_template), otherwise from the label files
+    sparse_labels = load_sparse_labels(path_label, param_default.file_info_label) if path_label else None
+    if sparse_labels is not None:
+        labels = sparse_labels.get_data_all()  # labels: (x,y,z,label)
+    else:
+        labels_tmp = np.empty([nb_labels], dtype=object)
+        for i_label in range(nb_labels):
+            im_label = Image(os.path.join(path_label, indiv_labels_files[i_label])).change_orientation("RPI")
+            labels_tmp[i_label] = np.expand_dims(im_label.data, 3)  # TODO: generalize to 2D input label
+        labels = np.concatenate(labels_tmp[:], 3)  # labels: (x,y,z,label)
     # Load vertebral levels
-    if vertebral_levels:
+    if levels:
         im_vertebral_labeling = Image(fname_vertebral_labeling).change_orientation("RPI")
     else:
         im_vertebral_labeling = None
 
-    # Get dimensions of data and labels
-    nx, ny, nz = data.data.shape
-    nx_atlas, ny_atlas, nz_atlas, nt_atlas = labels.shape
-
     # Check dimensions consistency between atlas and data
-    if (nx, ny, nz) != (nx_atlas, ny_atlas, nz_atlas):
-        sct.printv('\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.', 1, type='error')
+    for data in list_data:
+        if data.data.shape != labels.shape[:-1]:
+            sct.printv('\nERROR: Metric data and labels DO NOT HAVE SAME DIMENSIONS.', 1, type='error')
 
     # Combine individual labels for estimation
     if combine_labels:
@@ -336,12 +340,14 @@ def main(fname_data, path_label, method, slices, levels, fname_output, labels_us
 
     for id_label in labels_id_user:
         sct.printv('Estimation for label: '+label_struc[id_label].name, verbose)
-        agg_metric = extract_metric(data, labels=labels, slices=slices, levels=levels, perslice=perslice,
-                                    perlevel=perlevel, vert_level=im_vertebral_labeling, method=method,
-                                    label_struc=label_struc, id_label=id_label, indiv_labels_ids=indiv_labels_ids)
-
-        save_as_csv(agg_metric, fname_output, fname_in=fname_data, append=append_csv)
-        append_csv = True  # when looping across labels, need to append results in the same file
+        list_agg_metric = extract_metric(list_data, labels=labels, slices=slices, levels=levels, perslice=perslice,
+                                         perlevel=perlevel, vert_level=im_vertebral_labeling, method=method,
+                                         label_struc=label_struc, id_label=id_label,
+                                         indiv_labels_ids=indiv_labels_ids)
+
+        for fname, agg_metric in zip(fname_data, list_agg_metric):
+            save_as_csv(agg_metric, fname_output, fname_in=fname, append=append_csv)
+            append_csv = True  # when looping across labels and metrics, need to append results in the same file
     sct.display_open(fname_output)
 
 
@@ -355,7 +361,7 @@ if __name__ == "__main__":
     arguments = parser.parse(sys.argv[1:])
 
     overwrite = 0
-    fname_data = sct.get_absolute_path(arguments['-i'])
+    fname_data = [sct.get_absolute_path(fname) for fname in arguments['-i']]
     path_label = arguments['-f']
     method = arguments['-method']
     fname_output = arguments['-o']
@@ -63,6 +63,7 @@ class Param:
         self.iterAvg = 1  # iteratively average target image for more robust moco
         self.num_target = '0'
         self.is_sagittal = False  # if True, then split along Z (right-left) and register each 2D slice (vs. 3D volume)
+        self.cpu_number = 0  # number of CPU cores shared by the registrations and ITK. 0: all available cores.
         self.output_motion_param = True  # if True, the motion parameters are outputted
 
     # update constructor with user's parameters
@@ -139,6 +140,14 @@ The outputs of the motion correction process are:
                       mandatory=False,
                       default_value='linear',
                       example=['nn', 'linear', 'spline'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of CPU cores used for motion correction. Volumes are registered in parallel, "
+                                  "and the cores are shared with ITK threads. 0: use all available cores (or "
+                                  "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS if defined).",
+                      mandatory=False,
+                      default_value=param_default.cpu_number,
+                      example=['0', '4'])
     parser.add_option(name="-r",
                       type_value="multiple_choice",
                       description="""Remove temporary files.""",
@@ -169,7 +178,7 @@ def main(args=None):
 
     # Get parser info
     parser = get_parser()
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
 
     param.fname_data = arguments['-i']
     if '-g' in arguments:
@@ -184,6 +193,8 @@ def main(args=None):
         path_out = arguments['-ofolder']
     if '-r' in arguments:
         param.remove_temp_files = int(arguments['-r'])
+    if '-cpu-nb' in arguments:
+        param.cpu_number = arguments['-cpu-nb']
     param.verbose = int(arguments.get('-v'))
     sct.init_sct(log_level=param.verbose, update=True)  # Update log level
 
@@ -434,7 +434,7 @@ def concat_warp2d(fname_list, fname_warp3d, fname_dest):
     Concatenate 2d warping fields into a 3d warping field along z dimension. The 3rd dimension of the resulting warping
     field will be zeroed.
     :param
-    fname_list: list of 2d warping fields (along X and Y).
+    fname_list: list of 2d warping fields (along X and Y): file names, or arrays already loaded.
     fname_warp3d: output name of 3d warping field
     fname_dest: 3d destination file (used to copy header information)
     :return: none
@@ -445,12 +445,15 @@ def concat_warp2d(fname_list, fname_warp3d, fname_dest):
     # get dimensions
     # nib.load(fname_list[0])
     # im_0 = Image(fname_list[0])
-    nx, ny = nib.load(fname_list[0]).shape[0:2]
+    def load_warp2d(fname):
+        return fname if isinstance(fname, np.ndarray) else nib.load(fname).get_data()
+
+    nx, ny = load_warp2d(fname_list[0]).shape[0:2]
     nz = len(fname_list)
     # warp3d = tuple([nx, ny, nz, 1, 3])
     warp3d = zeros([nx, ny, nz, 1, 3])
     for iz, fname in enumerate(fname_list):
-        warp2d = nib.load(fname).get_data()
+        warp2d = load_warp2d(fname)
         warp3d[:, :, iz, 0, 0] = warp2d[:, :, 0, 0, 0]
         warp3d[:, :, iz, 0, 1] = warp2d[:, :, 0, 0, 1]
         del warp2d
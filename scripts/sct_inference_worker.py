@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+#########################################################################################
+#
+# Long-lived worker which keeps the deep learning models in memory, for sct_deepseg_sc, sct_deepseg_gm and
+# sct_deepseg_lesion.
+#
+# ---------------------------------------------------------------------------------------
+# Copyright (c) 2019 Polytechnique Montreal <www.neuro.polymtl.ca>
+#
+# About the license: see the file LICENSE.TXT
+#########################################################################################
+
+from __future__ import absolute_import
+
+import os
+import argparse
+
+import sct_utils as sct
+from spinalcordtoolbox import inference
+from spinalcordtoolbox.utils import Metavar, SmartFormatter
+
+
+def get_parser():
+    """Initialize the parser."""
+    parser = argparse.ArgumentParser(
+        description="Run a worker which keeps TensorFlow and the deep learning models loaded in memory. While it is "
+                    "running, sct_deepseg_sc, sct_deepseg_gm and sct_deepseg_lesion send their arguments to the "
+                    "worker, which runs them without reloading the models. This saves the startup time of each "
+                    "call when processing many images. The worker runs the requests one at a time, in the folder "
+                    "of the caller, until it is stopped (with -stop, or with Ctrl+C).",
+        formatter_class=SmartFormatter,
+        add_help=None,
+        prog=os.path.basename(__file__).strip(".py"))
+
+    optional = parser.add_argument_group("\nOPTIONAL ARGUMENTS")
+    optional.add_argument(
+        "-h",
+        "--help",
+        action="help",
+        help="show this help message and exit")
+    optional.add_argument(
+        "-stop",
+        action="store_true",
+        help="Stop the running worker.")
+    optional.add_argument(
+        "-status",
+        action="store_true",
+        help="Print whether the worker is running.")
+    optional.add_argument(
+        "-cache-size",
+        type=int,
+        metavar=Metavar.int,
+        default=inference.MODEL_CACHE_SIZE,
+        help="Maximum number of models kept in memory. The least recently used models are unloaded first.")
+    optional.add_argument(
+        "-socket",
+        metavar=Metavar.file,
+        default=inference.get_worker_address(),
+        help="Path of the Unix socket used to communicate with the worker. The scripts use the socket given by the "
+             "environment variable SCT_INFERENCE_WORKER, or the default one.")
+    optional.add_argument(
+        "-v",
+        type=int,
+        help="Verbose: 0 = nothing, 1 = classic, 2 = expended",
+        choices=(0, 1, 2),
+        default=1)
+    return parser
+
+
+def main(args=None):
+    parser = get_parser()
+    arguments = parser.parse_args(args=args)
+    sct.init_sct(log_level=arguments.v, update=True)  # Update log level
+
+    if arguments.status:
+        running = inference.is_running(arguments.socket)
+        sct.printv("Inference worker is {}: {}".format("running" if running else "not running", arguments.socket))
+    elif arguments.stop:
+        if inference.stop(arguments.socket):
+            sct.printv("Inference worker stopped: {}".format(arguments.socket))
+        else:
+            sct.printv("No inference worker running: {}".format(arguments.socket), type='warning')
+    else:
+        try:
+            inference.serve(arguments.socket, cache_size=arguments.cache_size)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    sct.init_sct()
+    main()
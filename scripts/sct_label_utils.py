@@ -186,11 +186,11 @@ class ProcessLabels(object):
         image_output = self.image_input.copy()
         # image_output.data *= 0
 
-        coordinates_input = self.image_input.getNonZeroCoordinates()
+        coordinates_input = self.image_input.get_nonzero_coordinates()
 
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = image_output.data[int(coord.x), int(coord.y), int(coord.z)] + float(value)
+        # add value to all non-zero voxels
+        index = coordinates_input['x'], coordinates_input['y'], coordinates_input['z']
+        image_output.data[index] = image_output.data[index] + float(value)
         return image_output
 
     def create_label(self, add=False):
@@ -317,20 +317,11 @@ class ProcessLabels(object):
         # 0. Initialization of output image
         output_image = msct_image.zeros_like(self.image_input)
 
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.image_input.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
+        # 1. Compute the center of mass of each group of voxels having the same value
+        centers_of_mass = self.image_input.getCoordinatesAveragedByValue()
 
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        for value, list_coord in groups.items():
-            center_of_mass = sum(list_coord) / float(len(list_coord))
+        # 2. Write them into the output image
+        for center_of_mass in centers_of_mass:
             sct.printv("Value = " + str(center_of_mass.value) + " : (" + str(center_of_mass.x) + ", " + str(center_of_mass.y) + ", " + str(center_of_mass.z) + ") --> ( " + str(np.round(center_of_mass.x)) + ", " + str(np.round(center_of_mass.y)) + ", " + str(np.round(center_of_mass.z)) + ")", verbose=self.verbose)
             output_image.data[int(np.round(center_of_mass.x)), int(np.round(center_of_mass.y)), int(np.round(center_of_mass.z))] = center_of_mass.value
 
@@ -343,11 +334,11 @@ class ProcessLabels(object):
         """
         image_output = msct_image.zeros_like(self.image_input)
 
-        coordinates_input = self.image_input.getNonZeroCoordinates(sorting='z', reverse_coord=True)
+        coordinates_input = self.image_input.get_nonzero_coordinates(sorting='z', reverse_coord=True)
 
-        # for all points with non-zeros neighbors, force the neighbors to 0
-        for i, coord in enumerate(coordinates_input):
-            image_output.data[int(coord.x), int(coord.y), int(coord.z)] = i + 1
+        # attribute values 1, 2, 3, etc. along the inverse z direction
+        image_output.data[coordinates_input['x'], coordinates_input['y'], coordinates_input['z']] = \
+            np.arange(1, len(coordinates_input) + 1)
 
         return image_output
 
@@ -360,14 +351,15 @@ class ProcessLabels(object):
         """
         image_output = msct_image.zeros_like(self.image_input)
 
-        coordinates_input = self.image_input.getNonZeroCoordinates()
-        coordinates_ref = self.image_ref.getNonZeroCoordinates(sorting='value')
+        coordinates_input = self.image_input.get_nonzero_coordinates()
+        coordinates_ref = self.image_ref.get_nonzero_coordinates(sorting='value')
 
         # for all points in input, find the value that has to be set up, depending on the vertebral level
-        for i, coord in enumerate(coordinates_input):
-            for j in range(0, len(coordinates_ref) - 1):
-                if coordinates_ref[j + 1].z < coord.z <= coordinates_ref[j].z:
-                    image_output.data[int(coord.x), int(coord.y), int(coord.z)] = coordinates_ref[j].value
+        for j in range(0, len(coordinates_ref) - 1):
+            is_level = (coordinates_ref['z'][j + 1] < coordinates_input['z']) & \
+                       (coordinates_input['z'] <= coordinates_ref['z'][j])
+            image_output.data[coordinates_input['x'][is_level], coordinates_input['y'][is_level],
+                              coordinates_input['z'][is_level]] = coordinates_ref['value'][j]
 
         return image_output
 
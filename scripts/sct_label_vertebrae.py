@@ -25,6 +25,7 @@ from spinalcordtoolbox.vertebrae.core import create_label_z, get_z_and_disc_valu
     clean_labeled_segmentation, label_discs, label_vert
 from spinalcordtoolbox.vertebrae.detect_c2c3 import detect_c2c3
 from spinalcordtoolbox.reports.qc import generate_qc
+from spinalcordtoolbox import cache
 import sct_straighten_spinalcord
 
 
@@ -62,7 +63,8 @@ def get_parser():
     parser.usage.set_description('''This function takes an anatomical image and its cord segmentation (binary file), and outputs the cord segmentation labeled with vertebral level. The algorithm requires an initialization (first disc) and then performs a disc search in the superior, then inferior direction, using template disc matching based on mutual information score. The automatic method uses the module implemented in "spinalcordtoolbox/vertebrae/detect_c2c3.py" to detect the C2-C3 disc.
     Tips: To run the function with init txt file that includes flags -initz/-initcenter:
     sct_label_vertebrae -i t2.nii.gz -s t2_seg_manual.nii.gz  "$(< init_label_vertebrae.txt)"
-    ''')
+
+    ''' + cache.HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="input image.",
@@ -239,27 +241,22 @@ def main(args=None):
 
     # Straighten spinal cord
     sct.printv('\nStraighten spinal cord...', verbose)
-    # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-    cache_sig = sct.cache_signature(
-     input_files=[fname_in, fname_seg],
-    )
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, "warp_curve2straight.nii.gz")) and os.path.isfile(os.path.join(curdir, "warp_straight2curve.nii.gz")) and os.path.isfile(os.path.join(curdir, "straight_ref.nii.gz")):
-        # if they exist, copy them into current folder
-        sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, "warp_curve2straight.nii.gz"), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, "warp_straight2curve.nii.gz"), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, "straight_ref.nii.gz"), 'straight_ref.nii.gz')
-        # apply straightening
-        s, o = sct.run(['sct_apply_transfo', '-i', 'data.nii', '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'data_straight.nii'])
-    else:
-        sct_straighten_spinalcord.main(args=[
-            '-i', 'data.nii',
-            '-s', 'segmentation.nii',
-            '-r', str(remove_temp_files),
-            '-v', str(verbose),
-        ])
-        sct.cache_save(cachefile, cache_sig)
+    # reuse the warping fields if the spinal cord was already straightened with the same inputs (see
+    # spinalcordtoolbox.cache)
+    with cache.step('sct_label_vertebrae.straightening', input_files=[fname_in, fname_seg],
+                    outputs=['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz', 'straight_ref.nii.gz']) \
+            as step:
+        if step.hit:
+            sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
+            # apply straightening
+            s, o = sct.run(['sct_apply_transfo', '-i', 'data.nii', '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'data_straight.nii'])
+        else:
+            sct_straighten_spinalcord.main(args=[
+                '-i', 'data.nii',
+                '-s', 'segmentation.nii',
+                '-r', str(remove_temp_files),
+                '-v', str(verbose),
+            ])
 
     # resample to 0.5mm isotropic to match template resolution
     sct.printv('\nResample to 0.5mm isotropic...', verbose)
@@ -52,7 +52,6 @@ import signal
 path_script = os.path.dirname(__file__)
 sys.path.append(os.path.join(sct.__sct_dir__, 'testing'))
 
-import concurrent.futures
 if "SCT_MPI_MODE" in os.environ:
     from mpi4py.futures import MPIPoolExecutor as PoolExecutor
     __MPI__ = True
@@ -70,6 +69,7 @@ import pandas as pd
 import sct_utils as sct
 import msct_parser
 import sct_testing
+from spinalcordtoolbox import scheduler
 
 def _pickle_method(method):
     """
@@ -310,9 +310,15 @@ def get_list_subj(folder_dataset, data_specifications=None, fname_database=''):
     return list_subj
 
 
-def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0):
+def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None, verbose=1, test_integrity=0,
+                 fname_db=':memory:', nb_cores=None, memory_budget=None):
     """
     Run a test function on the dataset using multiprocessing and save the results
+    :param fname_db: SQLite database where the status and results of each task are saved as soon as it completes. If it
+    contains completed tasks from a previous run, they are not run again.
+    :param nb_cores: total number of cores, divided between the processes and the ITK threads of each process
+    :param memory_budget: memory available for the tasks, in bytes. Tasks are only started if the estimated memory of
+    the running tasks fits. Default: available memory (see spinalcordtoolbox.scheduler)
     :return: results
     # results are organized as the following: tuple of (status, output, DataFrame with results)
     """
@@ -320,54 +326,35 @@ def run_function(function, folder_dataset, list_subj, list_args=[], nb_cpu=None,
     # add full path to each subject
     list_subj_path = [os.path.join(folder_dataset, subject) for subject in list_subj]
 
-    # All scripts that are using multithreading with ITK must not use it when using multiprocessing
-    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = "1"
+    # Divide the cores between processes and ITK threads
+    nb_cpu = nb_cpu or 1
+    os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"] = str(scheduler.get_nb_threads(nb_cores or cpu_count(), nb_cpu))
 
     # create list that finds all the combinations for function + subject path + arguments. Example of one list element:
     # ('sct_propseg', os.path.join(path_sct, 'data', 'sct_test_function', '200_005_s2''), '-i ' + os.path.join("t2", "t2.nii.gz") + ' -c t2', 1)
     list_func_subj_args = list(itertools.product(*[[function], list_subj_path, list_args, [test_integrity]]))
         # data_and_params = itertools.izip(itertools.repeat(function), data_subjects, itertools.repeat(parameters))
+    list_memory = [scheduler.estimate_task_memory(subj_path, args) for _, subj_path, args, _ in list_func_subj_args]
+    if memory_budget is None:
+        memory_budget = scheduler.get_available_memory()
 
-    logger.debug("stating pool with {} thread(s)".format(nb_cpu))
-    pool = PoolExecutor(nb_cpu)
-    compute_time = None
+    def log_progress(task, result, count, nb_tasks):
+        sct.no_new_line_log('Processing subjects... {}/{}'.format(count, nb_tasks))
+
+    logger.debug("stating pool with {} process(es), {} ITK thread(s) each".format(
+        nb_cpu, os.environ["ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"]))
+    store = scheduler.TaskStore(fname_db)
     try:
         compute_time = time.time()
-        count = 0
-        all_results = []
-
-        # logger.info('Waiting for results, be patient')
-        future_dirs = {pool.submit(function_launcher, subject_arg): subject_arg
-                         for subject_arg in list_func_subj_args}
-
-        for future in concurrent.futures.as_completed(future_dirs):
-            count += 1
-            subject = os.path.basename(future_dirs[future][1])
-            arguments = future_dirs[future][2]
-            try:
-                result = future.result()
-                sct.no_new_line_log('Processing subjects... {}/{}'.format(count, len(list_func_subj_args)))
-                all_results.append(result)
-            except Exception as exc:
-                logger.error('{} {} generated an exception: {}'.format(subject, arguments, exc))
-
+        scheduler.run_tasks(function_launcher, list_func_subj_args, store, nb_workers=nb_cpu,
+                            memory_budget=memory_budget, list_memory=list_memory, pool_executor=PoolExecutor,
+                            callback=log_progress)
         compute_time = time.time() - compute_time
 
-        # concatenate all_results into single Panda structure
-        results_dataframe = pd.concat(all_results)
-
-    except KeyboardInterrupt:
-        logger.warning("\nCaught KeyboardInterrupt, terminating workers")
-        for job in future_dirs:
-            job.cancel()
-    except Exception as e:
-        logger.error('Error on line {}'.format(sys.exc_info()[-1].tb_lineno))
-        logger.exception(e)
-        for job in future_dirs:
-            job.cancel()
-        raise
+        # concatenate all results (including the ones of a previous run) into single Panda structure
+        results_dataframe = pd.concat(store.get_results(list_func_subj_args))
     finally:
-        pool.shutdown()
+        store.close()
 
     return {'results': results_dataframe, "compute_time": compute_time}
 
@@ -421,6 +408,30 @@ def get_parser():
                       mandatory=False,
                       example='42')
 
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Total number of cores, divided between the subjects processed in parallel (-j) "
+                                  "and the ITK threads of each of them. By default, all available CPU cores.",
+                      mandatory=False,
+                      example='16')
+
+    parser.add_option(name="-mem",
+                      type_value="float",
+                      description="Memory (in GB) available for the subjects processed in parallel. A subject is "
+                                  "only started if the estimated memory of the running subjects (based on the size "
+                                  "of their images) fits. By default, 80% of the available memory.",
+                      mandatory=False,
+                      example='32')
+
+    parser.add_option(name="-db",
+                      type_value="str",
+                      description="SQLite file where the status and results of each subject are saved as soon as "
+                                  "they complete. To resume an interrupted run, use the file of this run: the "
+                                  "completed subjects are not processed again. By default, the results are only kept "
+                                  "in memory and the run cannot be resumed.",
+                      mandatory=False,
+                      example='pipeline.sqlite')
+
     parser.add_option(name="-test-integrity",
                       type_value="multiple_choice",
                       description="Run (=1) or not (=0) integrity testing which is defined in test_integrity() function of the test_ script. See example here: https://github.com/neuropoly/spinalcordtoolbox/blob/master/testing/test_sct_propseg.py",
@@ -498,6 +509,8 @@ if __name__ == "__main__":
         jobs = arguments["-j"]
     else:
         jobs = cpu_count()  # uses maximum number of available CPUs
+    nb_cores = arguments.get("-cpu-nb", None)
+    memory_budget = int(arguments["-mem"] * (1 << 30)) if "-mem" in arguments else None
     test_integrity = int(arguments['-test-integrity'])
     create_log = int(arguments['-log'])
     output_pickle = int(arguments['-pickle'])
@@ -536,6 +549,7 @@ if __name__ == "__main__":
         fname_log = file_log + '.log'
         # handle_log = sct.ForkStdoutToFile(fname_log)
         file_handler = sct.add_file_handler_to_logger(fname_log)
+    file_db = arguments.get("-db", ':memory:')
 
     logger.info('Testing started on: ' + time.strftime("%Y-%m-%d %H:%M:%S"))
 
@@ -583,7 +597,11 @@ if __name__ == "__main__":
             sct.remove_handler(file_handler)
         # run function
         logger.debug("enter test fct")
-        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1, test_integrity=test_integrity)
+        if file_db != ':memory:':
+            logger.info('Results saved in: ' + file_db)
+        tests_ret = run_function(function_to_test, path_data, list_subj, list_args=list_args, nb_cpu=jobs, verbose=1,
+                                 test_integrity=test_integrity, fname_db=file_db, nb_cores=nb_cores,
+                                 memory_budget=memory_budget)
         logger.debug("exit test fct")
         results = tests_ret['results']
         compute_time = tests_ret['compute_time']
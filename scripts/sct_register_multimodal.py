@@ -37,6 +37,7 @@ import sys, os, time
 import numpy as np
 
 from spinalcordtoolbox.reports.qc import generate_qc
+from spinalcordtoolbox import cache
 
 import sct_utils as sct
 from msct_parser import Parser
@@ -60,7 +61,8 @@ def get_parser(paramregmulti=None):
                                  'input spinal cord segmentations (binary mask) in order to achieve maximum robustness.'
                                  ' The program outputs a warping field that can be used to register other images to the'
                                  ' destination image. To apply the warping field to another image, use '
-                                 'sct_apply_transfo')
+                                 'sct_apply_transfo\n\n' +
+                                 cache.HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="Image source.",
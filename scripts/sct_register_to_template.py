@@ -25,6 +25,7 @@ from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
 from spinalcordtoolbox.reports.qc import generate_qc
 from spinalcordtoolbox.resampling import resample_file
+from spinalcordtoolbox import cache
 
 import sct_utils as sct
 import sct_maths
@@ -82,7 +83,8 @@ def get_parser():
                                  'If only one label is provided, a simple translation will be applied between the subject label and the template label. No scaling will be performed. \n\n'
                                  'If two labels are provided, a linear transformation (translation + rotation + superior-inferior linear scaling) will be applied. The strategy here is to defined labels that cover the region of interest. For example, if you are interested in studying C2 to C6 levels, then provide one label at C2 and another at C6. However, note that if the two labels are very far apart (e.g. C2 and T12), there might be a mis-alignment of discs because a subject''s intervertebral discs distance might differ from that of the template.\n\n'
                                  'If more than two labels (only with the parameter "-disc") are used, a non-linear registration will be applied to align the each intervertebral disc between the subject and the template, as described in sct_straighten_spinalcord. This the most accurate and preferred method. This feature does not work with the parameter "-ref subject".\n\n'
-                                 'More information about label creation can be found at https://www.slideshare.net/neuropoly/sct-course-20190121/42'
+                                 'More information about label creation can be found at https://www.slideshare.net/neuropoly/sct-course-20190121/42\n\n' +
+                                 cache.HELP
       )
     parser.add_option(name="-i",
                       type_value="file",
@@ -382,10 +384,10 @@ def main(args=None):
             # cropping the segmentation based on the label coverage to ensure good registration with level alignment
             # See https://github.com/neuropoly/spinalcordtoolbox/pull/1669 for details
             image_labels = Image(ftmp_label)
-            coordinates_labels = image_labels.getNonZeroCoordinates(sorting='z')
+            coordinates_labels = image_labels.get_nonzero_coordinates(sorting='z')
             nx, ny, nz, nt, px, py, pz, pt = image_labels.dim
             offset_crop = 10.0 * pz  # cropping the image 10 mm above and below the highest and lowest label
-            cropping_slices = [coordinates_labels[0].z - offset_crop, coordinates_labels[-1].z + offset_crop]
+            cropping_slices = [coordinates_labels['z'][0] - offset_crop, coordinates_labels['z'][-1] + offset_crop]
             # make sure that the cropping slices do not extend outside of the slice range (issue #1811)
             if cropping_slices[0] < 0:
                 cropping_slices[0] = 0
@@ -410,11 +412,8 @@ def main(args=None):
         # straighten segmentation
         sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
 
-        # check if warp_curve2straight and warp_straight2curve already exist (i.e. no need to do it another time)
-        fn_warp_curve2straight = os.path.join(curdir, "warp_curve2straight.nii.gz")
-        fn_warp_straight2curve = os.path.join(curdir, "warp_straight2curve.nii.gz")
-        fn_straight_ref = os.path.join(curdir, "straight_ref.nii.gz")
-
+        # reuse the warping fields if the spinal cord was already straightened with the same inputs (see
+        # spinalcordtoolbox.cache)
         cache_input_files = [ftmp_seg]
         if level_alignment:
             cache_input_files += [
@@ -422,39 +421,35 @@ def main(args=None):
              ftmp_label,
              ftmp_template_label,
             ]
-        cache_sig = sct.cache_signature(
-         input_files=cache_input_files,
-        )
-        cachefile = os.path.join(curdir, "straightening.cache")
-        if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(fn_warp_curve2straight) and os.path.isfile(fn_warp_straight2curve) and os.path.isfile(fn_straight_ref):
-            sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-            sct.copy(fn_warp_curve2straight, 'warp_curve2straight.nii.gz')
-            sct.copy(fn_warp_straight2curve, 'warp_straight2curve.nii.gz')
-            sct.copy(fn_straight_ref, 'straight_ref.nii.gz')
-            # apply straightening
-            sct_apply_transfo.main(args=[
-                '-i', ftmp_seg,
-                '-w', 'warp_curve2straight.nii.gz',
-                '-d', 'straight_ref.nii.gz',
-                '-o', add_suffix(ftmp_seg, '_straight')])
-        else:
-            from spinalcordtoolbox.straightening import SpinalCordStraightener
-            sc_straight = SpinalCordStraightener(ftmp_seg, ftmp_seg)
-            sc_straight.param_centerline = param_centerline
-            sc_straight.output_filename = add_suffix(ftmp_seg, '_straight')
-            sc_straight.path_output = './'
-            sc_straight.qc = '0'
-            sc_straight.remove_temp_files = param.remove_temp_files
-            sc_straight.verbose = verbose
-
-            if level_alignment:
-                sc_straight.centerline_reference_filename = ftmp_template_seg
-                sc_straight.use_straight_reference = True
-                sc_straight.discs_input_filename = ftmp_label
-                sc_straight.discs_ref_filename = ftmp_template_label
-
-            sc_straight.straighten()
-            sct.cache_save(cachefile, cache_sig)
+        with cache.step('sct_register_to_template.straightening', input_files=cache_input_files,
+                        params={'level_alignment': level_alignment, 'centerline': vars(param_centerline)},
+                        outputs=['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz',
+                                 'straight_ref.nii.gz']) as step:
+            if step.hit:
+                sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
+                # apply straightening
+                sct_apply_transfo.main(args=[
+                    '-i', ftmp_seg,
+                    '-w', 'warp_curve2straight.nii.gz',
+                    '-d', 'straight_ref.nii.gz',
+                    '-o', add_suffix(ftmp_seg, '_straight')])
+            else:
+                from spinalcordtoolbox.straightening import SpinalCordStraightener
+                sc_straight = SpinalCordStraightener(ftmp_seg, ftmp_seg)
+                sc_straight.param_centerline = param_centerline
+                sc_straight.output_filename = add_suffix(ftmp_seg, '_straight')
+                sc_straight.path_output = './'
+                sc_straight.qc = '0'
+                sc_straight.remove_temp_files = param.remove_temp_files
+                sc_straight.verbose = verbose
+
+                if level_alignment:
+                    sc_straight.centerline_reference_filename = ftmp_template_seg
+                    sc_straight.use_straight_reference = True
+                    sc_straight.discs_input_filename = ftmp_label
+                    sc_straight.discs_ref_filename = ftmp_template_label
+
+                sc_straight.straighten()
 
         # N.B. DO NOT UPDATE VARIABLE ftmp_seg BECAUSE TEMPORARY USED LATER
         # re-define warping field using non-cropped space (to avoid issue #367)
@@ -748,8 +743,8 @@ def resample_labels(fname_labels, fname_dest, fname_output):
     IMPORTANT: this function assumes that the origin and FOV of the two images are the SAME.
     """
     # get dimensions of input and destination files
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_labels).dim
-    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = Image(fname_dest).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_labels, lazy=True).dim
+    nxd, nyd, nzd, ntd, pxd, pyd, pzd, ptd = Image(fname_dest, lazy=True).dim
     sampling_factor = [float(nx) / nxd, float(ny) / nyd, float(nz) / nzd]
     # read labels
     processor = sct_label_utils.ProcessLabels(fname_labels)
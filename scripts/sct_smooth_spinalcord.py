@@ -23,6 +23,7 @@ import numpy as np
 import sct_utils as sct
 import sct_maths
 import spinalcordtoolbox.image as msct_image
+from spinalcordtoolbox import cache
 from sct_convert import convert
 from msct_parser import Parser
 
@@ -54,7 +55,8 @@ def get_parser():
     parser.usage.set_description('Smooth the spinal cord along its centerline. Steps are:\n'
                                  '1) Spinal cord is straightened (using centerline),\n'
                                  '2) a Gaussian kernel is applied in the superior-inferior direction,\n'
-                                 '3) then cord is de-straightened as originally.\n')
+                                 '3) then cord is de-straightened as originally.\n\n' +
+                                 cache.HELP)
     parser.add_option(name="-i",
                       type_value="file",
                       description="Image to smooth",
@@ -108,8 +110,11 @@ def main(args=None):
     param = Param()
     start_time = time.time()
 
+    if not args:
+        args = sys.argv[1:]
+
     parser = get_parser()
-    arguments = parser.parse(sys.argv[1:])
+    arguments = parser.parse(args)
 
     fname_anat = arguments['-i']
     fname_centerline = arguments['-s']
@@ -131,7 +136,7 @@ def main(args=None):
 
     # Check that input is 3D:
     from spinalcordtoolbox.image import Image
-    nx, ny, nz, nt, px, py, pz, pt = Image(fname_anat).dim
+    nx, ny, nz, nt, px, py, pz, pt = Image(fname_anat, lazy=True).dim
     dim = 4  # by default, will be adjusted later
     if nt == 1:
         dim = 3
@@ -178,23 +183,21 @@ def main(args=None):
     # Straighten the spinal cord
     # straighten segmentation
     sct.printv('\nStraighten the spinal cord using centerline/segmentation...', verbose)
-    cache_sig = sct.cache_signature(input_files=[fname_anat_rpi, fname_centerline_rpi],
-                                    input_params={"x": "spline"})
-    cachefile = os.path.join(curdir, "straightening.cache")
-    if sct.cache_valid(cachefile, cache_sig) and os.path.isfile(os.path.join(curdir, 'warp_curve2straight.nii.gz')) and os.path.isfile(os.path.join(curdir, 'warp_straight2curve.nii.gz')) and os.path.isfile(os.path.join(curdir, 'straight_ref.nii.gz')):
-        # if they exist, copy them into current folder
-        sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
-        sct.copy(os.path.join(curdir, 'warp_curve2straight.nii.gz'), 'warp_curve2straight.nii.gz')
-        sct.copy(os.path.join(curdir, 'warp_straight2curve.nii.gz'), 'warp_straight2curve.nii.gz')
-        sct.copy(os.path.join(curdir, 'straight_ref.nii.gz'), 'straight_ref.nii.gz')
-        # apply straightening
-        sct.run(['sct_apply_transfo', '-i', fname_anat_rpi, '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'anat_rpi_straight.nii', '-x', 'spline'], verbose)
-    else:
-        sct.run(['sct_straighten_spinalcord', '-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline', '-param', 'algo_fitting='+param.algo_fitting], verbose)
-        sct.cache_save(cachefile, cache_sig)
-        # move warping fields locally (to use caching next time)
-        sct.copy('warp_curve2straight.nii.gz', os.path.join(curdir, 'warp_curve2straight.nii.gz'))
-        sct.copy('warp_straight2curve.nii.gz', os.path.join(curdir, 'warp_straight2curve.nii.gz'))
+    # reuse the warping fields if the spinal cord was already straightened with the same inputs (see
+    # spinalcordtoolbox.cache)
+    with cache.step('sct_smooth_spinalcord.straightening', input_files=[fname_anat_rpi, fname_centerline_rpi],
+                    params={'x': 'spline', 'algo_fitting': param.algo_fitting},
+                    outputs=['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz', 'straight_ref.nii.gz']) \
+            as step:
+        if step.hit:
+            sct.printv('Reusing existing warping field which seems to be valid', verbose, 'warning')
+            # apply straightening
+            sct.run(['sct_apply_transfo', '-i', fname_anat_rpi, '-w', 'warp_curve2straight.nii.gz', '-d', 'straight_ref.nii.gz', '-o', 'anat_rpi_straight.nii', '-x', 'spline'], verbose)
+        else:
+            sct.run(['sct_straighten_spinalcord', '-i', fname_anat_rpi, '-o', 'anat_rpi_straight.nii', '-s', fname_centerline_rpi, '-x', 'spline', '-param', 'algo_fitting='+param.algo_fitting], verbose)
+    # copy the warping fields in the current folder
+    sct.copy('warp_curve2straight.nii.gz', os.path.join(curdir, 'warp_curve2straight.nii.gz'))
+    sct.copy('warp_straight2curve.nii.gz', os.path.join(curdir, 'warp_straight2curve.nii.gz'))
 
     # Smooth the straightened image along z
     sct.printv('\nSmooth the straightened image...')
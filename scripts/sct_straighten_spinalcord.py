@@ -151,8 +151,16 @@ def get_parser():
              "\nprecision: [1.0,inf[. Precision factor of straightening, related to the number of slices. Increasing this parameter increases the precision along with increased computational time. Not taken into account with hanning fitting method. Default=2"
              "\nthreshold_distance: [0.0,inf[. Threshold at which voxels are not considered into displacement. Increase this threshold if the image is blackout around the spinal cord too much. Default=10"
              "\naccuracy_results: {0, 1} Disable/Enable computation of accuracy results after straightening. Default=0"
-             "\ntemplate_orientation: {0, 1} Disable/Enable orientation of the straight image to be the same as the template. Default=0",
+             "\ntemplate_orientation: {0, 1} Disable/Enable orientation of the straight image to be the same as the template. Default=0"
+             "\nmemory_budget: ]0,inf[. Memory (in MB) used by intermediate arrays when computing the warping fields. Increasing this parameter reduces computational time. Default=1024",
         required=False)
+    optional.add_argument(
+        "-cpu-nb",
+        metavar=Metavar.int,
+        type=int,
+        help="Number of CPU cores used to compute the warping fields. 0: use all available cores.",
+        required=False,
+        default=1)
 
     optional.add_argument(
         "-x",
@@ -239,8 +247,7 @@ def main(args=None):
     sct.init_sct(log_level=verbose, update=True)  # Update log level
     sc_straight.verbose = verbose
 
-    # if "-cpu-nb" in arguments:
-    #     sc_straight.cpu_number = arguments.cpu-nb)
+    sc_straight.cpu_number = arguments.cpu_nb
     if arguments.disable_straight2curved:
         sc_straight.straight2curved = False
     if arguments.disable_curved2straight:
@@ -268,6 +275,8 @@ def main(args=None):
                 sc_straight.accuracy_results = int(param_split[1])
             if param_split[0] == 'template_orientation':
                 sc_straight.template_orientation = int(param_split[1])
+            if param_split[0] == 'memory_budget':
+                sc_straight.memory_budget = float(param_split[1])
 
     fname_straight = sc_straight.straighten()
 
@@ -18,9 +18,11 @@ from __future__ import print_function, division, absolute_import
 import sys, io, os, re, time, datetime, platform
 import errno
 import logging
+import multiprocessing
 import shutil
 import subprocess
 import tempfile
+import threading
 
 import numpy as np
 
@@ -241,6 +243,29 @@ def which_sct_binaries():
         return "binaries_osx"
 
 
+def get_sct_binary(name):
+    """
+    Get the path of an SCT binary (e.g. isct_antsRegistration). The binaries are downloaded if they are missing, so
+    this function should be called before running a binary from parallel processes.
+    :param name: str: name of the binary
+    :return: str: absolute path of the binary
+    """
+    path = None
+    #binaries_location_default = os.path.expanduser("~/.cache/spinalcordtoolbox-{}/bin".format(__version__)
+    binaries_location_default = os.path.join(__sct_dir__, "bin")
+    for directory in (
+     #binaries_location_default,
+     os.path.join(__sct_dir__, "bin"),
+     ):
+        candidate = os.path.join(directory, name)
+        if os.path.exists(candidate):
+            path = candidate
+    if path is None:
+        run(["sct_download_data", "-d", which_sct_binaries(), "-o", binaries_location_default])
+        path = os.path.join(binaries_location_default, name)
+    return path
+
+
 def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, is_sct_binary=False):
     # if verbose == 2:
     #     printv(sys._getframe().f_back.f_code.co_name, 1, 'process')
@@ -257,19 +282,7 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, is_sct_binary=
 
     if is_sct_binary:
         name = cmd[0] if isinstance(cmd, list) else cmd.split(" ", 1)[0]
-        path = None
-        #binaries_location_default = os.path.expanduser("~/.cache/spinalcordtoolbox-{}/bin".format(__version__)
-        binaries_location_default = os.path.join(__sct_dir__, "bin")
-        for directory in (
-         #binaries_location_default,
-         os.path.join(__sct_dir__, "bin"),
-         ):
-            candidate = os.path.join(directory, name)
-            if os.path.exists(candidate):
-                path = candidate
-        if path is None:
-            run(["sct_download_data", "-d", which_sct_binaries(), "-o", binaries_location_default])
-            path = os.path.join(binaries_location_default, name)
+        path = get_sct_binary(name)
 
         if isinstance(cmd, list):
             cmd[0] = path
@@ -286,6 +299,25 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, is_sct_binary=
     if verbose:
         printv("%s # in %s" % (cmdline, cwd), 1, 'code')
 
+    # Run SCT Python scripts in the current interpreter when possible, to save the interpreter startup, the
+    # imports, and the parsing of the libraries at each call. This changes the working directory and the standard
+    # output of the whole process, so scripts called from other threads are run in a subprocess. N.B. in-process,
+    # the output does not contain the messages of the logger (which are printed directly).
+    path_script = None
+    if isinstance(cmd, list) and env is os.environ and os.environ.get("SCT_RUN_IN_PROCESS", "1") != "0" \
+            and _is_main_thread():
+        path_script = get_sct_entry_point(cmd[0])
+    if path_script is not None:
+        time_start = time.time()
+        status, output, duration_load = run_in_process(path_script, cmd[1:], cwd=cwd)
+        log_run_timing(cmdline, 'in-process', time.time() - time_start, duration_load)
+        if verbose == 2 and output:
+            printv(output)
+        if status != 0 and raise_exception:
+            raise RunError(output)
+        return status, output
+
+    time_start = time.time()
     shell = isinstance(cmd, str)
 
     process = subprocess.Popen(cmd, shell=shell, cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
@@ -302,6 +334,7 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, is_sct_binary=
 
     status = process.returncode
     output = output_final.rstrip()
+    log_run_timing(cmdline, 'subprocess', time.time() - time_start)
 
     # process.stdin.close()
     # process.stdout.close()
@@ -313,6 +346,139 @@ def run(cmd, verbose=1, raise_exception=True, cwd=None, env=None, is_sct_binary=
     return status, output
 
 
+def _is_main_thread():
+    if sys.hexversion < 0x03040000:
+        return isinstance(threading.current_thread(), threading._MainThread)
+    return threading.current_thread() is threading.main_thread()
+
+
+# Cache of the SCT Python scripts that can be run in-process (name -> path or None)
+_sct_entry_points = {}
+
+
+def get_sct_entry_point(name):
+    """
+    Get the path of the SCT Python script which can be run in-process for a command.
+
+    A script can be run in-process if it defines `main(args)` and if its `__main__` block only initializes SCT and
+    calls `main()`: in this case, calling `main(args=...)` on a fresh copy of the module is equivalent to running the
+    script in a new interpreter.
+
+    :param name: str: name of the command, e.g. 'sct_maths'
+    :return: path of the script, or None if the command has to be run in a subprocess
+    """
+    if name not in _sct_entry_points:
+        _sct_entry_points[name] = None
+        path = os.path.join(__sct_dir__, 'scripts', name + '.py')
+        if re.match(r'^sct_\w+$', name) and os.path.isfile(path):
+            import ast
+            with io.open(path, 'rb') as f:
+                tree = ast.parse(f.read(), path)
+            dumps_allowed = [ast.dump(ast.parse(code).body[0])
+                             for code in ('sct.init_sct()', 'main()', 'main(sys.argv[1:])')]
+            dump_guard = ast.dump(ast.parse('__name__ == "__main__"', mode='eval').body)
+            has_main = any(isinstance(node, ast.FunctionDef) and node.name == 'main' and node.args.args
+                           for node in tree.body)
+            blocks_main = [node for node in tree.body if isinstance(node, ast.If) and ast.dump(node.test) == dump_guard]
+            if has_main and len(blocks_main) == 1 \
+                    and all(ast.dump(node) in dumps_allowed for node in blocks_main[0].body):
+                _sct_entry_points[name] = path
+    return _sct_entry_points[name]
+
+
+def run_in_process(path_script, args, cwd=None):
+    """
+    Run the `main(args)` function of an SCT Python script in the current interpreter, as if it was run in a subprocess.
+
+    A fresh copy of the script module is used for each call, so that module-level state does not leak between calls.
+    The standard output is captured, and the working directory and the logging levels (which are changed by
+    `init_sct()`) are restored after the call. Unlike with a subprocess, the captured output does not contain the
+    messages of the logger, whose handler writes to the original standard output.
+
+    The working directory and the standard output are those of the whole process: this function must not be called
+    from several threads.
+
+    :param path_script: path of the script, see get_sct_entry_point()
+    :param args: list of command-line arguments
+    :param cwd: working directory in which to run the script
+    :return: status, output, duration_load: exit status, captured output, and time spent loading the script (s)
+    """
+    import traceback
+    if sys.hexversion < 0x03000000:
+        from StringIO import StringIO
+    else:
+        from io import StringIO
+
+    name = os.path.splitext(os.path.basename(path_script))[0]
+    curdir = os.getcwd()
+    stdout = sys.stdout
+    log_levels = [(log, log.level) for log in (logging.root, logger)]
+    module_previous = sys.modules.get(name, None)
+    buffer = StringIO()
+    status = 0
+    duration_load = 0.0
+    try:
+        if cwd is not None:
+            os.chdir(cwd)
+        sys.stdout = buffer
+        time_start = time.time()
+        if sys.hexversion < 0x03050000:
+            import imp
+            module = imp.load_source(name, path_script)
+        else:
+            import importlib.util
+            spec = importlib.util.spec_from_file_location(name, path_script)
+            module = importlib.util.module_from_spec(spec)
+            # register the module while it runs, so that its functions can be pickled (e.g., by multiprocessing)
+            sys.modules[name] = module
+            spec.loader.exec_module(module)
+        duration_load = time.time() - time_start
+        module.main(args=list(args))
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            status = e.code or 0
+        else:
+            print(e.code)
+            status = 1
+    except Exception:
+        print(traceback.format_exc())
+        status = 1
+    finally:
+        sys.stdout = stdout
+        os.chdir(curdir)
+        for log, level in log_levels:
+            log.setLevel(level)
+        if module_previous is None:
+            sys.modules.pop(name, None)
+        else:
+            sys.modules[name] = module_previous
+
+    output = "\n".join(line.strip() for line in buffer.getvalue().splitlines()).rstrip()
+    return status, output, duration_load
+
+
+def log_run_timing(cmdline, mode, duration, duration_load=None):
+    """
+    Log the duration of a command executed by run().
+
+    If the environment variable SCT_RUN_TIMING_LOG is set, the timing is also appended to this file (tab-separated:
+    date, mode, duration, script loading duration, command), so that the startup and I/O cost saved by the in-process
+    execution can be compared with the subprocess execution (SCT_RUN_IN_PROCESS=0).
+
+    :param cmdline: str: command line
+    :param mode: str: 'in-process' or 'subprocess'
+    :param duration: float: duration of the command (s)
+    :param duration_load: float: time spent loading the script for in-process execution (s)
+    """
+    logger.debug("%s: %.3f s (%s)", cmdline, duration, mode)
+    fname_log = os.environ.get("SCT_RUN_TIMING_LOG", None)
+    if fname_log:
+        with io.open(fname_log, "a") as f:
+            f.write(u"{}\t{}\t{:.3f}\t{}\t{}\n".format(
+                datetime.datetime.now().isoformat(), mode, duration,
+                "" if duration_load is None else "{:.3f}".format(duration_load), cmdline))
+
+
 def display_open(file):
     """Print the syntax to open a file based on the platform."""
     if sys.platform == 'linux':
@@ -453,6 +619,22 @@ def rmtree(folder, verbose=1):
         raise # Must be another error
 
 
+#=======================================================================================================================
+# get_cpu_number
+#=======================================================================================================================
+def get_cpu_number(cpu_number=0):
+    """
+    Get the number of CPU cores used by parallel processing (e.g. shared by parallel registrations and their ITK
+    threads).
+    :param cpu_number: int: number of cores. 0: use ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS if defined, or all the cores.
+    :return: int
+    """
+    cpu_number = int(cpu_number)
+    if cpu_number == 0:
+        cpu_number = int(os.environ.get("ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS", 0)) or multiprocessing.cpu_count()
+    return max(1, cpu_number)
+
+
 #=======================================================================================================================
 # check RAM usage
 # work only on Mac OSX
@@ -611,7 +793,7 @@ def check_dim(fname, dim_lst=[3]):
     :return: True or False
     """
     from spinalcordtoolbox.image import Image
-    dim = Image(fname).hdr['dim'][:4]
+    dim = Image(fname, lazy=True).hdr['dim'][:4]
 
     if not dim[0] in dim_lst:
         printv('\nERROR: File ' + fname + ' has {} dimensions. Authorized dimensions are: {}. '
@@ -1276,6 +1458,7 @@ def cache_signature(input_files=[], input_data=[], input_params={}):
       To prevent that, the next step would be to record the outputs
       signature in the cache file, so as to also verify them prior
       to taking a shortcut.
+      This is what spinalcordtoolbox.cache does, for pipeline steps.
 
     """
     import hashlib
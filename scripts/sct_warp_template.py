@@ -14,8 +14,10 @@
 from __future__ import absolute_import
 
 import sys, os
+from multiprocessing.pool import ThreadPool
 
 import spinalcordtoolbox.metadata
+from spinalcordtoolbox import warping, cache
 from spinalcordtoolbox.reports.qc import generate_qc
 from msct_parser import Parser
 import sct_utils as sct
@@ -36,6 +38,9 @@ class Param:
         self.warp_atlas = 1
         self.warp_spinal_levels = 0
         self.list_labels_nn = ['_level.nii.gz', '_levels.nii.gz', '_csf.nii.gz', '_CSF.nii.gz', '_cord.nii.gz']  # list of files for which nn interpolation should be used. Default = linear.
+        self.batch = 1  # warp all the labels of a folder at once, in Python (instead of one isct_antsApplyTransforms call per label)
+        self.skip_uptodate = 1  # do not warp labels again if their output is up to date
+        self.cpu_number = 0  # number of threads for the batch warping (0: all available cores)
         self.verbose = 1  # verbose
         self.path_qc = None
 
@@ -75,11 +80,24 @@ class WarpTemplate:
         if self.warp_atlas == 1:
             sct.printv('\nWARP ATLAS OF WHITE MATTER TRACTS:', self.verbose)
             warp_label(self.path_template, self.folder_atlas, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            save_sparse_labels(os.path.join(self.folder_out, self.folder_atlas))
 
         # Warp spinal levels
         if self.warp_spinal_levels == 1:
             sct.printv('\nWARP SPINAL LEVELS:', self.verbose)
             warp_label(self.path_template, self.folder_spinal_levels, param.file_info_label, self.fname_src, self.fname_transfo, self.folder_out)
+            save_sparse_labels(os.path.join(self.folder_out, self.folder_spinal_levels))
+
+
+def save_sparse_labels(path_label):
+    """
+    Save a sparse copy of the warped labels, which is faster to read by sct_extract_metric and sct_analyze_lesion
+    (see spinalcordtoolbox.metadata.SparseLabels)
+    :param path_label: folder of the warped labels
+    :return:
+    """
+    fname_sparse = spinalcordtoolbox.metadata.save_sparse_labels(path_label, param.file_info_label)
+    sct.printv('  File created: ' + fname_sparse, param.verbose)
 
 
 def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, path_out):
@@ -105,22 +123,74 @@ def warp_label(path_label, folder_label, file_label, fname_src, fname_transfo, p
         # create output folder
         if not os.path.exists(os.path.join(path_out, folder_label)):
             os.makedirs(os.path.join(path_out, folder_label))
+        list_fname_label = [os.path.join(path_label, folder_label, fname) for fname in template_label_file]
+        list_fname_out = [os.path.join(path_out, folder_label, fname) for fname in template_label_file]
+
+        # Skip labels which are up to date: each warped label is stored in the cache (see spinalcordtoolbox.cache),
+        # with the signature of the inputs (warping field, destination image, label file and interpolation) with which
+        # it was generated as key
+        step_cache = cache.get_cache() if param.skip_uptodate else None
+        if step_cache is not None:
+            signature_transfo = warping.get_transfo_signature([fname_transfo], fname_src)
+            list_key = [step_cache.get_key('sct_warp_template', input_files=[fname_label],
+                                           params={'transfo': signature_transfo, 'interp': get_interp(file)},
+                                           outputs=[fname_out])
+                        for fname_label, fname_out, file in zip(list_fname_label, list_fname_out, template_label_file)]
+        list_index = []
+        for i in range(len(list_fname_label)):
+            if step_cache is not None and step_cache.restore(list_key[i], [list_fname_out[i]])[0]:
+                sct.printv('  Skipping up-to-date label: ' + list_fname_out[i], param.verbose)
+            else:
+                list_index.append(i)
+
         # Warp label
-        for i in range(0, len(template_label_file)):
-            fname_label = os.path.join(path_label, folder_label, template_label_file[i])
-            # apply transfo
-            sct.run('isct_antsApplyTransforms -d 3 -i %s -r %s -t %s -o %s -n %s' %
-                    (fname_label,
-                     fname_src,
-                     fname_transfo,
-                     os.path.join(path_out, folder_label, template_label_file[i]),
-                     get_interp(template_label_file[i])),
-                    is_sct_binary=True,
-                    verbose=param.verbose)
+        if param.batch and warping.is_supported(fname_transfo):
+            warp_label_batch([list_fname_label[i] for i in list_index], [list_fname_out[i] for i in list_index],
+                             fname_src, fname_transfo)
+        else:
+            for i in list_index:
+                # apply transfo
+                sct.run('isct_antsApplyTransforms -d 3 -i %s -r %s -t %s -o %s -n %s' %
+                        (list_fname_label[i],
+                         fname_src,
+                         fname_transfo,
+                         list_fname_out[i],
+                         get_interp(template_label_file[i])),
+                        is_sct_binary=True,
+                        verbose=param.verbose)
+        if step_cache is not None:
+            for i in list_index:
+                step_cache.save(list_key[i], 'sct_warp_template', [list_fname_out[i]])
         # Copy list.txt
         sct.copy(os.path.join(path_label, folder_label, param.file_info_label), os.path.join(path_out, folder_label))
 
 
+def warp_label_batch(list_fname_label, list_fname_out, fname_src, fname_transfo):
+    """
+    Warp label files at once: the labels which share the same interpolation are resampled together, in a single pass
+    (see spinalcordtoolbox.warping.warp_images), and the output files are written in parallel.
+    :param list_fname_label: list of label files
+    :param list_fname_out: list of output files
+    :param fname_src: destination image
+    :param fname_transfo: warping field
+    :return:
+    """
+    if not list_fname_label:
+        return
+    interp_sct = {'Linear': 'linear', 'NearestNeighbor': 'nn'}
+    list_im_out = warping.warp_images(list_fname_label, list_fname_out, [fname_transfo], fname_src,
+                                      interp=[interp_sct[get_interp(os.path.basename(fname))] for fname in list_fname_label],
+                                      nb_threads=param.cpu_number)
+    pool = ThreadPool(param.cpu_number or None)
+    try:
+        pool.map(lambda im_out: im_out.save(verbose=0), list_im_out)
+    finally:
+        pool.close()
+        pool.join()
+    for fname_out in list_fname_out:
+        sct.printv('  File created: ' + fname_out, param.verbose)
+
+
 # Get interpolation method
 # ==========================================================================================
 def get_interp(file_label):
@@ -140,7 +210,8 @@ def get_parser():
     param_default = Param()
     # Initialize parser
     parser = Parser(__file__)
-    parser.usage.set_description('This function warps the template and all atlases to a destination image.')
+    parser.usage.set_description('This function warps the template and all atlases to a destination image.\n\n' +
+                                 cache.HELP)
     parser.add_option(name="-d",
                       type_value="file",
                       description="destination image the template will be warped to",
@@ -186,6 +257,27 @@ def get_parser():
                       type_value='str',
                       description='If provided, this string will be mentioned in the QC report as the subject the process was run on',
                       )
+    parser.add_option(name="-batch",
+                      type_value="multiple_choice",
+                      description="Warp all the labels of a folder at once, in Python (1), or one by one with "
+                                  "isct_antsApplyTransforms (0).",
+                      mandatory=False,
+                      default_value=str(param_default.batch),
+                      example=['0', '1'])
+    parser.add_option(name="-skip-uptodate",
+                      type_value="multiple_choice",
+                      description="Do not warp again the labels which are up to date, i.e., which were generated "
+                                  "with the same warping field, destination image and template. The warped labels "
+                                  "are then restored from the cache, which must be enabled (see SCT_CACHE above).",
+                      mandatory=False,
+                      default_value=str(param_default.skip_uptodate),
+                      example=['0', '1'])
+    parser.add_option(name="-cpu-nb",
+                      type_value="int",
+                      description="Number of threads for the batch warping. 0: use all available cores.",
+                      mandatory=False,
+                      default_value=param_default.cpu_number,
+                      example="4")
     parser.add_option(name="-v",
                       type_value="multiple_choice",
                       description="""Verbose.""",
@@ -207,6 +299,10 @@ def main(args=None):
     warp_spinal_levels = int(arguments["-s"])
     folder_out = arguments['-ofolder']
     path_template = arguments['-t']
+    param.batch = int(arguments['-batch'])
+    param.skip_uptodate = int(arguments['-skip-uptodate'])
+    if '-cpu-nb' in arguments:
+        param.cpu_number = arguments['-cpu-nb']
     verbose = int(arguments.get('-v'))
     sct.init_sct(log_level=verbose, update=True)  # Update log level
     path_qc = arguments.get("-qc", None)
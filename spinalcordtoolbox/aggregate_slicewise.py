@@ -15,11 +15,33 @@ import csv
 import datetime
 import logging
 
-from spinalcordtoolbox.template import get_slices_from_vertebral_levels, get_vertebral_level_from_slice
+from spinalcordtoolbox.template import get_vertlevel_index
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.utils import __version__, parse_num_list_inv
 
 
+# Vertebral labeling file loaded by the last call to load_vert_level(): (path, modification time, Image)
+_vert_level_cache = (None, None, None)
+
+
+def load_vert_level(vert_level):
+    """
+    Load a vertebral labeling in RPI orientation. The image loaded from a file is kept for the next calls with the same
+    file, so that its vertebral level index (see template.VertLevelIndex) is built only once across metrics.
+    :param vert_level: Image or file name of the vertebral labeling
+    :return: Image
+    """
+    global _vert_level_cache
+    if isinstance(vert_level, Image):
+        if vert_level.orientation == 'RPI':
+            return vert_level
+        return Image(vert_level).change_orientation('RPI')
+    path, mtime = os.path.abspath(vert_level), os.path.getmtime(vert_level)
+    if _vert_level_cache[:2] != (path, mtime):
+        _vert_level_cache = (path, mtime, Image(vert_level).change_orientation('RPI'))
+    return _vert_level_cache[2]
+
+
 class Metric:
     """
     Class to include in dictionaries to associate data and label
@@ -69,6 +91,29 @@ def func_max(data, mask=None, map_clusters=None):
     return np.max(data), None
 
 
+def _get_id_clusters(map_clusters):
+    """
+    Iterate across all labels (excluding the first one) and generate cluster labels. Examples of input/output:
+      [[0], [0], [0], [1], [2], [0]] --> [0, 0, 0, 1, 2, 0]
+      [[0, 1], [0], [0], [1], [2]] --> [0, 0, 0, 0, 1]
+      [[0, 1], [0], [1], [2], [3]] --> [0, 0, 0, 1, 2]
+    :param map_clusters: list of list of int: see func_map()
+    :return: list of int: index of the cluster of each label
+    """
+    possible_clusters = [map_clusters[0]]
+    id_clusters = [0]  # this one corresponds to the first cluster
+    for i_cluster in map_clusters[1:]:  # skip the first
+        found_index = False
+        for possible_cluster in possible_clusters:
+            if i_cluster[0] in possible_cluster:
+                id_clusters.append(possible_clusters.index(possible_cluster))
+                found_index = True
+        if not found_index:
+            possible_clusters.append(i_cluster)
+            id_clusters.append(possible_clusters.index([i_cluster[0]]))
+    return id_clusters
+
+
 def func_map(data, mask, map_clusters):
     """
     Compute maximum a posteriori (MAP) by aggregating the last dimension of mask according to a clustering method
@@ -85,21 +130,7 @@ def func_map(data, mask, map_clusters):
     # Check number of labels and map_clusters
     assert mask.shape[-1] == len(map_clusters)
 
-    # Iterate across all labels (excluding the first one) and generate cluster labels. Examples of input/output:
-    #   [[0], [0], [0], [1], [2], [0]] --> [0, 0, 0, 1, 2, 0]
-    #   [[0, 1], [0], [0], [1], [2]] --> [0, 0, 0, 0, 1]
-    #   [[0, 1], [0], [1], [2], [3]] --> [0, 0, 0, 1, 2]
-    possible_clusters = [map_clusters[0]]
-    id_clusters = [0]  # this one corresponds to the first cluster
-    for i_cluster in map_clusters[1:]:  # skip the first
-        found_index = False
-        for possible_cluster in possible_clusters:
-            if i_cluster[0] in possible_cluster:
-                id_clusters.append(possible_clusters.index(possible_cluster))
-                found_index = True
-        if not found_index:
-            possible_clusters.append(i_cluster)
-            id_clusters.append(possible_clusters.index([i_cluster[0]]))
+    id_clusters = _get_id_clusters(map_clusters)
 
     # Sum across each clustered labels, then concatenate to generate mask_clusters
     # mask_clusters has dimension: x, y, z, n_clustered_labels, with n_clustered_labels being equal to the number of
@@ -167,6 +198,142 @@ def func_ml(data, mask, map_clusters=None):
     return beta[0], beta
 
 
+class LabelGram:
+    """
+    Linear system of ML and MAP estimations (see func_ml()) within a mask, for each slice group: the Gram matrix Xt.X,
+    with X the mask (one column per label). Only the voxels inside the mask are used, so that the dense
+    [nb_vox x nb_labels] matrix X is never built. It does not depend on the data, so it can be reused to estimate
+    several metrics within the same mask (see get_system()).
+    """
+    def __init__(self, mask, slicegroups):
+        """
+        :param mask: (n+1)d-array: input mask. The last dimension corresponds to the labels, the previous one to the
+        slices.
+        :param slicegroups: list of tuple of int: slices of each slice group
+        """
+        self.slicegroups = slicegroups
+        self.nb_slices, self.nb_labels = mask.shape[-2], mask.shape[-1]
+        # rows of X: voxels inside the mask, sorted by slice
+        ind_vox = np.nonzero(np.any(mask != 0, axis=-1))
+        order = np.argsort(ind_vox[-1], kind='mergesort')
+        self.ind_vox = tuple(ind[order] for ind in ind_vox)
+        self.x = mask[self.ind_vox].astype(np.float64)
+        self.bounds = np.searchsorted(self.ind_vox[-1], np.arange(self.nb_slices + 1))
+        xtx_slice = np.zeros((self.nb_slices, self.nb_labels, self.nb_labels))
+        mask_sum_slice = np.zeros(self.nb_slices)
+        for iz in np.unique(self.ind_vox[-1]):
+            x_slice = self.x[self.bounds[iz]:self.bounds[iz + 1]]
+            xtx_slice[iz] = np.dot(x_slice.T, x_slice)
+            mask_sum_slice[iz] = x_slice.sum()
+        self.xtx = self._sum_slicegroups(xtx_slice)
+        self.mask_sum = self._sum_slicegroups(mask_sum_slice)
+
+    def _sum_slicegroups(self, arr_slice):
+        """
+        :param arr_slice: array whose first dimension corresponds to the slices
+        :return: array whose first dimension corresponds to the slice groups
+        """
+        arr = np.zeros((len(self.slicegroups),) + arr_slice.shape[1:])
+        for i, slicegroup in enumerate(self.slicegroups):
+            arr[i] = arr_slice[list(slicegroup)].sum(axis=0)
+        return arr
+
+    def get_system(self, data):
+        """
+        Get the linear system of each slice group for a given data. As in aggregate_per_slice_or_level(), non-finite
+        values of the data are ignored: the contribution of their voxels is removed from the Gram matrices.
+        :param data: nd-array: input data. The last dimension corresponds to the slices.
+        :return: xtx [nb_groups x nb_labels x nb_labels], xty [nb_groups x nb_labels], mask_sum [nb_groups]: sum of the
+        mask within each slice group
+        """
+        if data.shape[-1] < self.nb_slices:
+            raise IndexError("The data has less slices than the mask: {} < {}".format(data.shape[-1],
+                                                                                       self.nb_slices))
+        y = data[self.ind_vox].astype(np.float64)
+        is_nonfinite = ~np.isfinite(y)
+        y[is_nonfinite] = 0.
+        xty_slice = np.zeros((self.nb_slices, self.nb_labels))
+        for iz in np.unique(self.ind_vox[-1]):
+            xty_slice[iz] = np.dot(self.x[self.bounds[iz]:self.bounds[iz + 1]].T, y[self.bounds[iz]:self.bounds[iz + 1]])
+        xty = self._sum_slicegroups(xty_slice)
+        xtx, mask_sum = self.xtx, self.mask_sum
+        if is_nonfinite.any():
+            x_nonfinite, z_nonfinite = self.x[is_nonfinite], self.ind_vox[-1][is_nonfinite]
+            xtx_slice = np.zeros((self.nb_slices, self.nb_labels, self.nb_labels))
+            mask_sum_slice = np.zeros(self.nb_slices)
+            for iz in np.unique(z_nonfinite):
+                x_slice = x_nonfinite[z_nonfinite == iz]
+                xtx_slice[iz] = np.dot(x_slice.T, x_slice)
+                mask_sum_slice[iz] = x_slice.sum()
+            xtx = xtx - self._sum_slicegroups(xtx_slice)
+            mask_sum = mask_sum - self._sum_slicegroups(mask_sum_slice)
+        return xtx, xty, mask_sum
+
+
+def _solve_ml(xtx, xty):
+    """
+    ML estimation of all the slice groups at once: beta = (Xt.X)^(-1) . Xt.y
+    :param xtx: [nb_groups x nb_labels x nb_labels]
+    :param xty: [nb_groups x nb_labels]
+    :return: beta [nb_groups x nb_labels]
+    """
+    return np.einsum('gij,gj->gi', np.linalg.pinv(xtx), xty)
+
+
+def _solve_map(xtx, xty, map_clusters):
+    """
+    MAP estimation of all the slice groups at once (see func_map()). The ML estimation of the prior beta_0 uses the
+    clustered mask X.C, with C the [nb_labels x nb_clusters] indicator matrix of the clusters, so its system is
+    Ct.Xt.X.C and Ct.Xt.y.
+    :param xtx: [nb_groups x nb_labels x nb_labels]
+    :param xty: [nb_groups x nb_labels]
+    :param map_clusters: list of list of int: see func_map()
+    :return: beta [nb_groups x nb_labels]
+    """
+    nb_labels = xtx.shape[-1]
+    assert nb_labels == len(map_clusters)
+    id_clusters = _get_id_clusters(map_clusters)
+    clusters = np.zeros((nb_labels, max(id_clusters) + 1))
+    clusters[np.arange(nb_labels), id_clusters] = 1
+    beta_cluster = _solve_ml(np.einsum('ik,gij,jl->gkl', clusters, xtx, clusters), np.dot(xty, clusters))
+    beta_0 = beta_cluster[:, id_clusters]
+    return beta_0 + np.einsum('gij,gj->gi', np.linalg.pinv(xtx + np.eye(nb_labels)),
+                              xty - np.einsum('gij,gj->gi', xtx, beta_0))
+
+
+def batch_ml(data, label_gram, map_clusters=None):
+    """
+    Compute maximum likelihood (ML) for the first label of mask, for all slice groups at once. Equivalent to calling
+    func_ml() on each slice group.
+    :param data: nd-array: input data. The last dimension corresponds to the slices.
+    :param label_gram: LabelGram of the input mask (see func_ml())
+    :param map_clusters: not used
+    :return: list of float: beta corresponding to the first label, for each slice group (None if the mask is empty)
+    """
+    xtx, xty, mask_sum = label_gram.get_system(data)
+    return _get_first_beta(_solve_ml(xtx, xty), mask_sum)
+
+
+def batch_map(data, label_gram, map_clusters):
+    """
+    Compute maximum a posteriori (MAP) for the first label of mask, for all slice groups at once. Equivalent to calling
+    func_map() on each slice group.
+    :param data: nd-array: input data. The last dimension corresponds to the slices.
+    :param label_gram: LabelGram of the input mask (see func_map())
+    :param map_clusters: list of list of int: see func_map()
+    :return: list of float: beta corresponding to the first label, for each slice group (None if the mask is empty)
+    """
+    xtx, xty, mask_sum = label_gram.get_system(data)
+    return _get_first_beta(_solve_map(xtx, xty, map_clusters), mask_sum)
+
+
+def _get_first_beta(beta, mask_sum):
+    """
+    :return: list of float: beta of the first label, or None for the empty slice groups and nan estimations
+    """
+    return [None if mask_sum[i] == 0 or np.isnan(beta[i, 0]) else beta[i, 0] for i in range(len(beta))]
+
+
 def func_std(data, mask=None, map_clusters=None):
     """
     Compute standard deviation
@@ -209,8 +376,13 @@ def func_wa(data, mask=None, map_clusters=None):
     return np.average(data, weights=mask), None
 
 
+# Estimations which are done for all slice groups at once
+BATCH_FUNCS = {func_ml: batch_ml, func_map: batch_map}
+
+
 def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], perslice=None, perlevel=False,
-                                 vert_level=None, group_funcs=(('MEAN', func_wa),), map_clusters=None):
+                                 vert_level=None, group_funcs=(('MEAN', func_wa),), map_clusters=None,
+                                 label_grams=None):
     """
     The aggregation will be performed along the last dimension of 'metric' ndarray.
     :param metric: Class Metric(): data to aggregate.
@@ -223,6 +395,8 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
     :param tuple group_funcs: Name and function to apply on metric. Example: (('MEAN', func_wa),)). Note, the function
       has special requirements in terms of i/o. See the definition to func_wa and use it as a template.
     :param map_clusters: list of list of int: See func_map()
+    :param label_grams: dict: LabelGram of the mask for ML and MAP estimations, per slice groups. Pass the same dict
+      to the calls with the same mask (e.g., to extract several metrics) so that they are computed only once.
     :return: Aggregated metric
     """
     # If user neither specified slices nor levels, set perslice=True, otherwise, the output will likely contain nan
@@ -240,9 +414,9 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
 
     # aggregation based on levels
     if levels:
-        im_vert_level = Image(vert_level).change_orientation('RPI')
+        vertlevel_index = get_vertlevel_index(load_vert_level(vert_level))
         # slicegroups = [(0, 1, 2), (3, 4, 5), (6, 7, 8)]
-        slicegroups = [tuple(get_slices_from_vertebral_levels(im_vert_level, level)) for level in levels]
+        slicegroups = [tuple(vertlevel_index.get_slices(level)) for level in levels]
         if perlevel:
             # vertgroups = [(2,), (3,), (4,)]
             vertgroups = [tuple([level]) for level in levels]
@@ -250,7 +424,7 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
             # slicegroups = [(0,), (1,), (2,), (3,), (4,), (5,), (6,), (7,), (8,)]
             slicegroups = [tuple([i]) for i in functools.reduce(operator.concat, slicegroups)]  # reduce to individual tuple
             # vertgroups = [(2,), (2,), (2,), (3,), (3,), (3,), (4,), (4,), (4,)]
-            vertgroups = [tuple([get_vertebral_level_from_slice(im_vert_level, i[0])]) for i in slicegroups]
+            vertgroups = [tuple([vertlevel_index.get_level(i[0])]) for i in slicegroups]
         # output aggregate metric across levels
         else:
             # slicegroups = [(0, 1, 2, 3, 4, 5, 6, 7, 8)]
@@ -268,6 +442,22 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
             slicegroups = [tuple(slices)]
     agg_metric = dict((slicegroup, dict()) for slicegroup in slicegroups)
 
+    # ML and MAP estimations of all slice groups are solved at once
+    batch_results = {}
+    if mask is not None and mask.data.ndim == metric.data.ndim + 1:
+        for (name, func) in group_funcs:
+            if func in BATCH_FUNCS:
+                try:
+                    if label_grams is None:
+                        label_grams = {}
+                    if tuple(slicegroups) not in label_grams:
+                        label_grams[tuple(slicegroups)] = LabelGram(mask.data, slicegroups)
+                    batch_results[func] = dict(zip(slicegroups, BATCH_FUNCS[func](
+                        metric.data, label_grams[tuple(slicegroups)], map_clusters)))
+                except (IndexError, ValueError) as e:
+                    # e.g., slices out of the data: errors are reported per slice group below
+                    logging.debug(e)
+
     # loop across slice group
     for slicegroup in slicegroups:
         # add level info
@@ -286,6 +476,9 @@ def aggregate_per_slice_or_level(metric, mask=None, slices=[], levels=[], persli
                     agg_metric[slicegroup]['Size [vox]'] = np.sum(mask_slicegroup.flatten())
                 else:
                     mask_slicegroup = np.ones(data_slicegroup.shape)
+                if func in batch_results:
+                    agg_metric[slicegroup]['{}({})'.format(name, metric.label)] = batch_results[func][slicegroup]
+                    continue
                 # Ignore nonfinite values
                 i_nonfinite = np.where(np.isfinite(data_slicegroup) == False)
                 data_slicegroup[i_nonfinite] = 0.
@@ -353,7 +546,8 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
                    vert_level=None, method=None, label_struc=None, id_label=None, indiv_labels_ids=None):
     """
     Extract metric within a data, using mask and a given method.
-    :param data: Class Metric(): Data (a.k.a. metric) of n-dimension to extract aggregated value from
+    :param data: Class Metric(): Data (a.k.a. metric) of n-dimension to extract aggregated value from. Could be a list
+    of Metric(): the mask is then built once, and the ML/MAP linear systems are shared across metrics.
     :param labels: Class Metric(): Labels of (n+1)dim. The last dim encloses the labels.
     :param slices:
     :param levels:
@@ -365,7 +559,7 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
     :param id_label: int: ID of label to select
     :param indiv_labels_ids: list of int: IDs of labels corresponding to individual (as opposed to combined) labels for
     use with ML or MAP estimation.
-    :return: aggregate_per_slice_or_level()
+    :return: aggregate_per_slice_or_level(), or list of aggregate_per_slice_or_level() if data is a list
     """
     # Initializations
     map_clusters = None
@@ -414,9 +608,12 @@ def extract_metric(data, labels=None, slices=None, levels=None, perslice=True, p
         mask = Metric(data=labels_sum, label=label_struc[id_label].name)
         group_funcs = (('MAX', func_max),)
 
-    return aggregate_per_slice_or_level(data, mask=mask, slices=slices, levels=levels, perslice=perslice,
-                                        perlevel=perlevel, vert_level=vert_level, group_funcs=group_funcs,
-                                        map_clusters=map_clusters)
+    label_grams = {}
+    list_agg_metric = [aggregate_per_slice_or_level(metric, mask=mask, slices=slices, levels=levels, perslice=perslice,
+                                                    perlevel=perlevel, vert_level=vert_level, group_funcs=group_funcs,
+                                                    map_clusters=map_clusters, label_grams=label_grams)
+                       for metric in (data if isinstance(data, list) else [data])]
+    return list_agg_metric if isinstance(data, list) else list_agg_metric[0]
 
 
 def make_a_string(item):
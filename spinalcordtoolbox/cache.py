@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Content-addressed cache of the results of pipeline steps (straightening, segmentation, registration, warping...).
+#
+# A step is identified by a key computed from its name, the content of its input files, its parameters and the version
+# of SCT. When a step completes, its output files are copied in the store under the hash of their content, and the
+# entry (key -> output files and hashes, optional result) is recorded in a SQLite index. When the same step is run
+# again with the same inputs, the outputs are restored from the store (after checking their hash) instead of being
+# recomputed. The least recently used entries are evicted when the store exceeds its maximum size.
+#
+# Hashing the inputs is the main cost of a cache lookup: the hash of each file is therefore recorded with its size,
+# modification time and inode, and only computed again if one of them changed.
+#
+# Usage:
+#     with cache.step('straightening', input_files=['data.nii', 'seg.nii'], params={'algo_fitting': 'bspline'},
+#                     outputs=['warp_curve2straight.nii.gz', 'warp_straight2curve.nii.gz']) as step:
+#         if not step.hit:
+#             ... compute the outputs
+#
+# The cache is disabled by default (see HELP).
+#
+# Environment variables:
+#     SCT_CACHE: set to 1 to enable the cache
+#     SCT_CACHE_DIR: folder of the store (default: ~/.cache/spinalcordtoolbox/steps)
+#     SCT_CACHE_SIZE: maximum size of the store, in GB (default: 10)
+
+from __future__ import absolute_import, division
+
+import os
+import io
+import json
+import time
+import shutil
+import pickle
+import sqlite3
+import hashlib
+import inspect
+import logging
+import functools
+
+from spinalcordtoolbox.utils import __version__
+
+logger = logging.getLogger(__name__)
+
+CACHE_SIZE = 10  # GB
+HASH_CHUNK_SIZE = 1 << 20
+
+# Description of the cache, for the help of the scripts which use it
+HELP = "The outputs of the steps already computed with the same inputs and parameters (e.g., straightening, " \
+       "registration, segmentation) can be reused from a cache, which is disabled by default. It is configured with " \
+       "environment variables: SCT_CACHE=1 enables the cache; SCT_CACHE_DIR sets its folder (default: " \
+       "~/.cache/spinalcordtoolbox/steps); SCT_CACHE_SIZE sets its maximum size, in GB (default: {}).".format(CACHE_SIZE)
+
+
+def _new_hash():
+    # BLAKE2 is faster than MD5/SHA1 on 64-bit platforms, but only available in Python >= 3.6
+    if hasattr(hashlib, 'blake2b'):
+        return hashlib.blake2b(digest_size=20)
+    return hashlib.sha1()
+
+
+def _get_file_stat(fname):
+    """
+    :return: tuple: (size, modification time in ns, inode) of the file
+    """
+    st = os.stat(fname)
+    return st.st_size, getattr(st, 'st_mtime_ns', int(st.st_mtime * 1e9)), st.st_ino
+
+
+def compute_file_hash(fname):
+    """
+    :param fname: path of a file
+    :return: str: hexadecimal hash of the content of the file
+    """
+    h = _new_hash()
+    with io.open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class StepCache(object):
+    """
+    Store of the outputs of pipeline steps, indexed by the signature of their inputs.
+    """
+    def __init__(self, path, max_size=CACHE_SIZE << 30):
+        """
+        :param path: folder of the store. It is created if it does not exist.
+        :param max_size: int: maximum size of the stored files, in bytes
+        """
+        self.path = path
+        self.path_objects = os.path.join(path, 'objects')
+        self.max_size = max_size
+        if not os.path.isdir(self.path_objects):
+            os.makedirs(self.path_objects)
+        self.conn = sqlite3.connect(os.path.join(path, 'index.sqlite'), timeout=60)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime INTEGER, "
+                              "inode INTEGER, hash TEXT)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, name TEXT, outputs TEXT, "
+                              "result BLOB, atime REAL)")
+
+    def hash_file(self, fname):
+        """
+        Hash of the content of a file. The hash is only computed if the size, modification time or inode of the file
+        changed since it was last hashed.
+        :param fname: path of a file
+        :return: str: hexadecimal hash
+        """
+        path = os.path.realpath(fname)
+        stat = _get_file_stat(path)
+        row = self.conn.execute("SELECT size, mtime, inode, hash FROM files WHERE path = ?", (path,)).fetchone()
+        if row is not None and tuple(row[:3]) == stat:
+            return row[3]
+        file_hash = compute_file_hash(path)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)", (path,) + stat + (file_hash,))
+        return file_hash
+
+    def get_key(self, name, input_files=(), params=None, outputs=()):
+        """
+        :param name: str: name of the step
+        :param input_files: list of paths of the files which the outputs depend on (None items are allowed)
+        :param params: dict of parameters which the outputs depend on. Values which are not JSON-serializable are
+        represented by their repr().
+        :param outputs: list of paths of the output files: only their extension is part of the key
+        :return: str: key of the step
+        """
+        h = _new_hash()
+        h.update(json.dumps([name, __version__, params or {}], sort_keys=True, default=repr).encode('utf-8'))
+        for fname in input_files:
+            h.update(b'\0' + (self.hash_file(fname) if fname is not None else 'None').encode('utf-8'))
+        for fname in outputs:
+            h.update(b'\0' + os.path.basename(fname).partition(os.extsep)[2].encode('utf-8'))
+        return h.hexdigest()
+
+    def _get_object(self, file_hash):
+        return os.path.join(self.path_objects, file_hash[:2], file_hash)
+
+    def restore(self, key, outputs=None):
+        """
+        Restore the outputs of a step from the store. Each output file is copied from the store if it does not
+        already exist with the right content, and the content of the stored files is checked against their hash.
+        :param key: key of the step (see get_key)
+        :param outputs: list of paths of the output files (None: the paths with which the step was saved)
+        :return: tuple: (True, result) if the outputs were restored, (False, None) otherwise
+        """
+        row = self.conn.execute("SELECT outputs, result FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return False, None
+        list_output = json.loads(row[0])
+        if outputs is None:
+            outputs = [fname for fname, _ in list_output]
+        if len(outputs) != len(list_output):
+            return False, None
+        for fname, (_, file_hash) in zip(outputs, list_output):
+            if os.path.isfile(fname) and self.hash_file(fname) == file_hash:
+                continue
+            fname_object = self._get_object(file_hash)
+            if not os.path.isfile(fname_object) or self.hash_file(fname_object) != file_hash:
+                logger.warning("Cached output of %s is missing or corrupted, the step will be run again", fname)
+                self.remove(key)
+                return False, None
+            path_out = os.path.dirname(os.path.abspath(fname))
+            if not os.path.isdir(path_out):
+                os.makedirs(path_out)
+            shutil.copyfile(fname_object, fname)
+            # record the hash of the copy, to avoid hashing it when it is used as the input of another step
+            self.hash_file_as(fname, file_hash)
+        with self.conn:
+            self.conn.execute("UPDATE entries SET atime = ? WHERE key = ?", (time.time(), key))
+        return True, pickle.loads(bytes(row[1])) if row[1] is not None else None
+
+    def hash_file_as(self, fname, file_hash):
+        """
+        Record the hash of a file whose content is known (e.g., a copy of a stored file)
+        """
+        path = os.path.realpath(fname)
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)",
+                              (path,) + _get_file_stat(path) + (file_hash,))
+
+    def save(self, key, name, outputs, result=None):
+        """
+        Copy the outputs of a step in the store, and record the entry of the step.
+        :param key: key of the step (see get_key)
+        :param name: str: name of the step
+        :param outputs: list of paths of the output files
+        :param result: picklable object returned by the step, restored with the outputs
+        """
+        list_output = []
+        for fname in outputs:
+            file_hash = self.hash_file(fname)
+            fname_object = self._get_object(file_hash)
+            if not os.path.isfile(fname_object):
+                if not os.path.isdir(os.path.dirname(fname_object)):
+                    os.makedirs(os.path.dirname(fname_object))
+                # copy then rename, so that other processes never see a partial file
+                fname_tmp = '{}.{}.tmp'.format(fname_object, os.getpid())
+                shutil.copyfile(fname, fname_tmp)
+                os.rename(fname_tmp, fname_object)
+                self.hash_file_as(fname_object, file_hash)
+            list_output.append((fname, file_hash))
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                              (key, name, json.dumps(list_output),
+                               sqlite3.Binary(pickle.dumps(result, protocol=2)) if result is not None else None,
+                               time.time()))
+        self.evict()
+
+    def remove(self, key):
+        with self.conn:
+            self.conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def evict(self, max_size=None):
+        """
+        Remove the least recently used entries until the stored files fit in max_size, and delete the stored files
+        which are not used by any entry.
+        :param max_size: int: maximum size of the stored files, in bytes (default: self.max_size)
+        """
+        if max_size is None:
+            max_size = self.max_size
+        entries = self.conn.execute("SELECT key, outputs FROM entries ORDER BY atime").fetchall()
+        # number of entries which use each stored file
+        refcount = {}
+        for _, outputs in entries:
+            for _, file_hash in json.loads(outputs):
+                refcount[file_hash] = refcount.get(file_hash, 0) + 1
+        list_unused = []
+        for dirpath, _, filenames in os.walk(self.path_objects):
+            # N.B. the temporary files of the objects being saved by other processes are kept
+            list_unused += [filename for filename in filenames
+                            if filename not in refcount and not filename.endswith('.tmp')]
+        object_size = {file_hash: os.path.getsize(self._get_object(file_hash)) for file_hash in refcount
+                     if os.path.isfile(self._get_object(file_hash))}
+        size = sum(object_size.values())
+        list_evicted = []
+        for key, outputs in entries:
+            if size <= max_size:
+                break
+            list_evicted.append(key)
+            for _, file_hash in json.loads(outputs):
+                refcount[file_hash] -= 1
+                if refcount[file_hash] == 0:
+                    size -= object_size.get(file_hash, 0)
+                    list_unused.append(file_hash)
+        if list_evicted:
+            logger.debug("Evicting %d cached step(s)", len(list_evicted))
+            with self.conn:
+                self.conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key in list_evicted])
+        for file_hash in list_unused:
+            fname_object = self._get_object(file_hash)
+            try:
+                os.remove(fname_object)
+            except OSError:
+                pass
+        # forget the hashes of the files which do not exist anymore (e.g., temporary files)
+        list_missing = [(path,) for path, in self.conn.execute("SELECT path FROM files") if not os.path.isfile(path)]
+        with self.conn:
+            self.conn.executemany("DELETE FROM files WHERE path = ?", list_missing)
+
+    def get_size(self):
+        """
+        :return: int: size of the stored files, in bytes
+        """
+        size = 0
+        for dirpath, _, filenames in os.walk(self.path_objects):
+            size += sum(os.path.getsize(os.path.join(dirpath, filename)) for filename in filenames)
+        return size
+
+    def clear(self):
+        """
+        Remove all entries and stored files
+        """
+        with self.conn:
+            self.conn.execute("DELETE FROM entries")
+        self.evict()
+
+    def close(self):
+        self.conn.close()
+
+    def step(self, name, input_files=(), params=None, outputs=None):
+        """
+        :return: Step context manager (see Step)
+        """
+        return Step(self, name, input_files, params, outputs)
+
+
+class Step(object):
+    """
+    Context manager of a cached step. On entry, the outputs are restored from the store if the step was already run
+    with the same inputs (hit is then True, and the body should not compute them again). On exit, if the step was
+    computed without error, its outputs are saved in the store.
+
+    If the paths of the outputs are only known once the step is computed, set the attribute outputs in the body: the
+    outputs are then restored to the same paths (relative paths are relative to the current directory). The attribute
+    result can also be set to a picklable object (e.g., the value returned by the step), which is restored with the
+    outputs.
+
+    Errors of the store (e.g., full disk, locked database) are logged, and the step is then simply not cached.
+    """
+    def __init__(self, cache, name, input_files=(), params=None, outputs=None):
+        """
+        :param cache: StepCache, or None to disable caching
+        :param name: str: name of the step
+        :param input_files: list of paths of the input files
+        :param params: dict of parameters
+        :param outputs: list of paths of the output files
+        """
+        self.cache = cache
+        self.name = name
+        self.input_files = list(input_files)
+        self.params = params
+        self.outputs = list(outputs) if outputs is not None else None
+        self.key = None
+        self.hit = False
+        self.result = None
+
+    def __enter__(self):
+        if self.cache is None:
+            return self
+        try:
+            self.key = self.cache.get_key(self.name, self.input_files, self.params, self.outputs or ())
+            self.hit, result = self.cache.restore(self.key, self.outputs)
+        except (EnvironmentError, sqlite3.Error) as e:
+            logger.warning("Cannot restore step %s from the cache: %s", self.name, e)
+            self.key = None
+            self.hit = False
+        else:
+            if self.hit:
+                self.result = result
+                logger.info("Reusing the cached outputs of step %s", self.name)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or self.hit or self.key is None or not self.outputs:
+            return False
+        try:
+            self.cache.save(self.key, self.name, self.outputs, result=self.result)
+        except (EnvironmentError, sqlite3.Error) as e:
+            logger.warning("Cannot save step %s in the cache: %s", self.name, e)
+        return False
+
+
+_cache = {}
+
+
+def get_cache():
+    """
+    :return: StepCache of the folder SCT_CACHE_DIR, or None if the cache is not enabled (SCT_CACHE=1)
+    """
+    if os.environ.get('SCT_CACHE', '0') != '1':
+        return None
+    path = os.environ.get('SCT_CACHE_DIR',
+                          os.path.join(os.path.expanduser('~'), '.cache', 'spinalcordtoolbox', 'steps'))
+    if path not in _cache:
+        try:
+            _cache[path] = StepCache(path, max_size=int(float(os.environ.get('SCT_CACHE_SIZE', CACHE_SIZE)) * (1 << 30)))
+        except (EnvironmentError, sqlite3.Error) as e:
+            logger.warning("Cannot open the cache %s: %s", path, e)
+            _cache[path] = None
+    return _cache[path]
+
+
+def step(name, input_files=(), params=None, outputs=None):
+    """
+    Cached step in the default store (see get_cache and Step).
+    :param name: str: name of the step
+    :param input_files: list of paths of the input files
+    :param params: dict of parameters
+    :param outputs: list of paths of the output files
+    :return: Step context manager
+    """
+    return Step(get_cache(), name, input_files, params, outputs)
+
+
+def cached(input_files=(), outputs=(), name=None):
+    """
+    Decorator of a function whose outputs are files: the function is only called if its outputs are not in the cache.
+    The arguments which are not input or output files are the parameters of the step, and the value returned by the
+    function is restored with the outputs.
+    :param input_files: names of the arguments which are paths of input files (or lists of paths)
+    :param outputs: names of the arguments which are paths of output files (or lists of paths)
+    :param name: name of the step (default: module and name of the function)
+    """
+    def _get_list(callargs, names):
+        list_fname = []
+        for arg in names:
+            value = callargs[arg]
+            list_fname += list(value) if isinstance(value, (list, tuple)) else [value]
+        return list_fname
+
+    def decorator(func):
+        name_step = name or '{}.{}'.format(func.__module__, func.__name__)
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            callargs = inspect.getcallargs(func, *args, **kwargs)
+            params = {arg: value for arg, value in callargs.items() if arg not in tuple(input_files) + tuple(outputs)}
+            with step(name_step, _get_list(callargs, input_files), params, _get_list(callargs, outputs)) as s:
+                if not s.hit:
+                    s.result = func(*args, **kwargs)
+            return s.result
+        return wrapper
+    return decorator
@@ -14,6 +14,7 @@ import json
 import os
 import sys
 import io
+import logging
 
 import nibabel as nib
 import numpy as np
@@ -32,16 +33,21 @@ except Exception as e:
 else:
     sys.stderr = original_stderr
 
-from spinalcordtoolbox import resampling
+from spinalcordtoolbox import resampling, inference
 from . import model
 from ..utils import __data_dir__
 
+logger = logging.getLogger(__name__)
 
 # Suppress warnings and TensorFlow logging
 warnings.simplefilter(action='ignore', category=FutureWarning)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 SMALL_INPUT_SIZE = 200
 BATCH_SIZE = 4
+# Number of random augmentations of the test-time augmentation (TTA), and number of slices whose augmentations are
+# predicted together
+TTA_NB_AUGMENTATIONS = 8
+TTA_NB_SLICES = 16
 
 
 def check_backend():
@@ -200,8 +206,62 @@ def threshold_predictions(predictions, thr=0.999):
     return thresholded_preds
 
 
+def predict_tta(deepgmseg_model, axial_slices, threshold=None, tta_margin=None):
+    """Predict axial slices with TTA (test-time augmentation): the
+    prediction is averaged with the predictions of the slices shifted by
+    random intensity offsets (the same offsets for all the slices).
+
+    The augmented slices are interleaved in the same predict batches, and
+    the mean is accumulated in place, so that only one prediction tensor
+    is kept in memory.
+
+    :param deepgmseg_model: the model.
+    :param axial_slices: the normalized slices (slices, height, width, 1).
+    :param threshold: threshold which will be applied to the predictions
+                      (if None, 0.5 is used to find uncertain slices).
+    :param tta_margin: if set, TTA is only used on uncertain slices, i.e.
+                       the slices with pixels whose prediction is within
+                       tta_margin of the threshold. The other slices keep
+                       their prediction without augmentation.
+    :return: averaged predictions.
+    """
+    offsets = [np.random.uniform(high=2.0) for i in range(TTA_NB_AUGMENTATIONS)]
+    if tta_margin is None:
+        preds = None
+        offsets.append(0.0)
+        slices_tta = np.arange(len(axial_slices))
+    else:
+        preds = deepgmseg_model.predict(axial_slices, batch_size=BATCH_SIZE,
+                                        verbose=True)
+        center = 0.5 if threshold is None else threshold
+        uncertain = (np.abs(preds - center) < tta_margin).any(axis=tuple(range(1, preds.ndim)))
+        slices_tta = np.where(uncertain)[0]
+        logger.info("TTA on {} uncertain slices (out of {})".format(len(slices_tta), len(axial_slices)))
+
+    for i in range(0, len(slices_tta), TTA_NB_SLICES):
+        slices_batch = slices_tta[i:i + TTA_NB_SLICES]
+        # the augmentations of each slice are consecutive
+        sampled_axial_slices = np.concatenate([axial_slices[slices_batch, np.newaxis] + offset
+                                               for offset in offsets], axis=1)
+        sampled_axial_slices = sampled_axial_slices.reshape((-1,) + axial_slices.shape[1:])
+        sampled_preds = deepgmseg_model.predict(sampled_axial_slices,
+                                                batch_size=BATCH_SIZE,
+                                                verbose=True)
+        sampled_preds = sampled_preds.reshape((len(slices_batch), len(offsets)) + sampled_preds.shape[1:])
+        if preds is None:
+            preds = np.zeros((len(axial_slices),) + sampled_preds.shape[2:], dtype=np.float32)
+        preds[slices_batch] += sampled_preds.sum(axis=1)
+
+    if preds is None:
+        # no slice to predict: the output has the shape of the (empty) input, as with deepgmseg_model.predict()
+        return np.zeros(axial_slices.shape, dtype=np.float32)
+    nb_predictions = TTA_NB_AUGMENTATIONS + 1
+    preds[slices_tta] /= nb_predictions
+    return preds
+
+
 def segment_volume(ninput_volume, model_name,
-                   threshold=0.999, use_tta=False):
+                   threshold=0.999, use_tta=False, tta_margin=None):
     """Segment a nifti volume.
 
     :param ninput_volume: the input volume.
@@ -209,6 +269,8 @@ def segment_volume(ninput_volume, model_name,
     :param threshold: threshold to be applied in predictions.
     :param use_tta: whether TTA (test-time augmentation)
                     should be used or not.
+    :param tta_margin: if set, TTA is only used on uncertain slices
+                       (see predict_tta()).
     :return: segmented slices.
     """
     gmseg_model_challenge = DataResource('deepseg_gm_models')
@@ -228,11 +290,15 @@ def segment_volume(ninput_volume, model_name,
         # larger sizer, crop at 200x200
         net_input_size = (SMALL_INPUT_SIZE, SMALL_INPUT_SIZE)
 
-    deepgmseg_model = model.create_model(metadata['filters'],
-                                         net_input_size)
-
     model_abs_path = gmseg_model_challenge.get_file_path(model_path)
-    deepgmseg_model.load_weights(model_abs_path)
+
+    def load_model():
+        deepgmseg_model = model.create_model(metadata['filters'],
+                                             net_input_size)
+        deepgmseg_model.load_weights(model_abs_path)
+        return deepgmseg_model
+    deepgmseg_model = inference.get_model(model_abs_path, (model_name, tuple(net_input_size)), load_model,
+                                          data_format='channels_last')
 
     volume_data = ninput_volume.get_data()
     axial_slices = []
@@ -255,21 +321,8 @@ def segment_volume(ninput_volume, model_name,
     axial_slices = normalization(axial_slices)
 
     if use_tta:
-        pred_sampled = []
-        for i in range(8):
-            sampled_value = np.random.uniform(high=2.0)
-            sampled_axial_slices = axial_slices + sampled_value
-            preds = deepgmseg_model.predict(sampled_axial_slices,
-                                            batch_size=BATCH_SIZE,
-                                            verbose=True)
-            pred_sampled.append(preds)
-
-        preds = deepgmseg_model.predict(axial_slices, batch_size=BATCH_SIZE,
-                                        verbose=True)
-        pred_sampled.append(preds)
-        pred_sampled = np.asarray(pred_sampled)
-        pred_sampled = np.mean(pred_sampled, axis=0)
-        preds = threshold_predictions(pred_sampled, threshold)
+        preds = predict_tta(deepgmseg_model, axial_slices, threshold, tta_margin)
+        preds = threshold_predictions(preds, threshold)
     else:
         preds = deepgmseg_model.predict(axial_slices, batch_size=BATCH_SIZE,
                                         verbose=True)
@@ -292,7 +345,7 @@ def segment_volume(ninput_volume, model_name,
 
 def segment_file(input_filename, output_filename,
                  model_name, threshold, verbosity,
-                 use_tta):
+                 use_tta, tta_margin=None):
     """Segment a volume file.
 
     :param input_filename: the input filename.
@@ -303,6 +356,8 @@ def segment_file(input_filename, output_filename,
     :param verbosity: the verbosity level.
     :param use_tta: whether it should use TTA (test-time augmentation)
                     or not.
+    :param tta_margin: if set, TTA is only used on uncertain slices
+                       (see predict_tta()).
     :return: the output filename.
     """
     nii_original = nib.load(input_filename)
@@ -312,7 +367,7 @@ def segment_file(input_filename, output_filename,
     nii_resampled = resampling.resample_nib(
         nii_original, new_size=target_resample, new_size_type='mm', interpolation='linear')
     pred_slices = segment_volume(nii_resampled, model_name, threshold,
-                                 use_tta)
+                                 use_tta, tta_margin)
 
     original_res = [
         nii_original.header["pixdim"][1],
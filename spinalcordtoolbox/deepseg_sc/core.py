@@ -2,15 +2,16 @@
 # -*- coding: utf-8
 # Functions dealing with deepseg_sc
 
-import os, sys, logging
+import os, sys, logging, time
 
 import numpy as np
+import psutil
 from scipy.ndimage.measurements import center_of_mass, label
 from skimage.exposure import rescale_intensity
 from scipy.ndimage import distance_transform_edt
 import nibabel as nib
 
-from spinalcordtoolbox import resampling
+from spinalcordtoolbox import resampling, inference
 from .cnn_models import nn_architecture_seg, nn_architecture_ctr
 from .postprocessing import post_processing_volume_wise, keep_largest_object, fill_holes_2d
 from spinalcordtoolbox.image import Image, empty_like, change_type, zeros_like
@@ -21,7 +22,16 @@ from sct_image import concat_data, split_data
 
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
-BATCH_SIZE = 4
+# Maximum number of slices predicted at once by the 2D CNN, and fraction of the available memory that can be used by
+# a batch (see get_batch_size())
+MAX_BATCH_SIZE_2D = 128
+BATCH_MEMORY_FRACTION = 0.25
+# Maximum number of 3D patches predicted at once, and number of slices shared by consecutive 3D patches (see
+# predict_patches_3d())
+MAX_BATCH_SIZE_3D = 8
+OVERLAP_3D = 0
+# Number of consecutive axial slices scanned at once by the centerline detection when the SC is lost (see heatmap())
+NB_SLICES_SCAN = 4
 # Thresholds to apply to binarize segmentations from the output of the 2D CNN. These thresholds were obtained by
 # minimizing the standard deviation of cross-sectional area across contrasts. For more details, see:
 # https://github.com/sct-pipeline/deepseg-threshold
@@ -75,18 +85,21 @@ def find_centerline(algo, image_fname, contrast_type, brain_bool, folder_output,
 
         # load model
         ctr_model_fname = os.path.join(sct.__sct_dir__, 'data', 'deepseg_sc_models', '{}_ctr.h5'.format(contrast_type))
-        ctr_model = nn_architecture_ctr(height=dct_patch_ctr[contrast_type]['size'][0],
-                                        width=dct_patch_ctr[contrast_type]['size'][1],
-                                        channels=1,
-                                        classes=1,
-                                        features=dct_params_ctr[contrast_type]['features'],
-                                        depth=2,
-                                        temperature=1.0,
-                                        padding='same',
-                                        batchnorm=True,
-                                        dropout=0.0,
-                                        dilation_layers=dct_params_ctr[contrast_type]['dilation_layers'])
-        ctr_model.load_weights(ctr_model_fname)
+        def load_ctr_model():
+            ctr_model = nn_architecture_ctr(height=dct_patch_ctr[contrast_type]['size'][0],
+                                            width=dct_patch_ctr[contrast_type]['size'][1],
+                                            channels=1,
+                                            classes=1,
+                                            features=dct_params_ctr[contrast_type]['features'],
+                                            depth=2,
+                                            temperature=1.0,
+                                            padding='same',
+                                            batchnorm=True,
+                                            dropout=0.0,
+                                            dilation_layers=dct_params_ctr[contrast_type]['dilation_layers'])
+            ctr_model.load_weights(ctr_model_fname)
+            return ctr_model
+        ctr_model = inference.get_model(ctr_model_fname, contrast_type, load_ctr_model, data_format='channels_last')
 
         # compute the heatmap
         im_heatmap, z_max = heatmap(im=im,
@@ -94,7 +107,8 @@ def find_centerline(algo, image_fname, contrast_type, brain_bool, folder_output,
                                     patch_shape=dct_patch_ctr[contrast_type]['size'],
                                     mean_train=dct_patch_ctr[contrast_type]['mean'],
                                     std_train=dct_patch_ctr[contrast_type]['std'],
-                                    brain_bool=brain_bool)
+                                    brain_bool=brain_bool,
+                                    nb_slices_scan=NB_SLICES_SCAN)
         im_ctl, _, _, _ = get_centerline(im_heatmap,
                                         ParamCenterline(algo_fitting='optic', contrast=contrast_type))
 
@@ -185,16 +199,44 @@ def crop_image_around_centerline(im_in, ctr_in, crop_size):
     return x_lst, y_lst, z_lst, im_new
 
 
-def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_out_dim):
-    """Scan the entire axial slice to detect the centerline."""
+def _predict_blocks(blocks, model, mean_train, std_train):
+    """
+    Predict a stack of blocks at once.
+    :param blocks: ndarray (n, x, y)
+    :return: ndarray (n, x, y): predictions
+    """
+    blocks_nn = _normalize_data(blocks[..., np.newaxis].astype(np.float32), mean_train, std_train)
+    return model.predict(blocks_nn, batch_size=min(len(blocks_nn), MAX_BATCH_SIZE_2D))[..., 0]
+
+
+def predict_slice_blocks(data_im, z_lst, model, mean_train, std_train, coord_lst):
+    """
+    Predict all the blocks of several axial slices at once, in a single batch.
+    :param data_im: ndarray (x, y, z)
+    :param z_lst: list of slice indices
+    :param coord_lst: coordinates of the blocks, see scan_slice()
+    :return: list (one item per slice) of dict {tuple(coord): prediction of the block}
+    """
+    blocks = np.stack([data_im[coord[0]:coord[2], coord[1]:coord[3], zz] for zz in z_lst for coord in coord_lst])
+    blocks_pred = _predict_blocks(blocks, model, mean_train, std_train)
+    nb_blocks = len(coord_lst)
+    return [{tuple(coord): blocks_pred[i_z * nb_blocks + i_block] for i_block, coord in enumerate(coord_lst)}
+            for i_z in range(len(z_lst))]
+
+
+def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_out_dim, blocks_pred=None):
+    """
+    Scan the entire axial slice to detect the centerline.
+    :param blocks_pred: predictions of the blocks of the slice, as returned by predict_slice_blocks(). If None, all the
+    blocks are predicted at once.
+    """
+    if blocks_pred is None:
+        blocks_pred = predict_slice_blocks(z_slice[:, :, np.newaxis], [0], model, mean_train, std_train, coord_lst)[0]
     z_slice_out = np.zeros(z_out_dim)
     sum_lst = []
     # loop across all the non-overlapping blocks of a cross-sectional slice
     for idx, coord in enumerate(coord_lst):
-        block = z_slice[coord[0]:coord[2], coord[1]:coord[3]]
-        block_nn = np.expand_dims(np.expand_dims(block, 0), -1)
-        block_nn_norm = _normalize_data(block_nn, mean_train, std_train)
-        block_pred = model.predict(block_nn_norm, batch_size=BATCH_SIZE)
+        block_pred = blocks_pred[tuple(coord)]
 
         if coord[2] > z_out_dim[0]:
             x_end = patch_shape[0] - (coord[2] - z_out_dim[0])
@@ -205,8 +247,8 @@ def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_
         else:
             y_end = patch_shape[1]
 
-        z_slice_out[coord[0]:coord[2], coord[1]:coord[3]] = block_pred[0, :x_end, :y_end, 0]
-        sum_lst.append(np.sum(block_pred[0, :x_end, :y_end, 0]))
+        z_slice_out[coord[0]:coord[2], coord[1]:coord[3]] = block_pred[:x_end, :y_end]
+        sum_lst.append(np.sum(block_pred[:x_end, :y_end]))
 
     # Put first the coord of the patch were the centerline is likely located so that the search could be faster for the
     # next axial slices
@@ -225,8 +267,12 @@ def scan_slice(z_slice, model, mean_train, std_train, coord_lst, patch_shape, z_
     return z_slice_out, x_CoM, y_CoM, coord_lst
 
 
-def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
-    """Compute the heatmap with CNN_1 representing the SC localization."""
+def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True, nb_slices_scan=1):
+    """
+    Compute the heatmap with CNN_1 representing the SC localization.
+    :param nb_slices_scan: int: when the SC is lost, number of consecutive axial slices which are scanned at once (in
+    a single batch). The predictions of the following slices are only used if the SC is still lost there.
+    """
     data_im = im.data.astype(np.float32)
     im_out = change_type(im, "uint8")
     del im
@@ -255,6 +301,8 @@ def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
 
     x_CoM, y_CoM = None, None
     z_sc_notDetected_cmpt = 0
+    # predictions of the blocks of the slices scanned in advance
+    scan_cache = {}
     for zz in range(data_im.shape[2]):
         # if SC was detected at zz-1, we will start doing the detection on the block centered around the previously
         # computed center of mass (CoM)
@@ -262,10 +310,7 @@ def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
             z_sc_notDetected_cmpt = 0  # SC detected, cmpt set to zero
             x_0, x_1 = _find_crop_start_end(x_CoM, patch_shape[0], data_im.shape[0])
             y_0, y_1 = _find_crop_start_end(y_CoM, patch_shape[1], data_im.shape[1])
-            block = data_im[x_0:x_1, y_0:y_1, zz]
-            block_nn = np.expand_dims(np.expand_dims(block, 0), -1)
-            block_nn_norm = _normalize_data(block_nn, mean_train, std_train)
-            block_pred = model.predict(block_nn_norm, batch_size=BATCH_SIZE)
+            block_pred = _predict_blocks(data_im[np.newaxis, x_0:x_1, y_0:y_1, zz], model, mean_train, std_train)
 
             # coordinates manipulation due to the above padding and cropping
             if x_1 > data.shape[0]:
@@ -281,7 +326,7 @@ def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
             else:
                 y_end = patch_shape[1]
 
-            data[x_0:x_1, y_0:y_1, zz] = block_pred[0, :x_end, :y_end, 0]
+            data[x_0:x_1, y_0:y_1, zz] = block_pred[0, :x_end, :y_end]
 
             # computation of the new center of mass
             if np.max(data[:, :, zz]) > 0.5:
@@ -294,9 +339,14 @@ def heatmap(im, model, patch_shape, mean_train, std_train, brain_bool=True):
         # if the SC was not detected at zz-1 or on the patch centered around CoM in slice zz, the entire cross-sectional
         # slice is scanned
         if x_CoM is None:
+            if zz not in scan_cache:
+                z_lst = list(range(zz, min(zz + nb_slices_scan, data_im.shape[2])))
+                scan_cache = dict(zip(z_lst, predict_slice_blocks(data_im, z_lst, model, mean_train, std_train,
+                                                                  coord_lst)))
             z_slice, x_CoM, y_CoM, coord_lst = scan_slice(data_im[:, :, zz], model,
                                                           mean_train, std_train,
-                                                          coord_lst, patch_shape, data.shape[:2])
+                                                          coord_lst, patch_shape, data.shape[:2],
+                                                          blocks_pred=scan_cache.pop(zz))
             data[:, :, zz] = z_slice
 
             z_sc_notDetected_cmpt += 1
@@ -331,35 +381,133 @@ def _normalize_data(data, mean, std):
     return data
 
 
-def segment_2d(model_fname, contrast_type, input_size, im_in):
+def get_batch_size(bytes_per_item, max_batch_size, memory_fraction=BATCH_MEMORY_FRACTION, memory_budget=None):
+    """
+    Get the number of items (e.g., slices) which can be processed at once, given the available memory.
+    :param bytes_per_item: int: estimated memory needed to process one item
+    :param max_batch_size: int: upper bound of the batch size
+    :param memory_fraction: float: fraction of the available memory that can be used by a batch
+    :param memory_budget: int: memory (in bytes) that can be used by a batch. If set, memory_fraction is ignored.
+    :return: int: batch size
     """
-    Segment data using 2D convolutions.
+    if memory_budget is None:
+        memory_budget = psutil.virtual_memory().available * memory_fraction
+    return int(np.clip(memory_budget // bytes_per_item, 1, max_batch_size))
+
+
+def segment_2d(model_fname, contrast_type, input_size, im_in, batch_size=None):
+    """
+    Segment data using 2D convolutions. The axial slices are predicted by batches, which are written directly into the
+    output array.
+    :param batch_size: int: number of slices predicted at once. If None, the batch size is set according to the
+    available memory. 1: predict slice by slice.
     :return: seg_crop.data: ndarray float32: Output prediction
     """
-    seg_model = nn_architecture_seg(height=input_size[0],
-                                    width=input_size[1],
-                                    depth=2 if contrast_type != 't2' else 3,
-                                    features=32,
-                                    batchnorm=False,
-                                    dropout=0.0)
-    seg_model.load_weights(model_fname)
+    def load_seg_model():
+        seg_model = nn_architecture_seg(height=input_size[0],
+                                        width=input_size[1],
+                                        depth=2 if contrast_type != 't2' else 3,
+                                        features=32,
+                                        batchnorm=False,
+                                        dropout=0.0)
+        seg_model.load_weights(model_fname)
+        return seg_model
+    seg_model = inference.get_model(model_fname, (contrast_type, tuple(input_size)), load_seg_model,
+                                    data_format='channels_last')
 
     seg_crop = zeros_like(im_in, dtype=np.float32)
 
     data_norm = im_in.data
-    # TODO: use tqdm
-    for zz in range(im_in.dim[2]):
-        # 2D CNN prediction
-        pred_seg = seg_model.predict(np.expand_dims(np.expand_dims(data_norm[:, :, zz], -1), 0),
-                                     batch_size=BATCH_SIZE)[0, :, :, 0]
-        seg_crop.data[:, :, zz] = pred_seg
+    nz = im_in.dim[2]
+    if batch_size is None:
+        # the activations of the network take about 10 times the memory of the first layer's feature maps
+        batch_size = get_batch_size(bytes_per_item=10 * 32 * 4 * input_size[0] * input_size[1],
+                                    max_batch_size=MAX_BATCH_SIZE_2D)
+    time_start = time.time()
+    for z_start in range(0, nz, batch_size):
+        z_stop = min(z_start + batch_size, nz)
+        # 2D CNN prediction: the slices are stacked along the first (batch) axis
+        batch = np.moveaxis(data_norm[:, :, z_start:z_stop], 2, 0)[..., np.newaxis]
+        pred_seg = seg_model.predict(batch, batch_size=batch.shape[0])
+        seg_crop.data[:, :, z_start:z_stop] = np.moveaxis(pred_seg[..., 0], 0, 2)
+    duration = time.time() - time_start
+    logger.info("Segmented {} slices in {:.1f}s ({:.1f} slices/s, batch size: {})".format(
+        nz, duration, nz / max(duration, 1e-6), batch_size))
 
     return seg_crop.data
 
 
-def segment_3d(model_fname, contrast_type, im_in):
+def _get_patch_starts(nz, z_patch_size, overlap):
+    """
+    :return: list of the first slice of each patch along z, so that the patches cover the nz slices
+    """
+    step = max(z_patch_size - overlap, 1)
+    z_starts = [0]
+    while z_starts[-1] + z_patch_size < nz:
+        z_starts.append(z_starts[-1] + step)
+    return z_starts
+
+
+def predict_patches_3d(model, data, patch_size, mean_train, std_train, batch_size=None, overlap=OVERLAP_3D,
+                       memory_budget=None):
+    """
+    Predict a volume with a 3D CNN (channels first), by patches along the z axis. The in-plane size of the volume is
+    the one of the patches (i.e., the volume is cropped around the centerline), and the last patch is padded with
+    zeros. Empty patches (e.g., outside of the centerline crop, or after a brain detection) are not predicted, and the
+    other patches are predicted by batches.
+    :param model: Keras model
+    :param data: ndarray (x, y, z)
+    :param patch_size: size of the patches (x, y, z)
+    :param batch_size: int: number of patches predicted at once. If None, the batch size is set according to the
+    memory budget.
+    :param overlap: int: number of slices shared by consecutive patches. With overlap, the predictions are blended with
+    weights which decrease linearly towards the borders of the patches, to remove the seams between patches. 0: the
+    patches do not overlap.
+    :param memory_budget: int: memory (in bytes) that can be used by a batch (default: a fraction of the available
+    memory)
+    :return: ndarray float32 (x, y, z): predictions (0 where the patches are empty)
+    """
+    z_patch_size = patch_size[2]
+    nz = data.shape[2]
+    if batch_size is None:
+        # the activations of the network take about 64 times the memory of the input patch
+        batch_size = get_batch_size(bytes_per_item=64 * 4 * int(np.prod(patch_size)),
+                                    max_batch_size=MAX_BATCH_SIZE_3D, memory_budget=memory_budget)
+
+    # patches which are not empty
+    z_starts = [zz for zz in _get_patch_starts(nz, z_patch_size, overlap) if np.any(data[:, :, zz:zz + z_patch_size])]
+
+    # blending weights along z, which decrease linearly in the overlapping slices (constant if there is no overlap)
+    index = np.arange(z_patch_size)
+    weights = np.minimum(1., np.minimum(index + 1, z_patch_size - index) / float(overlap + 1)).astype(np.float32)
+    pred_sum = np.zeros(data.shape, dtype=np.float32)
+    weight_sum = np.zeros(nz, dtype=np.float32)
+
+    time_start = time.time()
+    for i_batch in range(0, len(z_starts), batch_size):
+        z_starts_batch = z_starts[i_batch:i_batch + batch_size]
+        patches = np.zeros((len(z_starts_batch), 1) + tuple(patch_size), dtype=np.float32)
+        for i, zz in enumerate(z_starts_batch):
+            patch = data[:, :, zz:zz + z_patch_size]
+            patches[i, 0, :, :, :patch.shape[2]] = patch
+        patches_pred = model.predict(_normalize_data(patches, mean_train, std_train), batch_size=len(patches))
+        for i, zz in enumerate(z_starts_batch):
+            z_extracted = min(z_patch_size, nz - zz)
+            pred_sum[:, :, zz:zz + z_extracted] += patches_pred[i, 0, :, :, :z_extracted] * weights[:z_extracted]
+            weight_sum[zz:zz + z_extracted] += weights[:z_extracted]
+    logger.info("Predicted {} patches (out of {}) in {:.1f}s (batch size: {}, overlap: {})".format(
+        len(z_starts), len(_get_patch_starts(nz, z_patch_size, overlap)), time.time() - time_start, batch_size,
+        overlap))
+
+    weight_sum[weight_sum == 0] = 1
+    return pred_sum / weight_sum
+
+
+def segment_3d(model_fname, contrast_type, im_in, batch_size=None, overlap=OVERLAP_3D):
     """
     Perform segmentation with 3D convolutions.
+    :param batch_size: int: number of patches predicted at once, see predict_patches_3d()
+    :param overlap: int: number of slices shared by consecutive patches, see predict_patches_3d()
     :return: seg_crop.data: ndarray float32: Output prediction
     """
     from spinalcordtoolbox.deepseg_sc.cnn_models_3d import load_trained_model
@@ -367,36 +515,14 @@ def segment_3d(model_fname, contrast_type, im_in):
                        't2s': {'size': (96, 96, 48), 'mean': 87.0212, 'std': 64.425},
                        't1': {'size': (64, 64, 48), 'mean': 88.5001, 'std': 66.275}}
     # load 3d model
-    seg_model = load_trained_model(model_fname)
+    seg_model = inference.get_model(model_fname, contrast_type, lambda: load_trained_model(model_fname))
 
     out = zeros_like(im_in, dtype=np.float32)
 
     # segment the spinal cord
-    z_patch_size = dct_patch_sc_3d[contrast_type]['size'][2]
-    z_step_keep = list(range(0, im_in.data.shape[2], z_patch_size))
-    # TODO: use tqdm
-    for zz in z_step_keep:
-        if zz == z_step_keep[-1]:  # deal with instances where the im.data.shape[2] % patch_size_z != 0
-            patch_im = np.zeros(dct_patch_sc_3d[contrast_type]['size'])
-            z_patch_extracted = im_in.data.shape[2] - zz
-            patch_im[:, :, :z_patch_extracted] = im_in.data[:, :, zz:]
-        else:
-            z_patch_extracted = z_patch_size
-            patch_im = im_in.data[:, :, zz:z_patch_size + zz]
-
-        if np.any(patch_im):  # Check if the patch is (not) empty, which could occur after a brain detection.
-            patch_norm = \
-                _normalize_data(patch_im, dct_patch_sc_3d[contrast_type]['mean'], dct_patch_sc_3d[contrast_type]['std'])
-            patch_pred_proba = \
-                seg_model.predict(np.expand_dims(np.expand_dims(patch_norm, 0), 0), batch_size=BATCH_SIZE)
-            # pred_seg_th = (patch_pred_proba > 0.5).astype(int)[0, 0, :, :, :]
-            pred_seg_th = patch_pred_proba[0, 0, :, :, :]  # TODO: clarified variable (this is not thresholded!)
-
-            # TODO: add comment about what the code is doing below
-            if zz == z_step_keep[-1]:
-                out.data[:, :, zz:] = pred_seg_th[:, :, :z_patch_extracted]
-            else:
-                out.data[:, :, zz:z_patch_size + zz] = pred_seg_th
+    out.data = predict_patches_3d(seg_model, im_in.data, dct_patch_sc_3d[contrast_type]['size'],
+                                  dct_patch_sc_3d[contrast_type]['mean'], dct_patch_sc_3d[contrast_type]['std'],
+                                  batch_size=batch_size, overlap=overlap)
 
     return out.data
 
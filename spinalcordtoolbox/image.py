@@ -13,7 +13,7 @@
 
 from __future__ import division, absolute_import
 
-import sys, os, itertools, warnings, logging
+import sys, os, itertools, warnings, logging, mmap
 
 import nibabel
 import nibabel.orientations
@@ -52,6 +52,40 @@ def _get_permutations(im_src_orientation, im_dst_orientation):
     return perm, inversion
 
 
+def apply_affine(affine, coordi, dtype=np.float64):
+    """
+    Apply a 4x4 affine transformation to an array of points, with a single matrix product.
+
+    :param affine: 4x4 numpy array
+    :param coordi: sequence or numpy array of (nb_points x 3) coordinates
+    :param dtype: data type of the output
+    :return: numpy array (nb_points x 3)
+    """
+    coordi = np.asarray(coordi, dtype=np.float64).reshape(-1, 3)
+    ret = np.dot(coordi, affine[:3, :3].T)
+    ret += affine[:3, 3]
+    return ret.astype(dtype, copy=False)
+
+
+def _is_mapped_from(data, path):
+    """
+    Check whether an array is (a view of) a memory map of a file.
+
+    :param data: numpy array
+    :param path: file path
+    :return: True if data is mapped from path, or if the mapped file cannot be determined
+    """
+    if not os.path.exists(path):
+        return False
+    while data is not None:
+        if isinstance(data, np.memmap) and data.filename is not None:
+            return os.path.samefile(data.filename, path)
+        if isinstance(data, mmap.mmap):
+            return True
+        data = getattr(data, 'base', None)
+    return False
+
+
 class Slicer(object):
     """
     Provides a sliced view onto original image data.
@@ -61,6 +95,8 @@ class Slicer(object):
 
     - The original image data is directly available without copy,
       which is a nice feature, not a bug! Use .copy() if you need copies...
+    - For lazy images (not loaded yet), each slice is read from the file and
+      reoriented when indexed, so slices are copies.
 
     Example:
 
@@ -83,35 +119,23 @@ class Slicer(object):
         if not orientation in all_refspace_strings():
             raise ValueError("Invalid orientation spec")
 
-        # Get a different view on data, as if we were doing a reorientation
-
         perm, inversion = _get_permutations(im.orientation, orientation)
-
-        # axes inversion (flip)
-        data = im.data[::inversion[0], ::inversion[1], ::inversion[2]]
-
-        # axes manipulations (transpose)
-        if perm == [1, 0, 2]:
-            data = np.swapaxes(data, 0, 1)
-        elif perm == [2, 1, 0]:
-            data = np.swapaxes(data, 0, 2)
-        elif perm == [0, 2, 1]:
-            data = np.swapaxes(data, 1, 2)
-        elif perm == [2, 0, 1]:
-            data = np.swapaxes(data, 0, 2)  # transform [2, 0, 1] to [1, 0, 2]
-            data = np.swapaxes(data, 0, 1)  # transform [1, 0, 2] to [0, 1, 2]
-        elif perm == [1, 2, 0]:
-            data = np.swapaxes(data, 0, 2)  # transform [1, 2, 0] to [0, 2, 1]
-            data = np.swapaxes(data, 1, 2)  # transform [0, 2, 1] to [0, 1, 2]
-        elif perm == [0, 1, 2]:
-            # do nothing
-            pass
-        else:
-            raise NotImplementedError()
-
-        self._data = data
+        # axis of the image data corresponding to each axis of the slicer
+        self._axes = [int(x) for x in np.argsort(perm)]
+        self._inversion = inversion
         self._orientation = orientation
-        self._nb_slices = data.shape[2]
+        self._nb_slices = im.dataobj.shape[self._axes[2]]
+
+        if im.is_loaded:
+            # Get a different view on data, as if we were doing a reorientation:
+            # axes inversion (flip), then axes manipulations (transpose)
+            data = im.data[::inversion[0], ::inversion[1], ::inversion[2]]
+            self._data = np.transpose(data, self._axes + list(range(3, data.ndim)))
+            self._dataobj = None
+        else:
+            # Lazy image: slices are read from the file and reoriented when indexed
+            self._data = None
+            self._dataobj = im.dataobj
 
     def __len__(self):
        return self._nb_slices
@@ -127,7 +151,20 @@ class Slicer(object):
        if idx >= self._nb_slices:
            raise IndexError("I just have {} slices!".format(self._nb_slices))
 
-       return self._data[:,:,idx]
+       if self._data is not None:
+           return self._data[:,:,idx]
+
+       if idx < 0:
+           idx += self._nb_slices
+       axis = self._axes[2]
+       index = [slice(None)] * len(self._dataobj.shape)
+       index[axis] = idx if self._inversion[axis] == 1 else self._nb_slices - 1 - idx
+       data = np.asanyarray(self._dataobj[tuple(index)])
+       # the two remaining axes are in the order of the image data
+       data = data[tuple(slice(None, None, self._inversion[x]) for x in sorted(self._axes[:2]))]
+       if self._axes[0] > self._axes[1]:
+           data = np.swapaxes(data, 0, 1)
+       return data
 
 
 class SlicerOneAxis(object):
@@ -184,7 +221,7 @@ class SlicerOneAxis(object):
        if self.direction == -1:
            idx = self.nb_slices - 1 - idx
 
-       return self.im.data[self._slice(idx)]
+       return np.asanyarray(self.im.dataobj[self._slice(idx)])
 
 
 class SlicerMany(object):
@@ -219,11 +256,16 @@ class Image(object):
 
     """
 
-    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None, verbose=1):
+    def __init__(self, param=None, hdr=None, orientation=None, absolutepath=None, dim=None, verbose=1, lazy=False):
+        """
+        :param lazy: when loading from a file, do not read the data until it is accessed. Slices can be read without
+                     loading the whole array with Slicer/SlicerOneAxis, and sub-arrays with Image.dataobj.
+        """
         from nibabel import Nifti1Header
 
         # initialization of all parameters
         self.im_file = None
+        self._dataobj = None
         self.data = None
         self._path = None
         self.ext = ""
@@ -240,7 +282,7 @@ class Image(object):
 
         # load an image from file
         if isinstance(param, str) or (sys.hexversion < 0x03000000 and isinstance(param, unicode)):
-            self.loadFromPath(param, verbose)
+            self.loadFromPath(param, verbose, lazy=lazy)
         # copy constructor
         elif isinstance(param, type(self)):
             self.copy(param)
@@ -262,6 +304,38 @@ class Image(object):
         #     self.hdr.set_qform(self.hdr.get_qform(), code=0)
         #     self.header.set_qform(self.hdr.get_qform(), code=0)
 
+    @property
+    def data(self):
+        """
+        Image data. For images loaded with lazy=True, the data is read from the file when first accessed. For
+        uncompressed files, it is a copy-on-write memory map: only the modified pages are loaded in memory, and the
+        file is never modified.
+        """
+        if self._data is None and self._dataobj is not None:
+            self._data = np.asanyarray(self._dataobj)
+            self._dataobj = None
+        return self._data
+
+    @data.setter
+    def data(self, value):
+        self._data = value
+        self._dataobj = None
+
+    @property
+    def dataobj(self):
+        """
+        Array-like object to read a subset of the data, e.g. im.dataobj[..., 0] for the first volume of a 4D image.
+        For lazy images that have not been loaded yet, only the requested subset is read from the file.
+        """
+        if self._data is None and self._dataobj is not None:
+            return self._dataobj
+        return self.data
+
+    @property
+    def is_loaded(self):
+        """Whether the data is in memory (or memory-mapped), as opposed to being read on access."""
+        return self._dataobj is None
+
     @property
     def dim(self):
         return get_dimension(self)
@@ -333,10 +407,11 @@ class Image(object):
         self.hdr.set_sform(im_ref.hdr.get_sform())
         self.hdr._structarr['sform_code'] = im_ref.hdr._structarr['sform_code']
 
-    def loadFromPath(self, path, verbose):
+    def loadFromPath(self, path, verbose, lazy=False):
         """
         This function load an image from an absolute path using nibabel library
         :param path: path of the file from which the image will be loaded
+        :param lazy: if True, keep the nibabel array proxy and only read the data when it is accessed
         :return:
         """
 
@@ -344,13 +419,18 @@ class Image(object):
             self.im_file = nibabel.load(path)
         except nibabel.spatialimages.ImageFileError:
             sct.printv('Error: make sure ' + path + ' is an image.', 1, 'error')
-        self.data = self.im_file.get_data()
+        if lazy:
+            self.data = None
+            self._dataobj = self.im_file.dataobj
+        else:
+            self.data = self.im_file.get_data()
         self.hdr = self.im_file.header
         self.absolutepath = path
+        shape = self.hdr.get_data_shape()
         if path != self.absolutepath:
-            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, self.data.shape)
+            logger.debug("Loaded %s (%s) orientation %s shape %s", path, self.absolutepath, self.orientation, shape)
         else:
-            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, self.data.shape)
+            logger.debug("Loaded %s orientation %s shape %s", path, self.orientation, shape)
 
     def change_shape(self, shape, generate_path=False):
         """
@@ -470,9 +550,11 @@ class Image(object):
             if (dtype is not None) and (dtype not in ['minimize', 'minimize_int']):
                 hdr.set_data_dtype(dtype)
 
-        # nb. that copy() is important because if it were a memory map, save()
-        # would corrupt it
-        img = Nifti1Image(data.copy(), None, hdr)
+        # nb. if data is a memory map of the destination file, it must be copied, otherwise save() would corrupt it.
+        # Other arrays are written as is (copy on write).
+        if _is_mapped_from(data, path):
+            data = data.copy()
+        img = Nifti1Image(data, None, hdr)
         if os.path.isfile(path):
             sct.printv('WARNING: File ' + path + ' already exists. Will overwrite it.', verbose, 'warning')
 
@@ -495,88 +577,94 @@ class Image(object):
 
         return self
 
-    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False):
+    def get_nonzero_coordinates(self, sorting=None, reverse_coord=False):
         """
-        This function return all the non-zero coordinates that the image contains.
-        Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
-        If reverse_coord is True, coordinate are sorted from larger to smaller.
+        This function returns the coordinates and values of all the non-zero voxels of the image, as a coordinate table:
+        a numpy structured array with fields 'x', 'y', 'z' and 'value'. For 2D images, z is 0.
+        The table can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or
+        sorting='value' (stable sort). If reverse_coord is True, coordinates are sorted from larger to smaller.
+
+        Example:
+        coordinates = im.get_nonzero_coordinates(sorting='z')
+        z_min, z_max = coordinates['z'][0], coordinates['z'][-1]
         """
-        n_dim = 1
-        if self.dim[3] == 1:
-            n_dim = 3
-        else:
-            n_dim = 4
-        if self.dim[2] == 1:
-            n_dim = 2
+        data = self.data
+        if data.ndim == 2:
+            data = data[:, :, np.newaxis]
+        elif data.ndim > 3:
+            data = data.reshape(data.shape[:3])
+        X, Y, Z = (data > 0).nonzero()
+        table = np.empty(len(X), dtype=[('x', X.dtype), ('y', Y.dtype), ('z', Z.dtype), ('value', data.dtype)])
+        table['x'], table['y'], table['z'], table['value'] = X, Y, Z, data[X, Y, Z]
 
-        try:
-            if n_dim == 3:
-                X, Y, Z = (self.data > 0).nonzero()
-                list_coordinates = [Coordinate([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            elif n_dim == 2:
-                try:
-                    X, Y = (self.data > 0).nonzero()
-                    list_coordinates = [Coordinate([X[i], Y[i], 0, self.data[X[i], Y[i]]]) for i in range(0, len(X))]
-                except ValueError:
-                    X, Y, Z = (self.data > 0).nonzero()
-                    list_coordinates = [Coordinate([X[i], Y[i], 0, self.data[X[i], Y[i], 0]]) for i in range(0, len(X))]
-        except Exception as e:
-            sct.printv('ERROR: Exception ' + str(e) + ' caught while geting non Zeros coordinates', 1, 'error')
-
-        if coordValue:
-            from spinalcordtoolbox.types import CoordinateValue
-            if n_dim == 3:
-                list_coordinates = [CoordinateValue([X[i], Y[i], Z[i], self.data[X[i], Y[i], Z[i]]]) for i in range(0, len(X))]
-            else:
-                list_coordinates = [CoordinateValue([X[i], Y[i], 0, self.data[X[i], Y[i]]]) for i in range(0, len(X))]
         if sorting is not None:
             if reverse_coord not in [True, False]:
                 raise ValueError('reverse_coord parameter must be a boolean')
-
-            if sorting == 'x':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.x, reverse=reverse_coord)
-            elif sorting == 'y':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.y, reverse=reverse_coord)
-            elif sorting == 'z':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.z, reverse=reverse_coord)
-            elif sorting == 'value':
-                list_coordinates = sorted(list_coordinates, key=lambda obj: obj.value, reverse=reverse_coord)
-            else:
+            if sorting not in ['x', 'y', 'z', 'value']:
                 raise ValueError("sorting parameter must be either 'x', 'y', 'z' or 'value'")
+            key = table[sorting].astype(np.float64)
+            table = table[np.lexsort((-key if reverse_coord else key,))]
+
+        return table
+
+    def get_coordinates_averaged_by_value(self):
+        """
+        This function computes the mean coordinate of each group of voxels having the same value. This is especially
+        useful for label's images.
+        :return: coordinate table (see get_nonzero_coordinates()) with the center of mass of each group of value,
+        sorted by value.
+        """
+        coordinates = self.get_nonzero_coordinates()
+        values, inverse, counts = np.unique(coordinates['value'], return_inverse=True, return_counts=True)
+        averaged_coordinates = np.empty(len(values), dtype=[('x', np.float64), ('y', np.float64),
+                                                            ('z', np.float64), ('value', values.dtype)])
+        for axis in ['x', 'y', 'z']:
+            averaged_coordinates[axis] = np.bincount(inverse, weights=coordinates[axis], minlength=len(values)) / counts
+        averaged_coordinates['value'] = values
+        return averaged_coordinates
 
-        return list_coordinates
+    def getNonZeroCoordinates(self, sorting=None, reverse_coord=False, coordValue=False):
+        """
+        This function return all the non-zero coordinates that the image contains, as a list of Coordinate.
+        Coordinate list can also be sorted by x, y, z, or the value with the parameter sorting='x', sorting='y', sorting='z' or sorting='value'
+        If reverse_coord is True, coordinate are sorted from larger to smaller.
+        N.B. The list is a lazy view on get_nonzero_coordinates(), which should be preferred for large images.
+        """
+        from spinalcordtoolbox.types import CoordinateList, CoordinateValue
+        return CoordinateList(self.get_nonzero_coordinates(sorting=sorting, reverse_coord=reverse_coord),
+                              coordinate_class=CoordinateValue if coordValue else Coordinate)
 
     def getCoordinatesAveragedByValue(self):
         """
         This function computes the mean coordinate of group of labels in the image. This is especially useful for label's images.
         :return: list of coordinates that represent the center of mass of each group of value.
+        N.B. The list is a lazy view on get_coordinates_averaged_by_value().
         """
-        # 1. Extraction of coordinates from all non-null voxels in the image. Coordinates are sorted by value.
-        coordinates = self.getNonZeroCoordinates(sorting='value')
-
-        # 2. Separate all coordinates into groups by value
-        groups = dict()
-        for coord in coordinates:
-            if coord.value in groups:
-                groups[coord.value].append(coord)
-            else:
-                groups[coord.value] = [coord]
-
-        # 3. Compute the center of mass of each group of voxels and write them into the output image
-        averaged_coordinates = []
-        for value, list_coord in groups.items():
-            averaged_coordinates.append(sum(list_coord) / float(len(list_coord)))
-
-        averaged_coordinates = sorted(averaged_coordinates, key=lambda obj: obj.value, reverse=False)
-        return averaged_coordinates
+        from spinalcordtoolbox.types import CoordinateList
+        return CoordinateList(self.get_coordinates_averaged_by_value())
 
+    def get_affine(self, inverse=False):
+        """
+        Return the voxel-to-physical affine transformation of the image (or its inverse).
+        Both matrices are cached, and are recomputed only when the header changes.
 
-    def transfo_pix2phys(self, coordi=None):
+        :param inverse: if True, return the physical-to-voxel affine transformation.
+        :return: 4x4 numpy array
+        """
+        key = (id(self.hdr), self.hdr.binaryblock)
+        cache = getattr(self, '_affine_cache', None)
+        if cache is None or cache[0] != key:
+            m_p2f = self.hdr.get_best_affine()
+            cache = self._affine_cache = (key, m_p2f, np.linalg.inv(m_p2f))
+        return cache[2] if inverse else cache[1]
+
+    def transfo_pix2phys(self, coordi=None, dtype=np.float64):
         """
         This function returns the physical coordinates of all points of 'coordi'.
 
-        :param coordi: sequence of (nb_points x 3) values containing the pixel coordinate of points.
-        :return: sequence with the physical coordinates of the points in the space of the image.
+        :param coordi: sequence or numpy array of (nb_points x 3) values containing the pixel coordinate of points.
+        :param dtype: data type of the output (e.g. np.float32 to save memory with large arrays of points).
+        :return: numpy array (nb_points x 3) with the physical coordinates of the points in the space of the image.
 
         Example:
         img = Image('file.nii.gz')
@@ -585,38 +673,23 @@ class Image(object):
         coordi_phys = img.transfo_pix2phys(coordi=coordi_pix)
 
         """
+        return apply_affine(self.get_affine(), coordi, dtype)
 
-        m_p2f = self.hdr.get_best_affine()
-        aug = np.hstack((np.asarray(coordi), np.ones((len(coordi), 1))))
-        ret = np.empty_like(coordi, dtype=np.float64)
-        for idx_coord, coord in enumerate(aug):
-            phys = np.matmul(m_p2f, coord)
-            ret[idx_coord] = phys[:3]
-        return ret
-
-
-    def transfo_phys2pix(self, coordi, real=True):
+    def transfo_phys2pix(self, coordi, real=True, dtype=np.float64):
         """
         This function returns the pixels coordinates of all points of 'coordi'
 
-        :param coordi: sequence of (nb_points x 3) values containing the pixel coordinate of points.
+        :param coordi: sequence or numpy array of (nb_points x 3) values containing the physical coordinate of points.
         :param real: whether to return real pixel coordinates
-        :return: sequence with the physical coordinates of the points in the space of the image.
+        :param dtype: data type of the output if real is False.
+        :return: numpy array (nb_points x 3) with the pixel coordinates of the points in the space of the image.
         """
-
-        m_p2f = self.hdr.get_best_affine()
-        m_f2p = np.linalg.inv(m_p2f)
-        aug = np.hstack((np.asarray(coordi), np.ones((len(coordi), 1))))
-        ret = np.empty_like(coordi, dtype=np.float64)
-        for idx_coord, coord in enumerate(aug):
-            phys = np.matmul(m_f2p, coord)
-            ret[idx_coord] = phys[:3]
+        ret = apply_affine(self.get_affine(inverse=True), coordi, np.float64 if real else dtype)
         if real:
             return np.int32(np.round(ret))
         else:
             return ret
 
-
     def get_values(self, coordi=None, interpolation_mode=0, border='constant', cval=0.0):
         """
         This function returns the intensity value of the image at the position coordi (can be a list of coordinates).
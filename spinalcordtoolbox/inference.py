@@ -0,0 +1,285 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Cache of deep learning models, and long-lived inference worker.
+#
+# Building a Keras model and loading its weights takes longer than the inference itself for most images. The models
+# are therefore kept in a least-recently-used cache (see get_model()). To benefit from this cache across invocations,
+# a worker process (see serve(), or sct_inference_worker) runs SCT's deep learning scripts (sct_deepseg_sc,
+# sct_deepseg_gm, sct_deepseg_lesion) in-process: when it is running, these scripts forward their arguments to the
+# worker through a Unix socket (see forward()), so that TensorFlow is imported and the models are loaded only once.
+# The socket is in a private directory of the user, and the connections are authenticated with a key which only the
+# user can read, because the worker runs the scripts with the arguments it receives.
+
+from __future__ import absolute_import
+
+import sys
+import os
+import logging
+from collections import OrderedDict
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Listener, Client
+
+logger = logging.getLogger(__name__)
+
+# Maximum number of models kept in memory
+MODEL_CACHE_SIZE = int(os.environ.get('SCT_MODEL_CACHE_SIZE', 4))
+
+
+class ModelCache(object):
+    """
+    Least-recently-used cache of models.
+    """
+    def __init__(self, size=MODEL_CACHE_SIZE):
+        """
+        :param size: int: maximum number of models kept in the cache (0: no caching)
+        """
+        self.size = size
+        self.models = OrderedDict()
+
+    def get(self, key, build_fn):
+        """
+        :param key: hashable key of the model
+        :param build_fn: function without argument which returns the model, called if the model is not in the cache
+        :return: model
+        """
+        if key in self.models:
+            logger.debug("Reusing cached model: %s", key)
+            model = self.models.pop(key)
+        else:
+            model = build_fn()
+            while self.models and len(self.models) >= self.size:
+                self.models.popitem(last=False)
+        if self.size > 0:
+            self.models[key] = model
+        return model
+
+    def clear(self):
+        self.models.clear()
+
+
+_model_cache = ModelCache()
+
+
+def get_model(fname_model, key, build_fn, data_format=None):
+    """
+    Get a model from the cache, or build it (and load its weights).
+    :param fname_model: path of the model weights
+    :param key: hashable, other parameters which identify the model (e.g., contrast, input size)
+    :param build_fn: function without argument which builds the model and loads its weights
+    :param data_format: {'channels_last', 'channels_first'}: Keras image data format to use while building the model.
+    This matters because the data format is a global setting of Keras, which is changed by some models.
+    :return: model
+    """
+    def build():
+        if data_format is None:
+            return build_fn()
+        from keras import backend as K
+        data_format_previous = K.image_data_format()
+        K.set_image_data_format(data_format)
+        try:
+            return build_fn()
+        finally:
+            K.set_image_data_format(data_format_previous)
+
+    return _model_cache.get((os.path.abspath(fname_model), key), build)
+
+
+# Set to True in the worker process (so that scripts do not forward their arguments to themselves)
+_in_worker = False
+
+
+def _get_worker_dir():
+    """
+    :return: default directory of the socket of the inference worker, which only the user can access:
+    $XDG_RUNTIME_DIR/sct_inference_worker, or ~/.cache/spinalcordtoolbox/inference_worker
+    """
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'sct_inference_worker')
+    return os.path.join(os.path.expanduser('~'), '.cache', 'spinalcordtoolbox', 'inference_worker')
+
+
+def get_worker_address():
+    """
+    :return: path of the Unix socket of the inference worker (can be set with the SCT_INFERENCE_WORKER environment
+    variable)
+    """
+    return os.environ.get('SCT_INFERENCE_WORKER', os.path.join(_get_worker_dir(), 'worker.sock'))
+
+
+def _get_key_path(address):
+    """
+    :return: path of the file of the authentication key of the worker listening on address
+    """
+    return address + '.key'
+
+
+def _is_owned(path, private=False):
+    """
+    :param private: bool: also require that the group and the other users have no permission on path
+    :return: True if path belongs to the current user
+    """
+    st = os.stat(path)
+    return st.st_uid == os.getuid() and not (private and st.st_mode & 0o077)
+
+
+def _read_key(address):
+    """
+    :return: authentication key of the worker listening on address, or None if there is no key file that only the
+    current user can read
+    """
+    fname_key = _get_key_path(address)
+    if not os.path.isfile(fname_key) or not _is_owned(fname_key, private=True):
+        return None
+    with open(fname_key, 'rb') as f:
+        return f.read()
+
+
+def _connect(address):
+    """
+    :return: Connection to the worker, or None if the worker is not running (or if its socket or its key belong to
+    another user)
+    """
+    if not os.path.exists(address):
+        return None
+    if not _is_owned(address):
+        logger.warning("Ignoring the inference worker socket %s, which belongs to another user", address)
+        return None
+    authkey = _read_key(address)
+    if authkey is None:
+        return None
+    try:
+        return Client(address, family='AF_UNIX', authkey=authkey)
+    except (IOError, OSError, AuthenticationError):
+        return None
+
+
+def is_running(address=None):
+    """
+    :return: True if the inference worker is running
+    """
+    conn = _connect(address or get_worker_address())
+    if conn is None:
+        return False
+    try:
+        conn.send({'command': 'ping'})
+        return conn.recv()['status'] == 0
+    except (EOFError, IOError, OSError):
+        return False
+    finally:
+        conn.close()
+
+
+def serve(address=None, cache_size=None):
+    """
+    Run the inference worker: wait for requests, and run the requested SCT scripts in-process, one at a time.
+    The models loaded by the scripts stay in the cache between requests. Stop with stop() (or with Ctrl+C).
+    :param address: path of the Unix socket (default: get_worker_address())
+    :param cache_size: int: maximum number of models kept in memory (default: MODEL_CACHE_SIZE)
+    """
+    # scripts are run with sct_utils.run_in_process()
+    from spinalcordtoolbox.utils import __sct_dir__
+    sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+    import sct_utils as sct
+
+    global _in_worker
+    address = address or get_worker_address()
+    if is_running(address):
+        raise RuntimeError("An inference worker is already running: {}".format(address))
+    if os.path.exists(address):
+        # stale socket of a worker which was killed
+        os.remove(address)
+    if cache_size is not None:
+        _model_cache.size = cache_size
+    # only the current user can access the socket and the key (from their creation on)
+    umask = os.umask(0o077)
+    try:
+        path_socket = os.path.dirname(os.path.abspath(address))
+        if not os.path.isdir(path_socket):
+            os.makedirs(path_socket)
+        elif path_socket == os.path.abspath(_get_worker_dir()):
+            os.chmod(path_socket, 0o700)
+        fname_key = _get_key_path(address)
+        if os.path.exists(fname_key):
+            os.remove(fname_key)
+        authkey = os.urandom(32)
+        with os.fdopen(os.open(fname_key, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'wb') as f:
+            f.write(authkey)
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    finally:
+        os.umask(umask)
+    _in_worker = True
+    logger.info("Inference worker listening on %s", address)
+    try:
+        while True:
+            try:
+                conn = listener.accept()
+            except AuthenticationError as e:
+                logger.warning("Rejected a connection: %s", e)
+                continue
+            try:
+                request = conn.recv()
+                command = request.get('command', 'run')
+                if command == 'stop':
+                    conn.send({'status': 0, 'output': ''})
+                    break
+                elif command == 'ping':
+                    conn.send({'status': 0, 'output': ''})
+                    continue
+                path_script = sct.get_sct_entry_point(request['script'])
+                if path_script is None:
+                    # the script cannot be run in-process: the client runs it locally
+                    conn.send({'status': None, 'output': ''})
+                    continue
+                logger.info("Running %s %s", request['script'], " ".join(request['args']))
+                status, output, _ = sct.run_in_process(path_script, request['args'], cwd=request['cwd'])
+                conn.send({'status': status, 'output': output})
+            except (EOFError, IOError, OSError) as e:
+                logger.warning("Lost connection with the client: %s", e)
+            finally:
+                conn.close()
+    finally:
+        _in_worker = False
+        listener.close()
+        os.remove(fname_key)
+        logger.info("Inference worker stopped")
+
+
+def stop(address=None):
+    """
+    Stop the inference worker.
+    :return: True if a worker was running
+    """
+    conn = _connect(address or get_worker_address())
+    if conn is None:
+        return False
+    try:
+        conn.send({'command': 'stop'})
+        conn.recv()
+    finally:
+        conn.close()
+    return True
+
+
+def forward(script_name, args=None):
+    """
+    Run an SCT script in the inference worker, if it is running. The output of the script is printed.
+    :param script_name: name of the script (e.g., 'sct_deepseg_sc')
+    :param args: list of arguments of the script (default: sys.argv[1:])
+    :return: exit status of the script, or None if it was not run by the worker (it should then be run locally)
+    """
+    if _in_worker:
+        return None
+    conn = _connect(get_worker_address())
+    if conn is None:
+        return None
+    try:
+        conn.send({'script': script_name, 'args': list(sys.argv[1:] if args is None else args), 'cwd': os.getcwd()})
+        response = conn.recv()
+    except (EOFError, IOError, OSError) as e:
+        logger.warning("Could not run %s in the inference worker: %s", script_name, e)
+        return None
+    finally:
+        conn.close()
+    if response['output']:
+        print(response['output'])
+    return response['status']
@@ -4,11 +4,18 @@
 
 from __future__ import absolute_import
 
-import io, os, re
+import io, os, re, logging
 from operator import itemgetter
 
+import numpy as np
+
 from spinalcordtoolbox.utils import parse_num_list
 
+logger = logging.getLogger(__name__)
+
+# File of the sparse copy of the individual labels of a folder (see SparseLabels)
+FILE_SPARSE_LABELS = 'info_label_sparse.npz'
+
 
 class InfoLabel(object):
     """
@@ -235,3 +242,121 @@ def get_indiv_label_info(directory):
             'file': tuple(filename_lst)
             }
 
+
+class SparseLabels(object):
+    """
+    Compact copy of the individual labels of a folder (e.g., the warped atlas), saved in a single .npz file next to
+    info_label.txt. The labels are mostly zero, so only their non-null voxels are stored, as a CSR matrix of
+    [nb_labels x nb_voxels] with float16 values, in RPI orientation. Reading it is much faster than decompressing
+    and reorienting all the NIfTI files.
+    Note: with float16, the values are rounded to about 3 significant digits, which is appropriate for probabilistic
+    labels (between 0 and 1), but not for intensities.
+    """
+    def __init__(self, files, shape, indptr, indices, values):
+        """
+        :param files: list of str: label files (as in info_label.txt)
+        :param shape: tuple: shape of the labels (in RPI orientation)
+        :param indptr: [nb_labels + 1]: the non-null voxels of the i-th label are in indptr[i]:indptr[i+1]
+        :param indices: flat (C-order) indices of the non-null voxels
+        :param values: values of the non-null voxels
+        """
+        self.files = list(files)
+        self.shape = tuple(shape)
+        self.indptr = indptr
+        self.indices = indices
+        self.values = values
+
+    @classmethod
+    def from_files(cls, path_label, files):
+        """
+        :param path_label: folder of the label files
+        :param files: list of str: label files
+        :return: SparseLabels
+        """
+        from spinalcordtoolbox.image import Image
+        indptr, list_indices, list_values, shape = [0], [], [], None
+        for file in files:
+            data = np.asarray(Image(os.path.join(path_label, file)).change_orientation('RPI').data, dtype=np.float16)
+            if shape is None:
+                shape = data.shape
+            elif data.shape != shape:
+                raise ValueError("Label {} has a different shape: {} (expected: {})".format(file, data.shape, shape))
+            indices = np.flatnonzero(data)
+            list_indices.append(indices.astype(np.int32 if data.size < 2 ** 31 else np.int64))
+            list_values.append(data.flat[indices])
+            indptr.append(indptr[-1] + len(indices))
+        return cls(files, shape, np.array(indptr, dtype=np.int64), np.concatenate(list_indices),
+                   np.concatenate(list_values))
+
+    def get_data(self, i_label, dtype=np.float32):
+        """
+        :param i_label: int: index of the label, or str: label file
+        :return: dense array of the label
+        """
+        if not isinstance(i_label, (int, np.integer)):
+            i_label = self.files.index(i_label)
+        data = np.zeros(int(np.prod(self.shape)), dtype=dtype)
+        start, end = self.indptr[i_label], self.indptr[i_label + 1]
+        data[self.indices[start:end]] = self.values[start:end]
+        return data.reshape(self.shape)
+
+    def get_data_all(self, dtype=np.float32):
+        """
+        :return: dense array of all the labels, concatenated along a last dimension
+        """
+        data = np.zeros((int(np.prod(self.shape)), len(self.files)), dtype=dtype)
+        for i_label in range(len(self.files)):
+            start, end = self.indptr[i_label], self.indptr[i_label + 1]
+            data[self.indices[start:end], i_label] = self.values[start:end]
+        return data.reshape(self.shape + (len(self.files),))
+
+
+def _get_files_signature(path_label, files):
+    """
+    :return: size and modification time of the label files, to check that a sparse copy is up to date
+    """
+    return np.array([[os.path.getsize(os.path.join(path_label, file)), os.path.getmtime(os.path.join(path_label, file))]
+                     for file in files], dtype=np.float64)
+
+
+def save_sparse_labels(path_label, file_info_label='info_label.txt'):
+    """
+    Save a sparse copy of the individual labels of a folder (see SparseLabels). Nothing is done if it is up to date.
+    :param path_label: folder containing file_info_label and the label files
+    :param file_info_label: str
+    :return: path of the sparse file
+    """
+    files = read_label_file_atlas(path_label, file_info_label)[2]
+    fname_sparse = os.path.join(path_label, FILE_SPARSE_LABELS)
+    if load_sparse_labels(path_label, file_info_label) is not None:
+        return fname_sparse
+    sparse_labels = SparseLabels.from_files(path_label, files)
+    with io.open(fname_sparse, 'wb') as f:
+        np.savez(f, files=np.array(files), signature=_get_files_signature(path_label, files),
+                 shape=np.array(sparse_labels.shape), indptr=sparse_labels.indptr, indices=sparse_labels.indices,
+                 values=sparse_labels.values)
+    return fname_sparse
+
+
+def load_sparse_labels(path_label, file_info_label='info_label.txt'):
+    """
+    Load the sparse copy of the individual labels of a folder, if it exists and is up to date with the label files
+    (otherwise, the label files should be read).
+    :param path_label: folder containing file_info_label and the label files
+    :param file_info_label: str
+    :return: SparseLabels, or None
+    """
+    fname_sparse = os.path.join(path_label, FILE_SPARSE_LABELS)
+    if not os.path.isfile(fname_sparse):
+        return None
+    try:
+        files = list(read_label_file_atlas(path_label, file_info_label)[2])
+        with np.load(fname_sparse) as npz:
+            if [str(file) for file in npz['files']] != files \
+                    or not np.array_equal(npz['signature'], _get_files_signature(path_label, files)):
+                logger.debug("Sparse labels are not up to date: %s", fname_sparse)
+                return None
+            return SparseLabels(files, npz['shape'], npz['indptr'], npz['indices'], npz['values'])
+    except (IOError, OSError, ValueError, KeyError) as e:
+        logger.warning("Cannot read sparse labels %s: %s", fname_sparse, e)
+        return None
@@ -7,6 +7,8 @@ from __future__ import absolute_import
 import math
 import platform
 import numpy as np
+from scipy import ndimage
+from scipy.spatial import ConvexHull
 from skimage import measure, transform
 from tqdm import tqdm
 import logging
@@ -18,7 +20,7 @@ from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
 from spinalcordtoolbox.resampling import resample_nib
 
 
-def compute_shape(segmentation, angle_correction=True, param_centerline=None, verbose=1):
+def compute_shape(segmentation, angle_correction=True, param_centerline=None, verbose=1, method='batch'):
     """
     Compute morphometric measures of the spinal cord in the transverse (axial) plane from the segmentation.
     The segmentation could be binary or weighted for partial volume [0,1].
@@ -26,9 +28,14 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
     :param angle_correction:
     :param param_centerline: see centerline.core.ParamCenterline()
     :param verbose:
+    :param method: {'batch', 'slicewise'}: 'batch' processes stacks of slices at once using vectorized image moments.
+    'slicewise' loops across slices and relies on skimage.measure.regionprops (reference implementation).
     :return metrics: Dict of class Metric(). If a metric cannot be calculated, its value will be nan.
     :return fit_results: class centerline.core.FitResults()
     """
+    if method not in ['batch', 'slicewise']:
+        raise ValueError("method should be 'batch' or 'slicewise'")
+
     # List of properties to output (in the right order)
     property_list = ['area',
                      'angle_AP',
@@ -65,29 +72,80 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
         # compute the spinal cord centerline based on the spinal cord segmentation
         # here, param_centerline.minmax needs to be False because we need to retrieve the total number of input slices
         _, arr_ctl, arr_ctl_der, fit_results = get_centerline(im_segr, param=param_centerline, verbose=verbose)
+        angle_AP_rad, angle_RL_rad = _compute_angles(arr_ctl_der[0][:max_z_index - min_z_index + 1],
+                                                     arr_ctl_der[1][:max_z_index - min_z_index + 1],
+                                                     [px, py, pz])
+    else:
+        angle_AP_rad = np.zeros(max_z_index - min_z_index + 1)
+        angle_RL_rad = np.zeros(max_z_index - min_z_index + 1)
+
+    if method == 'batch':
+        _compute_shape_batch(data_seg, min_z_index, max_z_index, angle_AP_rad, angle_RL_rad, angle_correction,
+                             [px, py, pz], shape_properties, property_list)
+    else:
+        _compute_shape_slicewise(data_seg, min_z_index, max_z_index, angle_AP_rad, angle_RL_rad, angle_correction,
+                                 [px, py, pz], shape_properties, property_list)
+
+    metrics = {}
+    for key, value in shape_properties.items():
+        # Making sure all entries added to metrics have results
+        if not value == []:
+            metrics[key] = Metric(data=np.array(value), label=key)
+
+    return metrics, fit_results
+
+
+def _compute_angles(x_centerline_deriv, y_centerline_deriv, dim):
+    """
+    Compute the angle between the centerline and the normal vector to the slice, about the AP and RL axes.
+    :param x_centerline_deriv: 1d array: derivative of the centerline along x wrt. z (in voxel)
+    :param y_centerline_deriv: 1d array: derivative of the centerline along y wrt. z (in voxel)
+    :param dim: [px, py, pz]: Physical dimension of the image (in mm).
+    :return: angle_AP_rad, angle_RL_rad: 1d arrays of angles (in rad)
+    """
+    # Tangent vector to the centerline (i.e. its derivative), one column per slice
+    tangent_vect = np.vstack([np.asarray(x_centerline_deriv) * dim[0],
+                              np.asarray(y_centerline_deriv) * dim[1],
+                              np.full(len(x_centerline_deriv), dim[2])])
+    # Normalize vector by its L2 norm
+    tangent_vect = tangent_vect / np.linalg.norm(tangent_vect, axis=0)
+    # Angle between [tangent_x, tangent_z] and the normal vector to the slice [0, 1]:
+    # atan2(det([v0, v1]), dot(v0, v1)) = atan2(tangent_x, tangent_z)
+    angle_AP_rad = np.arctan2(tangent_vect[0], tangent_vect[2])
+    # Same with [tangent_y, tangent_z]
+    angle_RL_rad = np.arctan2(tangent_vect[1], tangent_vect[2])
+    return angle_AP_rad, angle_RL_rad
+
+
+def _fill_shape_properties(shape_property, iz, angle_AP_rad, angle_RL_rad, pz, shape_properties, property_list):
+    """
+    Add angle-related fields to the properties of one slice and store them in the output dictionary.
+    """
+    # Add custom fields
+    shape_property['angle_AP'] = angle_AP_rad * 180.0 / math.pi
+    shape_property['angle_RL'] = angle_RL_rad * 180.0 / math.pi
+    shape_property['length'] = pz / (np.cos(angle_AP_rad) * np.cos(angle_RL_rad))
+    # Loop across properties and assign values for function output
+    for property_name in property_list:
+        shape_properties[property_name][iz] = shape_property[property_name]
+
 
+def _compute_shape_slicewise(data_seg, min_z_index, max_z_index, angle_AP_rad, angle_RL_rad, angle_correction, dim,
+                             shape_properties, property_list):
+    """
+    Reference implementation of compute_shape: loop across slices and compute shape properties with regionprops.
+    Output is written in shape_properties.
+    """
+    px, py, pz = dim
     # Loop across z and compute shape analysis
     for iz in tqdm(range(min_z_index, max_z_index + 1), unit='iter', unit_scale=False, desc="Compute shape analysis",
                    ascii=True, ncols=80):
         # Extract 2D patch
-        current_patch = im_segr.data[:, :, iz]
+        current_patch = data_seg[:, :, iz]
         if angle_correction:
-            # Extract tangent vector to the centerline (i.e. its derivative)
-            tangent_vect = np.array([arr_ctl_der[0][iz - min_z_index] * px,
-                                     arr_ctl_der[1][iz - min_z_index] * py,
-                                     pz])
-            # Normalize vector by its L2 norm
-            tangent_vect = tangent_vect / np.linalg.norm(tangent_vect)
-            # Compute the angle about AP axis between the centerline and the normal vector to the slice
-            v0 = [tangent_vect[0], tangent_vect[2]]
-            v1 = [0, 1]
-            angle_AP_rad = np.math.atan2(np.linalg.det([v0, v1]), np.dot(v0, v1))
-            # Compute the angle about RL axis between the centerline and the normal vector to the slice
-            v0 = [tangent_vect[1], tangent_vect[2]]
-            v1 = [0, 1]
-            angle_RL_rad = np.math.atan2(np.linalg.det([v0, v1]), np.dot(v0, v1))
             # Apply affine transformation to account for the angle between the centerline and the normal to the patch
-            tform = transform.AffineTransform(scale=(np.cos(angle_RL_rad), np.cos(angle_AP_rad)))
+            tform = transform.AffineTransform(scale=(np.cos(angle_RL_rad[iz - min_z_index]),
+                                                     np.cos(angle_AP_rad[iz - min_z_index])))
             # Convert to float64, to avoid problems in image indexation causing issues when applying transform.warp
             current_patch = current_patch.astype(np.float64)
             # TODO: make sure pattern does not go extend outside of image border
@@ -98,17 +156,11 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
                                                   )
         else:
             current_patch_scaled = current_patch
-            angle_AP_rad, angle_RL_rad = 0.0, 0.0
         # compute shape properties on 2D patch
         shape_property = _properties2d(current_patch_scaled, [px, py])
         if shape_property is not None:
-            # Add custom fields
-            shape_property['angle_AP'] = angle_AP_rad * 180.0 / math.pi
-            shape_property['angle_RL'] = angle_RL_rad * 180.0 / math.pi
-            shape_property['length'] = pz / (np.cos(angle_AP_rad) * np.cos(angle_RL_rad))
-            # Loop across properties and assign values for function output
-            for property_name in property_list:
-                shape_properties[property_name][iz] = shape_property[property_name]
+            _fill_shape_properties(shape_property, iz, angle_AP_rad[iz - min_z_index],
+                                   angle_RL_rad[iz - min_z_index], pz, shape_properties, property_list)
         else:
             logging.warning('\nNo properties for slice: {}'.format(iz))
 
@@ -124,13 +176,36 @@ def compute_shape(segmentation, angle_correction=True, param_centerline=None, ve
         ax.set_ylabel('x')
         fig.savefig('tmp_fig.png')
         """
-    metrics = {}
-    for key, value in shape_properties.items():
-        # Making sure all entries added to metrics have results
-        if not value == []:
-            metrics[key] = Metric(data=np.array(value), label=key)
 
-    return metrics, fit_results
+
+def _compute_shape_batch(data_seg, min_z_index, max_z_index, angle_AP_rad, angle_RL_rad, angle_correction, dim,
+                         shape_properties, property_list, chunk_size=64):
+    """
+    Vectorized implementation of compute_shape: slices are processed by chunks of chunk_size. For each chunk, the
+    angle correction is applied with a single call to map_coordinates and shape properties are computed on the stack
+    of slices with _properties2d_batch(). Output is written in shape_properties.
+    """
+    px, py, pz = dim
+    for iz_start in tqdm(range(min_z_index, max_z_index + 1, chunk_size), unit='chunk', unit_scale=False,
+                         desc="Compute shape analysis", ascii=True, ncols=80):
+        iz_end = min(iz_start + chunk_size, max_z_index + 1)
+        # Stack slices along the first axis: (nz_chunk, nx, ny)
+        stack = np.moveaxis(np.asarray(data_seg[:, :, iz_start:iz_end], dtype=np.float64), 2, 0)
+        angle_AP_chunk = angle_AP_rad[iz_start - min_z_index:iz_end - min_z_index]
+        angle_RL_chunk = angle_RL_rad[iz_start - min_z_index:iz_end - min_z_index]
+        if angle_correction:
+            # Scale each slice by the cosine of its angles. Equivalent to transform.warp() with
+            # AffineTransform(scale=(cos(angle_RL), cos(angle_AP))) and linear interpolation, applied slice by slice.
+            stack = _scale_stack(stack, np.cos(angle_AP_chunk), axis=1)
+            stack = _scale_stack(stack, np.cos(angle_RL_chunk), axis=2)
+        properties = _properties2d_batch(stack, [px, py])
+        for i, shape_property in enumerate(properties):
+            iz = iz_start + i
+            if shape_property is not None:
+                _fill_shape_properties(shape_property, iz, angle_AP_chunk[i], angle_RL_chunk[i], pz,
+                                       shape_properties, property_list)
+            else:
+                logging.warning('\nNo properties for slice: {}'.format(iz))
 
 
 def _properties2d(image, dim):
@@ -198,6 +273,193 @@ def _properties2d(image, dim):
     return properties
 
 
+def _scale_stack(stack, scale, axis):
+    """
+    Scale each slice of a stack along one axis, using linear interpolation and zero outside of the field of view.
+    :param stack: 3D array (nz, nx, ny)
+    :param scale: 1d array (nz): scaling factor of each slice. Output at index i is input at index i / scale.
+    :param axis: {1, 2}: axis along which the scaling is applied
+    :return: 3D array (nz, nx, ny)
+    """
+    stack = np.moveaxis(stack, axis, 1)
+    nz, n = stack.shape[:2]
+    # Append a slab of zeros, used for points outside of the field of view
+    stack_pad = np.concatenate([stack, np.zeros((nz, 1) + stack.shape[2:])], axis=1)
+    coord = np.arange(n)[None, :] / np.asarray(scale)[:, None]
+    ind = np.floor(coord).astype(int)
+    weight = (coord - ind)[:, :, None]
+    ind_z = np.arange(nz)[:, None]
+    stack_scaled = (1 - weight) * stack_pad[ind_z, np.minimum(ind, n)] + weight * stack_pad[ind_z, np.minimum(ind + 1, n)]
+    return np.moveaxis(stack_scaled, 1, axis)
+
+
+def _get_oversampling_matrix(size, upscale):
+    """
+    Get the matrix M such as M.dot(image) oversamples image along its first axis by a factor upscale. Equivalent to
+    transform.pyramid_expand(sigma=None, order=1) along one axis: linear interpolation of the pixel centers (mirrored
+    at the border), followed by a gaussian smoothing. The interpolation weights are explicit, because the equivalent
+    ndimage.zoom(grid_mode=True) requires SciPy >= 1.6.
+    :param size: int: size of the image along the oversampled axis
+    :param upscale: int: upscale factor
+    :return: 2D array (size * upscale, size)
+    """
+    size_r = size * upscale
+    # Linear interpolation: coordinates of the centers of the output pixels in the input image
+    coord = (np.arange(size_r) + 0.5) / upscale - 0.5
+    if size > 1:
+        coord = np.abs(coord)
+        coord = np.where(coord > size - 1, 2 * (size - 1) - coord, coord)
+    else:
+        coord = np.zeros(size_r)
+    ind = np.minimum(np.floor(coord).astype(int), size - 1)
+    weight = coord - ind
+    matrix = np.zeros((size_r, size + 1))
+    matrix[np.arange(size_r), ind] = 1 - weight
+    matrix[np.arange(size_r), ind + 1] += weight
+    matrix = matrix[:, :size]
+    # Gaussian smoothing
+    return ndimage.gaussian_filter1d(matrix, 2 * upscale / 6.0, axis=0, mode='reflect')
+
+
+def _properties2d_batch(stack, dim):
+    """
+    Compute shape property of a stack of 2D images. Vectorized version of _properties2d(): the oversampling and the
+    image moments (used for orientation, diameters and eccentricity) are computed for all slices at once.
+    :param stack: 3D array (nz, nx, ny) of float images (weighted for partial volume), each having a single object.
+    :param dim: [px, py]: Physical dimension of the image (in mm). X,Y respectively correspond to AP,RL.
+    :return: list of properties (dict) for each slice. None for empty slices.
+    """
+    upscale = 5  # upscale factor for resampling the input image (for better precision)
+    pad = 3  # padding used for cropping
+    nz, nx, ny = stack.shape
+    properties = [None] * nz
+    # Check which slices are empty
+    is_valid = stack.reshape(nz, -1).any(axis=1)
+    if not is_valid.any():
+        return properties
+    ind_valid = np.where(is_valid)[0]
+    stack = stack[ind_valid]
+    # Normalize each slice between 0 and 1
+    stack_min = stack.min(axis=(1, 2), keepdims=True)
+    stack_max = stack.max(axis=(1, 2), keepdims=True)
+    stack_norm = ((stack - stack_min) / (stack_max - stack_min)).astype(np.float64)
+    # Get bounding box of the binarized object of each slice
+    stack_bin = stack_norm > 0.5
+    is_x, is_y = stack_bin.any(axis=2), stack_bin.any(axis=1)
+    minx, maxx = is_x.argmax(axis=1), nx - is_x[:, ::-1].argmax(axis=1)
+    miny, maxy = is_y.argmax(axis=1), ny - is_y[:, ::-1].argmax(axis=1)
+    x_start, x_end = np.clip(minx - pad, 0, nx), np.clip(maxx + pad, 0, nx)
+    y_start, y_end = np.clip(miny - pad, 0, ny), np.clip(maxy + pad, 0, ny)
+    # Crop slices around their bounding box (for faster processing). Crops are stacked in a common array and are
+    # zero-filled beyond their own size.
+    size_x, size_y = x_end - x_start, y_end - y_start
+    ind_x = x_start[:, None] + np.arange(size_x.max())
+    ind_y = y_start[:, None] + np.arange(size_y.max())
+    mask_crop = (ind_x < x_end[:, None])[:, :, None] & (ind_y < y_end[:, None])[:, None, :]
+    stack_crop = stack_norm[np.arange(len(ind_valid))[:, None, None],
+                            np.minimum(ind_x, nx - 1)[:, :, None],
+                            np.minimum(ind_y, ny - 1)[:, None, :]] * mask_crop
+    # Oversample images to reach sufficient precision when computing shape metrics on the binary mask. The
+    # oversampling is separable, so each crop is multiplied by the oversampling matrices corresponding to its own size:
+    # matrix_x * crop * matrix_y^T. Rows/columns beyond the crop size are zero.
+    matrix_x = np.zeros((len(ind_valid), upscale * size_x.max(), size_x.max()))
+    matrix_y = np.zeros((len(ind_valid), upscale * size_y.max(), size_y.max()))
+    for size in np.unique(size_x):
+        matrix_x[size_x == size, :upscale * size, :size] = _get_oversampling_matrix(size, upscale)
+    for size in np.unique(size_y):
+        matrix_y[size_y == size, :upscale * size, :size] = _get_oversampling_matrix(size, upscale)
+    stack_crop_r = np.matmul(np.matmul(matrix_x, stack_crop), matrix_y.transpose(0, 2, 1))
+    # Compute area with weighted segmentation and adjust area with physical pixel size
+    area = stack_crop_r.sum(axis=(1, 2)) * dim[0] * dim[1] / upscale ** 2
+    # Binarize images using threshold at 0.5
+    stack_crop_r_bin = (stack_crop_r > 0.5).astype(np.float64)
+    # Compute raw and central moments of the binary objects
+    coord_x = np.arange(stack_crop_r_bin.shape[1], dtype=np.float64)
+    coord_y = np.arange(stack_crop_r_bin.shape[2], dtype=np.float64)
+    m00 = stack_crop_r_bin.sum(axis=(1, 2))
+    m10 = np.einsum('nij,i->n', stack_crop_r_bin, coord_x)
+    m01 = np.einsum('nij,j->n', stack_crop_r_bin, coord_y)
+    # Objects that vanished after oversampling have m00 = 0: their properties are nan, and are discarded below
+    with np.errstate(divide='ignore', invalid='ignore'):
+        centroid_x, centroid_y = m10 / m00, m01 / m00
+        mu20 = np.einsum('nij,i->n', stack_crop_r_bin, coord_x ** 2) - m10 * centroid_x
+        mu02 = np.einsum('nij,j->n', stack_crop_r_bin, coord_y ** 2) - m01 * centroid_y
+        mu11 = np.einsum('nij,i,j->n', stack_crop_r_bin, coord_x, coord_y) - m10 * centroid_y
+        # Inertia tensor [[a, b], [b, c]] and its eigenvalues (see skimage.measure.inertia_tensor)
+        a, b, c = mu02 / m00, -mu11 / m00, mu20 / m00
+        delta = np.sqrt(((a - c) / 2) ** 2 + b ** 2)
+        l1 = np.clip((a + c) / 2 + delta, 0, None)
+        l2 = np.clip((a + c) / 2 - delta, 0, None)
+        major_axis_length, minor_axis_length = 4 * np.sqrt(l1), 4 * np.sqrt(l2)
+        eccentricity = np.where(l1 == 0, 0, np.sqrt(1 - l2 / l1))
+    orientation_rad = np.where(a - c == 0, np.where(b < 0, -math.pi / 4., math.pi / 4.),
+                               0.5 * np.arctan2(-2 * b, c - a))
+    # Deal with https://github.com/neuropoly/spinalcordtoolbox/issues/2307
+    compute_solidity = not any(x in platform.platform() for x in ['Darwin-15', 'Darwin-16'])
+    # Fill up dictionary
+    for i, iz in enumerate(ind_valid):
+        if m00[i] == 0:
+            continue
+        # Compute ellipse orientation, modulo pi, in deg, and between [0, 90]
+        orientation = fix_orientation(orientation_rad[i])
+        # Find RL and AP diameter based on major/minor axes and cord orientation
+        [diameter_AP, diameter_RL] = \
+            _find_AP_and_RL_diameter(major_axis_length[i], minor_axis_length[i], orientation,
+                                     [d / upscale for d in dim])
+        if compute_solidity:
+            # The convex hull cannot be obtained from image moments, so it is computed slice by slice
+            solidity = m00[i] / _convex_hull_area(stack_crop_r_bin[i].astype(bool))
+        else:
+            solidity = np.nan
+        properties[iz] = {'area': area[i],
+                          'diameter_AP': diameter_AP,
+                          'diameter_RL': diameter_RL,
+                          'centroid': (centroid_x[i], centroid_y[i]),
+                          'eccentricity': eccentricity[i],
+                          'orientation': orientation,
+                          'solidity': solidity  # convexity measure
+                          }
+
+    return properties
+
+
+def _convex_hull_area(image):
+    """
+    Count the pixels inside the convex hull of a binary object. Gives the same result as
+    np.sum(skimage.morphology.convex_hull_image(image)), without testing each pixel of the image against the hull
+    polygon: for each row, pixels inside the hull form a single interval, which is obtained from the hull equations.
+    :param image: 2D bool array
+    :return: int: number of pixels inside the convex hull (including its border)
+    """
+    tolerance = 1e-9
+    nx, ny = image.shape
+    # The convex hull only depends on the first and last pixel of each row
+    rows = np.where(image.any(axis=1))[0]
+    col_min = image[rows].argmax(axis=1)
+    col_max = ny - 1 - image[rows, ::-1].argmax(axis=1)
+    coords = np.concatenate([np.stack([rows, col_min], axis=1), np.stack([rows, col_max], axis=1)])
+    # Add a vertex for the middle of each pixel edge (see skimage.morphology.convex_hull_image). Coordinates are
+    # multiplied by 2 to remove duplicates on integer values.
+    offsets = np.array([[-1, 0], [1, 0], [0, -1], [0, 1]])
+    coords = (2 * coords[:, None, :] + offsets).reshape(-1, 2)
+    coords = np.unique(coords[:, 0] * (2 * ny + 2) + coords[:, 1] + 1)
+    coords = np.stack(np.divmod(coords, 2 * ny + 2), axis=1) - [0, 1]
+    # Each facet of the hull is defined by: normal_x * x + normal_y * y + offset <= 0
+    equations = ConvexHull(coords / 2.0).equations
+    normal_x, normal_y, offset = equations[:, 0], equations[:, 1], equations[:, 2]
+    # For each row x, find the interval of y satisfying all facet equations
+    bound = -(offset + normal_x * np.arange(nx)[:, None])
+    is_vertical = np.abs(normal_y) <= tolerance
+    with np.errstate(divide='ignore', invalid='ignore'):
+        bound_y = bound / normal_y
+    y_max = np.where(normal_y > tolerance, bound_y, np.inf).min(axis=1)
+    y_min = np.where(normal_y < -tolerance, bound_y, -np.inf).max(axis=1)
+    is_row_inside = np.all(~is_vertical | (bound >= -tolerance), axis=1)
+    y_max = np.minimum(np.floor(y_max + tolerance), ny - 1)
+    y_min = np.maximum(np.ceil(y_min - tolerance), 0)
+    return int(np.sum(np.where(is_row_inside, np.clip(y_max - y_min + 1, 0, None), 0)))
+
+
 def fix_orientation(orientation):
     """Re-map orientation from skimage.regionprops from [-pi/2,pi/2] to [0,90] and rotate by 90deg because image axis
     are inverted"""
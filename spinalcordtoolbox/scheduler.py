@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Scheduler of tasks over a cohort (e.g., one SCT function run on many subjects, see sct_pipeline).
+#
+# The status and result of each task are saved in a SQLite database as soon as the task completes, so that an
+# interrupted run (crash, Ctrl+C) can be resumed: the completed tasks are not run again. Tasks are admitted according
+# to their estimated memory, so that a few large (e.g., 4D) jobs running at the same time do not exhaust the memory of
+# the node, and the cores are divided between the worker processes and the threads of each process (ITK).
+
+from __future__ import absolute_import, division
+
+import os
+import json
+import time
+import pickle
+import sqlite3
+import logging
+import concurrent.futures
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# Estimated memory of a task: MEMORY_FACTOR x the memory of its input images (as float32), at least MIN_TASK_MEMORY
+MEMORY_FACTOR = 20
+MIN_TASK_MEMORY = 256 << 20
+# Fraction of the available memory that tasks can use
+MEMORY_FRACTION = 0.8
+
+
+class TaskStore(object):
+    """
+    Persistent status and result of tasks, in a SQLite database. Each task is identified by a key (a JSON string).
+    """
+    def __init__(self, fname_db=':memory:'):
+        """
+        :param fname_db: path of the SQLite database. It is created if it does not exist.
+        """
+        self.fname_db = fname_db
+        self.conn = sqlite3.connect(fname_db)
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tasks (key TEXT PRIMARY KEY, status TEXT, result BLOB, "
+                              "error TEXT, duration REAL, timestamp REAL)")
+
+    @staticmethod
+    def get_key(task):
+        """
+        :param task: tuple of JSON-serializable values
+        :return: str: key of the task
+        """
+        return json.dumps(list(task))
+
+    def set_done(self, task, result, duration=None):
+        """
+        Save the result of a task (committed immediately)
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, 'done', ?, NULL, ?, ?)",
+                              (self.get_key(task), sqlite3.Binary(pickle.dumps(result, protocol=2)), duration,
+                               time.time()))
+
+    def set_failed(self, task, error, duration=None):
+        """
+        Save the error of a task which raised an exception (it will be run again when resuming)
+        """
+        with self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO tasks VALUES (?, 'failed', NULL, ?, ?, ?)",
+                              (self.get_key(task), str(error), duration, time.time()))
+
+    def is_done(self, task):
+        row = self.conn.execute("SELECT status FROM tasks WHERE key = ?", (self.get_key(task),)).fetchone()
+        return row is not None and row[0] == 'done'
+
+    def get_results(self, tasks):
+        """
+        :param tasks: list of tasks
+        :return: list of the results of the completed tasks, in the order of tasks
+        """
+        results = []
+        for task in tasks:
+            row = self.conn.execute("SELECT result FROM tasks WHERE key = ? AND status = 'done'",
+                                    (self.get_key(task),)).fetchone()
+            if row is not None:
+                results.append(pickle.loads(bytes(row[0])))
+        return results
+
+    def close(self):
+        self.conn.close()
+
+
+def get_available_memory():
+    """
+    :return: int: memory that tasks can use, in bytes
+    """
+    import psutil
+    return int(psutil.virtual_memory().available * MEMORY_FRACTION)
+
+
+def estimate_image_memory(fname):
+    """
+    :param fname: NIfTI file
+    :return: int: memory of the image as float32, in bytes (read from the header only)
+    """
+    import nibabel
+    return int(np.prod(nibabel.load(fname).header.get_data_shape())) * 4
+
+
+def estimate_task_memory(path_subject, args):
+    """
+    Estimate the memory used by an SCT function from the size of the images given in its arguments.
+    :param path_subject: folder of the subject (the paths in args are relative to it)
+    :param args: str: arguments of the function
+    :return: int: estimated memory, in bytes
+    """
+    memory = 0
+    for arg in args.split():
+        fname = os.path.join(path_subject, arg)
+        if arg.endswith(('.nii', '.nii.gz')) and os.path.isfile(fname):
+            try:
+                memory += estimate_image_memory(fname)
+            except Exception as e:
+                logger.debug("Cannot read the header of %s: %s", fname, e)
+    return max(MEMORY_FACTOR * memory, MIN_TASK_MEMORY)
+
+
+def get_nb_threads(nb_cores, nb_workers):
+    """
+    Divide a core budget between worker processes and the threads of each worker.
+    :param nb_cores: int: total number of cores to use
+    :param nb_workers: int: number of worker processes
+    :return: int: number of threads per worker
+    """
+    return max(1, nb_cores // max(1, nb_workers))
+
+
+def run_tasks(function, tasks, store, nb_workers=1, memory_budget=None, list_memory=None,
+              pool_executor=concurrent.futures.ProcessPoolExecutor, callback=None):
+    """
+    Run function on each task in parallel, skipping the tasks already completed in store, and saving the result of
+    each task in store as soon as it completes. A task is only started if the estimated memory of the running tasks
+    stays within memory_budget (a task larger than the budget is run alone).
+    :param function: function called with each task as argument. It must be picklable for process pools.
+    :param tasks: list of tasks (tuples of JSON-serializable values)
+    :param store: TaskStore
+    :param nb_workers: int: maximum number of tasks running at the same time
+    :param memory_budget: int: memory available for the tasks, in bytes (None: no limit)
+    :param list_memory: list of int: estimated memory of each task, in bytes
+    :param pool_executor: class of the executor (e.g., ProcessPoolExecutor, ThreadPoolExecutor, MPIPoolExecutor)
+    :param callback: function called with (task, result, count, nb_tasks) after each completed task. result is None if
+    the task raised an exception.
+    :return: int: number of tasks run
+    """
+    if list_memory is None:
+        list_memory = [0] * len(tasks)
+    pending = [(task, memory) for task, memory in zip(tasks, list_memory) if not store.is_done(task)]
+    if len(pending) < len(tasks):
+        logger.info("Resuming: %d task(s) out of %d already completed", len(tasks) - len(pending), len(tasks))
+    nb_tasks = len(pending)
+    pool = pool_executor(max(1, nb_workers))
+    running = {}
+    count = 0
+    try:
+        while pending or running:
+            # admit the pending tasks which fit in the memory budget, in order
+            memory_running = sum(memory for _, memory, _ in running.values())
+            i = 0
+            while i < len(pending) and len(running) < max(1, nb_workers):
+                task, memory = pending[i]
+                if memory_budget is None or not running or memory_running + memory <= memory_budget:
+                    running[pool.submit(function, task)] = (task, memory, time.time())
+                    memory_running += memory
+                    del pending[i]
+                else:
+                    i += 1
+            done, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                task, _, time_start = running.pop(future)
+                count += 1
+                try:
+                    result = future.result()
+                except Exception as e:
+                    logger.error("{} generated an exception: {}".format(task, e))
+                    store.set_failed(task, e, time.time() - time_start)
+                    result = None
+                else:
+                    store.set_done(task, result, time.time() - time_start)
+                if callback is not None:
+                    callback(task, result, count, nb_tasks)
+    except KeyboardInterrupt:
+        logger.warning("\nCaught KeyboardInterrupt, terminating workers. The completed tasks are saved in {}: run "
+                       "again with this file to resume.".format(store.fname_db))
+        for future in running:
+            future.cancel()
+        raise
+    finally:
+        pool.shutdown()
+    return count
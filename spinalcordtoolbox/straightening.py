@@ -10,6 +10,7 @@ from __future__ import absolute_import
 
 import os, time, logging, inspect
 import bisect
+import multiprocessing
 import numpy as np
 from tqdm import tqdm
 from nibabel import Nifti1Image, save
@@ -18,6 +19,7 @@ from spinalcordtoolbox.types import Centerline
 import spinalcordtoolbox.image as msct_image
 from spinalcordtoolbox.image import Image
 from spinalcordtoolbox.centerline.core import ParamCenterline, get_centerline
+from spinalcordtoolbox.resampling import resample_file
 
 import sct_utils as sct
 from sct_image import pad_image
@@ -47,6 +49,8 @@ class SpinalCordStraightener(object):
         self.speed_factor = 1.0  # Speed parameter
         self.xy_size = 70  # in mm
         self.param_centerline = param_centerline
+        self.cpu_number = 1  # number of cores used to compute the warping fields
+        self.memory_budget = 1024  # in MB, memory used by intermediate arrays when computing the warping fields
 
         # QC metrics
         self.accuracy_results = 0
@@ -136,9 +140,8 @@ class SpinalCordStraightener(object):
         if intermediate_resampling:
             sct.mv('centerline_rpi.nii.gz', 'centerline_rpi_native.nii.gz')
             pz_native = pz
-            # TODO: remove system call
-            sct.run(['sct_resample', '-i', 'centerline_rpi_native.nii.gz', '-mm',
-                     str(px_r) + 'x' + str(py_r) + 'x' + str(pz_r), '-o', 'centerline_rpi.nii.gz'])
+            resample_file('centerline_rpi_native.nii.gz', 'centerline_rpi.nii.gz',
+                          str(px_r) + 'x' + str(py_r) + 'x' + str(pz_r), 'mm', 'linear', verbose=0)
             image_centerline = Image('centerline_rpi.nii.gz')
             nx, ny, nz, nt, px, py, pz, pt = image_centerline.dim
 
@@ -226,22 +229,18 @@ class SpinalCordStraightener(object):
 
             if self.discs_input_filename != "" and self.discs_ref_filename != "":
                 discs_input_image = Image('labels_input.nii.gz')
-                coord = discs_input_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                coord_physical = []
-                for c in coord:
-                    c_p = discs_input_image.transfo_pix2phys([[c.x, c.y, c.z]]).tolist()[0]
-                    c_p.append(c.value)
-                    coord_physical.append(c_p)
+                coord = discs_input_image.get_nonzero_coordinates(sorting='z', reverse_coord=True)
+                coord_pix = np.stack([coord['x'], coord['y'], coord['z']], axis=1)
+                coord_physical = np.hstack([discs_input_image.transfo_pix2phys(coord_pix),
+                                            coord['value'][:, np.newaxis]]).tolist()
                 centerline.compute_vertebral_distribution(coord_physical)
                 centerline.save_centerline(image=discs_input_image, fname_output='discs_input_image.nii.gz')
 
                 discs_ref_image = Image('labels_ref.nii.gz')
-                coord = discs_ref_image.getNonZeroCoordinates(sorting='z', reverse_coord=True)
-                coord_physical = []
-                for c in coord:
-                    c_p = discs_ref_image.transfo_pix2phys([[c.x, c.y, c.z]]).tolist()[0]
-                    c_p.append(c.value)
-                    coord_physical.append(c_p)
+                coord = discs_ref_image.get_nonzero_coordinates(sorting='z', reverse_coord=True)
+                coord_pix = np.stack([coord['x'], coord['y'], coord['z']], axis=1)
+                coord_physical = np.hstack([discs_ref_image.transfo_pix2phys(coord_pix),
+                                            coord['value'][:, np.newaxis]]).tolist()
                 centerline_straight.compute_vertebral_distribution(coord_physical)
                 centerline_straight.save_centerline(image=discs_ref_image, fname_output='discs_ref_image.nii.gz')
 
@@ -256,9 +255,8 @@ class SpinalCordStraightener(object):
             # TODO: Maybe this if case is not needed?
             if intermediate_resampling:
                 padding_z = int(np.ceil(1.5 * ((length_centerline - size_z_centerline) / 2.0) / pz_native))
-                sct.run(
-                    ['sct_image', '-i', 'centerline_rpi_native.nii.gz', '-o', 'tmp.centerline_pad_native.nii.gz',
-                     '-pad', '0,0,' + str(padding_z)])
+                pad_image(Image('centerline_rpi_native.nii.gz'), pad_z_i=padding_z, pad_z_f=padding_z) \
+                    .save('tmp.centerline_pad_native.nii.gz')
                 image_centerline_pad = Image('centerline_rpi_native.nii.gz')
                 nx, ny, nz, nt, px, py, pz, pt = image_centerline_pad.dim
                 start_point_coord_native = image_centerline_pad.transfo_phys2pix([[0, 0, start_point]])[0]
@@ -427,8 +425,8 @@ class SpinalCordStraightener(object):
         lookup_straight2curved = np.array(lookup_straight2curved)
 
         # Create volumes containing curved and straight warping fields
-        data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3))
-        data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3))
+        data_warp_curved2straight = np.zeros((nx_s, ny_s, nz_s, 1, 3), dtype=np.float32)
+        data_warp_straight2curved = np.zeros((nx, ny, nz, 1, 3), dtype=np.float32)
 
         # 5. compute transformations
         # Curved and straight images and the same dimensions, so we compute both warping fields at the same time.
@@ -436,61 +434,14 @@ class SpinalCordStraightener(object):
         # sct.printv(nx * ny * nz, nx_s * ny_s * nz_s)
 
         if self.curved2straight:
-            for u in tqdm(range(nz_s)):
-                x_s, y_s, z_s = np.mgrid[0:nx_s, 0:ny_s, u:u + 1]
-                indexes_straight = np.array(list(zip(x_s.ravel(), y_s.ravel(), z_s.ravel())))
-                physical_coordinates_straight = image_centerline_straight.transfo_pix2phys(indexes_straight)
-                nearest_indexes_straight = centerline_straight.find_nearest_indexes(physical_coordinates_straight)
-                distances_straight = centerline_straight.get_distances_from_planes(physical_coordinates_straight,
-                                                                                   nearest_indexes_straight)
-                lookup = lookup_straight2curved[nearest_indexes_straight]
-                indexes_out_distance_straight = np.logical_or(
-                    np.logical_or(distances_straight > self.threshold_distance,
-                                  distances_straight < -self.threshold_distance), lookup == 0)
-                projected_points_straight = centerline_straight.get_projected_coordinates_on_planes(
-                    physical_coordinates_straight, nearest_indexes_straight)
-                coord_in_planes_straight = centerline_straight.get_in_plans_coordinates(projected_points_straight,
-                                                                                        nearest_indexes_straight)
-
-                coord_straight2curved = centerline.get_inverse_plans_coordinates(coord_in_planes_straight, lookup)
-                displacements_straight = coord_straight2curved - physical_coordinates_straight
-                # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
-                # while ours is LPI-
-                # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
-                #  https://www.slicer.org/wiki/Coordinate_systems
-                displacements_straight[:, 2] = -displacements_straight[:, 2]
-                displacements_straight[indexes_out_distance_straight] = [100000.0, 100000.0, 100000.0]
-
-                data_warp_curved2straight[indexes_straight[:, 0], indexes_straight[:, 1], indexes_straight[:, 2], 0, :]\
-                    = -displacements_straight
+            logger.info('Compute curved to straight warping field...')
+            self._compute_warping_field(data_warp_curved2straight, image_centerline_straight, centerline_straight,
+                                        centerline, lookup_straight2curved, mode='curved2straight')
 
         if self.straight2curved:
-            for u in tqdm(range(nz)):
-                x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
-                indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
-                physical_coordinates = image_centerline_pad.transfo_pix2phys(indexes)
-                nearest_indexes_curved = centerline.find_nearest_indexes(physical_coordinates)
-                distances_curved = centerline.get_distances_from_planes(physical_coordinates,
-                                                                        nearest_indexes_curved)
-                lookup = lookup_curved2straight[nearest_indexes_curved]
-                indexes_out_distance_curved = np.logical_or(
-                    np.logical_or(distances_curved > self.threshold_distance,
-                                  distances_curved < -self.threshold_distance), lookup == 0)
-                projected_points_curved = centerline.get_projected_coordinates_on_planes(physical_coordinates,
-                                                                                         nearest_indexes_curved)
-                coord_in_planes_curved = centerline.get_in_plans_coordinates(projected_points_curved,
-                                                                             nearest_indexes_curved)
-
-                coord_curved2straight = centerline_straight.points[lookup]
-                coord_curved2straight[:, 0:2] += coord_in_planes_curved[:, 0:2]
-                coord_curved2straight[:, 2] += distances_curved
-
-                displacements_curved = coord_curved2straight - physical_coordinates
-
-                displacements_curved[:, 2] = -displacements_curved[:, 2]
-                displacements_curved[indexes_out_distance_curved] = [100000.0, 100000.0, 100000.0]
-
-                data_warp_straight2curved[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements_curved
+            logger.info('Compute straight to curved warping field...')
+            self._compute_warping_field(data_warp_straight2curved, image_centerline_pad, centerline,
+                                        centerline_straight, lookup_curved2straight, mode='straight2curved')
 
         # Creation of the safe zone based on pre-calculated safe boundaries
         coord_bound_curved_inf, coord_bound_curved_sup = image_centerline_pad.transfo_phys2pix(
@@ -549,15 +500,17 @@ class SpinalCordStraightener(object):
                     verbose=verbose)
             file_centerline_straight = Image('tmp.centerline_straight.nii.gz', verbose=verbose)
             nx, ny, nz, nt, px, py, pz, pt = file_centerline_straight.dim
-            coordinates_centerline = file_centerline_straight.getNonZeroCoordinates(sorting='z')
-            mean_coord = []
-            for z in range(coordinates_centerline[0].z, coordinates_centerline[-1].z):
-                temp_mean = [coord.value for coord in coordinates_centerline if coord.z == z]
-                if temp_mean:
-                    mean_value = np.mean(temp_mean)
-                    mean_coord.append(
-                        np.mean([[coord.x * coord.value / mean_value, coord.y * coord.value / mean_value]
-                                 for coord in coordinates_centerline if coord.z == z], axis=0))
+            coordinates_centerline = file_centerline_straight.get_nonzero_coordinates(sorting='z')
+            # compute the mean x-y position in each slice, weighted by the value of the voxels (last slice excluded)
+            z_min, z_max = coordinates_centerline['z'][0], coordinates_centerline['z'][-1]
+            coordinates_centerline = coordinates_centerline[coordinates_centerline['z'] < z_max]
+            z_index = coordinates_centerline['z'] - z_min
+            value = coordinates_centerline['value'].astype(np.float64)
+            sum_value = np.bincount(z_index, weights=value, minlength=z_max - z_min)
+            sum_xy = np.stack([np.bincount(z_index, weights=coordinates_centerline[axis] * value,
+                                           minlength=z_max - z_min) for axis in ['x', 'y']], axis=1)
+            is_nonzero_slice = np.bincount(z_index, minlength=z_max - z_min) > 0
+            mean_coord = list(sum_xy[is_nonzero_slice] / sum_value[is_nonzero_slice, np.newaxis])
 
             # compute error between the straightened centerline and the straight line.
             x0 = file_centerline_straight.data.shape[0] / 2.0
@@ -619,13 +572,128 @@ class SpinalCordStraightener(object):
 
         return fname_straight
 
+    def _compute_warping_field(self, data_warp, image, centerline_src, centerline_dest, lookup_table, mode):
+        """
+        Compute a warping field by chunks of slices, optionally distributed across a pool of processes.
+        The chunk size is chosen so that intermediate arrays of all workers fit in self.memory_budget.
+        :param data_warp: numpy array (nx, ny, nz, 1, 3) filled with the warping field
+        :param image: Image defining the space of the warping field
+        :param centerline_src: Centerline in the space of the warping field
+        :param centerline_dest: Centerline in the destination space
+        :param lookup_table: numpy array: index of the corresponding point of centerline_dest, for each point of
+        centerline_src
+        :param mode: {'curved2straight', 'straight2curved'}
+        :return:
+        """
+        nx, ny, nz = data_warp.shape[:3]
+        cpu_number = multiprocessing.cpu_count() if self.cpu_number == 0 else self.cpu_number
+        chunk_size = min(get_warp_chunk_size((nx, ny, nz), self.memory_budget / float(cpu_number)),
+                         int(np.ceil(nz / float(cpu_number))))
+        z_ranges = [(z, min(z + chunk_size, nz)) for z in range(0, nz, chunk_size)]
+        context = {'affine': image.get_affine(),
+                   'shape': (nx, ny),
+                   'centerline_src': centerline_src,
+                   'centerline_dest': centerline_dest,
+                   'lookup_table': lookup_table,
+                   'threshold_distance': self.threshold_distance,
+                   'mode': mode}
+        if cpu_number > 1 and len(z_ranges) > 1:
+            pool = multiprocessing.Pool(cpu_number, initializer=_init_warp_worker, initargs=(context,))
+            try:
+                for (z_start, z_end), warp in tqdm(pool.imap_unordered(_compute_warp_worker, z_ranges),
+                                                   total=len(z_ranges), unit='chunk'):
+                    data_warp[:, :, z_start:z_end, 0, :] = warp
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for z_start, z_end in tqdm(z_ranges, unit='chunk'):
+                data_warp[:, :, z_start:z_end, 0, :] = compute_warp_chunk(z_range=(z_start, z_end), workers=cpu_number,
+                                                                          **context)
+
+
+# Approximate number of bytes used by the intermediate arrays of each voxel in compute_warp_chunk()
+BYTES_PER_VOXEL_WARP = 512
+
+
+def get_warp_chunk_size(shape, memory_budget):
+    """
+    Return the number of slices that can be processed at once by compute_warp_chunk() within a memory budget.
+    :param shape: (nx, ny, nz): shape of the warping field
+    :param memory_budget: float: in MB
+    :return: int
+    """
+    nx, ny, nz = shape
+    return int(np.clip(memory_budget * 1024 ** 2 // (nx * ny * BYTES_PER_VOXEL_WARP), 1, nz))
+
+
+def compute_warp_chunk(affine, shape, z_range, centerline_src, centerline_dest, lookup_table, threshold_distance,
+                       mode, workers=1):
+    """
+    Compute the warping field for the slices z_range[0]:z_range[1] of the space defined by affine and shape.
+    For each voxel:
+        a. find the nearest plane of centerline_src
+        b. compute the position of the voxel in the plane
+        c. find the corresponding plane of centerline_dest, using lookup_table
+        d. compute the position of the voxel in the destination space
+    All voxels of the chunk are processed at once.
+    :param affine: 4x4 numpy array: voxel to physical transformation of the space of the warping field
+    :param shape: (nx, ny): in-plane shape of the warping field
+    :param z_range: (z_start, z_end)
+    :param centerline_src: Centerline in the space of the warping field
+    :param centerline_dest: Centerline in the destination space
+    :param lookup_table: numpy array: index of the corresponding point of centerline_dest, for each point of
+    centerline_src. Voxels mapped to 0 are considered outside of the field.
+    :param threshold_distance: float: voxels further from the nearest plane are considered outside of the field.
+    :param mode: {'curved2straight', 'straight2curved'}
+    :param workers: int: number of threads used for the KD-tree query.
+    :return: float32 numpy array (nx, ny, z_end - z_start, 3)
+    """
+    nx, ny = shape
+    z_start, z_end = z_range
+    # Voxel coordinates of the chunk, ordered as data[:, :, z_start:z_end]
+    indexes = np.indices((nx, ny, z_end - z_start)).reshape(3, -1)
+    indexes[2] += z_start
+    physical_coordinates = (np.dot(affine[:3, :3], indexes) + affine[:3, 3:]).T
+    nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates, workers=workers)
+    distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+    lookup = lookup_table[nearest_indexes]
+    indexes_out_distance = np.logical_or(np.abs(distances) > threshold_distance, lookup == 0)
+    projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+    coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+    if mode == 'curved2straight':
+        coord_dest = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup)
+    else:
+        coord_dest = centerline_dest.points[lookup]
+        coord_dest[:, 0:2] += coord_in_planes[:, 0:2]
+        coord_dest[:, 2] += distances
+    displacements = coord_dest - physical_coordinates
+    # Invert Z coordinate as ITK & ANTs physical coordinate system is LPS- (RAI+)
+    # while ours is LPI-
+    # Refs: https://sourceforge.net/p/advants/discussion/840261/thread/2a1e9307/#fb5a
+    #  https://www.slicer.org/wiki/Coordinate_systems
+    displacements[:, 2] = -displacements[:, 2]
+    displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+    return (-displacements).astype(np.float32).reshape(nx, ny, z_end - z_start, 3)
+
+
+# Arguments of compute_warp_chunk() shared by all chunks, set in each worker of the pool
+_warp_context = {}
+
+
+def _init_warp_worker(context):
+    _warp_context.update(context)
+
+
+def _compute_warp_worker(z_range):
+    return z_range, compute_warp_chunk(z_range=z_range, **_warp_context)
+
 
 def _get_centerline(img, param_centerline, verbose):
     nx, ny, nz, nt, px, py, pz, pt = img.dim
     _, arr_ctl, arr_ctl_der, _ = get_centerline(img, param_centerline, verbose=verbose)
     # Transform centerline to physical coordinate system
-    arr_ctl_phys = img.transfo_pix2phys(
-        [[arr_ctl[0][i], arr_ctl[1][i], arr_ctl[2][i]] for i in range(len(arr_ctl[0]))])
+    arr_ctl_phys = img.transfo_pix2phys(np.stack(arr_ctl[:3], axis=1))
     x_centerline, y_centerline, z_centerline = arr_ctl_phys[:, 0], arr_ctl_phys[:, 1], arr_ctl_phys[:, 2]
     # Adjust derivatives with pixel size
     x_centerline_deriv, y_centerline_deriv, z_centerline_deriv = arr_ctl_der[0][:] * px, \
@@ -10,6 +10,59 @@ import numpy as np
 logger = logging.getLogger(__name__)
 
 
+class VertLevelIndex(object):
+    """
+    Index of the vertebral levels of a vertebral labeling image: vertebral level of each slice, and slices of each
+    vertebral level. It is built with a single pass over the image, then lookups are done in constant time.
+    The level of a slice is the average of its non-null finite values, rounded to the closest integer.
+    Important: This class assumes that the 3rd dimension is Z.
+    """
+    def __init__(self, im_vertlevel):
+        """
+        :param im_vertlevel: image object of vertebral labeling (e.g., label/template/PAM50_levels.nii.gz)
+        """
+        data = np.asarray(im_vertlevel.data)
+        data = data.reshape(-1, data.shape[-1])
+        mask = np.isfinite(data) & (data != 0)
+        nb_vox = mask.sum(axis=0)
+        sum_vox = np.where(mask, data, 0).sum(axis=0, dtype=np.float64)
+        # level of each slice (None for empty slices)
+        self.slice_levels = [int(np.round(s / n)) if n else None for s, n in zip(sum_vox, nb_vox)]
+        # slices of each level
+        self.level_slices = {}
+        for iz, level in enumerate(self.slice_levels):
+            if level is not None:
+                self.level_slices.setdefault(level, []).append(iz)
+
+    def get_slices(self, level):
+        """
+        :param level: int: vertebral level
+        :return: list of int: slices
+        """
+        return list(self.level_slices.get(level, []))
+
+    def get_level(self, idx_slice):
+        """
+        :param idx_slice: int: slice (z)
+        :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
+        """
+        return self.slice_levels[idx_slice]
+
+
+def get_vertlevel_index(im_vertlevel):
+    """
+    Get the VertLevelIndex of a vertebral labeling image. The index is cached on the image object, and built again
+    only if its data array is replaced.
+    :param im_vertlevel: image object of vertebral labeling
+    :return: VertLevelIndex
+    """
+    data_cached, vertlevel_index = getattr(im_vertlevel, '_vertlevel_index', (None, None))
+    if vertlevel_index is None or data_cached is not im_vertlevel.data:
+        vertlevel_index = VertLevelIndex(im_vertlevel)
+        im_vertlevel._vertlevel_index = (im_vertlevel.data, vertlevel_index)
+    return vertlevel_index
+
+
 def get_slices_from_vertebral_levels(im_vertlevel, level):
     """
     Find the slices of the corresponding vertebral level.
@@ -18,21 +71,7 @@ def get_slices_from_vertebral_levels(im_vertlevel, level):
     :param level: int: vertebral level
     :return: list of int: slices
     """
-    data_vertlevel = im_vertlevel.data
-    slices = []
-    # loop across z
-    for iz in range(data_vertlevel.shape[-1]):
-        # fetch non-null and finite values
-        data_vertlevel_nonzero = data_vertlevel[..., iz].flatten()[np.nonzero(data_vertlevel[..., iz].flatten())]
-        data_vertlevel_nonzero_finite = [i for i in data_vertlevel_nonzero if np.isfinite(i)]
-        # avoid empty slice
-        if not data_vertlevel_nonzero_finite == []:
-            # average non-null values and round to closest
-            average_value = int(np.round(np.mean(data_vertlevel_nonzero_finite)))
-            # if that matches the desired level, append it to slice list
-            if average_value == level:
-                slices.append(iz)
-    return slices
+    return get_vertlevel_index(im_vertlevel).get_slices(level)
 
 
 def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
@@ -43,15 +82,4 @@ def get_vertebral_level_from_slice(im_vertlevel, idx_slice):
     :param idx_slice: int: slice (z)
     :return: int: vertebral level. If no level is found (only zeros on this slice), return None.
     """
-    data_vertlevel = im_vertlevel.data
-    # average non-null values and round to closest
-    try:
-        # find indices of non-null values
-        indx, indy = np.where(data_vertlevel[:, :, idx_slice])
-        vert_level = int(np.round(np.mean(data_vertlevel[indx, indy, idx_slice])))
-    except ValueError as e:
-        # slice is empty (no indx found). Do nothing.
-        logger.debug('Empty slice: z=%s (%s)', idx_slice, e)
-        vert_level = None
-    return vert_level
-
+    return get_vertlevel_index(im_vertlevel).get_level(idx_slice)
@@ -15,6 +15,11 @@
 
 from __future__ import division, absolute_import
 
+try:
+    from collections.abc import Sequence
+except ImportError:  # Python 2
+    from collections import Sequence
+
 from numpy import dot, cross, array, dstack, einsum, tile, multiply, stack, rollaxis, zeros
 from numpy.linalg import norm, inv
 import numpy as np
@@ -160,6 +165,54 @@ class CoordinateValue(Coordinate):
         return hash(self.value)
 
 
+class CoordinateList(Sequence):
+    """
+    Read-only list of Coordinate objects, backed by a coordinate table: a numpy structured array with fields x, y, z
+    and value (see Image.get_nonzero_coordinates()). Coordinate objects are only created when accessed, and are then
+    kept, so that they behave like the items of a list.
+    Example:
+      coordinates = CoordinateList(im.get_nonzero_coordinates())
+      coordinates[0].value
+      coordinates.table['z']  # array of z coordinates
+    """
+    def __init__(self, table, coordinate_class=Coordinate):
+        self.table = table
+        self._coordinate_class = coordinate_class
+        self._items = [None] * len(table)
+
+    def __len__(self):
+        return len(self.table)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('CoordinateList index out of range')
+        if self._items[index] is None:
+            row = self.table[index]
+            self._items[index] = self._coordinate_class([row['x'], row['y'], row['z'], row['value']])
+        return self._items[index]
+
+    def __add__(self, other):
+        return list(self) + list(other)
+
+    def __radd__(self, other):
+        return list(other) + list(self)
+
+    def __eq__(self, other):
+        if isinstance(other, (list, CoordinateList)):
+            return list(self) == list(other)
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __repr__(self):
+        return repr(list(self))
+
+
 class Centerline:
     """
     This class represents a centerline in an image. Its coordinates can be in voxel space as well as in physical space.
@@ -295,8 +348,18 @@ class Centerline:
 
         return result_index
 
-    def find_nearest_indexes(self, array_coordinates):
-        dist, result_indexes = self.tree_points.query(array_coordinates)
+    def find_nearest_indexes(self, array_coordinates, workers=1):
+        """
+        Returns the index of the nearest centerline point of each coordinate.
+        :param array_coordinates: numpy array (nb_points x 3)
+        :param workers: int: number of threads used for the KD-tree query. -1 uses all available cores.
+        :return: numpy array of indexes
+        """
+        try:
+            dist, result_indexes = self.tree_points.query(array_coordinates, workers=workers)
+        except TypeError:
+            # scipy < 1.6
+            dist, result_indexes = self.tree_points.query(array_coordinates, n_jobs=workers)
         return result_indexes
 
     def get_point_from_index(self, index):
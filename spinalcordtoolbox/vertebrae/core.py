@@ -29,14 +29,11 @@ def label_vert(fname_seg, fname_label, verbose=1):
     # Open labels
     im_disc = Image(fname_label).change_orientation("RPI")
     # retrieve all labels
-    coord_label = im_disc.getNonZeroCoordinates()
+    coord_label = im_disc.get_nonzero_coordinates()
     # compute list_disc_z and list_disc_value
-    list_disc_z = []
-    list_disc_value = []
-    for i in range(len(coord_label)):
-        list_disc_z.insert(0, coord_label[i].z)
-        # '-1' to use the convention "disc labelvalue=3 ==> disc C2/C3"
-        list_disc_value.insert(0, coord_label[i].value - 1)
+    list_disc_z = coord_label['z'][::-1].tolist()
+    # '-1' to use the convention "disc labelvalue=3 ==> disc C2/C3"
+    list_disc_value = (coord_label['value'][::-1] - 1).tolist()
 
     list_disc_value = [x for (y, x) in sorted(zip(list_disc_z, list_disc_value), reverse=True)]
     list_disc_z = [y for (y, x) in sorted(zip(list_disc_z, list_disc_value), reverse=True)]
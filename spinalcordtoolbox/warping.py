@@ -0,0 +1,474 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# Apply ANTs transformations (affine matrices and displacement fields) in Python, without calling
+# isct_antsApplyTransforms.
+#
+# Conventions (same as ITK/ANTs):
+# - transformations map the points of the destination (fixed) space to the source (moving) space,
+# - affine matrices and displacement vectors are expressed in LPS physical coordinates,
+# - in a list of transformations given to sct_apply_transfo (e.g., "-w warp1 warp2", i.e., warp1 is applied to the
+#   image first), the points of the destination space go through the last transformation first.
+
+from __future__ import division, absolute_import
+
+import os
+import io
+import logging
+import hashlib
+import itertools
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+import numpy as np
+import nibabel as nib
+from scipy.ndimage import map_coordinates
+from scipy.io import loadmat
+
+from spinalcordtoolbox.image import Image
+
+logger = logging.getLogger(__name__)
+
+# Conversion between ITK (LPS) and NIfTI (RAS) physical coordinates
+LPS_TO_RAS = np.diag([-1.0, -1.0, 1.0, 1.0])
+
+# Spline order of scipy's interpolation for each interpolation method of sct_apply_transfo
+SPLINE_ORDER = {'nn': 0, 'linear': 1, 'spline': 3}
+
+
+class AffineTransfo(object):
+    """
+    Affine transformation of physical (RAS) points.
+    """
+    def __init__(self, matrix):
+        """
+        :param matrix: 4x4 array, acting on RAS coordinates
+        """
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def load(cls, fname, inverse=False):
+        """
+        Load an ITK affine transformation, as written by ANTs (binary .mat) or by SCT (text .txt).
+        :param fname: path of the transformation
+        :param inverse: bool: if True, the transformation is inverted
+        :return: AffineTransfo
+        """
+        if fname.endswith('.mat'):
+            matfile = loadmat(fname, struct_as_record=True)
+            parameters = [matfile[key] for key in matfile if key.startswith(('AffineTransform', 'MatrixOffset'))][0]
+            fixed_parameters = matfile['fixed']
+        else:
+            with open(fname) as f:
+                lines = dict(line.split(':', 1) for line in f if ':' in line)
+            parameters = lines['Parameters'].split()
+            fixed_parameters = lines['FixedParameters'].split()
+        parameters = np.asarray(parameters, dtype=np.float64).ravel()
+        center = np.asarray(fixed_parameters, dtype=np.float64).ravel()
+        if parameters.size != 12:
+            raise ValueError("Only 3D affine transformations are supported: {}".format(fname))
+        # ITK: y = M * (x - c) + t + c
+        rotation, translation = parameters[:9].reshape(3, 3), parameters[9:]
+        matrix_lps = np.eye(4)
+        matrix_lps[:3, :3] = rotation
+        matrix_lps[:3, 3] = translation + center - np.dot(rotation, center)
+        matrix = np.dot(LPS_TO_RAS, np.dot(matrix_lps, LPS_TO_RAS))
+        return cls(np.linalg.inv(matrix) if inverse else matrix)
+
+    def transform_points(self, points):
+        """
+        :param points: (3, n) array of RAS coordinates
+        :return: (3, n) array of transformed RAS coordinates
+        """
+        return np.dot(self.matrix[:3, :3], points) + self.matrix[:3, 3:]
+
+
+class DisplacementField(object):
+    """
+    Displacement field transformation of physical (RAS) points. The displacement is linearly interpolated, and null
+    outside of the field.
+    """
+    def __init__(self, data, affine):
+        """
+        :param data: (nx, ny, nz, 3) array of displacements, in RAS coordinates
+        :param affine: 4x4 array: affine of the displacement field image
+        """
+        self.data = data
+        self.affine = np.asarray(affine, dtype=np.float64)
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Load an ITK displacement field (NIfTI image of shape (nx, ny, nz, 1, 3) with vector intent).
+        :param fname: path of the displacement field
+        :return: DisplacementField
+        """
+        im_warp = Image(fname)
+        data = im_warp.data.reshape(im_warp.data.shape[:3] + (3,)).astype(np.float32)
+        # convert vectors from LPS to RAS
+        data[..., :2] *= -1
+        return cls(data, im_warp.hdr.get_best_affine())
+
+    def save(self, fname):
+        """
+        Save as an ITK displacement field (vectors in LPS coordinates), which can be used by ANTs.
+        :param fname: path of the output image
+        """
+        data = self.data.copy()
+        data[..., :2] *= -1
+        img = nib.Nifti1Image(data.reshape(data.shape[:3] + (1, 3)), self.affine)
+        img.header.set_qform(self.affine, code=1)
+        img.header.set_sform(self.affine, code=1)
+        img.header.set_intent('vector', (), '')
+        nib.save(img, fname)
+
+    def transform_points(self, points):
+        """
+        :param points: (3, n) array of RAS coordinates
+        :return: (3, n) array of transformed RAS coordinates
+        """
+        affine_inv = np.linalg.inv(self.affine)
+        coords = np.dot(affine_inv[:3, :3], points) + affine_inv[:3, 3:]
+        displacement = np.stack([interpolate(self.data[..., i], coords, order=1) for i in range(3)])
+        return points + displacement
+
+
+def load_transfo(fname, inverse=False):
+    """
+    Load an ANTs transformation.
+    :param fname: path of an affine transformation (.txt, .mat) or of a displacement field (.nii, .nii.gz)
+    :param inverse: bool: invert the transformation (only for affine transformations)
+    :return: AffineTransfo or DisplacementField
+    """
+    if fname.endswith(('.txt', '.mat')):
+        return AffineTransfo.load(fname, inverse=inverse)
+    if fname.endswith(('.nii', '.nii.gz')):
+        if inverse:
+            raise ValueError("Displacement fields cannot be inverted: {}".format(fname))
+        return DisplacementField.load(fname)
+    raise ValueError("Unsupported transformation: {}".format(fname))
+
+
+def is_supported(fname):
+    """
+    :return: True if the transformation can be applied by this module
+    """
+    return fname.endswith(('.txt', '.mat', '.nii', '.nii.gz'))
+
+
+def interpolate(data, coords, order=1):
+    """
+    Interpolate a 3D volume at continuous voxel coordinates, like ITK: points outside of the volume (by more than half
+    a voxel) are set to 0, and B-spline coefficients are computed with mirror boundaries.
+    :param data: 3D array
+    :param coords: (3, ...) array of voxel coordinates
+    :param order: int: spline order (0: nearest neighbour, 1: linear, 3: cubic B-spline)
+    :return: array of interpolated values, of shape coords.shape[1:]
+    """
+    values = map_coordinates(data, coords, order=order, mode='mirror' if order > 1 else 'nearest')
+    outside = np.zeros(coords.shape[1:], dtype=bool)
+    for i in range(3):
+        outside |= (coords[i] < -0.5) | (coords[i] > data.shape[i] - 0.5)
+    values[outside] = 0
+    return values
+
+
+def _transform_slices(list_transfo, im_dest):
+    """
+    Transform the points of the destination grid through a chain of transformations, slice by slice (to limit memory
+    usage).
+    :return: iterator of (iz, points_dest, points): (3, nx * ny) arrays of RAS coordinates of the slice iz, before and
+    after transformation
+    """
+    nx, ny, nz = im_dest.dim[:3]
+    affine_dest = im_dest.hdr.get_best_affine()
+    ij = np.indices((nx, ny)).reshape(2, -1).astype(np.float64)
+    for iz in range(nz):
+        points_dest = np.dot(affine_dest[:3, :2], ij) + (affine_dest[:3, 2:3] * iz + affine_dest[:3, 3:])
+        points = points_dest
+        for transfo in reversed(list_transfo):
+            points = transfo.transform_points(points)
+        yield iz, points_dest, points
+
+
+def compute_source_coordinates(list_transfo, im_dest, affine_src):
+    """
+    Compute the voxel coordinates in the source image of each voxel of the destination image, through a chain of
+    transformations. The coordinates can then be used to resample any volume of the source space with
+    resample_volume().
+    :param list_transfo: list of AffineTransfo or DisplacementField, in the order of sct_apply_transfo's -w flag
+    :param im_dest: Image: destination image (only the header is used)
+    :param affine_src: 4x4 array: affine of the source image
+    :return: (3, nx, ny, nz) float32 array of voxel coordinates in the source image
+    """
+    nx, ny, nz = im_dest.dim[:3]
+    affine_src_inv = np.linalg.inv(affine_src)
+    coords = np.empty((3, nx, ny, nz), dtype=np.float32)
+    for iz, points_dest, points in _transform_slices(list_transfo, im_dest):
+        coords[:, :, :, iz] = (np.dot(affine_src_inv[:3, :3], points) + affine_src_inv[:3, 3:]).reshape(3, nx, ny)
+    return coords
+
+
+def compose_transfo(list_transfo, im_dest):
+    """
+    Compose a chain of transformations into a single displacement field, defined on the grid of the destination image.
+    :param list_transfo: list of AffineTransfo or DisplacementField, in the order of sct_apply_transfo's -w flag
+    :param im_dest: Image: destination image (only the header is used)
+    :return: DisplacementField
+    """
+    nx, ny, nz = im_dest.dim[:3]
+    data = np.empty((nx, ny, nz, 3), dtype=np.float32)
+    for iz, points_dest, points in _transform_slices(list_transfo, im_dest):
+        data[:, :, iz, :] = (points - points_dest).T.reshape(nx, ny, 3)
+    return DisplacementField(data, im_dest.hdr.get_best_affine())
+
+
+def get_transfo_signature(list_fname, fname_dest, list_fname_inverse=()):
+    """
+    Compute a signature of a chain of transformations, from the content of the transformation files and from the grid
+    of the destination image.
+    :param list_fname: list of paths of transformations, in the order of sct_apply_transfo's -w flag
+    :param fname_dest: path of the destination image
+    :param list_fname_inverse: transformations of list_fname which are inverted
+    :return: str: hexadecimal signature
+    """
+    h = hashlib.md5()
+    for fname in list_fname:
+        with io.open(fname, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b""):
+                h.update(chunk)
+        h.update(b'inverse' if fname in list_fname_inverse else b'direct')
+    hdr_dest = Image(fname_dest, lazy=True).hdr
+    h.update(np.asarray(hdr_dest.get_data_shape()[:3]).astype(np.int64).tobytes())
+    h.update(hdr_dest.get_best_affine().astype(np.float64).tobytes())
+    return h.hexdigest()
+
+
+# Composed transformations, by signature (only the last ones are kept)
+_composed_transfo_cache = {}
+COMPOSED_TRANSFO_CACHE_SIZE = 2
+
+
+def load_composed_transfo(list_fname, fname_dest, list_fname_inverse=(), path_cache=None):
+    """
+    Load a chain of transformations composed into a single displacement field on the grid of the destination image.
+    The composed field is cached in memory and, if path_cache is set, on disk, with the signature of the inputs as
+    key, so that the same chain is only composed once.
+    :param list_fname: list of paths of transformations, in the order of sct_apply_transfo's -w flag
+    :param fname_dest: path of the destination image
+    :param list_fname_inverse: transformations of list_fname which are inverted
+    :param path_cache: folder where the composed fields are cached
+    :return: DisplacementField
+    """
+    signature = get_transfo_signature(list_fname, fname_dest, list_fname_inverse)
+    fname_cache = os.path.join(path_cache, "warp_{}.nii.gz".format(signature)) if path_cache else None
+    if signature in _composed_transfo_cache:
+        logger.debug("Reusing composed transformation %s", signature)
+        field = _composed_transfo_cache[signature]
+    elif fname_cache is not None and os.path.isfile(fname_cache):
+        logger.debug("Loading composed transformation %s", fname_cache)
+        field = DisplacementField.load(fname_cache)
+    else:
+        list_transfo = [load_transfo(fname, inverse=fname in list_fname_inverse) for fname in list_fname]
+        field = compose_transfo(list_transfo, Image(fname_dest, lazy=True))
+
+    if fname_cache is not None and not os.path.isfile(fname_cache):
+        if not os.path.isdir(path_cache):
+            os.makedirs(path_cache)
+        field.save(fname_cache)
+    if signature not in _composed_transfo_cache:
+        if len(_composed_transfo_cache) >= COMPOSED_TRANSFO_CACHE_SIZE:
+            _composed_transfo_cache.clear()
+        _composed_transfo_cache[signature] = field
+    return field
+
+
+class Resampler(object):
+    """
+    Resample many volumes of the same source grid into the destination grid. The coordinates of the destination voxels
+    in the source grid are given once, and the volumes are then resampled together: the interpolation indices and
+    weights are computed once for all the volumes, and only the bounding box of the source voxels which are needed is
+    read from each volume.
+    """
+    # number of destination voxels processed at once by each thread
+    CHUNK_SIZE = 1 << 16
+
+    def __init__(self, coords, shape_src):
+        """
+        :param coords: (3, nx, ny, nz) array of voxel coordinates in the source grid, see compute_source_coordinates()
+        :param shape_src: shape of the source grid
+        """
+        self.shape_dest = coords.shape[1:]
+        self.shape_src = tuple(int(n) for n in shape_src[:3])
+        self.coords = coords.reshape(3, -1)
+        # bounding box of the source voxels used by the interpolation
+        self.bbox = []
+        for i, n in enumerate(self.shape_src):
+            coords_inside = self.coords[i][(self.coords[i] >= -0.5) & (self.coords[i] <= n - 0.5)]
+            if coords_inside.size:
+                self.bbox.append((max(0, int(np.floor(coords_inside.min()))),
+                                  min(n - 1, int(np.floor(coords_inside.max())) + 1) + 1))
+            else:
+                self.bbox.append((0, 1))
+
+    def resample(self, list_data, interp='linear', nb_threads=1):
+        """
+        :param list_data: list of 3D arrays (or array proxies, e.g., Image.dataobj) of the source grid
+        :param interp: {'nn', 'linear', 'spline'}. The 'spline' interpolation is done volume by volume.
+        :param nb_threads: int: number of threads. 0: use all available cores.
+        :return: float32 array of shape (nx, ny, nz, len(list_data))
+        """
+        nb_threads = multiprocessing.cpu_count() if nb_threads == 0 else nb_threads
+        if interp == 'spline':
+            coords = self.coords.reshape((3,) + self.shape_dest)
+            return np.stack([resample_volume(np.asarray(data), coords, interp) for data in list_data], axis=-1)
+
+        # stack the volumes, so that the values of a voxel are contiguous in memory
+        slices = tuple(slice(start, stop) for start, stop in self.bbox)
+        stack = np.stack([np.asarray(data[slices], dtype=np.float32) for data in list_data], axis=-1)
+        stack = stack.reshape(-1, len(list_data))
+        data_out = np.empty((self.coords.shape[1], len(list_data)), dtype=np.float32)
+
+        def resample_chunk(start):
+            stop = min(start + self.CHUNK_SIZE, self.coords.shape[1])
+            data_out[start:stop] = self._interpolate(stack, self.coords[:, start:stop], interp)
+
+        chunks = range(0, self.coords.shape[1], self.CHUNK_SIZE)
+        if nb_threads > 1 and len(chunks) > 1:
+            pool = ThreadPool(nb_threads)
+            try:
+                pool.map(resample_chunk, chunks)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for start in chunks:
+                resample_chunk(start)
+        return data_out.reshape(self.shape_dest + (len(list_data),))
+
+    def _interpolate(self, stack, coords, interp):
+        """
+        Interpolate the stacked volumes at some coordinates, like ITK (see interpolate()).
+        :param stack: (nb_voxels_bbox, nb_volumes) array
+        :param coords: (3, n) array of voxel coordinates in the source grid
+        :return: (n, nb_volumes) array
+        """
+        shape_bbox = [stop - start for start, stop in self.bbox]
+        outside = np.zeros(coords.shape[1], dtype=bool)
+        for i in range(3):
+            outside |= (coords[i] < -0.5) | (coords[i] > self.shape_src[i] - 0.5)
+        coords = coords - np.array([start for start, stop in self.bbox], dtype=np.float32)[:, np.newaxis]
+        if interp == 'nn':
+            index = [np.clip(np.floor(coords[i] + 0.5).astype(np.intp), 0, shape_bbox[i] - 1) for i in range(3)]
+            values = stack[np.ravel_multi_index(index, shape_bbox)]
+        else:
+            index_floor = np.floor(coords).astype(np.intp)
+            weight_ceil = coords - index_floor
+            values = np.zeros((coords.shape[1], stack.shape[1]), dtype=np.float32)
+            for corner in itertools.product([0, 1], repeat=3):
+                index = [np.clip(index_floor[i] + corner[i], 0, shape_bbox[i] - 1) for i in range(3)]
+                weight = np.prod([weight_ceil[i] if corner[i] else 1 - weight_ceil[i] for i in range(3)], axis=0)
+                values += weight[:, np.newaxis] * stack[np.ravel_multi_index(index, shape_bbox)]
+        values[outside] = 0
+        return values
+
+
+# Maximum size (in bytes) of the source volumes stacked by warp_images()
+WARP_BATCH_BYTES = 1 << 30
+
+
+def warp_images(list_fname_src, list_fname_out, list_fname_transfo, fname_dest, list_fname_inverse=(),
+                interp='linear', nb_threads=1, path_cache=None):
+    """
+    Apply the same chain of transformations to several images. The chain is composed once into a single displacement
+    field (see load_composed_transfo()), and the images which share the same grid and interpolation are resampled
+    together, in a single vectorized pass (see Resampler).
+    :param list_fname_src: list of paths of the 3D images to warp
+    :param list_fname_out: list of paths of the output images
+    :param list_fname_transfo: list of paths of transformations, in the order of sct_apply_transfo's -w flag
+    :param fname_dest: path of the destination image
+    :param list_fname_inverse: transformations of list_fname_transfo which are inverted
+    :param interp: {'nn', 'linear', 'spline'}, or list of interpolations (one per image)
+    :param nb_threads: int: number of threads. 0: use all available cores.
+    :param path_cache: folder where the composed transformations are cached
+    :return: list of the output Images
+    """
+    list_interp = [interp] * len(list_fname_src) if isinstance(interp, str) else list(interp)
+    field = load_composed_transfo(list_fname_transfo, fname_dest, list_fname_inverse, path_cache=path_cache)
+    im_dest = Image(fname_dest, lazy=True)
+    hdr_out = im_dest.hdr.copy()
+    hdr_out.set_data_shape(im_dest.dim[:3])
+    hdr_out.set_data_dtype(np.float32)
+
+    # group images by grid and interpolation
+    list_im_src = [Image(fname, lazy=True) for fname in list_fname_src]
+    groups = {}
+    for i, (im_src, interp_src) in enumerate(zip(list_im_src, list_interp)):
+        key_grid = (tuple(im_src.dim[:3]), im_src.hdr.get_best_affine().tobytes())
+        groups.setdefault(key_grid, {}).setdefault(interp_src, []).append(i)
+
+    list_im_out = [None] * len(list_fname_src)
+    for (shape_src, affine_bytes), groups_interp in groups.items():
+        affine_src = np.frombuffer(affine_bytes, dtype=np.float64).reshape(4, 4)
+        resampler = Resampler(compute_source_coordinates([field], im_dest, affine_src), shape_src)
+        # limit the size of the stack of source volumes
+        batch_size = max(1, WARP_BATCH_BYTES // (4 * int(np.prod([stop - start for start, stop in resampler.bbox]))))
+        for interp_src, list_index in groups_interp.items():
+            for i_batch in range(0, len(list_index), batch_size):
+                list_index_batch = list_index[i_batch:i_batch + batch_size]
+                data_out = resampler.resample([list_im_src[i].dataobj for i in list_index_batch], interp_src,
+                                              nb_threads)
+                for i_out, i in enumerate(list_index_batch):
+                    list_im_out[i] = Image(data_out[..., i_out], hdr=hdr_out.copy(), absolutepath=list_fname_out[i])
+    return list_im_out
+
+
+def resample_volume(data, coords, interp='linear'):
+    """
+    Resample a 3D volume of the source space into the destination space.
+    :param data: 3D array
+    :param coords: output of compute_source_coordinates()
+    :param interp: {'nn', 'linear', 'spline'}
+    :return: float32 array of shape coords.shape[1:]
+    """
+    return interpolate(np.asarray(data, dtype=np.float32), coords, order=SPLINE_ORDER[interp])
+
+
+def resample_4d(data, coords, interp='linear', cpu_number=1):
+    """
+    Resample each volume of a 4D array of the source space into the destination space. The volumes are written into
+    a preallocated output array, and can be processed in parallel.
+    :param data: 4D array (nx, ny, nz, nt), or array proxy of an uncompressed file (each volume is then read from the
+    file when it is resampled; do not use the proxy of a compressed file, which would be decompressed for each volume)
+    :param coords: output of compute_source_coordinates()
+    :param interp: {'nn', 'linear', 'spline'}
+    :param cpu_number: int: number of processes. 0: use all available cores.
+    :return: float32 array of shape coords.shape[1:] + (nt,)
+    """
+    nt = data.shape[3]
+    data_out = np.empty(coords.shape[1:] + (nt,), dtype=np.float32)
+    cpu_number = multiprocessing.cpu_count() if cpu_number == 0 else cpu_number
+    if cpu_number > 1 and nt > 1:
+        pool = multiprocessing.Pool(min(cpu_number, nt), initializer=_init_resample_worker,
+                                    initargs=({'data': data, 'coords': coords, 'interp': interp},))
+        try:
+            for it, data_vol in pool.imap_unordered(_resample_worker, range(nt)):
+                data_out[..., it] = data_vol
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for it in range(nt):
+            data_out[..., it] = resample_volume(data[..., it], coords, interp)
+    return data_out
+
+
+_resample_context = {}
+
+
+def _init_resample_worker(context):
+    _resample_context.update(context)
+
+
+def _resample_worker(it):
+    return it, resample_volume(_resample_context['data'][..., it], _resample_context['coords'],
+                               _resample_context['interp'])
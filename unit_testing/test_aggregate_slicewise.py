@@ -148,6 +148,31 @@ def test_aggregate_per_level(dummy_metrics, dummy_vert_level):
     assert agg_metric[(2, 3)] == {'VertLevel': (3,), 'WA()': 40.0}
 
 
+# noinspection 801,PyShadowingNames
+def test_vertlevel_index(dummy_vert_level, tmpdir):
+    """Test the vertebral level index, and its caching on the image and per file"""
+    from spinalcordtoolbox.template import get_vertlevel_index
+    vertlevel_index = get_vertlevel_index(dummy_vert_level)
+    assert get_vertlevel_index(dummy_vert_level) is vertlevel_index
+    assert [vertlevel_index.get_level(iz) for iz in range(9)] == [2, 2, 3, 3, 4, 4, 5, 5, 6]
+    assert vertlevel_index.get_slices(3) == [2, 3]
+    assert vertlevel_index.get_slices(7) == []
+    # non-finite values are ignored, and the level is the rounded average
+    data = np.zeros((3, 3, 3))
+    data[0, 0, :] = [np.nan, 2, 0]
+    data[1, 1, :] = [3, 3, 0]
+    data[2, 2, :] = [3, 3, 0]
+    vertlevel_index = get_vertlevel_index(Image(data))
+    assert vertlevel_index.slice_levels == [3, 3, None]
+    assert vertlevel_index.level_slices == {3: [0, 1]}
+    # the image loaded from a file is reused
+    fname = str(tmpdir.join('levels.nii.gz'))
+    dummy_vert_level.save(fname)
+    im_vert_level = aggregate_slicewise.load_vert_level(fname)
+    assert aggregate_slicewise.load_vert_level(fname) is im_vert_level
+    assert np.array_equal(im_vert_level.data, dummy_vert_level.data)
+
+
 # noinspection 801,PyShadowingNames
 def test_extract_metric(dummy_data_and_labels):
     """Test different estimation methods."""
@@ -192,6 +217,44 @@ def test_extract_metric(dummy_data_and_labels):
     assert agg_metric[list(agg_metric)[0]]['MAP()'] == pytest.approx(20.0, rel=0.01)
 
 
+def test_batch_ml_map():
+    """Test that the ML and MAP estimations of all slice groups at once match the estimations per slice group."""
+    rs = np.random.RandomState(0)
+    data = rs.rand(6, 6, 8) * 50
+    data[2, 2, 1] = np.nan
+    mask = rs.rand(6, 6, 8, 5) * (rs.rand(6, 6, 8, 5) < 0.5)
+    mask[..., 3, :] = 0
+    map_clusters = [[0], [0], [1], [1], [2]]
+    slicegroups = [(i,) for i in range(8)] + [(0, 1, 2)]
+    for func, batch_func in [(aggregate_slicewise.func_ml, aggregate_slicewise.batch_ml),
+                             (aggregate_slicewise.func_map, aggregate_slicewise.batch_map)]:
+        results = batch_func(data, aggregate_slicewise.LabelGram(mask, slicegroups), map_clusters)
+        for slicegroup, result in zip(slicegroups, results):
+            data_slicegroup, mask_slicegroup = data[..., slicegroup], mask[..., slicegroup, :]
+            i_nonfinite = ~np.isfinite(data_slicegroup)
+            data_slicegroup[i_nonfinite], mask_slicegroup[i_nonfinite] = 0, 0
+            if slicegroup == (3,):
+                assert result is None
+            else:
+                assert result == pytest.approx(func(data_slicegroup, mask_slicegroup, map_clusters)[0])
+
+
+# noinspection 801,PyShadowingNames
+def test_extract_metric_list(dummy_data_and_labels):
+    """Test the extraction of several metrics at once."""
+    data, labels, label_struc = dummy_data_and_labels
+    data_nan = Metric(data=data.data.copy())
+    data_nan.data[0] = np.nan
+    for method in ['ml', 'map']:
+        list_agg_metric = aggregate_slicewise.extract_metric([data, data_nan], labels=labels, label_struc=label_struc,
+                                                             id_label=0, indiv_labels_ids=[0, 1, 2], perslice=False,
+                                                             method=method)
+        for metric, agg_metric in zip([data, data_nan], list_agg_metric):
+            assert agg_metric == aggregate_slicewise.extract_metric(metric, labels=labels, label_struc=label_struc,
+                                                                    id_label=0, indiv_labels_ids=[0, 1, 2],
+                                                                    perslice=False, method=method)
+
+
 # noinspection 801,PyShadowingNames
 def test_extract_metric_2d(dummy_data_and_labels_2d):
     """Test different estimation methods."""
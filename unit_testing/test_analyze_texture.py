@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_analyze_texture
+
+from __future__ import absolute_import
+
+import sys, os
+
+import pytest
+import numpy as np
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+import sct_analyze_texture
+from sct_analyze_texture import greycomatrix, greycoprops
+
+
+FEATURES = ['contrast', 'dissimilarity', 'homogeneity', 'energy', 'correlation', 'ASM']
+
+
+def dummy_slice(shape=(30, 25), seed=0):
+    """Noisy image (with constant patches and values beyond the uint8 range) and an elliptic mask touching a border"""
+    rng = np.random.RandomState(seed)
+    im_z = rng.randint(0, 300, shape).astype(np.float64)
+    im_z[5:12, 5:12] = 42
+    x, y = np.mgrid[:shape[0], :shape[1]]
+    seg_z = (((x - 12.) / 12) ** 2 + ((y - 14.) / 8) ** 2 < 1).astype(np.float64)
+    return im_z, seg_z
+
+
+@pytest.mark.parametrize('distance', [1, 2, 3])
+def test_compute_texture_slice(distance):
+    """The texture of all the windows of a slice is the same as with greycomatrix/greycoprops voxel by voxel"""
+    im_z, seg_z = dummy_slice()
+    angles = ['0', '45', '90', '135']
+    x, y, dct_texture = sct_analyze_texture.compute_texture_slice(im_z, seg_z, distance, angles, FEATURES)
+    # windows entirely within the slice and the mask
+    expected = [(xx, yy) for xx in range(distance, im_z.shape[0] - distance)
+                for yy in range(distance, im_z.shape[1] - distance)
+                if seg_z[xx - distance:xx + distance + 1, yy - distance:yy + distance + 1].all()]
+    assert len(expected) > 0
+    assert list(zip(x, y)) == expected
+    for i, (xx, yy) in enumerate(expected):
+        window = im_z[xx - distance:xx + distance + 1, yy - distance:yy + distance + 1].astype(np.uint8)
+        for a in angles:
+            glcm = greycomatrix(window, [distance], [np.radians(int(a))], symmetric=True, normed=True)
+            for feature in FEATURES:
+                assert dct_texture[a][feature][i] == pytest.approx(greycoprops(glcm, feature)[0][0],
+                                                                   rel=1e-9, abs=1e-12)
+
+
+def test_compute_glcm_properties_invalid():
+    with pytest.raises(ValueError):
+        sct_analyze_texture.compute_glcm_properties(np.zeros((1, 2)), np.zeros((1, 2)), ['entropy'])
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.cache
+
+from __future__ import absolute_import
+
+import os
+import io
+
+import pytest
+
+from spinalcordtoolbox import cache
+
+
+def write(fname, content):
+    with io.open(fname, 'wb') as f:
+        f.write(content)
+
+
+def read(fname):
+    with io.open(fname, 'rb') as f:
+        return f.read()
+
+
+@pytest.fixture
+def step_cache(tmpdir):
+    step_cache = cache.StepCache(str(tmpdir.join('store')))
+    yield step_cache
+    step_cache.close()
+
+
+def run_step(step_cache, fname_in, fname_out, calls, params=None):
+    """Step which copies fname_in to fname_out, in upper case"""
+    with step_cache.step('upper', input_files=[fname_in], params=params, outputs=[fname_out]) as step:
+        if not step.hit:
+            calls.append(fname_in)
+            write(fname_out, read(fname_in).upper())
+    return step.hit
+
+
+def test_step_restore(tmpdir, step_cache):
+    fname_in, fname_out = str(tmpdir.join('in.txt')), str(tmpdir.join('out.txt'))
+    write(fname_in, b'spinal cord')
+    calls = []
+    assert not run_step(step_cache, fname_in, fname_out, calls)
+    # outputs deleted or modified: they are restored from the store
+    os.remove(fname_out)
+    assert run_step(step_cache, fname_in, fname_out, calls)
+    assert read(fname_out) == b'SPINAL CORD'
+    write(fname_out, b'modified')
+    assert run_step(step_cache, fname_in, fname_out, calls)
+    assert read(fname_out) == b'SPINAL CORD'
+    assert len(calls) == 1
+    # different parameters or input content: the step is run again
+    assert not run_step(step_cache, fname_in, fname_out, calls, params={'x': 1})
+    write(fname_in, b'gray matter')
+    assert not run_step(step_cache, fname_in, fname_out, calls)
+    assert read(fname_out) == b'GRAY MATTER'
+    assert len(calls) == 3
+
+
+def test_step_corrupted(tmpdir, step_cache):
+    fname_in, fname_out = str(tmpdir.join('in.txt')), str(tmpdir.join('out.txt'))
+    write(fname_in, b'spinal cord')
+    calls = []
+    run_step(step_cache, fname_in, fname_out, calls)
+    fname_object = step_cache._get_object(cache.compute_file_hash(fname_out))
+    os.remove(fname_out)
+    # corrupt the stored output: the step is run again
+    write(fname_object, b'SPINAL CORE')
+    assert not run_step(step_cache, fname_in, fname_out, calls)
+    assert read(fname_out) == b'SPINAL CORD'
+    assert len(calls) == 2
+
+
+def test_hash_file_shortcut(tmpdir, step_cache, monkeypatch):
+    fname = str(tmpdir.join('in.txt'))
+    write(fname, b'spinal cord')
+    list_hashed = []
+    compute_file_hash = cache.compute_file_hash
+    monkeypatch.setattr(cache, 'compute_file_hash', lambda fname: list_hashed.append(fname) or compute_file_hash(fname))
+    file_hash = step_cache.hash_file(fname)
+    assert step_cache.hash_file(fname) == file_hash
+    assert len(list_hashed) == 1
+    write(fname, b'gray matter')
+    assert step_cache.hash_file(fname) != file_hash
+    assert len(list_hashed) == 2
+
+
+def test_evict(tmpdir, step_cache):
+    calls = []
+    for i in range(4):
+        fname_in = str(tmpdir.join('in{}.txt'.format(i)))
+        write(fname_in, b'x' * 100 * (i + 1))
+        run_step(step_cache, fname_in, str(tmpdir.join('out{}.txt'.format(i))), calls)
+    # the least recently used entries are evicted first
+    assert run_step(step_cache, str(tmpdir.join('in0.txt')), str(tmpdir.join('out0.txt')), calls)
+    step_cache.evict(max_size=600)
+    assert step_cache.get_size() == 100 + 400
+    assert run_step(step_cache, str(tmpdir.join('in0.txt')), str(tmpdir.join('out0.txt')), calls)
+    assert not run_step(step_cache, str(tmpdir.join('in1.txt')), str(tmpdir.join('out1.txt')), calls)
+
+
+def test_cached(tmpdir, monkeypatch):
+    monkeypatch.setenv('SCT_CACHE', '1')
+    monkeypatch.setenv('SCT_CACHE_DIR', str(tmpdir.join('store')))
+    calls = []
+
+    @cache.cached(input_files=['fname_in'], outputs=['fname_out'])
+    def repeat(fname_in, fname_out, n=2):
+        calls.append(n)
+        write(fname_out, read(fname_in) * n)
+        return len(read(fname_in)) * n
+
+    fname_in, fname_out = str(tmpdir.join('in.txt')), str(tmpdir.join('out.txt'))
+    write(fname_in, b'ab')
+    assert repeat(fname_in, fname_out) == 4
+    os.remove(fname_out)
+    assert repeat(fname_in, fname_out=fname_out, n=2) == 4
+    assert read(fname_out) == b'abab'
+    assert repeat(fname_in, fname_out, n=3) == 6
+    assert calls == [2, 3]
+    # disabled cache (default)
+    monkeypatch.delenv('SCT_CACHE')
+    assert repeat(fname_in, fname_out, n=3) == 6
+    assert calls == [2, 3, 3]
+
+
+def test_key_output_location(tmpdir, step_cache):
+    """Only the extension of the outputs is part of the key, even with dots in the folders"""
+    fname_in = str(tmpdir.join('in.txt'))
+    write(fname_in, b'spinal cord')
+    key = step_cache.get_key('upper', [fname_in], outputs=['out.nii.gz'])
+    for fname_out in [str(tmpdir.join('ds000001.v1', 'out.nii.gz')), os.path.join('.', 'label', 'out.nii.gz')]:
+        assert step_cache.get_key('upper', [fname_in], outputs=[fname_out]) == key
+    assert step_cache.get_key('upper', [fname_in], outputs=['out.nii']) != key
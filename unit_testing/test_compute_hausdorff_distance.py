@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_compute_hausdorff_distance
+
+from __future__ import absolute_import
+
+import sys, os
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+from spinalcordtoolbox.image import Image
+import sct_compute_hausdorff_distance
+
+
+def dummy_slices(nz, shape=(60, 60), seed=0):
+    """Binary slices made of a few overlapping ellipses"""
+    rng = np.random.RandomState(seed)
+    x, y = np.mgrid[:shape[0], :shape[1]]
+    data = np.zeros((nz,) + shape, dtype=int)
+    for z in range(nz):
+        for _ in range(3):
+            cx, cy, a, b = rng.uniform(20, 40), rng.uniform(20, 40), rng.uniform(4, 15), rng.uniform(3, 10)
+            data[z] |= (((x - cx) / a) ** 2 + ((y - cy) / b) ** 2 < 1)
+    return data
+
+
+def test_zhang_suen_lut():
+    """The vectorized thinning gives the same skeleton as the reference implementation"""
+    thinning = sct_compute_hausdorff_distance.Thinning.__new__(sct_compute_hausdorff_distance.Thinning)
+    data = dummy_slices(4)
+    # foreground touching the borders of the image
+    data[3] = np.random.RandomState(0).rand(60, 60) > 0.5
+    data_thinned = sct_compute_hausdorff_distance.zhang_suen_lut(data)
+    for data_slice, data_slice_thinned in zip(data, data_thinned):
+        assert (thinning.zhang_suen(data_slice) == data_slice_thinned).all()
+        assert (sct_compute_hausdorff_distance.zhang_suen_lut(data_slice) == data_slice_thinned).all()
+
+
+def test_hausdorff_distance_kdtree():
+    data1, data2 = dummy_slices(2, seed=1)
+    data2[:10] = 1
+    dist_loop = sct_compute_hausdorff_distance.HausdorffDistance(data1, data2, v=0, method='loop')
+    dist = sct_compute_hausdorff_distance.HausdorffDistance(data1, data2, v=0)
+    assert np.allclose(dist.min_distances_1, dist_loop.min_distances_1)
+    assert np.allclose(dist.min_distances_2, dist_loop.min_distances_2)
+    assert dist.H == dist_loop.H
+    assert np.isclose(dist.M, (dist.min_distances_1.sum() + dist.min_distances_2.sum()) / (data1.sum() + data2.sum()))
+
+
+def test_compute_distances_3d():
+    """Slice-wise distances computed in parallel"""
+    param = sct_compute_hausdorff_distance.Param()
+    param.verbose = 0
+    param.cpu_number = 2
+    list_im = []
+    for seed in [2, 3]:
+        data = np.transpose(dummy_slices(5, seed=seed), (1, 2, 0)).astype(np.uint8)
+        im = Image(data, hdr=nibabel.Nifti1Image(data, np.eye(4)).header, dim=data.shape)
+        im.absolutepath = 'im{}.nii.gz'.format(seed)
+        list_im.append(im.change_orientation('IRP', generate_path=True))
+    param.thinning = False
+    computation = sct_compute_hausdorff_distance.ComputeDistances(list_im[0], im2=list_im[1], param=param)
+    assert len(computation.distances) == 5
+    for i, dist in enumerate(computation.distances):
+        assert dist.H == sct_compute_hausdorff_distance.HausdorffDistance(list_im[0].data[i], list_im[1].data[i], v=0).H
@@ -104,6 +104,31 @@ class TestCore(object):
         ret = gm_core.segment_volume(img, 'challenge')
         assert ret.shape == (200, 200, 2)
 
+    def test_predict_tta(self):
+        """Test the streamed TTA against the mean of the separate predictions."""
+        class FakeModel(object):
+            def predict(self, x, batch_size=None, verbose=False):
+                return 1. / (1. + np.exp(-(x - 1.)))
+
+        axial_slices = np.random.RandomState(0).randn(20, 8, 8, 1).astype(np.float32)
+        np.random.seed(0)
+        preds = gm_core.predict_tta(FakeModel(), axial_slices)
+        np.random.seed(0)
+        list_preds = [FakeModel().predict(axial_slices + np.random.uniform(high=2.0)) for i in range(8)]
+        list_preds.append(FakeModel().predict(axial_slices))
+        assert np.allclose(preds, np.mean(list_preds, axis=0), atol=1e-6)
+
+        # only the uncertain slices are augmented
+        axial_slices[:10] = 20.
+        np.random.seed(0)
+        preds = gm_core.predict_tta(FakeModel(), axial_slices, threshold=0.5, tta_margin=0.2)
+        assert np.allclose(preds[:10], FakeModel().predict(axial_slices[:10]))
+        assert np.allclose(preds[10:], np.mean(list_preds, axis=0)[10:], atol=1e-6)
+
+        # no slice
+        preds = gm_core.predict_tta(FakeModel(), axial_slices[:0])
+        assert preds.shape == (0, 8, 8, 1)
+
     def test_standardization_transform(self):
         """Test the standardization transform with specified parameters."""
         np_data = np.ones((200, 200, 2), dtype=np.float32)
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 import os
 import sys
 
+import pytest
 import numpy as np
 import nibabel as nib
 
@@ -73,7 +74,8 @@ def _preprocess_segment(fname_t2, fname_t2_seg, contrast_test, dim_3=False):
     return img, gt
 
 
-def test_segment_2d():
+@pytest.mark.parametrize("batch_size", [None, 1])
+def test_segment_2d(batch_size):
     from keras import backend as K
     K.set_image_data_format("channels_last")  # Set at channels_first in test_deepseg_lesion.test_segment()
 
@@ -85,7 +87,8 @@ def test_segment_2d():
 
     img, gt = _preprocess_segment(fname_t2, fname_t2_seg, contrast_test)
 
-    seg = deepseg_sc.segment_2d(model_fname=model_path, contrast_type=contrast_test, input_size=(64,64), im_in=img)
+    seg = deepseg_sc.segment_2d(model_fname=model_path, contrast_type=contrast_test, input_size=(64,64), im_in=img,
+                                batch_size=batch_size)
     assert seg.dtype == np.dtype('float32')
 
     seg_im = img.copy()
@@ -113,6 +116,23 @@ def test_segment_3d():
     assert msct_image.compute_dice(seg_im, gt) > 0.80
 
 
+@pytest.mark.parametrize("batch_size,overlap", [(1, 0), (3, 0), (2, 16)])
+def test_predict_patches_3d(batch_size, overlap):
+    """Check the tiling of predict_patches_3d() with a voxel-wise model, which does not depend on the patches"""
+    class VoxelwiseModel(object):
+        def predict(self, x, batch_size):
+            assert x.shape[1:] == (1, 8, 8, 48) and len(x) <= batch_size
+            return 1 / (1 + np.exp(-x))
+
+    data = np.random.RandomState(0).rand(8, 8, 130).astype(np.float32)
+    data[:, :, :60] = 0  # empty patch
+    pred = deepseg_sc.predict_patches_3d(VoxelwiseModel(), data, (8, 8, 48), 0.5, 0.25, batch_size=batch_size,
+                                         overlap=overlap)
+    assert pred.shape == data.shape
+    assert not np.any(pred[:, :, :32])  # only covered by the first (empty) patch
+    assert np.allclose(pred[:, :, 60:], 1 / (1 + np.exp(-(data[:, :, 60:] - 0.5) / 0.25)), atol=1e-6)
+
+
 def test_intensity_normalization():
     data_in = np.random.rand(10, 10)
     min_out, max_out = 0, 255
@@ -673,3 +673,96 @@ def test_sequences(fake_3dimage_sct):
      .save(path_b, mutable=True)
     assert img.absolutepath is not None
     assert img.absolutepath == os.path.abspath(path_b)
+
+
+def test_transfo_pix2phys(fake_3dimage_sct):
+    """
+    Test vectorized coordinate transformations against the affine of the header, and cache invalidation
+    """
+    img = fake_3dimage_sct.copy()
+    img.hdr.set_sform(np.array([[0.5, 0.1, 0, -10], [0, 0.8, 0.2, 20], [0, 0, 1.5, 3], [0, 0, 0, 1]]), code=1)
+    coord_pix = np.random.RandomState(0).uniform(0, 10, (1000, 3))
+
+    coord_phys = img.transfo_pix2phys(coord_pix)
+    affine = img.hdr.get_best_affine()
+    coord_phys_ref = np.array([np.dot(affine, np.append(c, 1))[:3] for c in coord_pix])
+    assert coord_phys.shape == (1000, 3)
+    assert np.allclose(coord_phys, coord_phys_ref)
+    assert img.transfo_pix2phys(coord_pix, dtype=np.float32).dtype == np.float32
+    assert np.allclose(img.transfo_phys2pix(coord_phys, real=False), coord_pix)
+    assert np.array_equal(img.transfo_phys2pix(coord_phys), np.int32(np.round(coord_pix)))
+    # Sequence of points
+    assert np.allclose(img.transfo_pix2phys([[1, 2, 3]]), [np.dot(affine, [1, 2, 3, 1])[:3]])
+
+    # The cached affine should follow changes of the header
+    img.hdr.set_sform(np.diag([2, 2, 2, 1]), code=1)
+    assert np.allclose(img.transfo_pix2phys([[1, 2, 3]]), [[2, 4, 6]])
+    assert np.allclose(img.get_affine(inverse=True), np.diag([0.5, 0.5, 0.5, 1]))
+
+
+@pytest.mark.parametrize('sorting,reverse_coord', [(None, False), ('x', False), ('z', True), ('value', False),
+                                                   ('value', True)])
+def test_get_nonzero_coordinates(sorting, reverse_coord):
+    """
+    Test the coordinate table and the list of Coordinate against a loop across non-zero voxels
+    """
+    data = np.random.RandomState(0).randint(0, 4, (6, 7, 8)) * (np.random.RandomState(1).rand(6, 7, 8) > 0.7)
+    img = msct_image.Image(data.astype(np.float32))
+    X, Y, Z = data.nonzero()
+    list_ref = [(X[i], Y[i], Z[i], data[X[i], Y[i], Z[i]]) for i in range(len(X))]
+    if sorting is not None:
+        list_ref = sorted(list_ref, key=lambda c: c['xyzv'.index(sorting[0])], reverse=reverse_coord)
+
+    table = img.get_nonzero_coordinates(sorting=sorting, reverse_coord=reverse_coord)
+    assert [tuple(c) for c in table.tolist()] == list_ref
+    coordinates = img.getNonZeroCoordinates(sorting=sorting, reverse_coord=reverse_coord)
+    assert len(coordinates) == len(list_ref)
+    assert [(c.x, c.y, c.z, c.value) for c in coordinates] == list_ref
+    assert coordinates[-1] is coordinates[len(list_ref) - 1]
+
+
+def test_get_coordinates_averaged_by_value():
+    data = np.zeros((6, 7, 8))
+    data[1:3, 2, 3] = 2
+    data[4, 5, 6:8] = 1
+    data[0, 0, 0] = 5
+    img = msct_image.Image(data)
+    coordinates = img.getCoordinatesAveragedByValue()
+    assert [(c.x, c.y, c.z, c.value) for c in coordinates] == [(4, 5, 6.5, 1), (1.5, 2, 3, 2), (0, 0, 0, 5)]
+
+
+@pytest.mark.parametrize('ext', ['.nii', '.nii.gz'])
+def test_lazy_image(fake_4dimage_sct, ext):
+    """
+    Test lazy loading: slicers and sub-arrays are read from the file without loading the image, and match the
+    loaded image in all orientations
+    """
+    path_tmp = sct.tmp_create(basename="test_lazy_image")
+    path = os.path.join(path_tmp, 'a' + ext)
+    fake_4dimage_sct.save(path)
+    img = msct_image.Image(path)
+
+    img_lazy = msct_image.Image(path, lazy=True)
+    assert not img_lazy.is_loaded
+    assert img_lazy.dim == img.dim
+    assert img_lazy.orientation == img.orientation
+    assert np.array_equal(img_lazy.dataobj[..., 1], img.data[..., 1])
+    for orientation in ['LPI', 'RPI', 'ASR', 'SAL', 'IRP', 'PLS']:
+        slicer, slicer_lazy = msct_image.Slicer(img, orientation), msct_image.Slicer(img_lazy, orientation)
+        assert len(slicer_lazy) == len(slicer)
+        for idx_slice in [0, len(slicer) - 1, -1]:
+            assert np.array_equal(slicer_lazy[idx_slice], slicer[idx_slice])
+    assert np.array_equal(msct_image.SlicerOneAxis(img_lazy, "SI")[0], msct_image.SlicerOneAxis(img, "SI")[0])
+    assert not img_lazy.is_loaded
+
+    # Data is read when accessed
+    assert np.array_equal(img_lazy.data, img.data)
+    assert img_lazy.is_loaded
+
+    # Modify a memory-mapped image and save it in place: the file is only modified by save()
+    img_lazy.data[0, 0, 0, 0] = -1
+    assert msct_image.Image(path).data[0, 0, 0, 0] == img.data[0, 0, 0, 0]
+    img_lazy.save()
+    img_saved = msct_image.Image(path)
+    assert img_saved.data[0, 0, 0, 0] == -1
+    assert np.array_equal(img_saved.data[1:], img.data[1:])
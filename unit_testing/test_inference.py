@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.inference
+
+from __future__ import absolute_import
+
+import os
+import time
+import multiprocessing
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client
+
+import pytest
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox import inference
+
+
+def test_model_cache():
+    cache = inference.ModelCache(size=2)
+    list_built = []
+
+    def build(name):
+        list_built.append(name)
+        return name
+
+    for name in ['a', 'b', 'a', 'c', 'a', 'b']:
+        assert cache.get(name, lambda: build(name)) == name
+    # 'b' is the least recently used model when 'c' is added
+    assert list_built == ['a', 'b', 'c', 'b']
+    assert list(cache.models) == ['a', 'b']
+
+
+def test_inference_worker(tmpdir, monkeypatch, capsys):
+    """Run a script in the worker, as sct_deepseg_* do when the worker is running"""
+    address = str(tmpdir.join('worker.sock'))
+    monkeypatch.setenv('SCT_INFERENCE_WORKER', address)
+    assert inference.forward('sct_image', ['-h']) is None
+
+    worker = multiprocessing.Process(target=inference.serve, args=(address,))
+    worker.start()
+    try:
+        for i in range(100):
+            if inference.is_running(address):
+                break
+            time.sleep(0.1)
+        nibabel.save(nibabel.Nifti1Image(np.zeros((2, 3, 4)), np.eye(4)), str(tmpdir.join('data.nii.gz')))
+        monkeypatch.chdir(str(tmpdir))
+        capsys.readouterr()
+        assert inference.forward('sct_image', ['-i', 'data.nii.gz', '-getorient']) == 0
+        assert capsys.readouterr().out.strip() == 'LPI'
+        assert inference.forward('sct_image', ['-i', 'data_not_found.nii.gz', '-getorient']) != 0
+        # scripts which cannot be run in-process are run locally
+        assert inference.forward('sct_warp_template', ['-h']) is None
+    finally:
+        assert inference.stop(address)
+        worker.join(10)
+    assert not inference.is_running(address)
+
+
+def test_inference_worker_authentication(tmpdir, monkeypatch):
+    """Clients only connect to a worker with the key of the user, and the worker rejects the other clients"""
+    monkeypatch.setenv('XDG_RUNTIME_DIR', str(tmpdir))
+    monkeypatch.delenv('SCT_INFERENCE_WORKER', raising=False)
+    address = inference.get_worker_address()
+    assert address == str(tmpdir.join('sct_inference_worker', 'worker.sock'))
+
+    worker = multiprocessing.Process(target=inference.serve)
+    worker.start()
+    try:
+        for i in range(100):
+            if inference.is_running(address):
+                break
+            time.sleep(0.1)
+        assert os.stat(os.path.dirname(address)).st_mode & 0o777 == 0o700
+        for fname in [address, address + '.key']:
+            assert os.stat(fname).st_mode & 0o077 == 0
+        # wrong key
+        with pytest.raises(AuthenticationError):
+            Client(address, family='AF_UNIX', authkey=b'0' * 32)
+        # key readable by other users
+        os.chmod(address + '.key', 0o644)
+        assert not inference.is_running(address)
+        os.chmod(address + '.key', 0o600)
+        assert inference.is_running(address)
+    finally:
+        assert inference.stop(address)
+        worker.join(10)
+    assert not os.path.exists(address + '.key')
@@ -59,3 +59,31 @@ def test_get_file_label(info_labels):
         _in = spinalcordtoolbox.metadata.get_indiv_label_info(os.path.dirname(info_label))['id']
         spinalcordtoolbox.metadata.get_file_label(os.path.dirname(info_label), id_label=_in[0], output="file")
         spinalcordtoolbox.metadata.get_file_label(os.path.dirname(info_label), id_label=_in[0], output="filewithpath")
+
+
+def test_sparse_labels(tmpdir):
+    """Save and load the sparse copy of labels, which must be discarded when a label file changes"""
+    import time
+    import numpy as np
+    import nibabel
+    from spinalcordtoolbox.image import Image
+    data = np.random.RandomState(0).rand(6, 7, 5, 3) * (np.random.RandomState(1).rand(6, 7, 5, 3) < 0.2)
+    affine = np.diag([-1, 1, 1, 1])  # LPI orientation
+    with io.open(str(tmpdir.join('info_label.txt')), 'w') as f:
+        f.write(u"# Keyword=IndivLabels\n")
+        for i in range(3):
+            nibabel.save(nibabel.Nifti1Image(data[..., i], affine), str(tmpdir.join('label_{}.nii.gz'.format(i))))
+            f.write(u"{}, label {}, label_{}.nii.gz\n".format(i, i, i))
+    assert spinalcordtoolbox.metadata.load_sparse_labels(str(tmpdir)) is None
+    spinalcordtoolbox.metadata.save_sparse_labels(str(tmpdir))
+    sparse_labels = spinalcordtoolbox.metadata.load_sparse_labels(str(tmpdir))
+    assert sparse_labels.files == ['label_{}.nii.gz'.format(i) for i in range(3)]
+    data_all = sparse_labels.get_data_all()
+    for i in range(3):
+        data_rpi = Image(str(tmpdir.join('label_{}.nii.gz'.format(i)))).change_orientation('RPI').data
+        assert np.allclose(sparse_labels.get_data(i), data_rpi, atol=1e-3)
+        assert np.array_equal(sparse_labels.get_data('label_{}.nii.gz'.format(i)), data_all[..., i])
+    # the sparse copy is not used anymore if a label is modified
+    time.sleep(0.01)
+    nibabel.save(nibabel.Nifti1Image(data[..., 0] * 2, affine), str(tmpdir.join('label_1.nii.gz')))
+    assert spinalcordtoolbox.metadata.load_sparse_labels(str(tmpdir)) is None
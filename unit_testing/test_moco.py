@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_moco
+
+from __future__ import absolute_import
+
+import os, sys
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+import msct_moco
+from sct_fmri_moco import Param
+
+
+# sagittal: the third axis is R-L
+AFFINE_SAG = np.array([[0, 0, -1., 0], [1., 0, 0, 0], [0, 1., 0, 0], [0, 0, 0, 1.]])
+
+
+def fake_run_ants(list_failed):
+    """
+    Replace the 2D registration of ANTs: the output is the source image. No output for the registrations of
+    list_failed, given as (iz, it).
+    """
+    def run(cmd, *args, **kwargs):
+        file_dest, file_src = cmd[cmd.index('--metric') + 1].split('[')[1].split(',')[:2]
+        file_mat, file_out = cmd[cmd.index('--output') + 1].strip('[]').split(',')
+        name = os.path.basename(file_mat)
+        if (int(name[5:9]), int(name[10:14])) not in list_failed:
+            img = nibabel.load(file_src)
+            nibabel.save(nibabel.Nifti1Image(img.get_fdata()[:, :, 0], img.affine), file_out)
+            nibabel.save(nibabel.Nifti1Image(np.zeros((2, 2, 1, 1, 2)), np.eye(4)), file_mat + 'Warp.nii.gz')
+        return 0, ''
+    return run
+
+
+def test_moco_failed_registration(tmpdir, monkeypatch):
+    """A registration failing at the second Z uses the closest good transformation, not the output of the first Z"""
+    nx, ny, nz, nt = 6, 5, 2, 3
+    data = np.arange(nx * ny * nz * nt, dtype=np.float64).reshape((nx, ny, nz, nt))
+    list_applied = []
+
+    def fake_apply_transfo(args):
+        list_applied.append(args[args.index('-i') + 1])
+        img = nibabel.load(args[args.index('-i') + 1])
+        nibabel.save(nibabel.Nifti1Image(-img.get_fdata(), img.affine), args[args.index('-o') + 1])
+
+    monkeypatch.setattr(msct_moco.sct, 'run', fake_run_ants([(1, 1)]))
+    monkeypatch.setattr(msct_moco.sct_apply_transfo, 'main', fake_apply_transfo)
+    with tmpdir.as_cwd():
+        nibabel.save(nibabel.Nifti1Image(data, AFFINE_SAG), 'data.nii')
+        nibabel.save(nibabel.Nifti1Image(data[..., 0], AFFINE_SAG), 'target.nii')
+        param = Param()
+        param.file_data, param.file_target, param.mat_moco, param.todo = 'data.nii', 'target.nii', 'mat', 'estimate_and_apply'
+        param.is_sagittal, param.iterAvg, param.cpu_number, param.verbose = True, 0, 1, 0
+        msct_moco.moco(param)
+        data_moco = nibabel.load('data_moco.nii').get_fdata()
+    assert list_applied == ['data_T0001.nii']
+    # failed registration: the source with the transformation of the closest volume
+    assert np.allclose(data_moco[:, :, 1, 1], -data[:, :, 1, 1])
+    mask = np.ones((nz, nt), dtype=bool)
+    mask[1, 1] = False
+    assert np.allclose(data_moco[:, :, mask], data[:, :, mask])
@@ -135,3 +135,31 @@ def test_compute_shape(im_seg, expected, params):
         else:
             expected_value = pytest.approx(expected[key], rel=0.05)
         assert obtained_value == expected_value
+
+
+# noinspection 801,PyShadowingNames
+@pytest.mark.parametrize('im_seg,expected,params', im_segs)
+def test_compute_shape_batch_vs_slicewise(im_seg, expected, params):
+    """Check that the batch method gives the same results as the reference slicewise method"""
+    metrics = {}
+    for method in ['batch', 'slicewise']:
+        metrics[method], _ = process_seg.compute_shape(im_seg,
+                                                       angle_correction=params['angle_corr'],
+                                                       param_centerline=ParamCenterline(),
+                                                       verbose=VERBOSE,
+                                                       method=method)
+    for key in metrics['slicewise'].keys():
+        # Small tolerance: upsampled pixels exactly at the binarization threshold can differ because of rounding
+        np.testing.assert_allclose(metrics['batch'][key].data, metrics['slicewise'][key].data, rtol=1e-3, atol=0.05)
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 7, 30])
+def test_get_oversampling_matrix(size):
+    """The oversampling matrices applied along both axes are equivalent to transform.pyramid_expand()"""
+    from skimage import transform
+    image = np.random.RandomState(size).rand(size, 11)
+    upscale = 5
+    image_r = process_seg._get_oversampling_matrix(size, upscale).dot(image).dot(
+        process_seg._get_oversampling_matrix(11, upscale).T)
+    np.testing.assert_allclose(image_r, transform.pyramid_expand(image, upscale=upscale, sigma=None, order=1),
+                               rtol=0, atol=1e-12)
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for msct_register
+
+from __future__ import absolute_import
+
+import os, sys
+
+import pytest
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+import msct_register
+
+
+AFFINE = np.diag([0.8, 0.5, 1., 1.])
+
+
+def dummy_rectangles(shape, nz, rows, cols):
+    """Rectangular segmentation in each slice, shifted along y (in pixel) by 1 pixel per slice"""
+    data = np.zeros(shape + (nz,))
+    for iz in range(nz):
+        data[rows[0]:rows[1], cols[0] + iz:cols[1] + iz, iz] = 1
+    data[:, :, -1] = 0  # empty slice
+    return data
+
+
+def test_register2d_columnwise(tmpdir):
+    """Column-wise registration of rectangles (non-square slices), scaled along x and translated along y"""
+    shape, nz = (40, 56), 4
+    nibabel.save(nibabel.Nifti1Image(dummy_rectangles(shape, nz, (5, 35), (20, 30)), AFFINE), str(tmpdir.join('src.nii')))
+    nibabel.save(nibabel.Nifti1Image(dummy_rectangles(shape, nz, (10, 30), (17, 27)), AFFINE), str(tmpdir.join('dest.nii')))
+    with tmpdir.as_cwd():
+        msct_register.register2d_columnwise('src.nii', 'dest.nii', smoothWarpXY=1)
+        warp = nibabel.load('warp_forward.nii.gz').get_fdata()
+        warp_inv = nibabel.load('warp_inverse.nii.gz').get_fdata()
+    for iz in range(nz - 1):
+        # the source is 1.5 times wider (scaling along x around the row 19.5), and 3 pixels further along y
+        assert -warp[25, 22 + iz, iz, 0, 0] == pytest.approx(0.5 * (25 - 19.5) * 0.8)
+        assert -warp[25, 22 + iz, iz, 0, 1] == pytest.approx(3 * 0.5)
+        assert -warp_inv[25, 25 + iz, iz, 0, 0] == pytest.approx(-(25 - 19.5) / 3. * 0.8)
+        assert -warp_inv[25, 25 + iz, iz, 0, 1] == pytest.approx(-3 * 0.5)
+    # no data: identity
+    assert (warp[:, :, -1] == 0).all() and (warp_inv[:, :, -1] == 0).all()
+
+
+def test_register2d_centermassrot(tmpdir):
+    """Center of mass alignment (without rotation)"""
+    pytest.importorskip('sklearn')
+    shape, nz = (40, 56), 4
+    nibabel.save(nibabel.Nifti1Image(dummy_rectangles(shape, nz, (5, 35), (20, 30)), AFFINE), str(tmpdir.join('src.nii')))
+    nibabel.save(nibabel.Nifti1Image(dummy_rectangles(shape, nz, (10, 30), (17, 27)), AFFINE), str(tmpdir.join('dest.nii')))
+    with tmpdir.as_cwd():
+        msct_register.register2d_centermassrot(['src.nii'], ['dest.nii'], paramreg=msct_register.Paramreg(),
+                                               rot_method='none')
+        warp = nibabel.load('warp_forward.nii.gz').get_fdata()
+        warp_inv = nibabel.load('warp_inverse.nii.gz').get_fdata()
+    # same center of mass along x, translation of 3 pixels along y, at every pixel
+    for iz in range(nz - 1):
+        assert np.allclose(-warp[:, :, iz, 0, 0], 0) and np.allclose(-warp[:, :, iz, 0, 1], 3 * 0.5)
+        assert np.allclose(-warp_inv[:, :, iz, 0, 0], 0) and np.allclose(-warp_inv[:, :, iz, 0, 1], -3 * 0.5)
+    assert (warp[:, :, -1] == 0).all() and (warp_inv[:, :, -1] == 0).all()
+
+
+def test_concat_warp2d(tmpdir):
+    """Slice-wise warping fields assembled along z, from files or from arrays already loaded"""
+    from sct_image import concat_warp2d
+    shape, nz = (6, 5), 3
+    fname_dest = str(tmpdir.join('dest.nii'))
+    nibabel.save(nibabel.Nifti1Image(np.zeros(shape + (nz,)), AFFINE), fname_dest)
+    list_warp2d = [np.random.RandomState(iz).rand(*(shape + (1, 1, 2))) for iz in range(nz)]
+    list_fname = []
+    for iz, warp2d in enumerate(list_warp2d):
+        list_fname.append(str(tmpdir.join('warp2d_{}.nii.gz'.format(iz))))
+        nibabel.save(nibabel.Nifti1Image(warp2d, np.eye(4)), list_fname[-1])
+    for name, list_input in [('files', list_fname), ('arrays', list_warp2d)]:
+        fname_warp = str(tmpdir.join('warp_{}.nii.gz'.format(name)))
+        concat_warp2d(list_input, fname_warp, fname_dest)
+        warp = nibabel.load(fname_warp)
+        assert warp.shape == shape + (nz, 1, 3)
+        assert np.allclose(warp.affine, AFFINE)
+        for iz in range(nz):
+            assert np.allclose(warp.get_fdata()[:, :, iz, 0, :2], list_warp2d[iz][:, :, 0, 0, :])
+        assert (warp.get_fdata()[..., 2] == 0).all()
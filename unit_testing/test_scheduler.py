@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for spinalcordtoolbox.scheduler
+
+from __future__ import absolute_import
+
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import nibabel
+import pytest
+
+from spinalcordtoolbox import scheduler
+
+
+class CountingFunction(object):
+    """Function which records the tasks it runs, and the maximum memory of the tasks running at the same time"""
+    def __init__(self, fail=()):
+        self.lock = threading.Lock()
+        self.tasks = []
+        self.memory_running = 0
+        self.memory_max = 0
+        self.fail = fail
+
+    def __call__(self, task):
+        with self.lock:
+            self.tasks.append(task)
+            self.memory_running += task[1]
+            self.memory_max = max(self.memory_max, self.memory_running)
+        time.sleep(0.02)
+        with self.lock:
+            self.memory_running -= task[1]
+        if task[0] in self.fail:
+            raise RuntimeError("Task {} failed".format(task[0]))
+        return {'subject': task[0]}
+
+
+def test_run_tasks_resume(tmpdir):
+    """The completed tasks are saved, and not run again"""
+    fname_db = str(tmpdir.join('tasks.sqlite'))
+    tasks = [('subj{}'.format(i), 1) for i in range(6)]
+    function = CountingFunction(fail=('subj2',))
+    store = scheduler.TaskStore(fname_db)
+    assert scheduler.run_tasks(function, tasks, store, nb_workers=3, pool_executor=ThreadPoolExecutor) == 6
+    store.close()
+
+    # resume: only the failed task is run again
+    function = CountingFunction()
+    store = scheduler.TaskStore(fname_db)
+    assert scheduler.run_tasks(function, tasks, store, nb_workers=3, pool_executor=ThreadPoolExecutor) == 1
+    assert function.tasks == [('subj2', 1)]
+    assert store.get_results(tasks) == [{'subject': task[0]} for task in tasks]
+    store.close()
+
+
+def test_run_tasks_memory_budget():
+    """Tasks are only started if they fit in the memory budget, and a task larger than the budget runs alone"""
+    tasks = [('subj{}'.format(i), memory) for i, memory in enumerate([4, 4, 4, 1, 1, 10, 2])]
+    function = CountingFunction()
+    scheduler.run_tasks(function, tasks, scheduler.TaskStore(), nb_workers=4, memory_budget=6,
+                        list_memory=[task[1] for task in tasks], pool_executor=ThreadPoolExecutor)
+    assert sorted(function.tasks) == sorted(tasks)
+    assert function.memory_max == 10
+
+
+def test_estimate_task_memory(tmpdir):
+    nibabel.save(nibabel.Nifti1Image(np.zeros((100, 100, 20, 40), dtype=np.int16), np.eye(4)),
+                 str(tmpdir.join('dmri.nii.gz')))
+    assert scheduler.estimate_task_memory(str(tmpdir), '-i dmri.nii.gz -o out.nii.gz') == \
+        scheduler.MEMORY_FACTOR * 100 * 100 * 20 * 40 * 4
+    assert scheduler.estimate_task_memory(str(tmpdir), '-i missing.nii.gz') == scheduler.MIN_TASK_MEMORY
+
+
+@pytest.mark.parametrize('nb_cores,nb_workers,nb_threads', [(16, 4, 4), (4, 8, 1), (6, 4, 1), (8, 0, 8)])
+def test_get_nb_threads(nb_cores, nb_workers, nb_threads):
+    assert scheduler.get_nb_threads(nb_cores, nb_workers) == nb_threads
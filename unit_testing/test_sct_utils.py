@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_utils
+
+from __future__ import print_function, absolute_import
+
+import sys, os, io, logging
+
+import pytest
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+import sct_utils as sct
+
+
+def test_get_sct_entry_point():
+    assert sct.get_sct_entry_point('sct_maths') == os.path.join(__sct_dir__, 'scripts', 'sct_maths.py')
+    # the __main__ block of sct_warp_template initializes global parameters, so main() cannot be called directly
+    assert sct.get_sct_entry_point('sct_warp_template') is None
+    assert sct.get_sct_entry_point('isct_antsRegistration') is None
+    assert sct.get_sct_entry_point('sct_does_not_exist') is None
+
+
+def test_run_in_process(tmpdir, monkeypatch):
+    """Run sct_maths through sct_utils.run(), without spawning a subprocess"""
+    data = np.arange(24, dtype=np.float32).reshape(2, 3, 4)
+    nibabel.save(nibabel.Nifti1Image(data, np.eye(4)), str(tmpdir.join('data.nii.gz')))
+    fname_log = str(tmpdir.join('timing.tsv'))
+    monkeypatch.setenv('SCT_RUN_TIMING_LOG', fname_log)
+    monkeypatch.setattr(sct.subprocess, 'Popen', None)
+    curdir = os.getcwd()
+    log_level = logging.root.level
+
+    status, output = sct.run(['sct_maths', '-i', 'data.nii.gz', '-mul', '2', '-o', 'data_mul.nii.gz', '-v', '2'],
+                             cwd=str(tmpdir))
+    assert status == 0
+    assert np.allclose(nibabel.load(str(tmpdir.join('data_mul.nii.gz'))).get_data(), 2 * data)
+    assert os.getcwd() == curdir
+    assert logging.root.level == log_level
+    # the standard output is captured
+    status, output = sct.run(['sct_image', '-i', 'data.nii.gz', '-getorient'], cwd=str(tmpdir))
+    assert output == 'LPI'
+    with io.open(fname_log) as f:
+        assert f.read().split('\t')[1] == 'in-process'
+
+    # errors are reported as for subprocesses
+    with pytest.raises(sct.RunError):
+        sct.run(['sct_maths', '-i', 'data_not_found.nii.gz', '-mul', '2', '-o', 'out.nii.gz'], cwd=str(tmpdir))
+    status, output = sct.run(['sct_maths', '-i', 'data.nii.gz', '-unknown-option'], cwd=str(tmpdir),
+                             raise_exception=False)
+    assert status == 2
+    assert os.getcwd() == curdir
+
+
+def test_run_in_thread(tmpdir, monkeypatch):
+    """Scripts called from another thread than the main one are run in a subprocess"""
+    import threading
+
+    class Popen(object):
+        def __init__(self, cmd, **kwargs):
+            list_cmd.append(cmd)
+            self.stdout = io.BytesIO(b'LPI\n')
+            self.returncode = 0
+
+        def poll(self):
+            return self.returncode
+
+    list_cmd, list_output = [], []
+    monkeypatch.setattr(sct, 'run_in_process', None)
+    monkeypatch.setattr(sct.subprocess, 'Popen', Popen)
+    thread = threading.Thread(target=lambda: list_output.append(
+        sct.run(['sct_image', '-i', 'data.nii.gz', '-getorient'], cwd=str(tmpdir), verbose=0)))
+    thread.start()
+    thread.join()
+    assert list_cmd == [['sct_image', '-i', 'data.nii.gz', '-getorient']]
+    assert list_output == [(0, 'LPI')]
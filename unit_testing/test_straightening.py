@@ -7,9 +7,15 @@ from __future__ import absolute_import
 
 import os, sys
 
+import pytest
+import numpy as np
+
 from spinalcordtoolbox.utils import __sct_dir__
 sys.path.append(os.path.join(__sct_dir__, 'scripts'))
-from spinalcordtoolbox.straightening import SpinalCordStraightener
+from spinalcordtoolbox.straightening import SpinalCordStraightener, _get_centerline
+from spinalcordtoolbox.centerline.core import ParamCenterline
+from spinalcordtoolbox.types import Centerline
+from spinalcordtoolbox.testing.create_test_data import dummy_segmentation
 import sct_utils as sct
 
 
@@ -26,3 +32,50 @@ def test_straighten():
     sc_straight.straighten()
     assert sc_straight.mse_straightening < 0.8
     assert sc_straight.max_distance_straightening < 1.2
+
+
+def _compute_warp_slicewise(image, centerline_src, centerline_dest, lookup_table, threshold_distance):
+    """Reference implementation: curved2straight warping field computed slice by slice"""
+    nx, ny, nz = image.data.shape
+    data_warp = np.zeros((nx, ny, nz, 1, 3))
+    for u in range(nz):
+        x, y, z = np.mgrid[0:nx, 0:ny, u:u + 1]
+        indexes = np.array(list(zip(x.ravel(), y.ravel(), z.ravel())))
+        physical_coordinates = image.transfo_pix2phys(indexes)
+        nearest_indexes = centerline_src.find_nearest_indexes(physical_coordinates)
+        distances = centerline_src.get_distances_from_planes(physical_coordinates, nearest_indexes)
+        lookup = lookup_table[nearest_indexes]
+        indexes_out_distance = np.logical_or(
+            np.logical_or(distances > threshold_distance, distances < -threshold_distance), lookup == 0)
+        projected_points = centerline_src.get_projected_coordinates_on_planes(physical_coordinates, nearest_indexes)
+        coord_in_planes = centerline_src.get_in_plans_coordinates(projected_points, nearest_indexes)
+        displacements = centerline_dest.get_inverse_plans_coordinates(coord_in_planes, lookup) - physical_coordinates
+        displacements[:, 2] = -displacements[:, 2]
+        displacements[indexes_out_distance] = [100000.0, 100000.0, 100000.0]
+        data_warp[indexes[:, 0], indexes[:, 1], indexes[:, 2], 0, :] = -displacements
+    return data_warp
+
+
+@pytest.mark.parametrize('cpu_number,memory_budget', [(1, 1024), (1, 0.1), (2, 0.1)])
+def test_compute_warping_field(cpu_number, memory_budget):
+    """Test that the warping field computed by chunks matches the slice-by-slice computation"""
+    im_seg = dummy_segmentation(size_arr=(24, 24, 20), pixdim=(1, 1, 1), shape='ellipse', radius_RL=3.0,
+                                radius_AP=2.0, angle_RL=15.0, angle_AP=-10.0)
+    centerline = _get_centerline(im_seg, ParamCenterline(), verbose=0)
+    # Straight centerline, aligned with z and having the same number of points
+    points = centerline.points.copy()
+    points[:, 0:2] = points[:, 0:2].mean(axis=0)
+    derivs = np.zeros_like(points)
+    derivs[:, 2] = 1
+    centerline_straight = Centerline(points[:, 0], points[:, 1], points[:, 2], derivs[:, 0], derivs[:, 1], derivs[:, 2])
+    lookup_table = np.arange(centerline.number_of_points)
+
+    sc_straight = SpinalCordStraightener('', '')
+    sc_straight.cpu_number = cpu_number
+    sc_straight.memory_budget = memory_budget
+    data_warp = np.zeros(im_seg.data.shape + (1, 3), dtype=np.float32)
+    sc_straight._compute_warping_field(data_warp, im_seg, centerline_straight, centerline, lookup_table,
+                                       mode='curved2straight')
+    data_warp_ref = _compute_warp_slicewise(im_seg, centerline_straight, centerline, lookup_table,
+                                            sc_straight.threshold_distance)
+    np.testing.assert_allclose(data_warp, data_warp_ref, rtol=1e-6, atol=1e-4)
@@ -18,6 +18,8 @@ import sct_utils as sct
 import spinalcordtoolbox.image as msct_image
 import sct_image
 import sct_apply_transfo
+import sct_concat_transfo
+from spinalcordtoolbox import warping
 
 
 def fake_image_custom(data):
@@ -453,3 +455,107 @@ def test_transfo_skip_pix2phys():
 
 
 
+
+
+@pytest.mark.parametrize("ext_src", [".nii", ".nii.gz"])
+@pytest.mark.parametrize("cpu_number", [1, 2])
+@pytest.mark.parametrize("orientation", ["LPI", "RPI", "ASR", "SAL"])
+def test_transfo_4d(tmpdir, orientation, cpu_number, ext_src):
+    """Apply a shift of (+1,+2,+3) (in LPI) to a 4D image, with a displacement field, an affine matrix, or both"""
+    data = fake_3dimage_sct().data
+    data_4d = np.stack([data * (it + 1) for it in range(3)], axis=3)
+    img_src = msct_image.Image(data_4d, hdr=nibabel.Nifti1Image(data_4d, np.eye(4)).header, orientation="LPI",
+                               dim=data_4d.shape)
+    path_src = str(tmpdir.join("src" + ext_src))
+    img_src.copy().change_orientation(orientation).save(path_src)
+    path_dest = str(tmpdir.join("dest.nii"))
+    fake_3dimage_sct().change_orientation(orientation).save(path_dest)
+
+    # displacement field of (+1,+2,+3) in LPI, expressed in ITK's LPS frame
+    data_warp = np.zeros(data.shape + (1, 3))
+    data_warp[..., 0, :] = [1, 2, -3]
+    img_warp = fake_image_sct_custom(data_warp)
+    img_warp.header.set_intent('vector', (), '')
+    path_warp = str(tmpdir.join("warp.nii"))
+    img_warp.change_orientation(orientation).save(path_warp)
+    path_warp_half = str(tmpdir.join("warp_half.nii"))
+    img_warp.data = img_warp.data / 2
+    img_warp.save(path_warp_half)
+
+    # affine translation of (+1,+2,+3) in LPI, written as by ITK
+    path_affine = str(tmpdir.join("affine.txt"))
+    path_affine_half = str(tmpdir.join("affine_half.txt"))
+    for path, factor in [(path_affine, 1), (path_affine_half, 0.5)]:
+        with io.open(path, "w") as f:
+            f.write(u"#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n")
+            f.write(u"Parameters: 1 0 0 0 1 0 0 0 1 {} {} {}\n".format(factor, 2 * factor, -3 * factor))
+            f.write(u"FixedParameters: 5 -3 2\n")
+
+    data_expected = np.zeros_like(data_4d)
+    data_expected[1:, 2:, 3:] = data_4d[:-1, :-2, :-3]
+
+    for list_warp in [[path_warp], [path_affine], [path_warp_half, path_affine_half]]:
+        path_dst = str(tmpdir.join("dst.nii"))
+        xform = sct_apply_transfo.Transform(input_filename=path_src, fname_dest=path_dest, list_warp=list_warp,
+                                            output_filename=path_dst, interp='linear', cpu_number=cpu_number)
+        xform.apply()
+        img_dst = msct_image.Image(path_dst)
+        assert img_dst.orientation == orientation
+        assert img_dst.data.shape[3] == 3
+        assert np.allclose(img_dst.change_orientation("LPI").data, data_expected, atol=1e-3)
+
+
+def test_compose_transfo(tmpdir):
+    """Compose a displacement field and an affine matrix with sct_concat_transfo, then warp images with the result"""
+    data = fake_3dimage_sct().data.astype(np.float32)
+    path_dest = str(tmpdir.join("dest.nii"))
+    fake_3dimage_sct().change_orientation("ASR").save(path_dest)
+    # smooth displacement field, in ITK's LPS frame
+    data_warp = np.zeros(data.shape + (1, 3))
+    data_warp[..., 0, 0] = np.linspace(0, 1.5, data.shape[2])[np.newaxis, np.newaxis, :]
+    data_warp[..., 0, 2] = -0.7
+    img_warp = fake_image_sct_custom(data_warp)
+    img_warp.header.set_intent('vector', (), '')
+    path_warp = str(tmpdir.join("warp.nii"))
+    img_warp.save(path_warp)
+    path_affine = str(tmpdir.join("affine.txt"))
+    with io.open(path_affine, "w") as f:
+        f.write(u"#Insight Transform File V1.0\n#Transform 0\nTransform: AffineTransform_double_3_3\n")
+        f.write(u"Parameters: 0.99 0.1 0 -0.1 0.99 0 0 0 1 0.3 -1.2 0.8\n")
+        f.write(u"FixedParameters: -5 3 2\n")
+
+    path_warp_final = str(tmpdir.join("warp_final.nii.gz"))
+    sct_concat_transfo.main(['-d', path_dest, '-w', path_affine, path_warp, '-winv', path_affine,
+                             '-o', path_warp_final, '-v', '0'])
+    assert nibabel.load(path_warp_final).header.get_intent()[0] == 'vector'
+
+    # the composed field gives the same source coordinates as the chain of transformations
+    im_dest = msct_image.Image(path_dest)
+    affine_src = np.eye(4)
+    coords_chain = warping.compute_source_coordinates(
+        [warping.load_transfo(path_affine, inverse=True), warping.load_transfo(path_warp)], im_dest, affine_src)
+    coords_composed = warping.compute_source_coordinates([warping.load_transfo(path_warp_final)], im_dest,
+                                                         affine_src)
+    assert np.allclose(coords_composed, coords_chain, atol=1e-4)
+
+    # the composed field is cached in memory and on disk
+    path_cache = str(tmpdir.join("cache"))
+    field = warping.load_composed_transfo([path_affine, path_warp], path_dest, [path_affine], path_cache=path_cache)
+    assert warping.load_composed_transfo([path_affine, path_warp], path_dest, [path_affine]) is field
+    assert len(os.listdir(path_cache)) == 1
+    assert warping.load_composed_transfo([path_affine, path_warp], path_dest) is not field
+
+    # several images are warped at once, like image by image
+    list_fname_src, list_fname_out = [], []
+    for i in range(3):
+        list_fname_src.append(str(tmpdir.join("src{}.nii".format(i))))
+        list_fname_out.append(str(tmpdir.join("src{}_reg.nii".format(i))))
+        fake_image_sct_custom(data * (i + 1)).save(list_fname_src[i])
+    for interp in ['nn', 'linear', 'spline']:
+        list_im_out = warping.warp_images(list_fname_src, list_fname_out, [path_affine, path_warp], path_dest,
+                                          [path_affine], interp=interp, nb_threads=2)
+        for i, im_out in enumerate(list_im_out):
+            assert im_out.absolutepath == list_fname_out[i]
+            assert im_out.data.shape == im_dest.data.shape
+            data_expected = warping.resample_volume(data * (i + 1), coords_composed, interp)
+            assert np.allclose(im_out.data, data_expected, atol=1e-4)
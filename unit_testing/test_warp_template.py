@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8
+# pytest unit tests for sct_warp_template
+
+from __future__ import print_function, absolute_import
+
+import sys, io, os
+
+import numpy as np
+import nibabel
+
+from spinalcordtoolbox.utils import __sct_dir__
+sys.path.append(os.path.join(__sct_dir__, 'scripts'))
+from spinalcordtoolbox import warping
+import sct_warp_template
+
+
+def test_warp_label_batch(tmpdir, monkeypatch):
+    """Warp a fake template folder with the batch mode, then check that up-to-date labels are skipped"""
+    monkeypatch.setattr(sct_warp_template, 'param', sct_warp_template.Param(), raising=False)
+    monkeypatch.setenv('SCT_CACHE', '1')
+    monkeypatch.setenv('SCT_CACHE_DIR', str(tmpdir.join('cache')))
+    path_template = tmpdir.mkdir('template')
+    data = np.random.RandomState(0).rand(10, 12, 8).astype(np.float32)
+    list_file = ['template_wm.nii.gz', 'template_gm.nii.gz', 'template_cord.nii.gz']
+    with io.open(str(path_template.join('info_label.txt')), 'w') as f:
+        f.write(u"# Keyword=IndivLabels\n")
+        for i, file_label in enumerate(list_file):
+            nibabel.save(nibabel.Nifti1Image(data * (i + 1), np.eye(4)), str(path_template.join(file_label)))
+            f.write(u"{}, label {}, {}\n".format(i, i, file_label))
+    fname_dest = str(tmpdir.join('dest.nii.gz'))
+    nibabel.save(nibabel.Nifti1Image(np.zeros((8, 10, 6), dtype=np.float32), np.diag([1.2, 1.2, 1.2, 1])),
+                 fname_dest)
+    data_warp = np.zeros((8, 10, 6, 1, 3), dtype=np.float32)
+    data_warp[..., 0, :] = [-0.4, 0.6, 0.3]
+    img_warp = nibabel.Nifti1Image(data_warp, np.diag([1.2, 1.2, 1.2, 1]))
+    img_warp.header.set_intent('vector', (), '')
+    fname_warp = str(tmpdir.join('warp.nii.gz'))
+    nibabel.save(img_warp, fname_warp)
+
+    path_out = str(tmpdir.join('label'))
+    sct_warp_template.warp_label(str(tmpdir), 'template', 'info_label.txt', fname_dest, fname_warp, path_out)
+    coords = warping.compute_source_coordinates([warping.load_transfo(fname_warp)],
+                                                warping.Image(fname_dest), np.eye(4))
+    for i, file_label in enumerate(list_file):
+        interp = 'nn' if file_label.endswith('_cord.nii.gz') else 'linear'
+        img_out = nibabel.load(os.path.join(path_out, 'template', file_label))
+        assert np.allclose(img_out.affine, np.diag([1.2, 1.2, 1.2, 1]))
+        assert np.allclose(img_out.get_data(), warping.resample_volume(data * (i + 1), coords, interp), atol=1e-5)
+    assert os.path.isfile(os.path.join(path_out, 'template', 'info_label.txt'))
+
+    # only the modified label is warped again
+    nibabel.save(nibabel.Nifti1Image(data * 10, np.eye(4)), str(path_template.join(list_file[1])))
+    list_warped = []
+    monkeypatch.setattr(sct_warp_template, 'warp_label_batch',
+                        lambda list_fname_label, *args: list_warped.extend(list_fname_label))
+    sct_warp_template.warp_label(str(tmpdir), 'template', 'info_label.txt', fname_dest, fname_warp, path_out)
+    assert list_warped == [str(path_template.join(list_file[1]))]